@@ -0,0 +1,44 @@
+"""create message_provider_ids lookup table
+
+Revision ID: 0010_message_provider_ids
+Revises: 0009_set_defaults_created_at
+Create Date: 2026-10-17 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0010_message_provider_ids'
+down_revision = '0009_set_defaults_created_at'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'message_provider_ids',
+        sa.Column('wa_msg_id', sa.String(), primary_key=True),
+        sa.Column('message_id', sa.String(), sa.ForeignKey('messages.id', ondelete='CASCADE')),
+        sa.Column('conversation_id', sa.String()),
+        sa.Column('org_id', sa.String()),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text('NOW()')),
+    )
+    op.create_index('ix_message_provider_ids_message_id', 'message_provider_ids', ['message_id'])
+
+    # Backfill from messages.meta so receipts for already-sent messages still resolve
+    op.execute(
+        """
+        INSERT INTO message_provider_ids (wa_msg_id, message_id, conversation_id, org_id, created_at)
+        SELECT m.meta->>'wa_msg_id', m.id, m.conversation_id, c.org_id, COALESCE(m.created_at, NOW())
+        FROM messages m
+        LEFT JOIN conversations c ON c.id = m.conversation_id
+        WHERE m.meta->>'wa_msg_id' IS NOT NULL
+        ON CONFLICT (wa_msg_id) DO NOTHING;
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_message_provider_ids_message_id', table_name='message_provider_ids')
+    op.drop_table('message_provider_ids')
@@ -0,0 +1,64 @@
+"""unique contacts per wa_id and one open conversation per contact/channel
+
+Revision ID: 0011_unique_contacts_open_conversations
+Revises: 0010_message_provider_ids
+Create Date: 2026-10-17 00:10:00
+
+"""
+from alembic import op
+
+
+revision = '0011_unique_contacts_open_conversations'
+down_revision = '0010_message_provider_ids'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Contacts created with only a phone used to match inbound wa_id lookups too
+    op.execute(
+        """
+        UPDATE contacts c SET wa_id = c.phone
+        WHERE c.wa_id IS NULL AND c.phone IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM contacts o WHERE o.org_id = c.org_id AND o.wa_id = c.phone);
+        """
+    )
+
+    # Merge duplicate contacts (same org + wa_id) into the first one before enforcing uniqueness
+    op.execute(
+        """
+        CREATE TEMP TABLE _dup_contacts ON COMMIT DROP AS
+        SELECT id, keep_id FROM (
+            SELECT id, FIRST_VALUE(id) OVER (PARTITION BY org_id, wa_id ORDER BY id) AS keep_id
+            FROM contacts WHERE wa_id IS NOT NULL
+        ) t WHERE id <> keep_id;
+        """
+    )
+    op.execute("UPDATE conversations c SET contact_id = d.keep_id FROM _dup_contacts d WHERE c.contact_id = d.id;")
+    op.execute("DELETE FROM contacts c USING _dup_contacts d WHERE c.id = d.id;")
+
+    # Keep the most recently active open conversation per (org, contact, channel); close the rest
+    op.execute(
+        """
+        UPDATE conversations SET state = 'closed'
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT c.id, ROW_NUMBER() OVER (
+                    PARTITION BY c.org_id, c.contact_id, c.channel_id
+                    ORDER BY (SELECT MAX(m.created_at) FROM messages m WHERE m.conversation_id = c.id) DESC NULLS LAST, c.id
+                ) AS rn
+                FROM conversations c WHERE c.state = 'open'
+            ) t WHERE rn > 1
+        );
+        """
+    )
+
+    op.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_contacts_org_wa ON contacts (org_id, wa_id);")
+    op.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_conversations_open ON conversations (org_id, contact_id, channel_id) WHERE state = 'open';"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS uq_conversations_open;")
+    op.execute("DROP INDEX IF EXISTS uq_contacts_org_wa;")
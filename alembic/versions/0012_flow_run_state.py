@@ -0,0 +1,39 @@
+"""flow_runs: one row per run, updated in place
+
+Revision ID: 0012_flow_run_state
+Revises: 0011_unique_contacts_open_conversations
+Create Date: 2026-10-17 00:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0012_flow_run_state'
+down_revision = '0011_unique_contacts_open_conversations'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('flow_runs', sa.Column('contact_key', sa.String()))
+    op.add_column('flow_runs', sa.Column('path', sa.String()))
+    op.add_column('flow_runs', sa.Column('step_index', sa.Integer()))
+    op.add_column('flow_runs', sa.Column('version', sa.Integer(), server_default=sa.text('0'), nullable=False))
+
+    # Rows written per message had no contact; they are history only, never active runs
+    op.execute("UPDATE flow_runs SET status = 'completed' WHERE status IN ('running', 'waiting') AND contact_key IS NULL;")
+    op.execute("UPDATE flow_runs SET path = last_step WHERE path IS NULL;")
+
+    op.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_flow_runs_active ON flow_runs (org_id, flow_id, contact_key) "
+        "WHERE status IN ('running', 'waiting');"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS uq_flow_runs_active;")
+    op.drop_column('flow_runs', 'version')
+    op.drop_column('flow_runs', 'step_index')
+    op.drop_column('flow_runs', 'path')
+    op.drop_column('flow_runs', 'contact_key')
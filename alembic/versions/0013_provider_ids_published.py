@@ -0,0 +1,34 @@
+"""message_provider_ids: track which events were published
+
+Revision ID: 0013_provider_ids_published
+Revises: 0012_flow_run_state
+Create Date: 2026-10-17 00:30:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0013_provider_ids_published'
+down_revision = '0012_flow_run_state'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('message_provider_ids', sa.Column('published_at', sa.DateTime()))
+    op.add_column('message_provider_ids', sa.Column('status_published', sa.String()))
+    # rows stored before this revision were published by the receiver that stored them
+    op.execute(
+        """
+        UPDATE message_provider_ids p
+        SET published_at = COALESCE(p.created_at, NOW()), status_published = m.status
+        FROM messages m
+        WHERE m.id = p.message_id;
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('message_provider_ids', 'status_published')
+    op.drop_column('message_provider_ids', 'published_at')
@@ -0,0 +1,86 @@
+"""Async Redis access for the stream workers (flow engine, send worker, webhook dispatcher).
+
+``from_url`` builds a ``redis.asyncio`` client on a ``BlockingConnectionPool``:
+when all connections are busy (e.g. a blocking XREADGROUP plus many concurrent
+handlers) callers wait for a free connection instead of failing with "Too many
+connections". Pool size and wait timeout come from ``REDIS_MAX_CONNECTIONS``
+(default 64) and ``REDIS_POOL_TIMEOUT`` seconds (default 5).
+
+Worker code awaits every call through ``maybe_await`` so the module-level
+``redis`` global can still be replaced by a synchronous client or a plain fake
+(tests do this); when ``redis.asyncio`` is unavailable ``from_url`` falls back
+to the sync client for the same reason.
+"""
+import inspect
+import os
+import weakref
+
+try:
+    from redis import asyncio as aioredis  # type: ignore
+except Exception:  # pragma: no cover - only without redis-py >= 4.2
+    aioredis = None
+
+try:
+    MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+except Exception:
+    MAX_CONNECTIONS = 64
+try:
+    POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+except Exception:
+    POOL_TIMEOUT = 5.0
+
+
+def from_url(url: str, max_connections: int | None = None, decode_responses: bool = True):
+    """Pooled ``redis.asyncio.Redis`` for ``url`` (sync ``Redis`` when asyncio support is missing)."""
+    if aioredis is None:
+        from redis import Redis
+        return Redis.from_url(url, decode_responses=decode_responses)
+    pool = aioredis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=max_connections or MAX_CONNECTIONS,
+        timeout=POOL_TIMEOUT,
+        decode_responses=decode_responses,
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+async def maybe_await(value):
+    """Result of a Redis call made on either an async or a sync client."""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def ensure_group(redis, stream: str, group: str, start_id: str = "$") -> bool:
+    """XGROUP CREATE ... MKSTREAM; ``False`` when the group already exists (or creation failed)."""
+    try:
+        await maybe_await(redis.xgroup_create(stream, group, id=start_id, mkstream=True))
+        return True
+    except Exception:
+        # BUSYGROUP (already exists) or a dev Redis without streams: nothing to do
+        return False
+
+
+async def read_group(redis, group: str, consumer: str, stream: str, count: int = 1, block_ms: int = 5000):
+    """XREADGROUP ``>`` for one stream; same reply shape as redis-py ``xreadgroup``."""
+    return await maybe_await(redis.xreadgroup(group, consumer, {stream: ">"}, count=count, block=block_ms))
+
+
+_scripts: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def script(redis, source: str):
+    """``register_script`` once per client and source (EVALSHA, reloaded on NOSCRIPT)."""
+    try:
+        per_client = _scripts.get(redis)
+        if per_client is None:
+            per_client = {}
+            _scripts[redis] = per_client
+    except TypeError:
+        # not weak-referenceable: register per call (still EVALSHA after the first load)
+        return redis.register_script(source)
+    registered = per_client.get(source)
+    if registered is None:
+        registered = redis.register_script(source)
+        per_client[source] = registered
+    return registered
@@ -0,0 +1,77 @@
+"""Asyncio micro-batching.
+
+``MicroBatcher`` collects items submitted by concurrent callers for a short
+window (or until ``max_items``) and hands them to one ``flush`` coroutine.
+Each caller awaits the results for its own items, in order; if the flush
+fails every caller of that batch gets the exception. ``close()`` flushes
+what is still queued and waits for in-flight flushes, for shutdown.
+"""
+import asyncio
+from typing import Awaitable, Callable
+
+
+class MicroBatcher:
+    def __init__(self, flush: Callable[[list], Awaitable[list | None]], window_ms: float = 5.0, max_items: int = 500):
+        self.flush = flush
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self.max_items = max(1, int(max_items))
+        self._pending: list[tuple[list, asyncio.Future]] = []
+        self._count = 0
+        self._timer: asyncio.TimerHandle | None = None
+        # strong references: the loop only keeps weak ones to running tasks
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, items: list) -> list:
+        items = list(items)
+        if not items:
+            return []
+        if self.window <= 0:
+            return self._split(await self.flush(items), [items])[0]
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((items, fut))
+        self._count += len(items)
+        if self._count >= self.max_items:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush_now)
+        return await fut
+
+    def _flush_now(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._count = self._pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self) -> None:
+        """Flush the queued items now and wait until every flush has finished."""
+        self._flush_now()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def _run(self, batch: list[tuple[list, asyncio.Future]]) -> None:
+        flat = [item for items, _ in batch for item in items]
+        try:
+            results = await self.flush(flat)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), part in zip(batch, self._split(results, [items for items, _ in batch])):
+            if not fut.done():
+                fut.set_result(part)
+
+    @staticmethod
+    def _split(results, groups: list[list]) -> list[list]:
+        total = sum(len(g) for g in groups)
+        results = list(results) if results is not None else [None] * total
+        out, i = [], 0
+        for g in groups:
+            out.append(results[i:i + len(g)])
+            i += len(g)
+        return out
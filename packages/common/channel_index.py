@@ -0,0 +1,293 @@
+"""Channel routing index for inbound webhooks.
+
+Maps a WhatsApp ``phone_number_id`` (and, as a fallback, the display phone
+number) to the owning ``(org_id, channel_id)`` so the webhook receiver never
+has to scan the ``channels`` table per request.
+
+Layout:
+- In-process LRU (with TTL) in front of everything.
+- Redis hash ``CHANNEL_INDEX_KEY`` (default ``nf:channels:index``) with fields
+  ``pnid:<phone_number_id>`` / ``phone:<display>`` -> ``{"org_id", "channel_id"}``.
+  The ``__ready__`` field marks a complete index; a miss on a ready index is a
+  definitive "unknown channel" and costs a single HMGET.
+- The hash is rebuilt from the DB when it is missing (first boot, flushed
+  Redis, or after a delete cleared the ready marker).
+- ``<key>:gen`` counts ``index_channel``/``unindex_channel`` writes. A rebuild
+  only installs its DB snapshot (in one Lua call) if the counter did not move
+  while the snapshot was read; otherwise a channel indexed meanwhile could be
+  wiped from a hash marked ready. It then reads the DB again.
+
+The api-gateway keeps the hash current through ``index_channel`` /
+``unindex_channel`` on channel create/update/delete. Other processes pick up
+changes when their LRU entries expire (``CHANNEL_INDEX_LRU_TTL``).
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from packages.common.aredis import script
+
+INDEX_KEY = os.getenv("CHANNEL_INDEX_KEY", "nf:channels:index")
+READY_FIELD = "__ready__"
+try:
+    LRU_SIZE = int(os.getenv("CHANNEL_INDEX_LRU_SIZE", "10000"))
+except Exception:
+    LRU_SIZE = 10000
+try:
+    LRU_TTL = float(os.getenv("CHANNEL_INDEX_LRU_TTL", "30"))
+except Exception:
+    LRU_TTL = 30.0
+
+try:
+    REBUILD_ATTEMPTS = int(os.getenv("CHANNEL_INDEX_REBUILD_ATTEMPTS", "3"))
+except Exception:
+    REBUILD_ATTEMPTS = 3
+
+_MISSING = object()
+
+# KEYS: index hash, generation counter; ARGV: generation seen before the DB read, ready stamp, field/value pairs
+SWAP_LUA = """
+local gen = redis.call('GET', KEYS[2]) or ''
+if gen ~= ARGV[1] then
+  return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV, 2 do
+  redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], '__ready__', ARGV[2])
+return 1
+"""
+
+
+def generation_key(key: str = INDEX_KEY) -> str:
+    return f"{key}:gen"
+
+
+def _text(value) -> str:
+    if value is None:
+        return ""
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def pnid_field(pnid) -> str:
+    return f"pnid:{pnid}"
+
+
+def phone_field(phone) -> str:
+    return f"phone:{phone}"
+
+
+def _credentials(raw) -> dict:
+    if isinstance(raw, dict):
+        return raw
+    if isinstance(raw, str) and raw:
+        try:
+            obj = json.loads(raw)
+            return obj if isinstance(obj, dict) else {}
+        except Exception:
+            return {}
+    return {}
+
+
+def _get(obj, name):
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def route_fields(channel) -> dict[str, str]:
+    """Return the index fields owned by a channel (ORM row or mapping)."""
+    value = json.dumps({"org_id": str(_get(channel, "org_id") or ""), "channel_id": str(_get(channel, "id") or "")})
+    out: dict[str, str] = {}
+    pnid = _credentials(_get(channel, "credentials")).get("phone_number_id")
+    if pnid:
+        out[pnid_field(pnid)] = value
+    phone = _get(channel, "phone_number")
+    if phone:
+        out[phone_field(phone)] = value
+    return out
+
+
+def _decode(raw) -> tuple[str, str] | None:
+    if not raw:
+        return None
+    try:
+        obj = json.loads(raw)
+        if obj.get("org_id") and obj.get("channel_id"):
+            return str(obj["org_id"]), str(obj["channel_id"])
+    except Exception:
+        pass
+    return None
+
+
+def load_routes() -> dict[str, str]:
+    """Build the full field map from the ``channels`` table (one query)."""
+    from sqlalchemy import text
+    from packages.common.db import SessionLocal
+
+    routes: dict[str, str] = {}
+    with SessionLocal() as db:
+        rows = db.execute(text("SELECT id, org_id, credentials, phone_number FROM channels"))
+        for r in rows:
+            for field, value in route_fields(dict(r._mapping)).items():
+                # first channel wins on shared display numbers, like the old scan
+                routes.setdefault(field, value)
+    return routes
+
+
+class ChannelIndex:
+    """LRU-fronted resolver over the Redis routing hash."""
+
+    def __init__(self, key: str = INDEX_KEY, lru_size: int = LRU_SIZE, ttl: float = LRU_TTL):
+        self.key = key
+        self.lru_size = max(1, int(lru_size))
+        self.ttl = float(ttl)
+        self._lru: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lru_get(self, field: str):
+        with self._lock:
+            item = self._lru.get(field)
+            if item is None:
+                return _MISSING
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                self._lru.pop(field, None)
+                return _MISSING
+            self._lru.move_to_end(field)
+            return value
+
+    def _lru_put(self, field: str, value) -> None:
+        with self._lock:
+            self._lru[field] = (time.monotonic() + self.ttl, value)
+            self._lru.move_to_end(field)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def clear_local(self) -> None:
+        with self._lock:
+            self._lru.clear()
+
+    def rebuild(self, redis, attempts: int | None = None) -> dict[str, str]:
+        """Reload all routes from the DB and replace the Redis hash atomically.
+
+        Retried while channels are (un)indexed during the DB read; if that
+        keeps happening the hash is left unready and the next miss rebuilds.
+        """
+        attempts = max(1, REBUILD_ATTEMPTS if attempts is None else int(attempts))
+        routes: dict[str, str] = {}
+        for _ in range(attempts):
+            try:
+                seen = _text(redis.get(generation_key(self.key)))
+            except Exception:
+                # Redis down: callers still get an answer from the DB snapshot
+                return load_routes()
+            routes = load_routes()
+            try:
+                if self._install(redis, routes, seen):
+                    return routes
+            except Exception:
+                return routes
+        return routes
+
+    def _install(self, redis, routes: dict[str, str], seen: str) -> bool:
+        gen_key = generation_key(self.key)
+        stamp = str(int(time.time()))
+        if hasattr(redis, "register_script"):
+            args = [seen, stamp]
+            for field, value in routes.items():
+                args += [field, value]
+            return bool(int(script(redis, SWAP_LUA)(keys=[self.key, gen_key], args=args)))
+        # fakes without scripting: same check, not atomic
+        if _text(redis.get(gen_key)) != seen:
+            return False
+        pipe = redis.pipeline(transaction=True)
+        pipe.delete(self.key)
+        if routes:
+            pipe.hset(self.key, mapping=routes)
+        pipe.hset(self.key, READY_FIELD, stamp)
+        pipe.execute()
+        return True
+
+    def resolve(self, redis, pnid=None, display=None) -> tuple[str, str] | None:
+        """Return ``(org_id, channel_id)`` for a phone_number_id/display number."""
+        fields = []
+        if pnid:
+            fields.append(pnid_field(pnid))
+        if display:
+            fields.append(phone_field(display))
+        if not fields:
+            return None
+
+        # 1) in-process LRU
+        pending = []
+        for f in fields:
+            hit = self._lru_get(f)
+            if hit is _MISSING:
+                pending.append(f)
+            elif hit is not None:
+                return hit
+        if not pending:
+            return None
+
+        # 2) Redis hash: one HMGET for all candidate fields plus the ready marker
+        try:
+            values = redis.hmget(self.key, [*pending, READY_FIELD])
+            ready = bool(values[-1])
+            found = None
+            for f, raw in zip(pending, values[:-1]):
+                route = _decode(raw)
+                if route or ready:
+                    self._lru_put(f, route)
+                if route and found is None:
+                    found = route
+            if found or ready:
+                return found
+            routes = self.rebuild(redis)
+        except Exception:
+            # 3) no usable Redis: answer from the DB
+            routes = load_routes()
+
+        found = None
+        for f in pending:
+            route = _decode(routes.get(f))
+            self._lru_put(f, route)
+            if route and found is None:
+                found = route
+        return found
+
+
+def index_channel(redis, channel, previous: dict[str, str] | None = None, key: str = INDEX_KEY) -> None:
+    """Add/refresh a channel's routes; ``previous`` are the fields it owned before an update."""
+    current = route_fields(channel)
+    stale = [f for f in (previous or {}) if f not in current]
+    pipe = redis.pipeline(transaction=True)
+    # a rebuild reading the DB right now must not install a snapshot without this change
+    pipe.incr(generation_key(key))
+    if stale:
+        pipe.hdel(key, *stale)
+        if any(f.startswith("phone:") for f in stale):
+            # the old display number may now belong to another org's channel
+            pipe.hdel(key, READY_FIELD)
+    for field, value in current.items():
+        if field.startswith("pnid:"):
+            pipe.hset(key, field, value)
+        else:
+            # display numbers may be shared across orgs; never steal another channel's route
+            pipe.hsetnx(key, field, value)
+    pipe.execute()
+
+
+def unindex_channel(redis, channel, key: str = INDEX_KEY) -> None:
+    """Drop a channel's routes and force the next miss to rebuild from the DB."""
+    fields = list(route_fields(channel).keys())
+    pipe = redis.pipeline(transaction=True)
+    pipe.incr(generation_key(key))
+    if fields:
+        pipe.hdel(key, *fields)
+    # another org may share the display number; a rebuild restores its route
+    pipe.hdel(key, READY_FIELD)
+    pipe.execute()
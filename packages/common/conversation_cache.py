@@ -0,0 +1,174 @@
+"""Contact/conversation resolution cache.
+
+Maps ``(org_id, channel_id, wa_id)`` -> ``(contact_id, open conversation_id)``
+so inbound persistence (webhook receiver) and outbound persistence
+(send_worker) skip the find-or-create queries in the steady state.
+
+Layout in Redis (all keys expire after ``CONV_CACHE_TTL`` seconds):
+- ``<prefix>:k:<org>:<channel>:<wa_id>`` -> ``{"contact_id", "conversation_id"}``
+- ``<prefix>:c:<conversation_id>`` -> set of forward keys, so a conversation
+  can be invalidated without knowing the contact's wa_id/phone.
+
+Whoever closes (or otherwise changes the state of) a conversation must call
+``invalidate_conversation``; the api-gateway does it in ``update_conversation``.
+It also leaves a tombstone ``<prefix>:x:<conversation_id>`` for
+``CONV_CACHE_TOMBSTONE_TTL`` seconds: a worker that resolved the conversation
+from the DB just before the close would otherwise cache it again, and
+``put_many`` skips tombstoned conversations (atomically, in a Lua script).
+Lookups are batched (one MGET) and every call is best-effort: a Redis error
+behaves like a cache miss. The ``*_async`` variants serve the asyncio workers.
+"""
+import json
+import os
+
+from packages.common.aredis import maybe_await, script
+
+PREFIX = os.getenv("CONV_CACHE_PREFIX", "nf:convcache")
+try:
+    TTL = int(os.getenv("CONV_CACHE_TTL", "3600"))
+except Exception:
+    TTL = 3600
+try:
+    TOMBSTONE_TTL = int(os.getenv("CONV_CACHE_TOMBSTONE_TTL", "60"))
+except Exception:
+    TOMBSTONE_TTL = 60
+ENABLED = os.getenv("CONV_CACHE_ENABLED", "true").lower() == "true"
+
+# KEYS: forward key, conversation's reverse set, tombstone; ARGV: value, ttl
+PUT_LUA = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+  return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('SADD', KEYS[2], KEYS[1])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+
+def cache_key(org_id, channel_id, wa_id, prefix: str = PREFIX) -> str:
+    return f"{prefix}:k:{org_id}:{channel_id}:{wa_id}"
+
+
+def conversation_key(conversation_id, prefix: str = PREFIX) -> str:
+    return f"{prefix}:c:{conversation_id}"
+
+
+def tombstone_key(conversation_id, prefix: str = PREFIX) -> str:
+    return f"{prefix}:x:{conversation_id}"
+
+
+def _decode(keys: list[tuple], values) -> dict[tuple, tuple[str, str]]:
+    out: dict[tuple, tuple[str, str]] = {}
+    for k, raw in zip(keys, values or []):
+        if not raw:
+            continue
+        try:
+            obj = json.loads(raw)
+            if obj.get("contact_id") and obj.get("conversation_id"):
+                out[k] = (str(obj["contact_id"]), str(obj["conversation_id"]))
+        except Exception:
+            continue
+    return out
+
+
+def _lookup_keys(redis, keys: list[tuple]) -> list[tuple]:
+    keys = [k for k in dict.fromkeys(keys) if all(k)]
+    if not ENABLED or redis is None:
+        return []
+    return keys
+
+
+def _puts(redis, entries: dict[tuple, tuple], prefix: str) -> list[tuple[str, str, str, str]]:
+    """``(forward key, reverse key, tombstone key, value)`` per cacheable entry."""
+    entries = {k: v for k, v in entries.items() if all(k) and v and all(v)}
+    if not ENABLED or not entries or redis is None:
+        return []
+    return [
+        (
+            cache_key(*k, prefix=prefix),
+            conversation_key(conversation_id, prefix=prefix),
+            tombstone_key(conversation_id, prefix=prefix),
+            json.dumps({"contact_id": str(contact_id), "conversation_id": str(conversation_id)}),
+        )
+        for k, (contact_id, conversation_id) in entries.items()
+    ]
+
+
+def _queue_puts(redis, pipe, puts: list[tuple], ttl: int, closed=None) -> list:
+    """Queue ``puts`` on ``pipe``; returns the script calls (coroutines on asyncio clients)."""
+    calls = []
+    for (fwd, rev, tomb, value), is_closed in zip(puts, closed or [None] * len(puts)):
+        if closed is None:
+            calls.append(script(redis, PUT_LUA)(keys=[fwd, rev, tomb], args=[value, ttl], client=pipe))
+        elif not is_closed:
+            pipe.set(fwd, value, ex=ttl)
+            pipe.sadd(rev, fwd)
+            pipe.expire(rev, ttl)
+    return calls
+
+
+def get_many(redis, keys: list[tuple], prefix: str = PREFIX) -> dict[tuple, tuple[str, str]]:
+    """Return ``{(org, channel, wa_id): (contact_id, conversation_id)}`` for cached keys."""
+    keys = _lookup_keys(redis, keys)
+    if not keys:
+        return {}
+    try:
+        values = redis.mget([cache_key(*k, prefix=prefix) for k in keys])
+    except Exception:
+        return {}
+    return _decode(keys, values)
+
+
+def put_many(redis, entries: dict[tuple, tuple], prefix: str = PREFIX, ttl: int = TTL) -> None:
+    """Cache resolved ``(contact_id, conversation_id)`` pairs (one pipeline); tombstoned ones are skipped."""
+    try:
+        puts = _puts(redis, entries, prefix)
+        if not puts:
+            return
+        # fakes without scripting: same tombstone check, not atomic
+        closed = None if hasattr(redis, "register_script") else redis.mget([p[2] for p in puts])
+        pipe = redis.pipeline(transaction=False)
+        _queue_puts(redis, pipe, puts, ttl, closed)
+        pipe.execute()
+    except Exception:
+        pass
+
+
+async def get_many_async(redis, keys: list[tuple], prefix: str = PREFIX) -> dict[tuple, tuple[str, str]]:
+    """``get_many`` for ``redis.asyncio`` clients (sync clients work too)."""
+    keys = _lookup_keys(redis, keys)
+    if not keys:
+        return {}
+    try:
+        values = await maybe_await(redis.mget([cache_key(*k, prefix=prefix) for k in keys]))
+    except Exception:
+        return {}
+    return _decode(keys, values)
+
+
+async def put_many_async(redis, entries: dict[tuple, tuple], prefix: str = PREFIX, ttl: int = TTL) -> None:
+    """``put_many`` for ``redis.asyncio`` clients (sync clients work too)."""
+    try:
+        puts = _puts(redis, entries, prefix)
+        if not puts:
+            return
+        closed = None if hasattr(redis, "register_script") else await maybe_await(redis.mget([p[2] for p in puts]))
+        pipe = redis.pipeline(transaction=False)
+        # the asyncio Script call is a coroutine even when it only queues on a pipeline
+        for call in _queue_puts(redis, pipe, puts, ttl, closed):
+            await maybe_await(call)
+        await maybe_await(pipe.execute())
+    except Exception:
+        pass
+
+
+def invalidate_conversation(redis, conversation_id, prefix: str = PREFIX) -> None:
+    """Drop every cached route pointing at ``conversation_id`` and block re-caching it for a while."""
+    if redis is None or not conversation_id:
+        return
+    # first: a put racing with the close then finds the tombstone
+    redis.set(tombstone_key(conversation_id, prefix=prefix), "1", ex=TOMBSTONE_TTL)
+    rev = conversation_key(conversation_id, prefix=prefix)
+    fwd = list(redis.smembers(rev) or [])
+    redis.delete(*fwd, rev)
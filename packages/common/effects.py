@@ -0,0 +1,130 @@
+"""Per-message effects buffer for the flow engine.
+
+Handling one inbound message used to cost a round trip per output (XADD to
+``nf:outbox``), per webhook step (XADD to ``nf:webhooks``), per wait/delay
+and a DB session per ``set_attribute`` step. ``EffectsBuffer`` collects
+everything one execution produces and ``flush`` writes it in:
+
+1. at most one DB transaction (all contact attribute writes), then
+2. one Redis ``MULTI``/``EXEC`` pipeline: outbox and webhook XADDs, wait
+   states, scheduled resumes and the run-state compare-and-set.
+
+The DB goes first (the engine runs it in a worker thread): if it fails,
+nothing has reached Redis and the message is retried; if Redis then fails the
+message is retried too and the attribute writes (plain assignments) are
+simply repeated. Inside the
+transaction the run-state CAS can still lose to another replica; ``flush``
+reports that (``run_conflict``) and the caller re-applies the run state.
+
+Clients without ``pipeline`` (test fakes) get the same writes one by one.
+"""
+from packages.common import run_store, scheduler, wait_state
+from packages.common.aredis import maybe_await
+
+
+class EffectsBuffer:
+    def __init__(self):
+        self.outbox: list[dict] = []
+        self.webhooks: list[dict] = []
+        self.attributes: dict[tuple[str, str], dict] = {}
+        self.waits: list[tuple[str, str, str]] = []
+        self.wait_clears: list[tuple[str, str, str | None]] = []
+        self.schedules: list[tuple[dict, float, str]] = []
+        self.run: tuple[dict, int] | None = None
+        self.run_conflict = False
+        # async callable that re-reads and re-applies the run state after a conflict
+        self.run_retry = None
+
+    def __len__(self) -> int:
+        return (
+            len(self.outbox) + len(self.webhooks) + len(self.attributes) + len(self.waits) + len(self.wait_clears)
+            + len(self.schedules) + (1 if self.run else 0)
+        )
+
+    def add_outbox(self, fields: dict) -> None:
+        # stream values must be strings
+        self.outbox.append({k: str(v) for k, v in fields.items()})
+
+    def add_webhook(self, event: dict) -> None:
+        self.webhooks.append(event)
+
+    def set_attributes(self, org_id, contact: str, updates: dict) -> None:
+        self.attributes.setdefault((str(org_id), str(contact)), {}).update(updates)
+
+    def set_wait(self, org_id, channel_id, contact, record: dict) -> None:
+        self.waits.append((wait_state.org_key(org_id), wait_state.contact_field(channel_id, contact), wait_state.encode(record)))
+
+    def clear_wait(self, org_id, channel_id, contact, legacy_key: str | None = None) -> None:
+        # applied before any set_wait, so a flow that waits again keeps its new record
+        self.wait_clears.append((wait_state.org_key(org_id), wait_state.contact_field(channel_id, contact), legacy_key))
+
+    def schedule(self, item: dict, due_at: float, route_key: str) -> None:
+        self.schedules.append((item, due_at, route_key))
+
+    def save_run(self, run: dict, expected_version: int) -> None:
+        self.run = (run, int(expected_version))
+
+    def flush_db(self, session_factory, contact_model) -> int:
+        """All attribute writes in one transaction; returns contacts updated."""
+        if not self.attributes or session_factory is None or contact_model is None:
+            return 0
+        updated = 0
+        with session_factory() as db:
+            for (org_id, target), updates in self.attributes.items():
+                ct = (
+                    db.query(contact_model)
+                    .filter(contact_model.org_id == org_id)
+                    .filter((contact_model.wa_id == target) | (contact_model.phone == target))
+                    .first()
+                )
+                if ct is None:
+                    continue
+                attrs = dict(getattr(ct, "attributes", None) or {})
+                attrs.update(updates)
+                ct.attributes = attrs
+                updated += 1
+            db.commit()
+        return updated
+
+    async def flush_redis(self, redis, sched_prefix: str, sched_shards: int,
+                          outbox_stream: str = "nf:outbox", webhook_stream: str = "nf:webhooks") -> None:
+        if not hasattr(redis, "pipeline"):
+            await self._flush_one_by_one(redis, sched_prefix, sched_shards, outbox_stream, webhook_stream)
+            return
+        pipe = redis.pipeline(transaction=True)
+        for fields in self.outbox:
+            pipe.xadd(outbox_stream, fields)
+        for event in self.webhooks:
+            pipe.xadd(webhook_stream, event)
+        for key, field, legacy_key in self.wait_clears:
+            pipe.hdel(key, field)
+            if legacy_key:
+                pipe.delete(legacy_key)
+        for key, field, raw in self.waits:
+            pipe.hset(key, field, raw)
+        for item, due_at, route_key in self.schedules:
+            scheduler.queue_item(pipe, sched_prefix, sched_shards, item, due_at, route_key)
+        if self.run:
+            await run_store.queue_save(redis, pipe, *self.run)
+        replies = await maybe_await(pipe.execute())
+        if self.run:
+            self.run_conflict = not run_store.saved(replies[-1])
+
+    async def _flush_one_by_one(self, redis, sched_prefix, sched_shards, outbox_stream, webhook_stream) -> None:
+        for fields in self.outbox:
+            await maybe_await(redis.xadd(outbox_stream, fields))
+        for event in self.webhooks:
+            await maybe_await(redis.xadd(webhook_stream, event))
+        for key, field, legacy_key in self.wait_clears:
+            await maybe_await(redis.hdel(key, field))
+            if legacy_key:
+                await maybe_await(redis.delete(legacy_key))
+        for key, field, raw in self.waits:
+            await maybe_await(redis.hset(key, field, raw))
+        for item, due_at, route_key in self.schedules:
+            await scheduler.schedule_item(redis, sched_prefix, sched_shards, item, due_at, route_key)
+        if self.run:
+            try:
+                await run_store.save(redis, *self.run)
+            except run_store.RunConflict:
+                self.run_conflict = True
@@ -0,0 +1,173 @@
+"""Compiled flow graphs for the flow engine.
+
+``compile_flow`` turns a ``flows.graph`` JSON document into the structure the
+engine executes: the intent map, validated path step lists and precompiled
+``wait_for_reply`` regexes. ``FlowCache`` keeps the compiled active flow per
+org in process, so steady-state execution does no DB reads:
+
+- entries are keyed by org (active flow lookup) and by
+  ``(org_id, flow_id, version)`` (the compiled graph itself);
+- "no active flow" is cached too, so orgs without flows stay off the DB;
+- the api-gateway calls ``publish_change`` after creating/updating/deleting a
+  flow; engines subscribed to ``FLOW_CACHE_CHANNEL`` drop that org's entry;
+- a load that was in flight when its org was invalidated is returned to its
+  caller but not cached (per-org generation counter);
+- only the current compiled version of each org's flow is kept;
+- pub/sub is fire-and-forget, so entries also expire after ``FLOW_CACHE_TTL``
+  seconds as a safety net for missed messages.
+
+``aget`` is the event-loop variant: hits are served inline, misses (a DB
+read plus compilation) run in a worker thread.
+"""
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+
+CHANNEL = os.getenv("FLOW_CACHE_CHANNEL", "nf:flows:published")
+try:
+    TTL = float(os.getenv("FLOW_CACHE_TTL", "300"))
+except Exception:
+    TTL = 300.0
+ENABLED = os.getenv("FLOW_CACHE_ENABLED", "true").lower() == "true"
+
+_MISSING = object()
+
+
+@lru_cache(maxsize=1024)
+def wait_regex(pattern: str):
+    """Compiled ``wait_for_reply`` pattern (case-insensitive); ``None`` when invalid."""
+    try:
+        return re.compile(str(pattern), re.IGNORECASE)
+    except re.error:
+        return None
+
+
+def compile_flow(flow_id, org_id, version, graph) -> dict | None:
+    """Validated, pre-indexed form of a flow graph (``None`` when it is not usable)."""
+    if not isinstance(graph, dict):
+        return None
+    intent_map = None
+    for node in graph.get("nodes") or []:
+        if isinstance(node, dict) and node.get("type") == "intent" and isinstance(node.get("map"), dict):
+            intent_map = dict(node["map"])
+            break
+    paths: dict[str, list[dict]] = {}
+    raw_paths = graph.get("paths") if isinstance(graph.get("paths"), dict) else {}
+    for name, steps in raw_paths.items():
+        if not isinstance(steps, list) or not steps:
+            continue
+        paths[str(name)] = list(steps)
+        for step in steps:
+            if isinstance(step, dict) and step.get("type") == "wait_for_reply" and step.get("pattern"):
+                # warm the shared regex cache used when the reply arrives
+                wait_regex(str(step["pattern"]))
+    return {
+        "flow_id": flow_id,
+        "org_id": str(org_id),
+        "version": version,
+        "intent_map": intent_map,
+        "paths": paths,
+    }
+
+
+class FlowCache:
+    """Per-process cache of each org's compiled active flow."""
+
+    def __init__(self, ttl: float = TTL, enabled: bool = ENABLED):
+        self.ttl = float(ttl)
+        self.enabled = enabled
+        self._by_org: dict[str, tuple[float, tuple | None]] = {}
+        self._compiled: dict[tuple, dict] = {}
+        # bumped by invalidate: a load that started before a change is not cached
+        self._gen: dict[str, int] = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, org_id, loader):
+        """Compiled active flow for ``org_id``.
+
+        ``loader(org_id)`` is only called on a miss and returns
+        ``(flow_id, version, graph)`` or ``None``.
+        """
+        org_id = str(org_id)
+        now = time.monotonic()
+        hit = self._hit(org_id, now)
+        if hit is not _MISSING:
+            return hit
+        with self._lock:
+            started = (self._epoch, self._gen.get(org_id, 0))
+        found = loader(org_id)
+        compiled = None
+        key = None
+        if found:
+            flow_id, version, graph = found
+            key = (org_id, flow_id, version)
+            with self._lock:
+                compiled = self._compiled.get(key)
+            if compiled is None:
+                compiled = compile_flow(flow_id, org_id, version, graph)
+        if self.enabled:
+            with self._lock:
+                if started != (self._epoch, self._gen.get(org_id, 0)):
+                    # invalidated while loading: this result may predate the change
+                    return compiled
+                self._by_org[org_id] = (now + self.ttl, key if compiled else None)
+                # one active flow per org: older versions are not needed any more
+                for old in [k for k in self._compiled if k[0] == org_id and k != key]:
+                    self._compiled.pop(old, None)
+                if compiled:
+                    self._compiled[key] = compiled
+        return compiled
+
+    async def aget(self, org_id, loader):
+        """``get`` for async callers: a miss runs ``loader`` off the event loop."""
+        hit = self._hit(str(org_id), time.monotonic())
+        if hit is not _MISSING:
+            return hit
+        return await asyncio.to_thread(self.get, org_id, loader)
+
+    def _hit(self, org_id: str, now: float):
+        if not self.enabled:
+            return _MISSING
+        with self._lock:
+            item = self._by_org.get(org_id)
+            if item is not None and item[0] > now:
+                key = item[1]
+                return self._compiled.get(key, _MISSING) if key else None
+        return _MISSING
+
+    def invalidate(self, org_id=None) -> None:
+        """Drop one org (or everything when ``org_id`` is None)."""
+        with self._lock:
+            if org_id is None:
+                self._epoch += 1
+                self._by_org.clear()
+                self._compiled.clear()
+                return
+            org_id = str(org_id)
+            self._gen[org_id] = self._gen.get(org_id, 0) + 1
+            self._by_org.pop(org_id, None)
+            for key in [k for k in self._compiled if k[0] == org_id]:
+                self._compiled.pop(key, None)
+
+    def handle_message(self, data) -> None:
+        """Apply one ``publish_change`` payload."""
+        try:
+            obj = json.loads(data)
+            org_id = obj.get("org_id") if isinstance(obj, dict) else None
+        except Exception:
+            org_id = None
+        # unreadable signal: be safe and forget everything
+        self.invalidate(org_id or None)
+
+
+def publish_change(redis, org_id, flow_id, version=None, op: str = "updated", channel: str = CHANNEL) -> None:
+    """Tell flow engines that an org's flows changed (best-effort)."""
+    try:
+        redis.publish(channel, json.dumps({"org_id": str(org_id), "flow_id": flow_id, "version": version, "op": op}))
+    except Exception:
+        pass
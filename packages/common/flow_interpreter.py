@@ -0,0 +1,315 @@
+"""Budgeted interpreter for compiled flows (see ``flow_cache.compile_flow``).
+
+``run`` executes a flow from ``(path, index)`` for one inbound message and
+returns what should happen instead of doing it: outbound messages
+(``outputs``) and side effects (``effects``: ``set_attribute``, ``webhook``,
+``schedule``, ``wait_for_reply``). The flow engine applies them; the
+api-gateway's ``/internal/flows/simulate`` returns them as a dry run.
+
+Execution continues across steps and paths in-process until the flow ends,
+waits, or the per-message budget runs out (``max_steps`` executed steps,
+``max_ms`` wall time, ``max_outbound`` messages). A stop on budget leaves
+``status == "running"`` with the position to continue from. ``trace`` keeps
+the first ``FLOW_TRACE_LIMIT`` steps (``trace_truncated`` past that).
+
+Step types: ``action`` (``send_text``/``send_template``/``send_media``/
+``webhook``), ``set_attribute``, ``wait``/``delay`` (``0`` seconds continues
+inline), ``wait_for_reply``, ``condition`` (``if`` -> ``then``/``else``
+path), ``ab``/``split`` (weighted, sticky per contact), ``intent`` (``map``
+of intent -> path) and ``goto``. Unknown steps end the run.
+"""
+import hashlib
+import json
+import os
+import time
+
+from packages.common.flow_cache import wait_regex
+
+try:
+    MAX_STEPS = int(os.getenv("FLOW_MAX_STEPS", "50"))
+except Exception:
+    MAX_STEPS = 50
+try:
+    MAX_MS = float(os.getenv("FLOW_MAX_MS", "250"))
+except Exception:
+    MAX_MS = 250.0
+try:
+    MAX_OUTBOUND = int(os.getenv("FLOW_MAX_OUTBOUND", "10"))
+except Exception:
+    MAX_OUTBOUND = 10
+# Ceilings for caller-supplied budgets (the simulate endpoint): a goto loop must not pin a worker
+try:
+    STEPS_CEILING = max(MAX_STEPS, int(os.getenv("FLOW_MAX_STEPS_CEILING", "1000")))
+except Exception:
+    STEPS_CEILING = max(MAX_STEPS, 1000)
+try:
+    MS_CEILING = max(MAX_MS, float(os.getenv("FLOW_MAX_MS_CEILING", "2000")))
+except Exception:
+    MS_CEILING = max(MAX_MS, 2000.0)
+try:
+    OUTBOUND_CEILING = max(MAX_OUTBOUND, int(os.getenv("FLOW_MAX_OUTBOUND_CEILING", "100")))
+except Exception:
+    OUTBOUND_CEILING = max(MAX_OUTBOUND, 100)
+try:
+    TRACE_LIMIT = int(os.getenv("FLOW_TRACE_LIMIT", "200"))
+except Exception:
+    TRACE_LIMIT = 200
+
+_MISSING = object()
+
+
+def budget(max_steps: int | None = None, max_ms: float | None = None, max_outbound: int | None = None) -> dict:
+    """Per-message limits; explicit values are clamped to the ``FLOW_MAX_*_CEILING`` ceilings."""
+    return {
+        "max_steps": min(STEPS_CEILING, max(1, int(max_steps if max_steps is not None else MAX_STEPS))),
+        "max_ms": min(MS_CEILING, max(0.0, float(max_ms if max_ms is not None else MAX_MS))),
+        "max_outbound": min(OUTBOUND_CEILING, max(0, int(max_outbound if max_outbound is not None else MAX_OUTBOUND))),
+    }
+
+
+def entry_path(flow: dict, intent: str | None) -> str:
+    """Path an inbound message starts on: the intent map, then ``default``, then ``path_default``."""
+    mapping = flow.get("intent_map") or {}
+    return mapping.get(intent) or mapping.get("default") or "path_default"
+
+
+def _seconds(step: dict, *keys: str) -> int:
+    try:
+        for key in keys:
+            if step.get(key):
+                return int(step.get(key))
+        return int((step.get("ms") or 0) / 1000)
+    except Exception:
+        return 0
+
+
+ATTRIBUTE_PREFIXES = ("attributes.", "attr.", "contact.")
+
+
+def _cond_reads_attributes(cond) -> bool:
+    if not isinstance(cond, dict):
+        return False
+    nested = list(cond.get("all") or []) + list(cond.get("any") or []) + ([cond["not"]] if "not" in cond else [])
+    if any(_cond_reads_attributes(c) for c in nested):
+        return True
+    return str(cond.get("var") or "").startswith(ATTRIBUTE_PREFIXES)
+
+
+def reads_attributes(flow: dict) -> bool:
+    """Whether any ``condition`` step reads contact attributes (memoized on the compiled flow)."""
+    cached = flow.get("_reads_attributes")
+    if cached is None:
+        cached = any(
+            isinstance(step, dict) and step.get("type") == "condition" and _cond_reads_attributes(step.get("if"))
+            for steps in (flow.get("paths") or {}).values() for step in steps
+        )
+        flow["_reads_attributes"] = cached
+    return cached
+
+
+class _Scope:
+    """Values conditions can read; contact attributes are fetched on first use."""
+
+    def __init__(self, text: str, intent: str | None, attributes):
+        self.text = text or ""
+        self.intent = intent
+        self._attributes = attributes
+        self._loaded = not callable(attributes)
+        self.writes: dict = {}
+
+    @property
+    def attributes(self) -> dict:
+        if not self._loaded:
+            try:
+                self._attributes = self._attributes() or {}
+            except Exception:
+                self._attributes = {}
+            self._loaded = True
+        return {**(self._attributes or {}), **self.writes}
+
+    def get(self, var: str):
+        var = str(var or "")
+        if var == "text":
+            return self.text
+        if var == "intent":
+            return self.intent
+        for prefix in ATTRIBUTE_PREFIXES:
+            if var.startswith(prefix):
+                return self.attributes.get(var[len(prefix):], _MISSING)
+        return _MISSING
+
+
+def evaluate(cond, scope: _Scope) -> bool:
+    """``{"var", "op", "value"}``, or ``{"all": [...]}``/``{"any": [...]}``/``{"not": cond}``."""
+    if not isinstance(cond, dict):
+        return bool(cond)
+    if "all" in cond:
+        return all(evaluate(c, scope) for c in cond.get("all") or [])
+    if "any" in cond:
+        return any(evaluate(c, scope) for c in cond.get("any") or [])
+    if "not" in cond:
+        return not evaluate(cond.get("not"), scope)
+    value = scope.get(cond.get("var"))
+    op = str(cond.get("op") or "eq")
+    expected = cond.get("value")
+    if op == "exists":
+        return value is not _MISSING and value is not None
+    if value is _MISSING:
+        return op == "ne"
+    try:
+        if op == "eq":
+            return value == expected
+        if op == "ne":
+            return value != expected
+        if op == "contains":
+            return str(expected).lower() in str(value).lower()
+        if op == "regex":
+            rx = wait_regex(str(expected))
+            return bool(rx and rx.search(str(value)))
+        if op == "in":
+            return value in (expected or [])
+        if op in ("gt", "gte", "lt", "lte"):
+            a, b = float(value), float(expected)
+            return {"gt": a > b, "gte": a >= b, "lt": a < b, "lte": a <= b}[op]
+    except Exception:
+        return False
+    return False
+
+
+def ab_variant(variants, seed: str) -> str | None:
+    """Weighted pick, stable for the same ``seed`` (contact + step)."""
+    options = [(v.get("path"), max(0, int(v.get("weight", 1) or 0))) for v in variants or [] if isinstance(v, dict) and v.get("path")]
+    total = sum(w for _, w in options)
+    if not total:
+        return None
+    point = int(hashlib.sha1(seed.encode("utf-8")).hexdigest()[:8], 16) % total
+    for path, weight in options:
+        if point < weight:
+            return path
+        point -= weight
+    return options[-1][0]
+
+
+def _message(step: dict) -> dict | None:
+    act = step.get("action")
+    if act == "send_text":
+        return {"type": "text", "text": step.get("text") or "Gracias por tu mensaje."}
+    if act == "send_template":
+        tpl = {
+            "name": step.get("template") or "welcome",
+            "language": step.get("language") or {"code": "es"},
+            "components": step.get("components") or [],
+        }
+        return {"type": "template", "template": json.dumps(tpl)}
+    if act == "send_media":
+        media = step.get("media") or {"kind": "image", "link": step.get("asset") or "https://example.com/demo.jpg"}
+        return {"type": "media", "media": json.dumps(media)}
+    return None
+
+
+def run(flow: dict, path: str, index: int = 0, *, intent: str | None = None, text: str = "", attributes=None,
+        contact_key: str = "", limits: dict | None = None, clock=time.monotonic) -> dict:
+    """Execute ``flow`` from ``(path, index)`` within ``limits`` (see ``budget``).
+
+    ``attributes`` is the contact's attribute dict, or a callable returning it
+    (only called when a condition reads attributes).
+    """
+    limits = limits or budget()
+    scope = _Scope(text, intent, attributes if attributes is not None else {})
+    paths = flow.get("paths") or {}
+    started = clock()
+    result = {"outputs": [], "effects": [], "trace": [], "status": "completed", "stop": "end", "steps": 0}
+    index = max(0, int(index or 0))
+    while True:
+        steps = paths.get(path)
+        if not steps or index >= len(steps):
+            break
+        if result["steps"] >= limits["max_steps"]:
+            result.update(status="running", stop="budget_steps")
+            break
+        if result["steps"] and (clock() - started) * 1000.0 > limits["max_ms"]:
+            result.update(status="running", stop="budget_time")
+            break
+        step = steps[index]
+        stype = step.get("type") if isinstance(step, dict) else None
+        if stype == "action" and step.get("action") != "webhook" and len(result["outputs"]) >= limits["max_outbound"]:
+            result.update(status="running", stop="budget_outbound")
+            break
+        result["steps"] += 1
+        entry = {"path": path, "index": index, "type": stype}
+        if len(result["trace"]) < TRACE_LIMIT:
+            result["trace"].append(entry)
+        else:
+            result["trace_truncated"] = True
+        if stype == "action":
+            act = step.get("action")
+            if act == "webhook":
+                result["effects"].append({"type": "webhook", "path": path, "index": index, "data": step.get("data") or step.get("payload") or {}})
+                index += 1
+                continue
+            msg = _message(step)
+            if msg is None:
+                result["stop"] = "unsupported"
+                break
+            result["outputs"].append(msg)
+            index += 1
+        elif stype == "set_attribute":
+            if step.get("key"):
+                scope.writes[str(step["key"])] = step.get("value")
+                result["effects"].append({"type": "set_attribute", "key": str(step["key"]), "value": step.get("value")})
+            index += 1
+        elif stype in ("wait", "delay"):
+            seconds = _seconds(step, "seconds", "sec")
+            index += 1
+            if seconds <= 0:
+                continue
+            result["effects"].append({"type": "schedule", "path": path, "index": index, "seconds": seconds})
+            result.update(status="waiting", stop="wait")
+            break
+        elif stype == "wait_for_reply":
+            index += 1
+            result["effects"].append({
+                "type": "wait_for_reply",
+                "path": path,
+                "index": index,
+                "pattern": step.get("pattern"),
+                "seconds": _seconds(step, "seconds", "timeout_seconds"),
+                "timeout_path": step.get("timeout_path"),
+            })
+            result.update(status="waiting", stop="wait")
+            break
+        elif stype == "condition":
+            target = step.get("then") if evaluate(step.get("if"), scope) else step.get("else")
+            entry["branch"] = target
+            path, index = (str(target), 0) if target else (path, index + 1)
+        elif stype in ("ab", "split"):
+            target = ab_variant(step.get("variants"), f"{contact_key}:{path}:{index}")
+            entry["branch"] = target
+            path, index = (str(target), 0) if target else (path, index + 1)
+        elif stype == "intent":
+            mapping = step.get("map") if isinstance(step.get("map"), dict) else {}
+            target = mapping.get(intent) or mapping.get("default")
+            entry["branch"] = target
+            path, index = (str(target), 0) if target else (path, index + 1)
+        elif stype == "goto" and step.get("path"):
+            path, index = str(step["path"]), max(0, int(step.get("index") or 0))
+        else:
+            result["stop"] = "unsupported"
+            break
+    result["path"] = path
+    result["index"] = index
+    result["elapsed_ms"] = round((clock() - started) * 1000.0, 3)
+    return result
+
+
+def cost(result: dict) -> dict:
+    """Per-message cost summary of a ``run`` result."""
+    kinds = [e.get("type") for e in result.get("effects") or []]
+    return {
+        "steps": result.get("steps", 0),
+        "elapsed_ms": result.get("elapsed_ms", 0.0),
+        "outbound": len(result.get("outputs") or []),
+        "webhooks": kinds.count("webhook"),
+        "attribute_writes": kinds.count("set_attribute"),
+        "scheduled": kinds.count("schedule") + kinds.count("wait_for_reply"),
+    }
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Text
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Text, Index, text
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.types import JSON as SAJSON
 
@@ -48,6 +48,11 @@ class Contact(Base):
     locale = Column(String)
     timezone = Column(String)
 
+    __table_args__ = (
+        # NULL wa_ids never conflict; see packages/common/upserts.py
+        Index("uq_contacts_org_wa", "org_id", "wa_id", unique=True),
+    )
+
 class Conversation(Base):
     __tablename__ = "conversations"
     id = Column(String, primary_key=True)
@@ -58,6 +63,14 @@ class Conversation(Base):
     assignee = Column(String)
     last_activity_at = Column(DateTime)
 
+    __table_args__ = (
+        # at most one open conversation per contact and channel
+        Index(
+            "uq_conversations_open", "org_id", "contact_id", "channel_id", unique=True,
+            postgresql_where=text("state = 'open'"), sqlite_where=text("state = 'open'"),
+        ),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(String, primary_key=True)
@@ -71,6 +84,19 @@ class Message(Base):
     client_id = Column(String)
     created_at = Column(DateTime)
 
+class MessageProviderId(Base):
+    """Provider message id (WhatsApp ``wamid``) -> message, for indexed status/dedup lookups."""
+    __tablename__ = "message_provider_ids"
+    wa_msg_id = Column(String, primary_key=True)
+    message_id = Column(ForeignKey("messages.id"), index=True)
+    conversation_id = Column(String)
+    org_id = Column(String)
+    created_at = Column(DateTime)
+    # set once the inbound message's fan-out/event was published (NULL: persisted, not published yet)
+    published_at = Column(DateTime)
+    # last receipt status whose ``message.status`` event was published
+    status_published = Column(String)
+
 class Template(Base):
     __tablename__ = "templates"
     id = Column(String, primary_key=True)
@@ -107,12 +133,25 @@ class FlowRun(Base):
     id = Column(String, primary_key=True)
     org_id = Column(ForeignKey("organizations.id"))
     flow_id = Column(ForeignKey("flows.id"))
-    status = Column(String)  # running|completed|failed
+    contact_key = Column(String)  # contact phone/wa_id the run belongs to
+    status = Column(String)  # running|waiting|completed|failed
     last_step = Column(String)  # path/key of last executed step
+    path = Column(String)  # current path
+    step_index = Column(Integer)  # next step to execute in ``path``
     context = Column(JSONType)  # execution context/scratch
+    version = Column(Integer, default=0)  # optimistic concurrency; see packages/common/run_store.py
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
 
+    __table_args__ = (
+        # at most one active run per contact and flow
+        Index(
+            "uq_flow_runs_active", "org_id", "flow_id", "contact_key", unique=True,
+            postgresql_where=text("status IN ('running', 'waiting')"),
+            sqlite_where=text("status IN ('running', 'waiting')"),
+        ),
+    )
+
 
 class Note(Base):
     __tablename__ = "notes"
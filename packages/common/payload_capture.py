@@ -0,0 +1,109 @@
+"""Sampled capture of raw request payloads.
+
+Replaces logging every raw body on the hot path. ``PayloadCapture.maybe_capture``
+returns immediately for unsampled requests (one ``random()`` call, no
+decoding/formatting). Sampled payloads are truncated, have long digit runs
+(phone numbers, ids) masked, and go to:
+
+- a structured log record (``extra={"payload_sample": {...}}``), and
+- optionally a Redis stream capped with ``MAXLEN ~`` that works as a ring
+  buffer (``XREVRANGE <stream> + - COUNT 20`` to inspect).
+
+Everything is best-effort: capture must never fail a request.
+"""
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+
+_DIGITS = re.compile(r"\d{7,}")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def redact(text: str) -> str:
+    """Mask digit runs of 7+ characters, keeping the last 4 for correlation."""
+    return _DIGITS.sub(lambda m: "*" * (len(m.group()) - 4) + m.group()[-4:], text)
+
+
+class PayloadCapture:
+    def __init__(
+        self,
+        prefix: str,
+        stream: str,
+        rate: float = 0.0,
+        max_bytes: int = 2048,
+        maxlen: int = 1000,
+        to_redis: bool = False,
+        redact_digits: bool = True,
+        logger: logging.Logger | None = None,
+    ):
+        self.stream = stream
+        self.rate = max(0.0, min(1.0, float(rate)))
+        self.max_bytes = max(0, int(max_bytes))
+        self.maxlen = max(1, int(maxlen))
+        self.to_redis = to_redis
+        self.redact_digits = redact_digits
+        self.logger = logger or logging.getLogger(prefix)
+        self.captured = 0
+
+    @classmethod
+    def from_env(cls, prefix: str, stream: str, logger: logging.Logger | None = None) -> "PayloadCapture":
+        """Read ``<PREFIX>_CAPTURE_{RATE,MAX_BYTES,MAXLEN,REDIS,REDACT,STREAM}``."""
+        return cls(
+            prefix=prefix.lower(),
+            stream=os.getenv(f"{prefix}_CAPTURE_STREAM", stream),
+            rate=_env_float(f"{prefix}_CAPTURE_RATE", 0.0),
+            max_bytes=_env_int(f"{prefix}_CAPTURE_MAX_BYTES", 2048),
+            maxlen=_env_int(f"{prefix}_CAPTURE_MAXLEN", 1000),
+            to_redis=os.getenv(f"{prefix}_CAPTURE_REDIS", "false").lower() == "true",
+            redact_digits=os.getenv(f"{prefix}_CAPTURE_REDACT", "true").lower() == "true",
+            logger=logger,
+        )
+
+    def sampled(self) -> bool:
+        return self.rate > 0 and (self.rate >= 1.0 or random.random() < self.rate)
+
+    def maybe_capture(self, redis, body: bytes, reason: str = "sample", force: bool = False) -> bool:
+        """Capture ``body`` when sampled (or ``force``, e.g. for malformed payloads)."""
+        if not (force or self.sampled()):
+            return False
+        try:
+            snippet = body[: self.max_bytes].decode(errors="replace")
+            if self.redact_digits:
+                snippet = redact(snippet)
+            sample = {
+                "reason": reason,
+                "bytes": str(len(body)),
+                "truncated": "1" if len(body) > self.max_bytes else "0",
+                "sha256": hashlib.sha256(body).hexdigest()[:16],
+                "ts": str(int(time.time() * 1000)),
+                "body": snippet,
+            }
+            self.logger.info("payload sample (%s, %s bytes)", reason, sample["bytes"], extra={"payload_sample": sample})
+            if self.to_redis and redis is not None:
+                redis.xadd(self.stream, sample, maxlen=self.maxlen, approximate=True)
+            self.captured += 1
+            return True
+        except Exception:
+            self.logger.debug("payload capture failed", exc_info=True)
+            return False
+
+    def recent(self, redis, count: int = 20) -> list[dict]:
+        """Newest samples first from the Redis ring buffer."""
+        rows = redis.xrevrange(self.stream, "+", "-", count=max(1, int(count)))
+        return [{"id": msg_id, **fields} for msg_id, fields in rows or []]
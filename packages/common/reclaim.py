@@ -0,0 +1,210 @@
+"""Pending-entry reclaim for the stream consumer groups (``XAUTOCLAIM``).
+
+Workers only read ``>`` (new) entries, so an entry delivered to a consumer
+that dies before its ``XACK`` stays in the group's PEL forever, and a
+replacement replica with a new ``HOSTNAME`` never sees it. ``reclaim_loop``
+runs next to each worker loop and, every ``STREAM_RECLAIM_INTERVAL_S``:
+
+1. ``XAUTOCLAIM``s entries idle for at least ``STREAM_RECLAIM_MIN_IDLE_MS``
+   (any consumer, including this one after a restart) to this consumer, in
+   batches of ``STREAM_RECLAIM_COUNT`` and at most
+   ``STREAM_RECLAIM_MAX_BATCHES`` batches per pass;
+2. reads the claimed entries' delivery counts (one ranged ``XPENDING``); entries
+   delivered more than ``STREAM_RECLAIM_MAX_DELIVERIES`` times are copied to
+   the worker's DLQ stream (``error``, ``source_id``, ``deliveries``) and
+   acked instead of being handled again;
+3. hands the rest to the worker's ``handle(entries)``, which processes and
+   acks them exactly like freshly read entries.
+
+The min-idle time, the per-pass cap, the jittered interval and the delivery
+cap keep several replicas from reprocessing the same backlog in a storm:
+claiming resets an entry's idle time, so only one replica gets it per round.
+
+Handlers that can run longer than the min-idle time (HTTP retries with
+backoff) wrap the work in ``keep_claimed``: it re-claims the entry for its
+consumer (``XCLAIM ... JUSTID``, which leaves the delivery count alone) every
+``STREAM_RECLAIM_TOUCH_S`` so it never looks idle while in flight.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import random
+
+from packages.common.aredis import maybe_await
+
+logger = logging.getLogger("reclaim")
+
+ENABLED = os.getenv("STREAM_RECLAIM_ENABLED", "true").lower() == "true"
+try:
+    MIN_IDLE_MS = int(os.getenv("STREAM_RECLAIM_MIN_IDLE_MS", "60000"))
+except Exception:
+    MIN_IDLE_MS = 60000
+try:
+    INTERVAL_S = float(os.getenv("STREAM_RECLAIM_INTERVAL_S", "30"))
+except Exception:
+    INTERVAL_S = 30.0
+try:
+    COUNT = int(os.getenv("STREAM_RECLAIM_COUNT", "100"))
+except Exception:
+    COUNT = 100
+try:
+    MAX_BATCHES = int(os.getenv("STREAM_RECLAIM_MAX_BATCHES", "10"))
+except Exception:
+    MAX_BATCHES = 10
+try:
+    MAX_DELIVERIES = int(os.getenv("STREAM_RECLAIM_MAX_DELIVERIES", "5"))
+except Exception:
+    MAX_DELIVERIES = 5
+try:
+    TOUCH_S = float(os.getenv("STREAM_RECLAIM_TOUCH_S", str(MIN_IDLE_MS / 3000.0)))
+except Exception:
+    TOUCH_S = MIN_IDLE_MS / 3000.0
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _fields(kvs) -> dict | None:
+    if kvs is None:
+        return None
+    if isinstance(kvs, dict):
+        return {_text(k): _text(v) for k, v in kvs.items()}
+    return {_text(kvs[i]): _text(kvs[i + 1]) for i in range(0, len(kvs) - 1, 2)}
+
+
+def _id(value) -> tuple[int, int]:
+    ms, _, seq = _text(value).partition("-")
+    return int(ms or 0), int(seq or 0)
+
+
+async def delivery_counts(redis, stream: str, group: str, ids: list[str], consumer: str | None = None) -> dict[str, int]:
+    """``times_delivered`` per pending id (ids no longer pending are left out).
+
+    One ranged ``XPENDING`` from the lowest to the highest id, restricted to
+    ``consumer`` when given; further pages are only read when other pending
+    entries sit between the ids.
+    """
+    wanted = {_text(i) for i in ids}
+    if not wanted:
+        return {}
+    ordered = sorted(wanted, key=_id)
+    start, end = ordered[0], ordered[-1]
+    page = max(len(wanted), COUNT)
+    extra = {"consumername": consumer} if consumer else {}
+    counts: dict[str, int] = {}
+    while True:
+        rows = list(await maybe_await(redis.xpending_range(stream, group, min=start, max=end, count=page, **extra)) or [])
+        for row in rows:
+            msg_id = _text(row.get("message_id"))
+            if msg_id in wanted:
+                counts[msg_id] = int(row.get("times_delivered") or 0)
+        if len(rows) < page or len(counts) == len(wanted):
+            return counts
+        last = _text(rows[-1].get("message_id"))
+        if _id(last) >= _id(end):
+            return counts
+        start = f"({last}"
+
+
+async def dead_letter(redis, stream: str, group: str, dlq_stream: str, msg_id: str, fields: dict | None,
+                      deliveries: int, error: str = "max_deliveries") -> None:
+    """Copy an entry to ``dlq_stream`` and ack the original."""
+    payload = {**(fields or {}), "error": error, "source_id": msg_id, "deliveries": str(deliveries)}
+    await maybe_await(redis.xadd(dlq_stream, {k: str(v) for k, v in payload.items()}))
+    await maybe_await(redis.xack(stream, group, msg_id))
+
+
+@contextlib.asynccontextmanager
+async def keep_claimed(redis, stream: str, group: str, consumer: str, msg_id: str, interval_s: float | None = None):
+    """Keep ``msg_id`` owned by ``consumer`` (not idle) while the block runs."""
+    interval_s = max(0.001, TOUCH_S if interval_s is None else float(interval_s))
+    # only entries idle for half an interval: one another consumer just claimed is not taken back
+    min_idle_ms = int(interval_s * 500)
+
+    async def touch():
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                await maybe_await(redis.xclaim(stream, group, consumer, min_idle_ms, [msg_id], justid=True))
+            except Exception:
+                logger.exception("keep-claimed touch failed for %s %s", stream, msg_id)
+
+    task = asyncio.create_task(touch())
+    try:
+        yield
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+async def reclaim_once(redis, stream: str, group: str, consumer: str, handle, *, dlq_stream: str,
+                       min_idle_ms: int | None = None, count: int | None = None,
+                       max_batches: int | None = None, max_deliveries: int | None = None) -> dict:
+    """One reclaim pass; returns ``{"claimed", "handled", "dead", "deleted"}``."""
+    min_idle_ms = MIN_IDLE_MS if min_idle_ms is None else int(min_idle_ms)
+    count = max(1, COUNT if count is None else int(count))
+    max_batches = max(1, MAX_BATCHES if max_batches is None else int(max_batches))
+    max_deliveries = MAX_DELIVERIES if max_deliveries is None else int(max_deliveries)
+    report = {"claimed": 0, "handled": 0, "dead": 0, "deleted": 0}
+    start = "0-0"
+    for _ in range(max_batches):
+        reply = await maybe_await(redis.xautoclaim(stream, group, consumer, min_idle_ms, start_id=start, count=count))
+        reply = list(reply or [])
+        next_start = _text(reply[0]) if reply else "0-0"
+        claimed = reply[1] if len(reply) > 1 else []
+        # Redis 7 lists entries deleted from the stream (their PEL slots are dropped)
+        report["deleted"] += len(reply[2]) if len(reply) > 2 and reply[2] else 0
+        entries = [(_text(e[0]), _fields(e[1])) for e in claimed or []]
+        report["claimed"] += len(entries)
+        if entries:
+            counts = await delivery_counts(redis, stream, group, [msg_id for msg_id, _ in entries], consumer)
+            live = []
+            for msg_id, fields in entries:
+                deliveries = counts.get(msg_id, 0)
+                if fields is not None and deliveries > max_deliveries:
+                    try:
+                        await dead_letter(redis, stream, group, dlq_stream, msg_id, fields, deliveries)
+                        report["dead"] += 1
+                        continue
+                    except Exception:
+                        logger.exception("reclaim dead-letter failed for %s %s", stream, msg_id)
+                live.append((msg_id, fields))
+            if live:
+                await handle(live)
+                report["handled"] += len(live)
+        if next_start == "0-0":
+            break
+        start = next_start
+    return report
+
+
+async def reclaim_loop(redis, stream: str, group: str, consumer: str, handle, *, dlq_stream: str,
+                       interval_s: float | None = None, on_report=None, **options) -> None:
+    """``reclaim_once`` forever (jittered interval); stops quietly without XAUTOCLAIM support."""
+    if not ENABLED:
+        return
+    interval_s = INTERVAL_S if interval_s is None else float(interval_s)
+    if not hasattr(redis, "xautoclaim"):
+        logger.warning("redis client has no xautoclaim; pending-entry reclaim disabled for %s", stream)
+        return
+    while True:
+        # first pass after a jittered delay: replicas starting together do not race for the same entries
+        await asyncio.sleep(interval_s * random.uniform(0.5, 1.5))
+        try:
+            report = await reclaim_once(redis, stream, group, consumer, handle, dlq_stream=dlq_stream, **options)
+            if report["claimed"]:
+                logger.info(
+                    "reclaimed %s pending entries on %s (handled=%s dead=%s)",
+                    report["claimed"], stream, report["handled"], report["dead"],
+                )
+            if on_report is not None:
+                on_report(report)
+        except Exception as e:
+            if "unknown command" in str(e).lower():
+                # Redis < 6.2
+                logger.warning("XAUTOCLAIM unsupported; pending-entry reclaim disabled for %s", stream)
+                return
+            logger.exception("reclaim pass failed on %s", stream)
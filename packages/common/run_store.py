@@ -0,0 +1,321 @@
+"""Flow run state: one active run per (org, flow, contact), cached in Redis.
+
+A run is a plain dict (``id``, ``org_id``, ``flow_id``, ``contact_key``,
+``status``, ``path``, ``step_index``, ``context``, ``version``,
+``created_at``/``updated_at`` as epoch seconds) stored as JSON under
+``<FLOW_RUN_PREFIX>:<org>:<flow>:<contact>``:
+
+- ``load`` reads the cached state; on a miss ``loader`` (the ``flow_runs``
+  table) fills the cache;
+- ``save`` is a compare-and-set on ``version`` (``SAVE_LUA``): the write only
+  lands when nobody else saved since ``expected_version``, otherwise
+  ``RunConflict`` is raised. Successful saves add the key to the dirty set;
+- ``drain_dirty`` + ``persist_runs`` flush dirty runs to ``flow_runs`` in
+  batches (the flow engine does this every ``FLOW_RUN_FLUSH_INTERVAL_MS``);
+  the upsert only moves a row forward in ``version``, so replays are harmless.
+
+A run that reaches ``completed``/``failed`` stays cached (shorter TTL) until
+the next message for that contact starts a new run under the same key; the
+``version`` counter keeps growing across runs so the CAS keeps working. If
+that happens before the finished run was flushed, the save first copies its
+final state to ``<key>:done:<run id>`` and marks that key dirty, so the
+terminal row still reaches the DB.
+"""
+import asyncio
+import calendar
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import tuple_, update
+from sqlalchemy.exc import IntegrityError
+
+from packages.common.aredis import maybe_await, script
+from packages.common.upserts import dialect_insert
+
+ACTIVE = ("running", "waiting")
+TERMINAL = ("completed", "failed")
+PREFIX = os.getenv("FLOW_RUN_PREFIX", "fe:run")
+DIRTY_KEY = f"{PREFIX}:dirty"
+try:
+    TTL_S = int(os.getenv("FLOW_RUN_TTL_S", str(7 * 86400)))
+except Exception:
+    TTL_S = 7 * 86400
+try:
+    DONE_TTL_S = int(os.getenv("FLOW_RUN_DONE_TTL_S", "3600"))
+except Exception:
+    DONE_TTL_S = 3600
+
+SAVE_LUA = """
+local cur = redis.call('GET', KEYS[1])
+local version = 0
+local prev
+if cur then
+  local ok, obj = pcall(cjson.decode, cur)
+  if ok and type(obj) == 'table' then
+    version = tonumber(obj.version) or 0
+    prev = obj
+  end
+end
+if version ~= tonumber(ARGV[1]) then return {0, version} end
+if prev and (prev.status == 'completed' or prev.status == 'failed') and prev.id
+   and tostring(prev.id) ~= ARGV[4] and redis.call('SISMEMBER', KEYS[2], KEYS[1]) == 1 then
+  -- finished run replaced before its flush: its final state gets its own dirty key
+  local done = KEYS[1] .. ':done:' .. tostring(prev.id)
+  redis.call('SET', done, cur, 'EX', ARGV[5])
+  redis.call('SADD', KEYS[2], done)
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+redis.call('SADD', KEYS[2], KEYS[1])
+return {1, version + 1}
+"""
+
+
+class RunConflict(Exception):
+    """The cached run changed since it was loaded."""
+
+    def __init__(self, key: str, current_version: int):
+        super().__init__(f"run {key} is at version {current_version}")
+        self.key = key
+        self.current_version = current_version
+
+
+def run_key(org_id, flow_id, contact_key) -> str:
+    return f"{PREFIX}:{org_id}:{flow_id}:{contact_key}"
+
+
+def is_active(run: dict | None) -> bool:
+    return bool(run) and run.get("status") in ACTIVE
+
+
+def new_run(org_id, flow_id, contact_key, version: int = 0, now: float | None = None) -> dict:
+    now = time.time() if now is None else now
+    return {
+        "id": str(uuid.uuid4()),
+        "org_id": str(org_id),
+        "flow_id": flow_id,
+        "contact_key": str(contact_key),
+        "status": "running",
+        "path": None,
+        "step_index": 0,
+        "context": {},
+        "version": int(version),
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def _decode(raw) -> dict | None:
+    try:
+        run = json.loads(raw) if raw else None
+    except Exception:
+        return None
+    return run if isinstance(run, dict) else None
+
+
+async def load(redis, org_id, flow_id, contact_key, loader=None) -> dict | None:
+    """Latest state for the key (active or just finished); ``None`` when unknown."""
+    key = run_key(org_id, flow_id, contact_key)
+    run = _decode(await maybe_await(redis.get(key)))
+    if run is None and loader is not None:
+        # loaders query the DB: keep them off the event loop
+        run = await asyncio.to_thread(loader, org_id, flow_id, contact_key)
+        if run is not None:
+            # fill only if nobody saved meanwhile; the DB copy is not dirty
+            await maybe_await(redis.set(key, json.dumps(run), ex=TTL_S, nx=True))
+    return run
+
+
+def _save_args(run: dict, expected_version: int, raw: str, ttl: int) -> list:
+    return [int(expected_version), raw, ttl, str(run["id"]), TTL_S]
+
+
+def _prepare(run: dict, expected_version: int) -> tuple[str, str, int]:
+    run["version"] = int(expected_version) + 1
+    run["updated_at"] = time.time()
+    ttl = DONE_TTL_S if run.get("status") in TERMINAL else TTL_S
+    return run_key(run["org_id"], run["flow_id"], run["contact_key"]), json.dumps(run), ttl
+
+
+async def queue_save(redis, pipe, run: dict, expected_version: int) -> None:
+    """Add ``save``'s compare-and-set to a MULTI pipeline; check its reply with ``saved``."""
+    key, raw, ttl = _prepare(run, expected_version)
+    # the asyncio Script call is a coroutine even when it only queues on a pipeline
+    await maybe_await(script(redis, SAVE_LUA)(keys=[key, DIRTY_KEY], args=_save_args(run, expected_version, raw, ttl), client=pipe))
+
+
+def saved(reply) -> bool:
+    """Whether a queued ``SAVE_LUA`` call wrote the run."""
+    try:
+        return bool(int(reply[0]))
+    except Exception:
+        return False
+
+
+async def save(redis, run: dict, expected_version: int) -> dict:
+    """Write ``run`` if the cached version is still ``expected_version``."""
+    key, raw, ttl = _prepare(run, expected_version)
+    if hasattr(redis, "register_script"):
+        ok, current = await maybe_await(script(redis, SAVE_LUA)(keys=[key, DIRTY_KEY], args=_save_args(run, expected_version, raw, ttl)))
+    else:
+        # fakes without scripting: same checks, not atomic (finished runs are always kept)
+        cached = _decode(await maybe_await(redis.get(key)))
+        current = int((cached or {}).get("version") or 0)
+        ok = current == int(expected_version)
+        if ok:
+            if cached and cached.get("status") in TERMINAL and cached.get("id") and str(cached["id"]) != str(run["id"]):
+                done = f"{key}:done:{cached['id']}"
+                await maybe_await(redis.set(done, json.dumps(cached), ex=TTL_S))
+                await maybe_await(redis.sadd(DIRTY_KEY, done))
+            await maybe_await(redis.set(key, raw, ex=ttl))
+            await maybe_await(redis.sadd(DIRTY_KEY, key))
+    if not int(ok):
+        run["version"] = int(expected_version)
+        raise RunConflict(key, int(current))
+    return run
+
+
+async def drain_dirty(redis, limit: int = 500) -> tuple[list[str], list[dict]]:
+    """Pop up to ``limit`` dirty keys; returns ``(keys, runs)`` (expired keys are dropped)."""
+    keys = await maybe_await(redis.spop(DIRTY_KEY, limit)) or []
+    if not keys:
+        return [], []
+    keys = list(keys)
+    raws = await maybe_await(redis.mget(keys))
+    return keys, [run for run in (_decode(raw) for raw in raws or []) if run]
+
+
+async def mark_dirty(redis, keys) -> None:
+    """Put keys back after a failed flush."""
+    if keys:
+        await maybe_await(redis.sadd(DIRTY_KEY, *keys))
+
+
+def _row(run: dict) -> dict:
+    def ts(value):
+        try:
+            return datetime.utcfromtimestamp(float(value))
+        except Exception:
+            return datetime.utcnow()
+
+    return {
+        "id": run["id"],
+        "org_id": run.get("org_id"),
+        "flow_id": run.get("flow_id"),
+        "contact_key": run.get("contact_key"),
+        "status": run.get("status"),
+        "last_step": run.get("path"),
+        "path": run.get("path"),
+        "step_index": int(run.get("step_index") or 0),
+        "context": run.get("context") or {},
+        "version": int(run.get("version") or 0),
+        "created_at": ts(run.get("created_at")),
+        "updated_at": ts(run.get("updated_at")),
+    }
+
+
+def write_runs(db, model, runs: list[dict]) -> int:
+    """Upsert runs into ``flow_runs`` (newer ``version`` wins); caller commits.
+
+    Another active row of the same contact and flow (a predecessor whose final
+    state was never flushed) is closed as ``failed`` first, so the new active
+    row does not hit ``uq_flow_runs_active``; a later flush of the
+    predecessor's final state still wins by ``version``.
+    """
+    # finished runs first: a contact's next run must not meet its predecessor still active
+    rows = [_row(r) for r in sorted(runs, key=lambda r: (r.get("status") not in TERMINAL, float(r.get("updated_at") or 0)))]
+    insert = dialect_insert(db)
+    tbl = model.__table__
+    active = [row for row in rows if row["status"] in ACTIVE]
+    if active:
+        db.execute(
+            update(tbl)
+            .where(tuple_(tbl.c.org_id, tbl.c.flow_id, tbl.c.contact_key).in_([(r["org_id"], r["flow_id"], r["contact_key"]) for r in active]))
+            .where(tbl.c.id.notin_([r["id"] for r in active]))
+            .where(tbl.c.status.in_(ACTIVE))
+            .values(status="failed")
+            .execution_options(synchronize_session=False)
+        )
+    for row in rows:
+        if insert is not None:
+            stmt = insert(tbl).values(**row)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[tbl.c.id],
+                set_={k: stmt.excluded[k] for k in row if k not in ("id", "created_at")},
+                where=tbl.c.version < stmt.excluded.version,
+            )
+            db.execute(stmt)
+            continue
+        obj = db.get(model, row["id"])
+        if obj is None:
+            db.add(model(**row))
+        elif int(getattr(obj, "version", 0) or 0) < row["version"]:
+            for k, v in row.items():
+                if k not in ("id", "created_at"):
+                    setattr(obj, k, v)
+    return len(rows)
+
+
+def persist_runs(session_factory, model, runs: list[dict]) -> tuple[int, list[dict]]:
+    """Write a drained batch; returns ``(written, rejected)``.
+
+    The batch goes in one transaction. If the DB rejects a row (constraint
+    violation), the runs are retried one per transaction and the rejected ones
+    are returned instead of failing the batch. Other errors (DB unavailable)
+    propagate, so the caller puts the whole batch back.
+    """
+    with session_factory() as db:
+        try:
+            n = write_runs(db, model, runs)
+            db.commit()
+            return n, []
+        except IntegrityError:
+            db.rollback()
+    written, rejected = 0, []
+    for run in runs:
+        with session_factory() as db:
+            try:
+                written += write_runs(db, model, [run])
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+                rejected.append(run)
+    return written, rejected
+
+
+def _epoch(value) -> float:
+    # flow_runs stores naive UTC datetimes
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6 if value else time.time()
+
+
+def db_loader(session_factory, model):
+    """``load`` fallback reading the newest active run from ``flow_runs``."""
+    def _load(org_id, flow_id, contact_key):
+        with session_factory() as db:
+            obj = (
+                db.query(model)
+                .filter(model.org_id == str(org_id))
+                .filter(model.flow_id == flow_id)
+                .filter(model.contact_key == str(contact_key))
+                .filter(model.status.in_(ACTIVE))
+                .order_by(model.updated_at.desc())
+                .first()
+            )
+            if obj is None:
+                return None
+            return {
+                "id": obj.id,
+                "org_id": obj.org_id,
+                "flow_id": obj.flow_id,
+                "contact_key": obj.contact_key,
+                "status": obj.status,
+                "path": obj.path or obj.last_step,
+                "step_index": int(obj.step_index or 0),
+                "context": obj.context or {},
+                "version": int(obj.version or 0),
+                "created_at": _epoch(obj.created_at),
+                "updated_at": _epoch(obj.updated_at),
+            }
+    return _load
@@ -0,0 +1,335 @@
+"""Delayed flow resumes: a ZSET of due items forwarded to ``nf:incoming``.
+
+Members are the JSON resume items written by the flow engine
+(``payload``, ``org_id``, ``channel_id``, ``contact_phone``, ``engine_resume``
+and, for ``wait_for_reply`` timeouts, ``resume_token``); scores are due
+times in epoch seconds (fractional, so delays keep sub-second accuracy).
+
+``claim_due`` runs ``CLAIM_DUE_LUA`` server side: in one call it pops every
+due member up to ``limit``, drops ``wait_for_reply`` timeouts whose
+``resume_token`` no longer matches the wait key (the reply already arrived),
+XADDs the rest and returns the next due score so the caller can sleep exactly
+until then. Popping inside the script makes the claim atomic across replicas.
+
+Sharded layout (``schedule_item`` / ``claim_due_shards``): items are spread
+over ``shards`` ZSETs ``<prefix>:<n>`` chosen by a stable hash of the contact;
+each ZSET member is only a short item id and the JSON item lives in the
+shard's hash ``<prefix>:<n>:items``. The ZSETs stay small and cheap to scan,
+and shards are split among engine replicas by ``owned_shards`` (heartbeats in
+``<prefix>:members``); a claim is still atomic, so two replicas briefly owning
+the same shard during a rebalance only share work. The legacy single ZSET
+(JSON members) is still drained with ``claim_due``.
+
+``wait_for_reply`` waits (``wait_state``) get a scheduler item carrying their
+``resume_token``: a timeout resume, or an ``expire`` item that only drops the
+wait. Either acts only while the wait still holds that token.
+
+Note: the wait keys are derived inside the scripts rather than declared in
+``KEYS``; fine on a single Redis, not on Redis Cluster.
+"""
+import json
+import time
+import uuid
+import zlib
+
+from packages.common.aredis import maybe_await, script
+
+# Shared by both claim scripts: the wait-token check (consumes the wait) and the
+# forward-to-stream step, so the legacy and sharded layouts cannot drift apart.
+# ARGV[3] is the legacy per-contact key prefix, ARGV[4] (optional) the per-org hash prefix.
+_FORWARD_LUA = """
+local now, limit, wait_prefix, wait_hash = ARGV[1], tonumber(ARGV[2]), ARGV[3], ARGV[4]
+
+local function str(v, default)
+  if v == nil or v == cjson.null or v == '' then return default end
+  return tostring(v)
+end
+
+local function wait_current(item, token)
+  local org = str(item.org_id, '')
+  local field = str(item.channel_id, 'wa_main') .. ':' .. str(item.contact_phone, '')
+  if wait_hash and wait_hash ~= '' then
+    local hkey = wait_hash .. ':' .. org
+    local rec = redis.call('HGET', hkey, field)
+    if rec then
+      local ok, st = pcall(cjson.decode, rec)
+      if ok and type(st) == 'table' and str(st[4], nil) == token then
+        redis.call('HDEL', hkey, field)
+        return true
+      end
+      return false
+    end
+  end
+  local wkey = wait_prefix .. ':' .. org .. ':' .. field
+  local state = redis.call('GET', wkey)
+  if state then
+    local ok, st = pcall(cjson.decode, state)
+    if ok and type(st) == 'table' and str(st.resume_token, nil) == token then
+      redis.call('DEL', wkey)
+      return true
+    end
+  end
+  return false
+end
+
+-- decode one claimed item and XADD it unless its wait is gone or it only expires one
+local function forward(stream, raw)
+  local ok, item = false, nil
+  if raw then ok, item = pcall(cjson.decode, raw) end
+  if not ok or type(item) ~= 'table' then return false end
+  local token = str(item.resume_token, nil)
+  if token and not wait_current(item, token) then return false end
+  -- expiry items only drop a wait that is still current
+  if str(item.expire, nil) then return false end
+  local fields = {
+    'payload', str(item.payload, ''),
+    'org_id', str(item.org_id, ''),
+    'channel_id', str(item.channel_id, 'wa_main'),
+    'engine_resume', str(item.engine_resume, ''),
+  }
+  local phone = str(item.contact_phone, nil)
+  if phone then
+    table.insert(fields, 'contact_phone')
+    table.insert(fields, phone)
+  end
+  redis.call('XADD', stream, '*', unpack(fields))
+  return true
+end
+"""
+
+CLAIM_DUE_LUA = _FORWARD_LUA + """
+local zset, stream = KEYS[1], KEYS[2]
+
+local published, skipped = 0, 0
+local due = redis.call('ZRANGEBYSCORE', zset, '-inf', now, 'LIMIT', 0, limit)
+for _, raw in ipairs(due) do
+  redis.call('ZREM', zset, raw)
+  if forward(stream, raw) then
+    published = published + 1
+  else
+    skipped = skipped + 1
+  end
+end
+local head = redis.call('ZRANGE', zset, 0, 0, 'WITHSCORES')
+return {published, skipped, head[2] or false}
+"""
+
+CLAIM_SHARDS_LUA = _FORWARD_LUA + """
+local stream = KEYS[1]
+
+local published, skipped, head = 0, 0, nil
+for i = 2, #KEYS, 2 do
+  local zset, items = KEYS[i], KEYS[i + 1]
+  if limit > published + skipped then
+    local due = redis.call('ZRANGEBYSCORE', zset, '-inf', now, 'LIMIT', 0, limit - published - skipped)
+    for _, id in ipairs(due) do
+      redis.call('ZREM', zset, id)
+      local raw = redis.call('HGET', items, id)
+      redis.call('HDEL', items, id)
+      if forward(stream, raw) then
+        published = published + 1
+      else
+        skipped = skipped + 1
+      end
+    end
+  end
+  local first = redis.call('ZRANGE', zset, 0, 0, 'WITHSCORES')
+  if first[2] and (head == nil or tonumber(first[2]) < tonumber(head)) then head = first[2] end
+end
+return {published, skipped, head or false}
+"""
+
+def due_score(delay_seconds: float, now: float | None = None) -> float:
+    return (time.time() if now is None else now) + max(0.0, float(delay_seconds))
+
+
+def wait_key(prefix: str, item: dict) -> str:
+    return f"{prefix}:{item.get('org_id') or ''}:{item.get('channel_id') or 'wa_main'}:{item.get('contact_phone') or ''}"
+
+
+def resume_fields(item: dict) -> dict:
+    """``nf:incoming`` entry for a claimed resume item."""
+    fields = {
+        "payload": item.get("payload") or "",
+        "org_id": item.get("org_id") or "",
+        "channel_id": item.get("channel_id") or "wa_main",
+        "engine_resume": item.get("engine_resume") or "",
+    }
+    # also pass through contact_phone for faster resolution
+    if item.get("contact_phone"):
+        fields["contact_phone"] = item.get("contact_phone")
+    return fields
+
+
+def _args(now: float, limit: int, wait_prefix: str, wait_hash_prefix: str | None) -> list:
+    args = [repr(float(now)), int(limit), wait_prefix]
+    return args + [wait_hash_prefix] if wait_hash_prefix else args
+
+
+async def claim_due(redis, zset: str, stream: str, wait_prefix: str, limit: int = 100, now: float | None = None,
+                    wait_hash_prefix: str | None = None) -> tuple[int, int, float | None]:
+    """Forward due items; returns ``(published, skipped, next_due_score)``.
+
+    Token checks look in the per-org wait hash (``wait_hash_prefix``, see
+    ``wait_state``) first and then in the legacy ``wait_prefix`` keys.
+    """
+    now = time.time() if now is None else now
+    if not hasattr(redis, "register_script"):
+        return await _claim_due_stepwise(redis, zset, stream, wait_prefix, limit, now, wait_hash_prefix)
+    res = await maybe_await(script(redis, CLAIM_DUE_LUA)(keys=[zset, stream], args=_args(now, limit, wait_prefix, wait_hash_prefix)))
+    published, skipped, head = (list(res) + [None, None, None])[:3]
+    return int(published or 0), int(skipped or 0), float(head) if head is not None else None
+
+
+async def _claim_due_stepwise(redis, zset, stream, wait_prefix, limit, now, wait_hash_prefix=None) -> tuple[int, int, float | None]:
+    """Round-trip-per-item fallback for clients without scripting (test fakes)."""
+    published = skipped = 0
+    items = await maybe_await(redis.zrangebyscore(zset, "-inf", now, start=0, num=limit)) or []
+    for raw in items:
+        # attempt to claim by removing; if removed==1 we own it
+        if not await maybe_await(redis.zrem(zset, raw)):
+            continue
+        try:
+            item = json.loads(raw)
+        except Exception:
+            item = None
+        if not isinstance(item, dict):
+            skipped += 1
+            continue
+        if not await _token_ok(redis, wait_prefix, item, wait_hash_prefix) or item.get("expire"):
+            skipped += 1
+            continue
+        await maybe_await(redis.xadd(stream, resume_fields(item)))
+        published += 1
+    head = None
+    try:
+        first = await maybe_await(redis.zrange(zset, 0, 0, withscores=True))
+        head = float(first[0][1]) if first else None
+    except Exception:
+        head = None
+    return published, skipped, head
+
+
+# --- sharded layout -----------------------------------------------------------------
+
+
+def shard_for(route_key: str, shards: int) -> int:
+    """Stable shard for a contact (same in every process, unlike ``hash()``)."""
+    return zlib.crc32(str(route_key).encode("utf-8")) % max(1, int(shards))
+
+
+def shard_keys(prefix: str, shard: int) -> tuple[str, str]:
+    """``(zset, items_hash)`` for one shard."""
+    return f"{prefix}:{shard}", f"{prefix}:{shard}:items"
+
+
+def queue_item(pipe, prefix: str, shards: int, item: dict, due_at: float, route_key: str) -> str:
+    """Add the writes for one item to a MULTI pipeline; returns the item id."""
+    item_id = uuid.uuid4().hex[:20]
+    zset, items = shard_keys(prefix, shard_for(route_key, shards))
+    pipe.hset(items, item_id, json.dumps(item))
+    pipe.zadd(zset, {item_id: due_at})
+    return item_id
+
+
+async def schedule_item(redis, prefix: str, shards: int, item: dict, due_at: float, route_key: str) -> str:
+    """Store ``item`` in its contact's shard, due at ``due_at``; returns the item id."""
+    if hasattr(redis, "pipeline"):
+        # MULTI: a claim never sees the ZSET member without its payload
+        pipe = redis.pipeline(transaction=True)
+        item_id = queue_item(pipe, prefix, shards, item, due_at, route_key)
+        await maybe_await(pipe.execute())
+        return item_id
+    item_id = uuid.uuid4().hex[:20]
+    zset, items = shard_keys(prefix, shard_for(route_key, shards))
+    await maybe_await(redis.hset(items, item_id, json.dumps(item)))
+    await maybe_await(redis.zadd(zset, {item_id: due_at}))
+    return item_id
+
+
+async def claim_due_shards(redis, prefix: str, shard_ids, stream: str, wait_prefix: str, limit: int = 100, now: float | None = None,
+                           wait_hash_prefix: str | None = None) -> tuple[int, int, float | None]:
+    """``claim_due`` over several shards in one server-side call."""
+    shard_ids = list(shard_ids)
+    if not shard_ids:
+        return 0, 0, None
+    now = time.time() if now is None else now
+    keys = [stream]
+    for shard in shard_ids:
+        keys.extend(shard_keys(prefix, shard))
+    if not hasattr(redis, "register_script"):
+        return await _claim_shards_stepwise(redis, keys[1:], stream, wait_prefix, limit, now, wait_hash_prefix)
+    res = await maybe_await(script(redis, CLAIM_SHARDS_LUA)(keys=keys, args=_args(now, limit, wait_prefix, wait_hash_prefix)))
+    published, skipped, head = (list(res) + [None, None, None])[:3]
+    return int(published or 0), int(skipped or 0), float(head) if head is not None else None
+
+
+async def _claim_shards_stepwise(redis, shard_keys_flat, stream, wait_prefix, limit, now, wait_hash_prefix=None) -> tuple[int, int, float | None]:
+    published = skipped = 0
+    head = None
+    for zset, items in zip(shard_keys_flat[::2], shard_keys_flat[1::2]):
+        remaining = limit - published - skipped
+        ids = await maybe_await(redis.zrangebyscore(zset, "-inf", now, start=0, num=remaining)) if remaining > 0 else []
+        for item_id in ids or []:
+            if not await maybe_await(redis.zrem(zset, item_id)):
+                continue
+            raw = await maybe_await(redis.hget(items, item_id))
+            await maybe_await(redis.hdel(items, item_id))
+            try:
+                item = json.loads(raw) if raw else None
+            except Exception:
+                item = None
+            if not isinstance(item, dict) or not await _token_ok(redis, wait_prefix, item, wait_hash_prefix) or item.get("expire"):
+                skipped += 1
+                continue
+            await maybe_await(redis.xadd(stream, resume_fields(item)))
+            published += 1
+        try:
+            first = await maybe_await(redis.zrange(zset, 0, 0, withscores=True))
+            if first and (head is None or float(first[0][1]) < head):
+                head = float(first[0][1])
+        except Exception:
+            pass
+    return published, skipped, head
+
+
+async def _token_ok(redis, wait_prefix: str, item: dict, wait_hash_prefix: str | None = None) -> bool:
+    """``wait_for_reply`` timeouts only fire while their wait state is current (consumes it)."""
+    if not item.get("resume_token"):
+        return True
+    if wait_hash_prefix:
+        hkey = f"{wait_hash_prefix}:{item.get('org_id') or ''}"
+        field = f"{item.get('channel_id') or 'wa_main'}:{item.get('contact_phone') or ''}"
+        raw = await maybe_await(redis.hget(hkey, field))
+        if raw:
+            try:
+                record = json.loads(raw)
+            except Exception:
+                record = None
+            # compact record: resume_token is the 4th element (wait_state.FIELDS)
+            if not isinstance(record, list) or len(record) < 4 or record[3] != item.get("resume_token"):
+                return False
+            await maybe_await(redis.hdel(hkey, field))
+            return True
+    wkey = wait_key(wait_prefix, item)
+    raw_state = await maybe_await(redis.get(wkey))
+    try:
+        state = json.loads(raw_state) if raw_state else None
+    except Exception:
+        state = None
+    if not isinstance(state, dict) or state.get("resume_token") != item.get("resume_token"):
+        return False
+    await maybe_await(redis.delete(wkey))
+    return True
+
+
+async def owned_shards(redis, members_key: str, member: str, shards: int, ttl_s: float = 15.0, now: float | None = None) -> list[int]:
+    """Heartbeat ``member`` and return its share of the shards among live members."""
+    now = time.time() if now is None else now
+    await maybe_await(redis.zadd(members_key, {member: now}))
+    await maybe_await(redis.zremrangebyscore(members_key, "-inf", now - ttl_s))
+    members = sorted(await maybe_await(redis.zrange(members_key, 0, -1)) or [])
+    if member not in members:
+        members = sorted([*members, member])
+    idx = members.index(member)
+    return [s for s in range(max(1, int(shards))) if s % len(members) == idx]
@@ -0,0 +1,114 @@
+"""Per-stage latency for a stream worker: Prometheus histogram + optional tracing.
+
+``StageTimer`` wraps each stage of the hot path in ``with stages("nlp"):``.
+It observes the elapsed seconds in a histogram labelled by ``stage`` and,
+when a tracer is given, opens a span ``<span_prefix><stage>`` around it.
+Spans nest under the current span, so a per-message span groups that
+message's stages. With neither a histogram nor a tracer it costs one call
+returning a shared null context.
+
+OpenTelemetry is optional: ``tracer()`` returns ``None`` (with a warning)
+when ``opentelemetry-api`` is not installed. Exporters, sampling and the
+service name are configured by the deployment (SDK env vars or
+``opentelemetry-instrument``); without an SDK the API's tracer is a no-op.
+
+``consumer_lag`` reads a consumer group's backlog for a lag gauge.
+"""
+import contextlib
+import logging
+import time
+
+from packages.common.aredis import maybe_await
+
+logger = logging.getLogger("stage_metrics")
+
+# 0.5 ms .. 10 s: Redis round trips at the low end, NLP timeouts / blocked reads at the top
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NULL = contextlib.nullcontext()
+
+
+def tracer(name: str):
+    """OpenTelemetry tracer ``name``, or ``None`` when the API package is missing."""
+    try:
+        from opentelemetry import trace  # type: ignore
+    except ImportError:
+        logger.warning("opentelemetry-api not installed; stage spans disabled")
+        return None
+    return trace.get_tracer(name)
+
+
+class StageTimer:
+    def __init__(self, histogram=None, tracer=None, span_prefix: str = ""):
+        self.histogram = histogram
+        self.tracer = tracer
+        self.span_prefix = span_prefix
+        self._children: dict = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.histogram is not None or self.tracer is not None
+
+    def __call__(self, stage: str):
+        if not self.enabled:
+            return _NULL
+        return self._timed(stage)
+
+    def span(self, name: str):
+        """A span without a histogram sample (e.g. the per-message parent span)."""
+        if self.tracer is None:
+            return _NULL
+        return self.tracer.start_as_current_span(self.span_prefix + name)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if self.histogram is None:
+            return
+        child = self._children.get(stage)
+        if child is None:
+            child = self._children[stage] = self.histogram.labels(stage=stage)
+        child.observe(seconds)
+
+    @contextlib.contextmanager
+    def _timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            with self.span(stage):
+                yield
+        finally:
+            # failed stages are timed too: a slow timeout is what we are looking for
+            self.observe(stage, time.perf_counter() - start)
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _id(value) -> tuple[int, int]:
+    ms, _, seq = _text(value or "0-0").partition("-")
+    return int(ms or 0), int(seq or 0)
+
+
+async def consumer_lag(redis, stream: str, group: str, max_count: int = 10000) -> dict | None:
+    """``{"pending", "lag"}`` for ``group`` on ``stream`` (``None``: no such group).
+
+    ``pending``: delivered but not acked (the group's PEL, as ``XPENDING``).
+    ``lag``: entries after the group's ``last-delivered-id`` not read yet.
+    Redis >= 7 reports it in ``XINFO GROUPS``; otherwise it is counted with an
+    ``XRANGE`` after ``last-delivered-id`` (capped at ``max_count``) unless the
+    group is caught up with the stream's ``last-generated-id``.
+    """
+    groups = await maybe_await(redis.xinfo_groups(stream))
+    info = next((g for g in groups or [] if _text(g.get("name")) == group), None)
+    if info is None:
+        return None
+    pending = int(info.get("pending") or 0)
+    lag = info.get("lag")
+    if lag is None:
+        last = _text(info.get("last-delivered-id") or "0-0")
+        tail = (await maybe_await(redis.xinfo_stream(stream)) or {}).get("last-generated-id")
+        if tail is None or _id(tail) <= _id(last):
+            lag = 0
+        else:
+            rows = await maybe_await(redis.xrange(stream, min=f"({last}", max="+", count=max_count))
+            lag = len(rows or [])
+    return {"pending": pending, "lag": int(lag)}
@@ -0,0 +1,196 @@
+"""Retention policy and trimmer for the Redis streams.
+
+Producers XADD without MAXLEN: trimming at XADD time would drop entries a
+consumer group has not read yet. Instead ``trim_streams`` runs periodically
+(the flow engine runs it under a leader lock, see ``trim_loop_once``) and for
+every configured stream:
+
+1. computes the policy cutoff: entries older than ``max_age_s`` (from the
+   clock: stream ids are millisecond timestamps) and/or beyond the newest
+   ``maxlen`` entries (``length_cutoff``, a few ``COUNT 1`` reads);
+2. computes the group floor: the oldest entry some consumer group still needs
+   (oldest pending entry, or the first entry after ``last-delivered-id``);
+3. ``XTRIM <stream> MINID ~ min(cutoff, floor)``.
+
+A dead or stuck group would otherwise pin a stream forever, so ``hard_maxlen``
+is enforced regardless of lag (``XTRIM MAXLEN ~``) to keep memory bounded.
+
+Config: defaults below, overridden per stream by ``STREAM_RETENTION`` (JSON
+object ``{"<stream>": {"maxlen": N, "max_age_s": S, "hard_maxlen": H}}``; a
+``null`` value disables retention for that stream).
+"""
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("stream_retention")
+
+DAY = 86400
+DEFAULT_POLICIES: dict[str, dict] = {
+    "nf:incoming": {"maxlen": 100_000, "max_age_s": 3 * DAY},
+    "nf:inbox": {"maxlen": 50_000, "max_age_s": 1 * DAY},
+    "nf:outbox": {"maxlen": 100_000, "max_age_s": 3 * DAY},
+    "nf:sent": {"maxlen": 100_000, "max_age_s": 3 * DAY},
+    "nf:webhooks": {"maxlen": 100_000, "max_age_s": 3 * DAY},
+    "nf:webhooks:raw": {"maxlen": 200_000, "max_age_s": 2 * DAY},
+    "wh:delivered": {"maxlen": 50_000, "max_age_s": 7 * DAY},
+    "nf:incoming:dlq": {"maxlen": 10_000, "max_age_s": 14 * DAY},
+    "nf:outbox:dlq": {"maxlen": 10_000, "max_age_s": 14 * DAY},
+    "nf:webhooks:dlq": {"maxlen": 10_000, "max_age_s": 14 * DAY},
+}
+HARD_MAXLEN_FACTOR = 5
+try:
+    TRIM_BATCH = int(os.getenv("STREAM_TRIM_BATCH", "10000"))
+except Exception:
+    TRIM_BATCH = 10000
+LEADER_KEY = os.getenv("STREAM_TRIM_LEADER_KEY", "nf:retention:leader")
+# "~" lets Redis trim whole macro nodes only (cheap); exact trimming is for tests/small streams
+APPROXIMATE = os.getenv("STREAM_TRIM_APPROXIMATE", "true").lower() == "true"
+
+
+def load_policies(raw: str | None = None) -> dict[str, dict]:
+    """Defaults merged with the ``STREAM_RETENTION`` JSON override."""
+    policies = {k: dict(v) for k, v in DEFAULT_POLICIES.items()}
+    raw = os.getenv("STREAM_RETENTION", "") if raw is None else raw
+    if raw:
+        try:
+            override = json.loads(raw)
+            for stream, pol in (override or {}).items():
+                if pol is None:
+                    policies.pop(stream, None)
+                elif isinstance(pol, dict):
+                    policies.setdefault(stream, {}).update(pol)
+        except Exception:
+            logger.exception("invalid STREAM_RETENTION, using defaults")
+    for pol in policies.values():
+        if pol.get("maxlen") and "hard_maxlen" not in pol:
+            pol["hard_maxlen"] = int(pol["maxlen"]) * HARD_MAXLEN_FACTOR
+    return policies
+
+
+def parse_id(stream_id) -> tuple[int, int]:
+    if isinstance(stream_id, bytes):
+        stream_id = stream_id.decode()
+    ms, _, seq = str(stream_id).partition("-")
+    return int(ms or 0), int(seq or 0)
+
+
+def format_id(parts: tuple[int, int]) -> str:
+    return f"{parts[0]}-{parts[1]}"
+
+
+def _next_id(parts: tuple[int, int]) -> tuple[int, int]:
+    return parts[0], parts[1] + 1
+
+
+def group_floor(redis, stream: str) -> tuple[int, int] | None:
+    """Oldest entry id any consumer group still needs; ``None`` when there are no groups."""
+    try:
+        groups = redis.xinfo_groups(stream)
+    except Exception:
+        return None
+    floor = None
+    for g in groups or []:
+        name = g.get("name")
+        pending = int(g.get("pending") or 0)
+        candidate = None
+        if pending:
+            try:
+                summary = redis.xpending(stream, name)
+                if summary and summary.get("min"):
+                    candidate = parse_id(summary["min"])
+            except Exception:
+                candidate = (0, 0)  # unknown: be conservative
+        if candidate is None:
+            candidate = _next_id(parse_id(g.get("last-delivered-id") or "0-0"))
+        if floor is None or candidate < floor:
+            floor = candidate
+    return floor
+
+
+def policy_cutoff(redis, stream: str, policy: dict, length: int, now_ms: int | None = None) -> tuple[int, int] | None:
+    """First id to keep according to age/length policy (``None``: nothing to trim)."""
+    cutoff = None
+    age = policy.get("max_age_s")
+    if age:
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        cutoff = (max(0, now_ms - int(float(age) * 1000)), 0)
+    maxlen = policy.get("maxlen")
+    if maxlen and length > int(maxlen):
+        by_len = length_cutoff(redis, stream, length, min(length - int(maxlen), TRIM_BATCH))
+        if by_len is not None:
+            cutoff = by_len if cutoff is None or by_len > cutoff else cutoff
+    return cutoff
+
+
+def length_cutoff(redis, stream: str, length: int, excess: int) -> tuple[int, int] | None:
+    """Id of (about) the ``excess``-th oldest entry, without reading the entries before it.
+
+    The id is interpolated between the first and last entry ids and snapped to
+    the first real entry at or after it (``XRANGE <id> + COUNT 1``): exact at a
+    steady rate, approximate (like ``~``) with bursts; the next pass corrects
+    what is left.
+    """
+    first = redis.xrange(stream, "-", "+", count=1)
+    last = redis.xrevrange(stream, "+", "-", count=1)
+    if not first or not last or length < 2 or excess <= 0:
+        return None
+    lo, hi = parse_id(first[0][0]), parse_id(last[0][0])
+    share = min(excess, length - 1) / (length - 1)
+    if hi[0] > lo[0]:
+        estimate = (lo[0] + int((hi[0] - lo[0]) * share), 0)
+    else:
+        estimate = (lo[0], lo[1] + int((hi[1] - lo[1]) * share))
+    rows = redis.xrange(stream, format_id(estimate), "+", count=1)
+    return parse_id(rows[0][0]) if rows else None
+
+
+def trim_stream(redis, stream: str, policy: dict, now_ms: int | None = None) -> dict:
+    """Apply one retention pass to ``stream``; returns a small report."""
+    report = {"stream": stream, "trimmed": 0}
+    try:
+        length = int(redis.xlen(stream) or 0)
+    except Exception:
+        return report
+    report["length"] = length
+    if not length:
+        return report
+    cutoff = policy_cutoff(redis, stream, policy, length, now_ms=now_ms)
+    floor = group_floor(redis, stream)
+    if cutoff is not None:
+        minid = cutoff if floor is None or cutoff < floor else floor
+        if minid > (0, 0):
+            report["minid"] = format_id(minid)
+            report["trimmed"] += int(redis.xtrim(stream, minid=format_id(minid), approximate=APPROXIMATE) or 0)
+    hard = policy.get("hard_maxlen")
+    if hard and length - report["trimmed"] > int(hard):
+        # a lagging/dead group must not make memory unbounded
+        logger.warning("stream %s above hard_maxlen=%s despite consumer lag; trimming", stream, hard)
+        report["trimmed"] += int(redis.xtrim(stream, maxlen=int(hard), approximate=APPROXIMATE) or 0)
+        report["hard"] = True
+    return report
+
+
+def trim_streams(redis, policies: dict[str, dict] | None = None, now_ms: int | None = None) -> list[dict]:
+    policies = load_policies() if policies is None else policies
+    out = []
+    for stream, policy in policies.items():
+        try:
+            out.append(trim_stream(redis, stream, policy, now_ms=now_ms))
+        except Exception:
+            logger.exception("trim failed for %s", stream)
+    return out
+
+
+def trim_loop_once(redis, owner: str, interval_s: float, policies: dict[str, dict] | None = None) -> list[dict] | None:
+    """Run ``trim_streams`` if this process holds (or acquires) the leader lock."""
+    ttl_ms = max(1000, int(interval_s * 2000))
+    try:
+        if not redis.set(LEADER_KEY, owner, nx=True, px=ttl_ms):
+            if redis.get(LEADER_KEY) != owner:
+                return None
+            redis.pexpire(LEADER_KEY, ttl_ms)
+    except Exception:
+        return None
+    return trim_streams(redis, policies)
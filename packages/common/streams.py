@@ -0,0 +1,18 @@
+"""Redis stream helpers shared by the services."""
+
+
+def xadd_many(redis, items) -> list:
+    """XADD several ``(stream, fields)`` entries in one round trip.
+
+    Uses a non-transactional pipeline when the client supports it and falls
+    back to one XADD per entry otherwise (minimal clients/stubs).
+    """
+    items = list(items)
+    if not items:
+        return []
+    if not hasattr(redis, "pipeline"):
+        return [redis.xadd(stream, fields) for stream, fields in items]
+    pipe = redis.pipeline(transaction=False)
+    for stream, fields in items:
+        pipe.xadd(stream, fields)
+    return pipe.execute()
@@ -0,0 +1,122 @@
+"""Race-free find-or-create for contacts and open conversations.
+
+Backed by the unique indexes from migration 0011:
+- ``uq_contacts_org_wa`` on ``contacts (org_id, wa_id)``
+- ``uq_conversations_open`` on ``conversations (org_id, contact_id, channel_id) WHERE state = 'open'``
+
+On PostgreSQL and SQLite each entity resolves with a single
+``INSERT ... ON CONFLICT DO UPDATE ... RETURNING id`` (the update is a no-op
+on the conflict key; ``DO NOTHING`` would return no row for an existing
+entity and need a second SELECT). Concurrent replicas converge on the same
+row instead of creating duplicates. Contacts created with only a phone (the
+contacts API) get their ``wa_id`` backfilled when the upsert had to insert
+(first inbound message from that sender): the new row is swapped for the
+phone-only contact, so no twin is left behind and the hot path stays at one
+statement.
+
+Models without the unique index (e.g. sqlite-friendly test models) and other
+dialects fall back to the classic find-then-insert.
+"""
+import uuid
+
+from sqlalchemy import delete, or_, select, text, update
+
+CONTACT_INDEX = "uq_contacts_org_wa"
+OPEN_CONVERSATION_INDEX = "uq_conversations_open"
+
+
+def dialect_insert(db):
+    name = db.get_bind().dialect.name
+    if name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+
+def _has_index(model, name: str) -> bool:
+    return any(ix.name == name for ix in getattr(model.__table__, "indexes", ()))
+
+
+def _claim_phone_contact(db, tbl, org_id: str, wa_id: str, phone: str | None, created_id: str) -> str:
+    """Swap a just-created contact for a phone-only contact matching the sender, if there is one.
+
+    Only called when the upsert inserted a row (the first message from this
+    ``wa_id``), so senders that already have a contact pay one statement.
+    """
+    phones = list(dict.fromkeys(p for p in (wa_id, phone) if p))
+    found = db.execute(
+        select(tbl.c.id)
+        .where(tbl.c.org_id == str(org_id))
+        .where(tbl.c.phone.in_(phones))
+        .where(or_(tbl.c.wa_id.is_(None), tbl.c.wa_id == ""))
+        .limit(1)
+    ).scalar()
+    if found is None:
+        return created_id
+    # the new row is uncommitted and unreferenced; concurrent upserts of this
+    # wa_id wait on it and then conflict with the claimed contact instead
+    db.execute(delete(tbl).where(tbl.c.id == created_id).execution_options(synchronize_session=False))
+    db.execute(update(tbl).where(tbl.c.id == found).values(wa_id=wa_id).execution_options(synchronize_session=False))
+    return found
+
+
+def upsert_contact(db, model, org_id: str, wa_id: str, phone: str | None = None) -> str:
+    """Return the id of the org's contact with ``wa_id`` (or, failing that, ``phone``), creating it if needed."""
+    tbl = model.__table__
+    insert = dialect_insert(db) if _has_index(model, CONTACT_INDEX) else None
+    if insert is not None and wa_id:
+        new_id = str(uuid.uuid4())
+        stmt = insert(tbl).values(
+            id=new_id, org_id=str(org_id), wa_id=wa_id, phone=phone or wa_id, name=None, attributes={},
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tbl.c.org_id, tbl.c.wa_id],
+            set_={"wa_id": stmt.excluded.wa_id},
+        ).returning(tbl.c.id)
+        contact_id = db.execute(stmt).scalar_one()
+        if contact_id != new_id:
+            return contact_id
+        return _claim_phone_contact(db, tbl, org_id, wa_id, phone, new_id)
+
+    ct = db.execute(
+        select(model).where(model.org_id == str(org_id)).where((model.wa_id == wa_id) | (model.phone == wa_id)).limit(1)
+    ).scalars().first()
+    if ct is None:
+        ct = model(id=str(uuid.uuid4()), org_id=str(org_id), wa_id=wa_id, phone=phone or wa_id, name=None, attributes={})
+        db.add(ct)
+        db.flush()
+    return ct.id
+
+
+def upsert_open_conversation(db, model, org_id: str, contact_id: str, channel_id: str) -> str:
+    """Return the id of the open conversation for contact+channel, opening one if needed."""
+    tbl = model.__table__
+    insert = dialect_insert(db) if _has_index(model, OPEN_CONVERSATION_INDEX) else None
+    if insert is not None:
+        stmt = insert(tbl).values(
+            id=str(uuid.uuid4()), org_id=str(org_id), contact_id=contact_id, channel_id=str(channel_id), state="open", assignee=None,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tbl.c.org_id, tbl.c.contact_id, tbl.c.channel_id],
+            # literal predicate: PostgreSQL infers partial indexes only from constants
+            index_where=text("state = 'open'"),
+            set_={"state": stmt.excluded.state},
+        ).returning(tbl.c.id)
+        return db.execute(stmt).scalar_one()
+
+    conv = db.execute(
+        select(model)
+        .where(model.org_id == str(org_id))
+        .where(model.contact_id == contact_id)
+        .where(model.channel_id == str(channel_id))
+        .where(model.state == "open")
+        .limit(1)
+    ).scalars().first()
+    if conv is None:
+        conv = model(id=str(uuid.uuid4()), org_id=str(org_id), contact_id=contact_id, channel_id=str(channel_id), state="open", assignee=None)
+        db.add(conv)
+        db.flush()
+    return conv.id
@@ -0,0 +1,101 @@
+"""Batch-aware decoding of WhatsApp Cloud webhook payloads.
+
+Meta batches several ``entry[]`` / ``changes[]`` / ``messages[]`` /
+``statuses[]`` into a single POST under load. ``decode_webhook`` flattens one
+payload into normalized inbound message events and status events (plain
+dicts), each carrying the ``metadata`` of the change it came from so channel
+routing works per change.
+
+Every inbound event also carries ``payload``: a single-message webhook
+envelope (same shape Meta sends) so downstream consumers that read
+``entry[0].changes[0].value.messages[0]`` keep working unchanged.
+"""
+
+MEDIA_TYPES = {"image", "video", "audio", "document", "sticker"}
+
+
+def iter_changes(payload):
+    """Yield ``(entry, change, value)`` for every change in the payload."""
+    if not isinstance(payload, dict):
+        return
+    for entry in payload.get("entry") or []:
+        if not isinstance(entry, dict):
+            continue
+        for change in entry.get("changes") or []:
+            if not isinstance(change, dict):
+                continue
+            value = change.get("value")
+            if isinstance(value, dict):
+                yield entry, change, value
+
+
+def message_text(msg: dict) -> str | None:
+    """Best-effort text of an inbound message (text body, button/list replies, captions)."""
+    mtype = msg.get("type") or "text"
+    if mtype == "text":
+        return (msg.get("text") or {}).get("body")
+    if mtype == "button":
+        return (msg.get("button") or {}).get("text")
+    if mtype == "interactive":
+        inter = msg.get("interactive") or {}
+        reply = inter.get("button_reply") or inter.get("list_reply") or {}
+        return reply.get("title")
+    if mtype in MEDIA_TYPES:
+        return (msg.get(mtype) or {}).get("caption")
+    return None
+
+
+def _contact_for(contacts: list, wa_from: str | None) -> dict:
+    for c in contacts:
+        if isinstance(c, dict) and wa_from and c.get("wa_id") == wa_from:
+            return c
+    if len(contacts) == 1 and isinstance(contacts[0], dict):
+        return contacts[0]
+    return {}
+
+
+def decode_webhook(payload) -> tuple[list[dict], list[dict]]:
+    """Return ``(messages, statuses)`` for every message/status in the payload."""
+    messages: list[dict] = []
+    statuses: list[dict] = []
+    for entry, change, value in iter_changes(payload):
+        meta = value.get("metadata") or {}
+        pnid = meta.get("phone_number_id")
+        display = meta.get("display_phone_number")
+        contacts = [c for c in (value.get("contacts") or []) if isinstance(c, dict)]
+        for msg in value.get("messages") or []:
+            if not isinstance(msg, dict):
+                continue
+            contact = _contact_for(contacts, msg.get("from"))
+            single_value = {k: v for k, v in value.items() if k not in ("messages", "statuses", "contacts")}
+            single_value["messages"] = [msg]
+            if contact:
+                single_value["contacts"] = [contact]
+            envelope = {
+                "object": payload.get("object", "whatsapp_business_account"),
+                "entry": [{"id": entry.get("id"), "changes": [{"field": change.get("field", "messages"), "value": single_value}]}],
+            }
+            messages.append({
+                "wa_msg_id": msg.get("id"),
+                "from": msg.get("from") or contact.get("wa_id"),
+                "type": msg.get("type") or "text",
+                "text": message_text(msg),
+                "timestamp": msg.get("timestamp"),
+                "profile_name": (contact.get("profile") or {}).get("name"),
+                "phone_number_id": pnid,
+                "display_phone_number": display,
+                "payload": envelope,
+            })
+        for st in value.get("statuses") or []:
+            if not isinstance(st, dict) or not st.get("id") or not st.get("status"):
+                continue
+            statuses.append({
+                "wa_msg_id": str(st.get("id")),
+                "status": str(st.get("status")),
+                "recipient_id": st.get("recipient_id"),
+                "timestamp": st.get("timestamp"),
+                "errors": st.get("errors"),
+                "phone_number_id": pnid,
+                "display_phone_number": display,
+            })
+    return messages, statuses
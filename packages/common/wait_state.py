@@ -0,0 +1,162 @@
+"""``wait_for_reply`` state: one Redis hash per org, one compact record per contact.
+
+A wait lives in ``<FLOW_WAIT_PREFIX>:<org_id>`` under the field
+``<channel_id>:<contact>``; the value is a JSON array in ``FIELDS`` order
+(``flow_id``, ``path``, ``index``, ``resume_token``, ``expires_at``,
+``timeout_path``, ``pattern``), a fraction of the old per-key JSON object.
+
+- The engine reads a contact's wait with one ``HGET`` (``lookup``) and
+  matches the reply against ``pattern`` compiled once per pattern text
+  (``flow_cache.wait_regex``, an LRU shared with flow compilation).
+- Writes and clears go through the per-message ``EffectsBuffer`` MULTI.
+- Hash fields have no TTL: every wait gets a scheduler item with its
+  ``resume_token`` (the ``timeout_path``/next-step resume, or an ``expire``
+  item after ``FLOW_WAIT_DEFAULT_TTL_S`` when the step has no timeout). The
+  scheduler only acts on it while the token is still current and removes the
+  field; ``lookup`` also ignores records past ``expires_at`` in case the
+  scheduler lags.
+- Ops helpers (``summary``, ``cancel``) walk one org's hash with ``HSCAN``
+  instead of ``KEYS fe:wait:*``; they take a synchronous client (api-gateway).
+
+Waits written before this layout (``<FLOW_ENGINE_WAIT_PREFIX>:<org>:<channel>:<contact>``
+string keys with a TTL) are still honoured through ``legacy_prefix``.
+"""
+import json
+import os
+import time
+import uuid
+
+from packages.common.aredis import maybe_await
+from packages.common.flow_cache import wait_regex
+
+PREFIX = os.getenv("FLOW_WAIT_PREFIX", "fe:waits")
+try:
+    DEFAULT_TTL_S = int(os.getenv("FLOW_WAIT_DEFAULT_TTL_S", "3600"))
+except Exception:
+    DEFAULT_TTL_S = 3600
+
+FIELDS = ("flow_id", "path", "index", "resume_token", "expires_at", "timeout_path", "pattern")
+
+
+def org_key(org_id, prefix: str = PREFIX) -> str:
+    return f"{prefix}:{org_id}"
+
+
+def contact_field(channel_id, contact) -> str:
+    return f"{channel_id or 'wa_main'}:{contact}"
+
+
+def new_wait(flow_id, path: str, index: int, pattern=None, seconds: int = 0, timeout_path=None, now: float | None = None) -> dict:
+    now = time.time() if now is None else now
+    return {
+        "flow_id": flow_id,
+        "path": path,
+        "index": int(index),
+        "resume_token": uuid.uuid4().hex[:16],
+        "expires_at": int(now + (seconds if seconds and seconds > 0 else DEFAULT_TTL_S)),
+        "timeout_path": timeout_path or None,
+        "pattern": pattern or None,
+    }
+
+
+def encode(record: dict) -> str:
+    return json.dumps([record.get(f) for f in FIELDS], separators=(",", ":"))
+
+
+def decode(raw) -> dict | None:
+    """Record from a compact array (or a legacy JSON object); ``None`` when unreadable."""
+    try:
+        obj = json.loads(raw) if raw else None
+    except Exception:
+        return None
+    if isinstance(obj, list):
+        return dict(zip(FIELDS, obj))
+    return obj if isinstance(obj, dict) else None
+
+
+def expired(record: dict, now: float | None = None) -> bool:
+    try:
+        return bool(record.get("expires_at")) and float(record["expires_at"]) <= (time.time() if now is None else now)
+    except Exception:
+        return False
+
+
+def matches(record: dict, text: str) -> bool:
+    """Whether ``text`` satisfies the wait (no pattern: any reply does)."""
+    pattern = record.get("pattern")
+    if not pattern:
+        return True
+    rx = wait_regex(str(pattern))
+    return bool(rx and rx.search(text or ""))
+
+
+async def lookup(redis, org_id, channel_id, contact, legacy_prefix: str | None = None, now: float | None = None) -> dict | None:
+    """The contact's current wait, or ``None``; legacy records carry their key in ``legacy_key``."""
+    record = decode(await maybe_await(redis.hget(org_key(org_id), contact_field(channel_id, contact))))
+    if record is None and legacy_prefix:
+        key = f"{legacy_prefix}:{org_id}:{channel_id or 'wa_main'}:{contact}"
+        record = decode(await maybe_await(redis.get(key)))
+        if record is not None:
+            record["legacy_key"] = key
+    if record is None or expired(record, now):
+        return None
+    return record
+
+
+def expiry_item(org_id, channel_id, contact, record: dict) -> dict:
+    """Scheduler item that drops the wait at ``expires_at`` if it is still current."""
+    return {
+        "org_id": str(org_id or ""),
+        "channel_id": channel_id or "wa_main",
+        "contact_phone": str(contact or ""),
+        "resume_token": record["resume_token"],
+        "expire": "1",
+    }
+
+
+def _scan(redis, org_id, count: int = 500):
+    for field, raw in redis.hscan_iter(org_key(org_id), count=count):
+        record = decode(raw)
+        if record is not None:
+            yield field, record
+
+
+def _selected(field: str, record: dict, flow_id=None, path=None, index=None, contacts=None) -> bool:
+    if flow_id is not None and str(record.get("flow_id")) != str(flow_id):
+        return False
+    if path is not None and record.get("path") != path:
+        return False
+    if index is not None and int(record.get("index") or 0) != int(index):
+        return False
+    if contacts is not None and field.split(":", 1)[-1] not in contacts:
+        return False
+    return True
+
+
+def summary(redis, org_id, flow_id=None, now: float | None = None) -> dict:
+    """Waiting contacts per ``(flow_id, path, index)`` for one org (expired records counted apart)."""
+    now = time.time() if now is None else now
+    steps: dict[tuple, int] = {}
+    total = stale = 0
+    for field, record in _scan(redis, org_id):
+        if not _selected(field, record, flow_id=flow_id):
+            continue
+        if expired(record, now):
+            stale += 1
+            continue
+        total += 1
+        key = (record.get("flow_id"), record.get("path"), int(record.get("index") or 0))
+        steps[key] = steps.get(key, 0) + 1
+    rows = [{"flow_id": f, "path": p, "index": i, "waiting": n} for (f, p, i), n in steps.items()]
+    rows.sort(key=lambda r: (-r["waiting"], str(r["flow_id"]), str(r["path"]), r["index"]))
+    return {"org_id": str(org_id), "waiting": total, "expired": stale, "steps": rows}
+
+
+def cancel(redis, org_id, flow_id=None, path=None, index=None, contacts=None, chunk: int = 500) -> int:
+    """Drop matching waits (their pending timeouts then find a stale token); returns how many."""
+    contacts = {str(c) for c in contacts} if contacts is not None else None
+    fields = [f for f, record in _scan(redis, org_id) if _selected(f, record, flow_id, path, index, contacts)]
+    removed = 0
+    for i in range(0, len(fields), chunk):
+        removed += int(redis.hdel(org_key(org_id), *fields[i:i + chunk]) or 0)
+    return removed
@@ -8,8 +8,11 @@ from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 from redis import Redis
 from sqlalchemy import text, func, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from packages.common.db import engine, SessionLocal
+from packages.common import channel_index, conversation_cache, flow_cache, flow_interpreter, wait_state
+from packages.common.upserts import upsert_contact, upsert_open_conversation
 from packages.common.models import (
     Organization,
     User,
@@ -985,8 +988,12 @@ def create_conversation(body: ConversationCreate, user: dict = require_roles(Rol
         from uuid import uuid4 as _uuid4
         val = body.contact_id
         is_phone = bool(val and (val.isdigit() or val.startswith("+")))
-        contact = Contact(id=str(_uuid4()), org_id=org_id, wa_id=val if is_phone else None, phone=val if is_phone else None, name=None, attributes={})
-        db.add(contact)
+        if is_phone:
+            # race-free against concurrent inbound webhooks for the same number
+            contact = db.get(Contact, upsert_contact(db, Contact, org_id, val))
+        else:
+            contact = Contact(id=str(_uuid4()), org_id=org_id, wa_id=None, phone=None, name=None, attributes={})
+            db.add(contact)
         db.commit()
         db.refresh(contact)
     # Ensure channel belongs to org when channels table is available; otherwise tolerate in MVP
@@ -997,18 +1004,22 @@ def create_conversation(body: ConversationCreate, user: dict = require_roles(Rol
     except Exception:
         # channels table may not exist under sqlite test setup
         pass
-    # Create conversation
-    cid = str(uuid4())
+    # Create conversation; at most one open conversation per contact+channel (returns the existing one)
     state = body.state or "open"
-    conv = Conversation(
-        id=cid,
-        org_id=org_id,
-        contact_id=contact.id,
-        channel_id=body.channel_id,
-        state=state,
-        assignee=body.assignee,
-    )
-    db.add(conv)
+    if state == "open":
+        conv = db.get(Conversation, upsert_open_conversation(db, Conversation, org_id, contact.id, body.channel_id))
+        if body.assignee is not None:
+            conv.assignee = body.assignee
+    else:
+        conv = Conversation(
+            id=str(uuid4()),
+            org_id=org_id,
+            contact_id=contact.id,
+            channel_id=body.channel_id,
+            state=state,
+            assignee=body.assignee,
+        )
+        db.add(conv)
     db.commit()
     return ConversationOut(
         id=conv.id,
@@ -1075,12 +1086,23 @@ def update_conversation(conv_id: str, body: ConversationUpdate, user: dict = req
     conv = _load_conv_for_org(db, conv_id, user.get("org_id"))
     if not conv:
         raise HTTPException(status_code=404, detail="conversation not found")
+    state_changed = body.state is not None and body.state != conv.state
     if body.state is not None:
         conv.state = body.state
     if body.assignee is not None:
         conv.assignee = body.assignee
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="contact already has an open conversation on this channel")
     db.refresh(conv)
+    if state_changed:
+        # inbound/outbound workers must stop routing to a closed conversation
+        try:
+            conversation_cache.invalidate_conversation(redis, conv.id)
+        except Exception:
+            pass
     try:
         _audit(db, user, "conversation.updated", "conversation", conv.id, {"state": conv.state, "assignee": conv.assignee})
     except Exception:
@@ -2212,6 +2234,17 @@ def _ensure_unique_channel(db: Session, org_id: str, phone_number: str | None, p
             raise HTTPException(status_code=409, detail="phone_number_id-already-in-use")
 
 
+def _sync_channel_index(ch, previous: dict | None = None, deleted: bool = False) -> None:
+    # Keep the webhook receiver's phone_number_id -> channel routing hash current (best-effort)
+    try:
+        if deleted:
+            channel_index.unindex_channel(redis, ch)
+        else:
+            channel_index.index_channel(redis, ch, previous=previous)
+    except Exception:
+        pass
+
+
 @app.post("/api/channels", response_model=ChannelOut)
 def create_channel(body: ChannelCreate, user: dict = require_roles(Role.admin), db: Session = Depends(lambda: SessionLocal())):
     ch_id = str(uuid4())
@@ -2230,6 +2263,7 @@ def create_channel(body: ChannelCreate, user: dict = require_roles(Role.admin),
     )
     db.add(ch)
     db.commit()
+    _sync_channel_index(ch)
     try:
         _audit(db, user, "channel.created", "channel", ch.id, {"type": ch.type, "mode": ch.mode, "phone_number": ch.phone_number})
     except Exception:
@@ -2271,6 +2305,7 @@ def update_channel(ch_id: str, body: ChannelUpdate, user: dict = require_roles(R
     phone_number = body.phone_number if body.phone_number is not None else ch.phone_number
     pnid_final = pnid if pnid is not None else _get_pnid(ch.credentials)
     _ensure_unique_channel(db, user.get("org_id"), phone_number, pnid_final, exclude_id=ch.id)
+    previous_routes = channel_index.route_fields(ch)
     if body.type is not None:
         ch.type = body.type
     if body.mode is not None:
@@ -2295,6 +2330,7 @@ def update_channel(ch_id: str, body: ChannelUpdate, user: dict = require_roles(R
             ch.credentials = body.credentials
     db.commit()
     db.refresh(ch)
+    _sync_channel_index(ch, previous=previous_routes)
     try:
         _audit(db, user, "channel.updated", "channel", ch.id, {"status": ch.status, "phone_number": ch.phone_number})
     except Exception:
@@ -2307,8 +2343,10 @@ def delete_channel(ch_id: str, user: dict = require_roles(Role.admin), db: Sessi
     ch = _load_channel_for_org(db, ch_id, user.get("org_id"))
     if not ch:
         raise HTTPException(status_code=404, detail="channel not found")
+    routes_owner = {"id": ch.id, "org_id": ch.org_id, "credentials": ch.credentials, "phone_number": ch.phone_number}
     db.delete(ch)
     db.commit()
+    _sync_channel_index(routes_owner, deleted=True)
     try:
         _audit(db, user, "channel.deleted", "channel", ch_id, None)
     except Exception:
@@ -2561,6 +2599,11 @@ def list_flows(user: dict = require_roles(Role.admin, Role.agent, Role.owner, Ro
     return out
 
 
+def _publish_flow_change(row, op: str) -> None:
+    # Flow engines cache the compiled active flow per org; tell them to reload it
+    flow_cache.publish_change(redis, row.org_id, row.id, getattr(row, "version", None), op)
+
+
 @app.post("/api/flows", response_model=FlowOut)
 def create_flow(body: FlowCreate, user: dict = require_roles(Role.admin), db: Session = Depends(lambda: SessionLocal())):
     fid = str(uuid4())
@@ -2578,6 +2621,7 @@ def create_flow(body: FlowCreate, user: dict = require_roles(Role.admin), db: Se
         _audit(db, user, "flow.created", "flow", fid, {"name": body.name, "status": body.status or "draft"})
     except Exception:
         pass
+    _publish_flow_change(row, "created")
     return FlowOut(id=row.id, org_id=row.org_id, name=row.name, version=row.version, graph=row.graph if isinstance(row.graph, dict) else None, status=row.status, created_by=row.created_by)
 
 
@@ -2622,6 +2666,7 @@ def update_flow(flow_id: str, body: FlowUpdate, user: dict = require_roles(Role.
         _audit(db, user, "flow.updated", "flow", flow_id, {"status": r.status, "version": r.version})
     except Exception:
         pass
+    _publish_flow_change(r, "updated")
     return FlowOut(id=r.id, org_id=r.org_id, name=r.name, version=r.version, graph=r.graph if isinstance(r.graph, dict) else None, status=r.status, created_by=r.created_by)
 
 
@@ -2636,8 +2681,74 @@ def delete_flow(flow_id: str, user: dict = require_roles(Role.admin), db: Sessio
         _audit(db, user, "flow.deleted", "flow", flow_id, None)
     except Exception:
         pass
+    _publish_flow_change(r, "deleted")
     return {"ok": True}
 
+
+class FlowSimulateBody(BaseModel):
+    flow_id: str | None = None  # a stored flow of the caller's org...
+    graph: dict | None = None  # ...or an unsaved graph
+    text: str = ""
+    intent: str | None = None  # defaults to the flow's "default" mapping
+    attributes: dict | None = None
+    contact: str = "simulated"  # seeds A/B splits
+    path: str | None = None
+    index: int = 0
+    max_steps: int | None = None
+    max_ms: float | None = None
+    max_outbound: int | None = None
+
+
+@app.post("/internal/flows/simulate")
+def simulate_flow(body: FlowSimulateBody, user: dict = require_roles(Role.admin, Role.owner), db: Session = Depends(lambda: SessionLocal())):
+    """Dry run: what one inbound message would do, and what it costs, without sending anything."""
+    org_id = user.get("org_id")
+    flow_id, version, graph = None, None, body.graph
+    if body.flow_id:
+        r = _load_flow_for_org(db, body.flow_id, org_id)
+        if not r:
+            raise HTTPException(status_code=404, detail="flow not found")
+        flow_id, version, graph = r.id, r.version, r.graph
+    compiled = flow_cache.compile_flow(flow_id, org_id, version, graph)
+    if compiled is None:
+        raise HTTPException(status_code=400, detail="flow_id or a graph object is required")
+    intent = body.intent or "default"
+    path = body.path or flow_interpreter.entry_path(compiled, intent)
+    limits = flow_interpreter.budget(body.max_steps, body.max_ms, body.max_outbound)
+    result = flow_interpreter.run(
+        compiled, path, body.index,
+        intent=intent, text=body.text, attributes=body.attributes or {}, contact_key=body.contact, limits=limits,
+    )
+    return {"flow_id": flow_id, "start": {"path": path, "index": body.index}, "budget": limits, **result, "cost": flow_interpreter.cost(result)}
+
+
+@app.get("/internal/flows/waits")
+def flow_waits(flow_id: str | None = None, user: dict = require_roles(Role.admin, Role.owner)):
+    """Contacts waiting for a reply, grouped by flow step (one HSCAN of the org's wait hash)."""
+    try:
+        return wait_state.summary(redis, user.get("org_id"), flow_id=flow_id)
+    except Exception:
+        raise HTTPException(status_code=503, detail="wait state unavailable")
+
+
+class FlowWaitsCancelBody(BaseModel):
+    flow_id: str | None = None
+    path: str | None = None
+    index: int | None = None
+    contacts: list[str] | None = None  # phones / wa_ids
+
+
+@app.post("/internal/flows/waits/cancel")
+def cancel_flow_waits(body: FlowWaitsCancelBody, user: dict = require_roles(Role.admin, Role.owner)):
+    """Drop matching waits; their contacts get normal replies again and pending timeouts are skipped."""
+    if not body.flow_id and not body.contacts:
+        raise HTTPException(status_code=400, detail="flow_id or contacts is required")
+    try:
+        cancelled = wait_state.cancel(redis, user.get("org_id"), flow_id=body.flow_id, path=body.path, index=body.index, contacts=body.contacts)
+    except Exception:
+        raise HTTPException(status_code=503, detail="wait state unavailable")
+    return {"cancelled": cancelled}
+
 # ----------------------------------------------------------------------------
 # Contacts (CRUD + simple search) - mirrors services/contacts for convenience
 
@@ -2706,7 +2817,11 @@ def create_contact(payload: ContactCreate, user: dict = require_roles(Role.admin
         timezone=payload.timezone,
     )
     db.add(contact)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="contact with this wa_id already exists")
     db.refresh(contact)
     return ContactOut(
         id=contact.id,
@@ -2783,7 +2898,11 @@ def update_contact(contact_id: str, payload: ContactUpdate, user: dict = require
         data = payload.dict(exclude_unset=True)
     for field, value in data.items():
         setattr(c, field, value)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="contact with this wa_id already exists")
     db.refresh(c)
     return ContactOut(
         id=c.id,
@@ -29,8 +29,7 @@ def make_token(role: str, org_id: str = "o1", sub: str = "u1") -> str:
     return jwt.encode({"sub": sub, "role": role, "org_id": org_id}, secret, algorithm="HS256")
 
 
-@pytest.fixture
-def client(tmp_path) -> TestClient:
+def _load_main(tmp_path):
     os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'test.db').as_posix()}"
     os.environ["JWT_SECRET"] = "testsecret"
 
@@ -39,6 +38,12 @@ def client(tmp_path) -> TestClient:
     spec = importlib.util.spec_from_file_location("api_gateway_main", module_path)
     main = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(main)
+    return main
+
+
+@pytest.fixture
+def client(tmp_path) -> TestClient:
+    main = _load_main(tmp_path)
 
     # Swap Flow model for sqlite-friendly version and create table
     main.DBFlow = FlowModel  # type: ignore
@@ -93,3 +98,99 @@ def test_flows_crud_and_activation(client: TestClient):
     r = client.delete(f"/api/flows/{f2['id']}", headers={"Authorization": f"Bearer {admin}"})
     assert r.status_code == 200
 
+
+
+def test_simulate_flow_reports_outputs_and_cost(client: TestClient):
+    admin = make_token("admin", org_id="o1", sub="user-1")
+    graph = {
+        "nodes": [{"id": "n1", "type": "intent", "map": {"default": "p"}}],
+        "paths": {
+            "p": [
+                {"type": "condition", "if": {"var": "attributes.vip", "op": "eq", "value": True}, "then": "vip"},
+                {"type": "action", "action": "send_text", "text": "hola"},
+                {"type": "wait", "seconds": 60},
+            ],
+            "vip": [{"type": "action", "action": "send_text", "text": "hola vip"}],
+        },
+    }
+    r = client.post("/api/flows", headers={"Authorization": f"Bearer {admin}"}, json={"name": "F", "graph": graph})
+    flow_id = r.json()["id"]
+
+    r = client.post("/internal/flows/simulate", headers={"Authorization": f"Bearer {admin}"}, json={"flow_id": flow_id, "text": "hi"})
+    assert r.status_code == 200
+    body = r.json()
+    assert [o["text"] for o in body["outputs"]] == ["hola"]
+    assert (body["status"], body["path"], body["index"]) == ("waiting", "p", 3)
+    assert body["cost"]["steps"] == 3 and body["cost"]["scheduled"] == 1
+
+    # unsaved graph, with attributes
+    r = client.post("/internal/flows/simulate", headers={"Authorization": f"Bearer {admin}"}, json={"graph": graph, "attributes": {"vip": True}})
+    assert [o["text"] for o in r.json()["outputs"]] == ["hola vip"]
+
+    other = make_token("admin", org_id="o2", sub="user-2")
+    r = client.post("/internal/flows/simulate", headers={"Authorization": f"Bearer {other}"}, json={"flow_id": flow_id})
+    assert r.status_code == 404
+    r = client.post("/internal/flows/simulate", json={"graph": graph})
+    assert r.status_code == 401
+
+
+def test_simulate_clamps_caller_budgets_and_trace(client: TestClient):
+    from packages.common import flow_interpreter
+
+    admin = make_token("admin", org_id="o1", sub="user-1")
+    graph = {"nodes": [{"id": "n1", "type": "intent", "map": {"default": "loop"}}], "paths": {"loop": [{"type": "goto", "path": "loop"}]}}
+    r = client.post(
+        "/internal/flows/simulate", headers={"Authorization": f"Bearer {admin}"},
+        json={"graph": graph, "max_steps": 10**9, "max_ms": 1e9, "max_outbound": 10**6},
+    )
+    assert r.status_code == 200
+    body = r.json()
+    assert body["budget"] == {
+        "max_steps": flow_interpreter.STEPS_CEILING,
+        "max_ms": flow_interpreter.MS_CEILING,
+        "max_outbound": flow_interpreter.OUTBOUND_CEILING,
+    }
+    assert body["status"] == "running" and body["stop"] in ("budget_steps", "budget_time")
+    assert body["steps"] <= flow_interpreter.STEPS_CEILING
+    assert len(body["trace"]) <= flow_interpreter.TRACE_LIMIT
+
+
+class WaitHashRedis:
+    def __init__(self):
+        self.hashes = {}
+
+    def hscan_iter(self, key, count=None):
+        return iter(list(self.hashes.get(key, {}).items()))
+
+    def hdel(self, key, *fields):
+        h = self.hashes.get(key, {})
+        return sum(1 for f in fields if h.pop(f, None) is not None)
+
+
+def test_flow_waits_summary_and_cancel(tmp_path):
+    from packages.common import wait_state
+
+    main = _load_main(tmp_path)
+    fake = WaitHashRedis()
+    main.redis = fake
+    now = 1_900_000_000
+    for phone, (flow, path, index) in {"1": ("f1", "p", 2), "2": ("f1", "p", 2), "3": ("f1", "q", 0), "4": ("f2", "p", 1)}.items():
+        fake.hashes.setdefault("fe:waits:o1", {})[f"wa_main:{phone}"] = wait_state.encode(wait_state.new_wait(flow, path, index, now=now))
+    fake.hashes["fe:waits:o2"] = {"wa_main:9": wait_state.encode(wait_state.new_wait("f9", "p", 0, now=now))}
+    admin = {"Authorization": f"Bearer {make_token('admin', org_id='o1')}"}
+
+    with TestClient(main.app) as c:
+        r = c.get("/internal/flows/waits", headers=admin, params={"flow_id": "f1"})
+        assert r.status_code == 200
+        body = r.json()
+        assert body["waiting"] == 3
+        assert body["steps"][0] == {"flow_id": "f1", "path": "p", "index": 2, "waiting": 2}
+
+        assert c.post("/internal/flows/waits/cancel", headers=admin, json={}).status_code == 400
+        r = c.post("/internal/flows/waits/cancel", headers=admin, json={"flow_id": "f1", "path": "p", "index": 2})
+        assert r.json() == {"cancelled": 2}
+        r = c.post("/internal/flows/waits/cancel", headers=admin, json={"contacts": ["4"]})
+        assert r.json() == {"cancelled": 1}
+        assert set(fake.hashes["fe:waits:o1"]) == {"wa_main:3"}
+        # other orgs are untouched
+        assert "wa_main:9" in fake.hashes["fe:waits:o2"]
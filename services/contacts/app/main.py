@@ -5,6 +5,7 @@ from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from uuid import uuid4
 
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from packages.common.db import SessionLocal, engine
@@ -131,7 +132,11 @@ def create_contact(payload: ContactCreate, db: Session = Depends(get_db), user:
         timezone=payload.timezone,
     )
     db.add(contact)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="contact with this wa_id already exists")
     db.refresh(contact)
     return contact
 
@@ -168,7 +173,11 @@ def update_contact(contact_id: str, payload: ContactUpdate, db: Session = Depend
         data = payload.dict(exclude_unset=True)
     for field, value in data.items():
         setattr(contact, field, value)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="contact with this wa_id already exists")
     db.refresh(contact)
     return contact
 
@@ -0,0 +1,392 @@
+"""End-to-end throughput benchmark for one flow-engine worker.
+
+Seeds ``--orgs`` orgs (each with ``--contacts`` contacts and an active flow
+using an intent node, ``set_attribute``, a ``webhook`` step, a delay and
+``wait_for_reply``), runs the real worker loops (consumer, scheduler, run
+flush) in-process against SQLite and a Redis stand-in with the NLP service
+stubbed at the HTTP layer, pumps synthetic inbound events into
+``nf:incoming`` and prints one JSON document with:
+
+- sustained ``msgs_per_s`` (measured messages / time from the first XADD to
+  the last first reply);
+- ``e2e_ms``: latency from the XADD to ``nf:incoming`` to the message's first
+  ``nf:outbox`` entry (p50/p95/p99/max);
+- ``scheduler_lag_ms``: how late the delayed step's reply arrived versus its
+  due time (includes handling the resumed message);
+- DB queries and Redis round trips per message.
+
+Usage (from repo root):
+  python services/flow-engine/bench/bench_engine.py
+  python services/flow-engine/bench/bench_engine.py -n 5000 --orgs 20 --rate 500 --out before.json
+  python services/flow-engine/bench/bench_engine.py --redis-url redis://localhost:6379/15
+
+Redis backend: ``--redis-url`` (real server, the DB is flushed), else
+``fakeredis`` with Lua support (``pip install "fakeredis[lua]"``).
+"""
+import argparse
+import asyncio
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SERVICE_ROOT = Path(__file__).resolve().parents[1]
+REPO_ROOT = SERVICE_ROOT.parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+NLP_STUB_URL = "http://nlp-stub"
+_SEQ = re.compile(r"#(\d+)$")
+
+
+def flow_graph(delay_s: int, wait_timeout_s: int) -> dict:
+    main = [
+        {"type": "action", "action": "send_text", "text": "hola"},
+        {"type": "set_attribute", "key": "bench_seen", "value": True},
+        {"type": "action", "action": "webhook", "data": {"stage": "start"}},
+    ]
+    if delay_s > 0:
+        main += [{"type": "wait", "seconds": delay_s}, {"type": "action", "action": "send_text", "text": "seguimos"}]
+    main += [
+        {"type": "wait_for_reply", "pattern": "^(hola|precio)", "seconds": wait_timeout_s},
+        {"type": "action", "action": "send_text", "text": "gracias"},
+    ]
+    return {
+        "nodes": [{"id": "n1", "type": "intent", "map": {"pricing": "p_pricing", "default": "p_main"}}],
+        "paths": {
+            "p_main": main,
+            "p_pricing": [{"type": "action", "action": "send_text", "text": "precio"}, {"type": "goto", "path": "p_main", "index": 2}],
+        },
+    }
+
+
+class _CountingPipe:
+    def __init__(self, parent, pipe):
+        self._parent = parent
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        attr = getattr(self.pipe, name)
+        if name != "execute":
+            return attr
+
+        async def _execute(*args, **kwargs):
+            self._parent.calls += 1
+            return await attr(*args, **kwargs)
+        return _execute
+
+
+class _CountingScript:
+    def __init__(self, parent, script):
+        self._parent = parent
+        self._script = script
+
+    async def __call__(self, keys=None, args=None, client=None):
+        if isinstance(client, _CountingPipe):
+            # queued on a pipeline: counted by its execute()
+            return await self._script(keys=keys, args=args, client=client.pipe)
+        self._parent.calls += 1
+        return await self._script(keys=keys, args=args, client=client)
+
+
+class CountingRedis:
+    """Async proxy that counts round trips (a pipeline execute or a script call counts once)."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = 0
+
+    def pipeline(self, *args, **kwargs):
+        return _CountingPipe(self, self.inner.pipeline(*args, **kwargs))
+
+    def register_script(self, source):
+        return _CountingScript(self, self.inner.register_script(source))
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if not callable(attr):
+            return attr
+
+        async def _call(*args, **kwargs):
+            self.calls += 1
+            return await attr(*args, **kwargs)
+        return _call
+
+
+async def _make_redis(url: str | None):
+    if url:
+        from packages.common import aredis
+        r = aredis.from_url(url)
+        await r.flushdb()
+        return r, "redis"
+    try:
+        import fakeredis
+        import lupa  # noqa: F401  (scheduler, run store and effects flush use Lua)
+    except ImportError:
+        raise SystemExit('bench_engine needs --redis-url or fakeredis with Lua support: pip install "fakeredis[lua]"')
+    return fakeredis.FakeAsyncRedis(decode_responses=True), "fakeredis"
+
+
+def _nlp_transport(latency_ms: float):
+    import httpx
+
+    def label(text: str) -> str:
+        return "pricing" if "precio" in text.lower() else "greeting"
+
+    async def handler(request):
+        if latency_ms > 0:
+            await asyncio.sleep(latency_ms / 1000.0)
+        body = json.loads(request.content or b"{}")
+        if request.url.path.endswith(":batch"):
+            return httpx.Response(200, json={"results": [{"primary_intent": label(t)} for t in body.get("texts") or []]})
+        return httpx.Response(200, json={"primary_intent": label(body.get("text") or "")})
+
+    return httpx.MockTransport(handler)
+
+
+def _load_engine(db_path: Path, args):
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path.as_posix()}"
+    os.environ["NLP_SERVICE_URL"] = NLP_STUB_URL
+    os.environ.setdefault("FLOW_ENGINE_CONCURRENCY", str(args.concurrency))
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+    spec = importlib.util.spec_from_file_location("flow_engine_bench_worker", SERVICE_ROOT / "worker" / "engine_worker.py")
+    engine = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(engine)
+    return engine, common_db
+
+
+def _seed(common_db, orgs: int, contacts: int, graph: dict) -> None:
+    from packages.common.models import Base, Contact, Flow
+    tables = ("flows", "contacts", "flow_runs")
+    Base.metadata.create_all(bind=common_db.engine, tables=[Base.metadata.tables[t] for t in tables])
+    with common_db.SessionLocal() as s:
+        for o in range(orgs):
+            s.add(Flow(id=f"flow-bench-{o}", org_id=f"org-bench-{o}", name="bench", version=1, graph=graph, status="active", created_by="bench"))
+            for c in range(contacts):
+                phone = _phone(o, c)
+                s.add(Contact(id=f"ct-bench-{o}-{c}", org_id=f"org-bench-{o}", wa_id=phone, phone=phone, attributes={}))
+        s.commit()
+
+
+def _phone(org: int, contact: int) -> str:
+    return f"52155{org:03d}{contact:05d}"
+
+
+def _event(seq: int, orgs: int, contacts: int) -> dict:
+    org = seq % orgs
+    phone = _phone(org, (seq // orgs) % contacts)
+    text = f"{'precio' if seq % 10 == 0 else 'hola'} #{seq}"
+    payload = {"contact": {"phone": phone}, "text": text}
+    return {"payload": json.dumps(payload), "org_id": f"org-bench-{org}", "channel_id": "wa_main", "contact_phone": phone}
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def _summary(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50": round(statistics.median(values), 3) if values else 0.0,
+        "p95": round(_percentile(values, 95), 3),
+        "p99": round(_percentile(values, 99), 3),
+        "max": round(max(values), 3) if values else 0.0,
+    }
+
+
+class Collector:
+    """Tails ``nf:outbox`` (outside the group, not counted) and timestamps replies per message."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.last_id = "0-0"
+        self.first: dict[int, float] = {}
+        self.followup: dict[int, float] = {}
+        self.outbox = 0
+
+    async def run(self):
+        while True:
+            reply = await self.redis.xread({"nf:outbox": self.last_id}, count=1000)
+            now = time.perf_counter()
+            entries = reply[0][1] if reply else []
+            for msg_id, fields in entries:
+                self.last_id = msg_id
+                self.outbox += 1
+                m = _SEQ.search(fields.get("orig_text") or "")
+                if not m:
+                    continue
+                seq = int(m.group(1))
+                self.first.setdefault(seq, now)
+                if fields.get("text") == "seguimos":
+                    self.followup.setdefault(seq, now)
+            if not entries:
+                await asyncio.sleep(0.002)
+
+
+async def _pump(redis, seqs, orgs: int, contacts: int, rate: float, sent: dict) -> None:
+    started = time.perf_counter()
+    for n, seq in enumerate(seqs):
+        if rate > 0:
+            ahead = started + n / rate - time.perf_counter()
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+        sent[seq] = time.perf_counter()
+        await redis.xadd("nf:incoming", _event(seq, orgs, contacts))
+        if rate <= 0 and n % 50 == 49:
+            # let the worker run while pumping flat out
+            await asyncio.sleep(0)
+
+
+async def _wait_for(predicate, timeout_s: float) -> bool:
+    deadline = time.perf_counter() + timeout_s
+    while time.perf_counter() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+async def _settle(count, quiet_s: float, timeout_s: float) -> None:
+    """Wait until ``count()`` has not grown for ``quiet_s`` (or ``timeout_s`` passed)."""
+    deadline = time.perf_counter() + timeout_s
+    last, changed = count(), time.perf_counter()
+    while time.perf_counter() < deadline and time.perf_counter() - changed < quiet_s:
+        await asyncio.sleep(0.05)
+        if count() != last:
+            last, changed = count(), time.perf_counter()
+
+
+async def run_bench(args, engine, common_db) -> dict:
+    from sqlalchemy import event
+
+    backend, backend_name = await _make_redis(args.redis_url)
+    counted = CountingRedis(backend)
+    engine.redis = counted
+    import httpx
+    engine._NLP_CLIENT = httpx.AsyncClient(transport=_nlp_transport(args.nlp_latency_ms))
+    engine._NLP_CLIENT_LOOP = asyncio.get_running_loop()
+    db_queries = {"n": 0}
+    event.listen(common_db.get_engine(), "before_cursor_execute", lambda *a, **k: db_queries.__setitem__("n", db_queries["n"] + 1))
+
+    collector = Collector(backend)
+    tasks = [asyncio.create_task(engine.loop()), asyncio.create_task(engine.scheduler_loop()), asyncio.create_task(collector.run())]
+    if engine._RUN_STORE_ENABLED and engine.DBFlowRun:
+        tasks.append(asyncio.create_task(engine.run_flush_loop()))
+    sent: dict[int, float] = {}
+    try:
+        await asyncio.sleep(0.05)
+        warm = range(args.warmup)
+        await _pump(backend, warm, args.orgs, args.contacts, 0, sent)
+        await _wait_for(lambda: all(s in collector.first for s in warm), args.settle_s)
+
+        measured = range(args.warmup, args.warmup + args.messages)
+        counted.calls = 0
+        db_queries["n"] = 0
+        t0 = time.perf_counter()
+        await _pump(backend, measured, args.orgs, args.contacts, args.rate, sent)
+        pumped_s = time.perf_counter() - t0
+        await _wait_for(lambda: all(s in collector.first for s in measured), args.settle_s)
+        done = [s for s in measured if s in collector.first]
+        last_reply = max((collector.first[s] for s in done), default=time.perf_counter())
+        redis_calls, queries = counted.calls, db_queries["n"]
+        if args.delay_s > 0:
+            # delayed replies of the last messages (a contact's next message may
+            # satisfy its wait_for_reply instead, so not every message gets one)
+            await _settle(lambda: len(collector.followup), args.delay_s + 1.0, args.settle_s)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await engine.close_nlp_client()
+
+    e2e = [(collector.first[s] - sent[s]) * 1000.0 for s in done]
+    # the first reply and the delayed resume are written in the same flush
+    lag = [max(0.0, (collector.followup[s] - collector.first[s] - args.delay_s) * 1000.0) for s in measured if s in collector.followup and s in collector.first]
+    span = last_reply - t0
+    n = max(1, len(done))
+    return {
+        "redis_backend": backend_name,
+        "messages": args.messages,
+        "completed": len(done),
+        "missing": args.messages - len(done),
+        "pump_s": round(pumped_s, 3),
+        "elapsed_s": round(span, 3),
+        "msgs_per_s": round(len(done) / span, 1) if span > 0 else None,
+        "e2e_ms": _summary(e2e),
+        "scheduler_lag_ms": _summary(lag),
+        "db_queries_per_message": round(queries / n, 2),
+        "redis_roundtrips_per_message": round(redis_calls / n, 2),
+        "outbox_entries": collector.outbox,
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main(argv=None) -> dict:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-n", "--messages", type=int, default=1000, help="measured inbound messages")
+    ap.add_argument("--warmup", type=int, default=50)
+    ap.add_argument("--orgs", type=int, default=10)
+    ap.add_argument("--contacts", type=int, default=100, help="contacts per org")
+    ap.add_argument("--rate", type=float, default=0, help="target inbound msgs/s (0 = as fast as possible)")
+    ap.add_argument("--concurrency", type=int, default=16, help="FLOW_ENGINE_CONCURRENCY unless already set")
+    ap.add_argument("--delay-s", type=int, default=1, help="seconds of the flow's delay step (0 drops it)")
+    ap.add_argument("--wait-timeout-s", type=int, default=30, help="wait_for_reply timeout")
+    ap.add_argument("--nlp-latency-ms", type=float, default=5.0, help="latency of the stubbed NLP service")
+    ap.add_argument("--settle-s", type=float, default=30.0, help="max wait for outstanding replies")
+    ap.add_argument("--redis-url", default=None, help="use a real Redis instead of fakeredis")
+    ap.add_argument("--out", default=None, help="also write the JSON report to this file")
+    args = ap.parse_args(argv)
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, common_db = _load_engine(Path(tmp) / "bench.db", args)
+        _seed(common_db, args.orgs, args.contacts, flow_graph(args.delay_s, args.wait_timeout_s))
+        result = asyncio.run(run_bench(args, engine, common_db))
+        common_db.get_engine().dispose()
+
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "database": "sqlite",
+        "config": {
+            "orgs": args.orgs,
+            "contacts_per_org": args.contacts,
+            "rate": args.rate,
+            "concurrency": int(os.environ.get("FLOW_ENGINE_CONCURRENCY", args.concurrency)),
+            "delay_s": args.delay_s,
+            "nlp_latency_ms": args.nlp_latency_ms,
+        },
+        **result,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import importlib.util
+from pathlib import Path
+
+from packages.common import aredis
+
+root = Path(__file__).resolve().parents[2].parent
+module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+spec = importlib.util.spec_from_file_location("engine_worker_async_redis", str(module_path))
+engine_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_worker)
+
+
+class AsyncStreamRedis:
+    """Coroutine-returning fake in the shape of ``redis.asyncio.Redis``."""
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.acks = []
+        self.reads = []
+        self.groups = []
+
+    async def xgroup_create(self, stream, group, id="$", mkstream=False):
+        self.groups.append((stream, group, mkstream))
+        return True
+
+    async def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        self.reads.append((group, consumer, dict(streams), count, block))
+        if not self.entries:
+            await asyncio.sleep(block / 1000.0 if block else 0)
+            return []
+        batch, self.entries = self.entries[:count], self.entries[count:]
+        return [["nf:incoming", batch]]
+
+    async def xack(self, stream, group, *ids):
+        self.acks.extend(ids)
+        return len(ids)
+
+    async def xadd(self, stream, fields):
+        return "99-0"
+
+
+def test_maybe_await_accepts_sync_and_async_results():
+    async def coro():
+        return 7
+
+    assert asyncio.run(aredis.maybe_await(3)) == 3
+    assert asyncio.run(aredis.maybe_await(coro())) == 7
+
+
+def test_ensure_group_swallows_busygroup():
+    class Busy:
+        def xgroup_create(self, *a, **k):
+            raise Exception("BUSYGROUP Consumer Group name already exists")
+
+    assert asyncio.run(aredis.ensure_group(Busy(), "s", "g")) is False
+
+
+def test_engine_loop_runs_on_async_client(monkeypatch):
+    entries = [(f"{i}-0", {"payload": json.dumps({"contact": {"phone": f"5{i}"}, "text": "hola"})}) for i in range(5)]
+    r = AsyncStreamRedis(entries)
+    monkeypatch.setattr(engine_worker, "redis", r)
+    monkeypatch.setattr(engine_worker, "ENGINE_READ_COUNT", 3)
+    monkeypatch.setattr(engine_worker, "ENGINE_BLOCK_MS", 20)
+    handled = []
+
+    async def fake_handle(msg_id, fields):
+        handled.append(msg_id)
+        return True
+
+    monkeypatch.setattr(engine_worker, "handle_message", fake_handle)
+
+    async def run():
+        task = asyncio.create_task(engine_worker.loop())
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if len(r.acks) == 5:
+                break
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    assert sorted(handled) == sorted(r.acks) == sorted(m for m, _ in entries)
+    assert r.groups == [("nf:incoming", engine_worker.CONSUMER_GROUP, True)]
+    assert r.reads[0][2] == {"nf:incoming": ">"} and r.reads[0][3] == 3
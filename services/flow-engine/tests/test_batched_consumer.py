@@ -0,0 +1,226 @@
+import asyncio
+import json
+import importlib.util
+import time
+from pathlib import Path
+
+root = Path(__file__).resolve().parents[2].parent
+module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+spec = importlib.util.spec_from_file_location("engine_worker_batched", str(module_path))
+engine_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_worker)
+
+
+class AckRedis:
+    def __init__(self):
+        self.acks = []
+        self.added = []
+
+    def xack(self, stream, group, *ids):
+        self.acks.append(ids)
+        return len(ids)
+
+    def xadd(self, stream, fields):
+        self.added.append((stream, dict(fields)))
+        return "9-0"
+
+
+def _entry(i, phone):
+    payload = {"contact": {"phone": phone}, "text": f"m{i}"}
+    return (f"{i}-0", {"org_id": "o1", "payload": json.dumps(payload)})
+
+
+def test_same_contact_serialized_other_contacts_concurrent(monkeypatch):
+    r = AckRedis()
+    monkeypatch.setattr(engine_worker, "redis", r)
+    log = []
+    active = {"now": 0, "max": 0}
+
+    async def fake_handle(msg_id, fields):
+        phone = json.loads(fields["payload"])["contact"]["phone"]
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        log.append(("start", phone, msg_id))
+        await asyncio.sleep(0.01)
+        log.append(("end", phone, msg_id))
+        active["now"] -= 1
+        return True
+
+    monkeypatch.setattr(engine_worker, "handle_message", fake_handle)
+    entries = [_entry(i, "111" if i % 2 else "222") for i in range(6)]
+    acked = asyncio.run(engine_worker.process_entries("nf:incoming", entries, asyncio.Semaphore(4)))
+
+    assert acked == 6 and len(r.acks) == 1 and len(r.acks[0]) == 6  # one XACK for the batch
+    assert active["max"] == 2  # one in flight per contact
+    for phone in ("111", "222"):
+        seq = [(kind, mid) for kind, p, mid in log if p == phone]
+        # strictly start/end alternating, in stream order
+        assert [k for k, _ in seq] == ["start", "end"] * 3
+        mids = [mid for _, mid in seq[::2]]
+        assert mids == sorted(mids, key=lambda m: int(m.split("-")[0]))
+    assert engine_worker._KEY_LOCKS == {}
+
+
+def test_semaphore_bounds_concurrency(monkeypatch):
+    monkeypatch.setattr(engine_worker, "redis", AckRedis())
+    active = {"now": 0, "max": 0}
+
+    async def fake_handle(msg_id, fields):
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        await asyncio.sleep(0.01)
+        active["now"] -= 1
+        return True
+
+    monkeypatch.setattr(engine_worker, "handle_message", fake_handle)
+    entries = [_entry(i, f"55{i}") for i in range(10)]
+    asyncio.run(engine_worker.process_entries("nf:incoming", entries, asyncio.Semaphore(3)))
+    assert active["max"] == 3
+
+
+def test_failures_stay_pending_without_requeue_and_unparseable_entries_are_acked(monkeypatch):
+    r = AckRedis()
+    monkeypatch.setattr(engine_worker, "redis", r)
+    monkeypatch.setattr(engine_worker, "_FAILED", {})
+
+    async def failing(msg_id, fields):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(engine_worker, "handle_message", failing)
+    entries = [_entry(1, "111"), ("2-0", None)]
+    asyncio.run(engine_worker.process_entries("nf:incoming", entries))
+    # no re-XADD: the failed entry stays pending for retry_loop
+    assert r.added == []
+    assert r.acks == [("2-0",)]
+    assert list(engine_worker._FAILED) == ["1-0"]
+
+
+class PendingRedis(AckRedis):
+    """AckRedis plus a PEL: XPENDING delivery counts and XCLAIM (which bumps them)."""
+
+    def __init__(self, entries):
+        super().__init__()
+        self.entries = dict(entries)
+        self.deliveries = {msg_id: 1 for msg_id in self.entries}
+        self.claims = []
+        self.xpending_calls = 0
+
+    def xack(self, stream, group, *ids):
+        for msg_id in ids:
+            self.deliveries.pop(msg_id, None)
+        return super().xack(stream, group, *ids)
+
+    def xpending_range(self, stream, group, min, max, count, consumername=None, idle=None):
+        self.xpending_calls += 1
+        lo, hi = (tuple(int(p) for p in v.lstrip("(").split("-")) for v in (min, max))
+        rows = [
+            {"message_id": msg_id, "consumer": "engine-1", "time_since_delivered": 0, "times_delivered": n}
+            for msg_id, n in sorted(self.deliveries.items(), key=lambda kv: tuple(int(p) for p in kv[0].split("-")))
+            if lo <= tuple(int(p) for p in msg_id.split("-")) <= hi
+        ]
+        return rows[:count]
+
+    def xclaim(self, stream, group, consumer, min_idle_time, message_ids):
+        self.claims.append((min_idle_time, list(message_ids)))
+        out = []
+        for msg_id in message_ids:
+            if msg_id in self.deliveries:
+                self.deliveries[msg_id] += 1
+                out.append((msg_id, self.entries[msg_id]))
+        return out
+
+
+def test_retry_uses_delivery_count_backoff_and_dead_letters(monkeypatch):
+    msg_id, fields = _entry(1, "111")
+    r = PendingRedis([(msg_id, fields)])
+    monkeypatch.setattr(engine_worker, "redis", r)
+    monkeypatch.setattr(engine_worker, "_FAILED", {})
+    monkeypatch.setattr(engine_worker, "ENGINE_MAX_RETRIES", 2)
+    monkeypatch.setattr(engine_worker, "_RETRY_BASE_MS", 1000)
+    attempts = []
+
+    async def failing(mid, f):
+        attempts.append(mid)
+        return False
+
+    monkeypatch.setattr(engine_worker, "handle_message", failing)
+    asyncio.run(engine_worker.process_entries("nf:incoming", [(msg_id, fields)]))
+    assert attempts == ["1-0"]
+
+    # backoff not elapsed yet: nothing is claimed
+    assert asyncio.run(engine_worker.retry_once()) == 0
+    assert r.claims == []
+
+    def age(ms):
+        f, t = engine_worker._FAILED[msg_id]
+        engine_worker._FAILED[msg_id] = (f, t - ms / 1000.0)
+
+    age(1000)
+    assert asyncio.run(engine_worker.retry_once()) == 1
+    age(2000)
+    assert asyncio.run(engine_worker.retry_once()) == 1
+    # backoff doubles with the delivery count; no stream writes for the retries
+    assert r.claims == [(1000, ["1-0"]), (2000, ["1-0"])]
+    assert attempts == ["1-0"] * 3
+    assert r.added == []
+
+    # third delivery failed: past ENGINE_MAX_RETRIES it goes to the DLQ and is acked
+    asyncio.run(engine_worker.retry_once())
+    assert r.added[0][0] == "nf:incoming:dlq"
+    assert r.added[0][1]["error"] == "max-retries-exceeded" and r.added[0][1]["deliveries"] == "3"
+    assert ("1-0",) in r.acks
+    assert engine_worker._FAILED == {}
+
+
+def test_retry_success_acks_and_forgets(monkeypatch):
+    msg_id, fields = _entry(2, "222")
+    r = PendingRedis([(msg_id, fields)])
+    monkeypatch.setattr(engine_worker, "redis", r)
+    monkeypatch.setattr(engine_worker, "_FAILED", {msg_id: (fields, 0.0)})
+    monkeypatch.setattr(engine_worker, "ENGINE_MAX_RETRIES", 2)
+
+    async def ok(mid, f):
+        return True
+
+    monkeypatch.setattr(engine_worker, "handle_message", ok)
+    assert asyncio.run(engine_worker.retry_once()) == 1
+    assert r.acks == [("2-0",)]
+    assert engine_worker._FAILED == {}
+
+
+def test_retry_pass_reads_all_delivery_counts_with_one_xpending(monkeypatch):
+    entries = [_entry(n, str(100 + n)) for n in range(1, 6)]
+    r = PendingRedis(entries)
+    monkeypatch.setattr(engine_worker, "redis", r)
+    # backoff not elapsed for any of them: the pass only reads counts
+    monkeypatch.setattr(engine_worker, "_FAILED", {msg_id: (fields, time.monotonic()) for msg_id, fields in entries})
+    monkeypatch.setattr(engine_worker, "_RETRY_BASE_MS", 60_000)
+    assert asyncio.run(engine_worker.retry_once()) == 0
+    assert r.xpending_calls == 1
+    assert len(engine_worker._FAILED) == 5
+
+
+def test_retries_share_the_worker_concurrency_budget(monkeypatch):
+    entries = [_entry(n, str(300 + n)) for n in range(1, 5)]
+    r = PendingRedis(entries)
+    monkeypatch.setattr(engine_worker, "redis", r)
+    monkeypatch.setattr(engine_worker, "_FAILED", {msg_id: (fields, 0.0) for msg_id, fields in entries})
+    monkeypatch.setattr(engine_worker, "ENGINE_CONCURRENCY", 16)
+    running, peak = [0], [0]
+
+    async def slow(mid, f):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        return True
+
+    monkeypatch.setattr(engine_worker, "handle_message", slow)
+
+    async def scenario():
+        # the main loop's semaphore with one slot left
+        sem = asyncio.Semaphore(1)
+        return await engine_worker.retry_once("nf:incoming", sem)
+
+    assert asyncio.run(scenario()) == 4
+    assert peak[0] == 1
@@ -0,0 +1,28 @@
+import importlib.util
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+
+def test_bench_harness_reports_end_to_end_numbers(tmp_path):
+    # only probed here (other tests may stub ``redis`` in this process); the harness imports them
+    if not (importlib.util.find_spec("fakeredis") and importlib.util.find_spec("lupa")):
+        pytest.skip("fakeredis[lua] not installed")
+    path = Path(__file__).resolve().parents[1] / "bench" / "bench_engine.py"
+    out = tmp_path / "bench.json"
+    # separate process: the harness binds packages.common.db to its own SQLite file
+    subprocess.run(
+        [sys.executable, str(path), "-n", "20", "--warmup", "2", "--orgs", "2", "--contacts", "20",
+         "--delay-s", "1", "--nlp-latency-ms", "0", "--settle-s", "10", "--out", str(out)],
+        check=True, capture_output=True, timeout=120,
+    )
+    report = json.loads(out.read_text())
+    assert report["completed"] == 20 and report["missing"] == 0
+    assert report["msgs_per_s"] > 0
+    assert report["e2e_ms"]["p99"] >= report["e2e_ms"]["p50"] > 0
+    # every contact's first message reaches the delayed step
+    assert report["scheduler_lag_ms"]["count"] > 0
+    assert report["redis_roundtrips_per_message"] > 0
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import importlib.util
+import threading
+from pathlib import Path
+
+from packages.common import flow_cache
+
+root = Path(__file__).resolve().parents[2].parent
+module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+spec = importlib.util.spec_from_file_location("engine_worker_flow_cache", str(module_path))
+engine_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_worker)
+
+GRAPH = {
+    "nodes": [{"id": "n1", "type": "intent", "map": {"default": "p", "ventas": "v"}}],
+    "paths": {
+        "p": [{"type": "action", "action": "send_text", "text": "hola"}],
+        "v": [{"type": "wait_for_reply", "pattern": "^s[ií]$"}],
+        "broken": "not-a-list",
+    },
+}
+
+
+def test_compile_flow_indexes_graph_and_warms_regexes():
+    compiled = flow_cache.compile_flow("f1", "o1", 3, GRAPH)
+    assert compiled["intent_map"] == {"default": "p", "ventas": "v"}
+    assert set(compiled["paths"]) == {"p", "v"}
+    assert flow_cache.wait_regex("^s[ií]$").search("SÍ")
+    assert flow_cache.wait_regex("([") is None
+    assert flow_cache.compile_flow("f1", "o1", 1, None) is None
+
+
+def test_cache_hits_skip_loader_until_invalidated():
+    calls = []
+
+    def loader(org_id):
+        calls.append(org_id)
+        return ("f1", 1, GRAPH) if org_id == "o1" else None
+
+    cache = flow_cache.FlowCache(ttl=60)
+    assert cache.get("o1", loader)["flow_id"] == "f1"
+    assert cache.get("o1", loader)["flow_id"] == "f1"
+    assert cache.get("o2", loader) is None
+    assert cache.get("o2", loader) is None  # negative entries are cached too
+    assert calls == ["o1", "o2"]
+
+    cache.handle_message(json.dumps({"org_id": "o1", "flow_id": "f1", "op": "updated"}))
+    cache.get("o1", loader)
+    cache.get("o2", loader)
+    assert calls == ["o1", "o2", "o1"]
+
+    cache.handle_message("garbage")  # unreadable signal drops everything
+    cache.get("o2", loader)
+    assert calls[-1] == "o2"
+
+
+def test_async_get_loads_misses_off_the_event_loop():
+    threads = []
+
+    def loader(org_id):
+        threads.append(threading.get_ident())
+        return ("f1", 1, GRAPH)
+
+    async def scenario():
+        cache = flow_cache.FlowCache(ttl=60)
+        first = await cache.aget("o1", loader)
+        second = await cache.aget("o1", loader)
+        return first, second, threading.get_ident()
+
+    first, second, loop_thread = asyncio.run(scenario())
+    assert first is second and first["flow_id"] == "f1"
+    # one miss, loaded in a worker thread; the hit never reached the loader
+    assert len(threads) == 1 and threads[0] != loop_thread
+
+
+def test_publish_change_uses_the_shared_channel():
+    sent = []
+
+    class R:
+        def publish(self, channel, data):
+            sent.append((channel, json.loads(data)))
+
+    flow_cache.publish_change(R(), "o1", "f1", 2, "deleted")
+    assert sent == [(flow_cache.CHANNEL, {"org_id": "o1", "flow_id": "f1", "version": 2, "op": "deleted"})]
+
+
+def test_engine_runs_flow_without_db_reads_when_cached(monkeypatch):
+    loads = []
+
+    def fake_load(org_id):
+        loads.append(org_id)
+        return ("f1", 1, GRAPH)
+
+    async def fake_classify(text, memo=None):
+        return "default"
+
+    class R:
+        def __init__(self):
+            self.xadds = []
+
+        def get(self, key):
+            return None
+
+        def xadd(self, stream, mapping):
+            self.xadds.append((stream, dict(mapping)))
+
+    r = R()
+    monkeypatch.setattr(engine_worker, "redis", r)
+    monkeypatch.setattr(engine_worker, "FLOWS", flow_cache.FlowCache(ttl=60))
+    monkeypatch.setattr(engine_worker, "_load_active_flow", fake_load)
+    monkeypatch.setattr(engine_worker, "classify_intent", fake_classify)
+    monkeypatch.setattr(engine_worker, "DBFlowRun", None)
+    if engine_worker.SessionLocal is None or engine_worker.DBFlow is None:
+        monkeypatch.setattr(engine_worker, "SessionLocal", object())
+        monkeypatch.setattr(engine_worker, "DBFlow", object())
+
+    fields = {"payload": json.dumps({"contact": {"phone": "123"}, "text": "hola"}), "org_id": "o1", "channel_id": "wa_main"}
+    for i in range(3):
+        asyncio.run(engine_worker.handle_message(f"{i}-0", dict(fields)))
+    assert loads == ["o1"]
+    assert [m["text"] for s, m in r.xadds if s == "nf:outbox"] == ["hola"] * 3
+
+
+def test_load_racing_an_invalidation_is_not_cached_and_old_versions_are_dropped():
+    cache = flow_cache.FlowCache(ttl=60)
+    versions = iter([1, 2, 3])
+
+    def loader(org_id):
+        version = next(versions)
+        if version == 1:
+            # the flow is edited (and published) while this load is in flight
+            cache.handle_message(json.dumps({"org_id": org_id, "flow_id": "f1", "op": "updated"}))
+        return ("f1", version, GRAPH)
+
+    assert cache.get("o1", loader)["version"] == 1
+    # not cached: the next call loads the edited version
+    assert cache.get("o1", loader)["version"] == 2
+    assert cache.get("o1", loader)["version"] == 2
+
+    cache.invalidate("o1")
+    assert cache.get("o1", loader)["version"] == 3
+    assert list(cache._compiled) == [("o1", "f1", 3)]
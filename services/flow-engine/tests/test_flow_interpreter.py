@@ -0,0 +1,133 @@
+import asyncio
+import importlib.util
+import json
+from pathlib import Path
+
+from packages.common import flow_cache, flow_interpreter
+
+root = Path(__file__).resolve().parents[2].parent
+module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+spec = importlib.util.spec_from_file_location("engine_worker_interpreter", str(module_path))
+engine_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_worker)
+
+
+def _send(text):
+    return {"type": "action", "action": "send_text", "text": text}
+
+
+def _flow(paths, intent_map=None):
+    graph = {"nodes": [{"id": "n1", "type": "intent", "map": intent_map or {"default": "main"}}], "paths": paths}
+    return flow_cache.compile_flow("f1", "o1", 1, graph)
+
+
+def test_branches_run_inline_within_one_message():
+    flow = _flow({
+        "main": [
+            {"type": "set_attribute", "key": "seen", "value": True},
+            {"type": "wait", "seconds": 0},
+            {"type": "condition", "if": {"all": [{"var": "attributes.vip", "op": "eq", "value": True}, {"var": "attributes.seen", "op": "exists"}]}, "then": "vip", "else": "std"},
+        ],
+        "vip": [_send("vip"), {"type": "intent", "map": {"ventas": "sales", "default": "std"}}],
+        "sales": [{"type": "action", "action": "webhook", "data": {"x": 1}}, {"type": "goto", "path": "std", "index": 1}],
+        "std": [_send("std"), _send("bye")],
+    })
+    loads = []
+
+    def attrs():
+        loads.append(1)
+        return {"vip": True}
+
+    res = flow_interpreter.run(flow, "main", 0, intent="ventas", attributes=attrs)
+    assert [o["text"] for o in res["outputs"]] == ["vip", "bye"]
+    assert [e["type"] for e in res["effects"]] == ["set_attribute", "webhook"]
+    assert (res["status"], res["stop"], res["path"], res["index"]) == ("completed", "end", "std", 2)
+    assert loads == [1]
+    # no condition on attributes: the contact is never loaded
+    res = flow_interpreter.run(flow, "std", 0, attributes=attrs)
+    assert loads == [1] and res["steps"] == 2
+    # the engine only prefetches attributes for flows whose conditions read them
+    assert flow_interpreter.reads_attributes(flow)
+    assert not flow_interpreter.reads_attributes(_flow({"main": [{"type": "condition", "if": {"var": "text", "op": "contains", "value": "x"}, "then": "main"}]}))
+
+
+def test_budget_stops_with_a_resumable_position_and_ab_is_sticky():
+    flow = _flow({
+        "main": [_send(str(i)) for i in range(12)],
+        "loop": [{"type": "goto", "path": "loop"}],
+        "split": [{"type": "ab", "variants": [{"path": "a", "weight": 1}, {"path": "b", "weight": 1}]}],
+        "a": [_send("a")],
+        "b": [_send("b")],
+    })
+    res = flow_interpreter.run(flow, "main", 0, limits=flow_interpreter.budget(max_outbound=10))
+    assert len(res["outputs"]) == 10
+    assert (res["status"], res["stop"], res["index"]) == ("running", "budget_outbound", 10)
+    res = flow_interpreter.run(flow, "loop", 0, limits=flow_interpreter.budget(max_steps=7))
+    assert (res["stop"], res["steps"]) == ("budget_steps", 7)
+    picks = {flow_interpreter.run(flow, "split", 0, contact_key=f"c{i}")["outputs"][0]["text"] for i in range(20)}
+    assert picks == {"a", "b"}
+    same = {flow_interpreter.run(flow, "split", 0, contact_key="c1")["outputs"][0]["text"] for _ in range(5)}
+    assert len(same) == 1
+
+
+def test_engine_runs_past_five_steps_and_continues_when_out_of_budget(monkeypatch):
+    flow = _flow({"main": [_send(str(i)) for i in range(8)]})
+    scheduled = []
+
+    class R:
+        def __init__(self):
+            self.xadds = []
+
+        def get(self, key):
+            return None
+
+        def xadd(self, stream, mapping):
+            self.xadds.append((stream, dict(mapping)))
+
+    async def fake_classify(text, memo=None):
+        return "default"
+
+    async def fake_schedule(**kwargs):
+        scheduled.append(kwargs)
+
+    r = R()
+    monkeypatch.setattr(engine_worker, "redis", r)
+    class Flows:
+        async def aget(self, org_id, loader):
+            return flow
+
+    monkeypatch.setattr(engine_worker, "FLOWS", Flows())
+    monkeypatch.setattr(engine_worker, "classify_intent", fake_classify)
+    monkeypatch.setattr(engine_worker, "_schedule_resume", fake_schedule)
+    monkeypatch.setattr(engine_worker, "DBFlowRun", None)
+    if engine_worker.SessionLocal is None or engine_worker.DBFlow is None:
+        monkeypatch.setattr(engine_worker, "SessionLocal", object())
+        monkeypatch.setattr(engine_worker, "DBFlow", object())
+
+    fields = {"payload": json.dumps({"contact": {"phone": "123"}, "text": "hola"}), "org_id": "o1", "channel_id": "wa_main"}
+    asyncio.run(engine_worker.handle_message("1-0", dict(fields)))
+    sent = [m for s, m in r.xadds if s == "nf:outbox"]
+    assert [m["text"] for m in sent] == [str(i) for i in range(8)]
+    assert len({m["client_id"] for m in sent}) == 8
+    assert scheduled == []
+
+    r.xadds.clear()
+    monkeypatch.setattr(engine_worker, "_FLOW_BUDGET", flow_interpreter.budget(max_outbound=3))
+    asyncio.run(engine_worker.handle_message("2-0", dict(fields)))
+    assert [m["text"] for s, m in r.xadds if s == "nf:outbox"] == ["0", "1", "2"]
+    assert [(s["path_key"], s["next_index"], s["delay_seconds"], s["hops"]) for s in scheduled] == [("main", 3, 0, 1)]
+
+
+def test_trace_is_capped_and_explicit_budgets_are_clamped(monkeypatch):
+    monkeypatch.setattr(flow_interpreter, "TRACE_LIMIT", 5)
+    flow = _flow({"loop": [{"type": "goto", "path": "loop"}]})
+    res = flow_interpreter.run(flow, "loop", 0, limits={"max_steps": 20, "max_ms": 10_000, "max_outbound": 1})
+    assert res["steps"] == 20 and len(res["trace"]) == 5 and res["trace_truncated"]
+
+    limits = flow_interpreter.budget(10**9, 1e9, 10**9)
+    assert limits == {
+        "max_steps": flow_interpreter.STEPS_CEILING,
+        "max_ms": flow_interpreter.MS_CEILING,
+        "max_outbound": flow_interpreter.OUTBOUND_CEILING,
+    }
+    assert flow_interpreter.budget(0, -5, -1) == {"max_steps": 1, "max_ms": 0.0, "max_outbound": 0}
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import importlib.util
+from pathlib import Path
+
+import httpx
+
+root = Path(__file__).resolve().parents[2].parent
+module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+spec = importlib.util.spec_from_file_location("engine_worker_nlp_batching", str(module_path))
+engine_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_worker)
+
+LABELS = {"hola": "greeting", "precio": "pricing", "ayuda": "support"}
+
+
+def _install(monkeypatch, batch_status=200, service_max=256):
+    calls = []
+
+    def handler(request):
+        body = json.loads(request.content)
+        if request.url.path.endswith(":batch"):
+            calls.append(("batch", body["texts"]))
+            if batch_status != 200:
+                return httpx.Response(batch_status)
+            if len(body["texts"]) > service_max:
+                # the nlp service's NLP_MAX_BATCH (pydantic max_length)
+                return httpx.Response(422, json={"detail": [{"type": "too_long", "loc": ["body", "texts"]}]})
+            return httpx.Response(200, json={"results": [{"primary_intent": LABELS.get(t, "default")} for t in body["texts"]]})
+        calls.append(("single", body["text"]))
+        return httpx.Response(200, json={"primary_intent": LABELS.get(body["text"], "default")})
+
+    monkeypatch.setattr(engine_worker, "_nlp_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(engine_worker, "_INTENT_CACHE_TTL", 0)
+    monkeypatch.setattr(engine_worker, "_NLP_BATCH_SUPPORTED", True)
+    return calls
+
+
+def test_concurrent_classifications_share_one_batch_request(monkeypatch):
+    calls = _install(monkeypatch)
+    texts = ["hola", "precio", "hola", "ayuda", "otra cosa"]
+
+    async def run():
+        return await asyncio.gather(*(engine_worker.classify_intent(t) for t in texts))
+
+    assert asyncio.run(run()) == ["greeting", "pricing", "greeting", "support", "default"]
+    # one request, duplicates sent once
+    assert calls == [("batch", ["hola", "precio", "ayuda", "otra cosa"])]
+
+
+def test_falls_back_to_single_requests_without_batch_endpoint(monkeypatch):
+    calls = _install(monkeypatch, batch_status=404)
+
+    async def run():
+        return await asyncio.gather(*(engine_worker.classify_intent(t) for t in ("hola", "precio")))
+
+    assert asyncio.run(run()) == ["greeting", "pricing"]
+    assert calls[0][0] == "batch" and sorted(c[1] for c in calls[1:]) == ["hola", "precio"]
+    assert engine_worker._NLP_BATCH_SUPPORTED is False
+
+
+def test_server_errors_use_the_heuristic_fallback(monkeypatch):
+    _install(monkeypatch, batch_status=500)
+    assert asyncio.run(engine_worker.classify_intent("cuál es el precio")) == "pricing"
+
+
+def _classify_all(texts):
+    async def run():
+        return await asyncio.gather(*(engine_worker.classify_intent(t) for t in texts))
+
+    return asyncio.run(run())
+
+
+def test_flushes_are_chunked_to_the_service_batch_limit(monkeypatch):
+    calls = _install(monkeypatch, service_max=2)
+    monkeypatch.setattr(engine_worker, "_NLP_SERVICE_MAX_BATCH", 2)
+    assert _classify_all(["hola", "precio", "ayuda", "otra cosa", "hola"]) == ["greeting", "pricing", "support", "default", "greeting"]
+    assert calls == [("batch", ["hola", "precio"]), ("batch", ["ayuda", "otra cosa"])]
+
+
+def test_rejected_batch_is_logged_and_classified_one_by_one(monkeypatch, caplog):
+    # engine configured above the service's limit: 422 instead of labels
+    calls = _install(monkeypatch, service_max=1)
+    monkeypatch.setattr(engine_worker, "_NLP_SERVICE_MAX_BATCH", 256)
+    with caplog.at_level("WARNING"):
+        assert _classify_all(["hola", "precio"]) == ["greeting", "pricing"]
+    assert calls[0] == ("batch", ["hola", "precio"])
+    assert sorted(c[1] for c in calls[1:]) == ["hola", "precio"]
+    assert any("rejected (422" in r.getMessage() for r in caplog.records)
+    # not an outage: the batch endpoint stays in use
+    assert engine_worker._NLP_BATCH_SUPPORTED is True
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import importlib.util
+from pathlib import Path
+
+import httpx
+
+from packages.common import flow_cache
+
+root = Path(__file__).resolve().parents[2].parent
+module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+spec = importlib.util.spec_from_file_location("engine_worker_nlp_client", str(module_path))
+engine_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_worker)
+
+
+def _mock_nlp(monkeypatch, label="greeting"):
+    requests = []
+
+    def handler(request):
+        body = json.loads(request.content)
+        if request.url.path.endswith(":batch"):
+            requests.extend({"text": t} for t in body["texts"])
+            return httpx.Response(200, json={"results": [{"primary_intent": label} for _ in body["texts"]]})
+        requests.append(body)
+        return httpx.Response(200, json={"primary_intent": label})
+
+    monkeypatch.setattr(engine_worker, "_nlp_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(engine_worker, "_INTENT_CACHE", engine_worker.OrderedDict())
+    return requests
+
+
+def test_client_is_shared_within_an_event_loop():
+    async def run():
+        a = engine_worker._nlp_client()
+        b = engine_worker._nlp_client()
+        await engine_worker.close_nlp_client()
+        return a, b
+
+    a, b = asyncio.run(run())
+    assert a is b and a.is_closed
+
+
+def test_ttl_cache_reuses_classification_for_normalized_text(monkeypatch):
+    requests = _mock_nlp(monkeypatch)
+
+    async def run():
+        return [await engine_worker.classify_intent(t) for t in ("Hola!", " hola ", "HOLA", "precio?")]
+
+    assert asyncio.run(run()) == ["greeting"] * 4
+    assert [r["text"] for r in requests] == ["Hola!", "precio?"]
+
+
+def test_one_classification_per_message_without_ttl_cache(monkeypatch):
+    requests = _mock_nlp(monkeypatch, label="pricing")
+    monkeypatch.setattr(engine_worker, "_INTENT_CACHE_TTL", 0)
+
+    class R:
+        def get(self, key):
+            return None
+
+        def xadd(self, stream, mapping):
+            return "1-0"
+
+    # active flow whose intent maps to a missing path: the fallback reply classifies again
+    cache = flow_cache.FlowCache(ttl=60)
+    monkeypatch.setattr(engine_worker, "FLOWS", cache)
+    monkeypatch.setattr(engine_worker, "_load_active_flow", lambda org_id: ("f1", 1, {"nodes": [{"type": "intent", "map": {"pricing": "nope"}}], "paths": {}}))
+    monkeypatch.setattr(engine_worker, "redis", R())
+    if engine_worker.SessionLocal is None or engine_worker.DBFlow is None:
+        monkeypatch.setattr(engine_worker, "SessionLocal", object())
+        monkeypatch.setattr(engine_worker, "DBFlow", object())
+
+    fields = {"payload": json.dumps({"contact": {"phone": "1"}, "text": "cuanto cuesta"}), "org_id": "o1"}
+    asyncio.run(engine_worker.handle_message("1-0", fields))
+    assert len(requests) == 1
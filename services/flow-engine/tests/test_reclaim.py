@@ -0,0 +1,180 @@
+import asyncio
+import time
+
+from packages.common import reclaim
+
+
+def _key(msg_id):
+    ms, _, seq = msg_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class PelRedis:
+    """One stream + one group's PEL, with XAUTOCLAIM/XPENDING semantics and a manual clock (ms)."""
+
+    def __init__(self):
+        self.now = 0
+        self.entries = {}
+        self.pending = {}  # id -> [consumer, delivered_at, times_delivered]
+        self.xadds = []
+        self.acks = []
+        self.xpending_calls = 0
+
+    def deliver(self, msg_id, fields, consumer, at=0, times=1):
+        self.entries[msg_id] = fields
+        self.pending[msg_id] = [consumer, at, times]
+
+    def xautoclaim(self, stream, group, consumer, min_idle_time, start_id="0-0", count=100):
+        ids = sorted(i for i in self.pending if i >= start_id)
+        claimed = []
+        for i in ids:
+            if len(claimed) >= count:
+                return [i, claimed, []]
+            slot = self.pending[i]
+            if self.now - slot[1] >= min_idle_time:
+                slot[0], slot[1], slot[2] = consumer, self.now, slot[2] + 1
+                claimed.append((i, self.entries.get(i)))
+        return ["0-0", claimed, []]
+
+    def xpending_range(self, stream, group, min, max, count, consumername=None, idle=None):
+        self.xpending_calls += 1
+        lo, hi = _key(min.lstrip("(")), _key(max)
+        return [
+            {"message_id": i, "consumer": s[0], "time_since_delivered": self.now - s[1], "times_delivered": s[2]}
+            for i, s in sorted(self.pending.items(), key=lambda kv: _key(kv[0]))
+            if (lo < _key(i) if min.startswith("(") else lo <= _key(i)) and _key(i) <= hi
+            and consumername in (None, s[0])
+        ][:count]
+
+    def xadd(self, stream, fields):
+        self.xadds.append((stream, dict(fields)))
+        return "9-0"
+
+    def xack(self, stream, group, *ids):
+        for i in ids:
+            self.pending.pop(i, None)
+            self.acks.append(i)
+        return len(ids)
+
+
+def _run(fake, handled, **kw):
+    async def handle(entries):
+        for msg_id, fields in entries:
+            handled.append((msg_id, fields))
+            fake.xack("s", "g", msg_id)
+
+    return asyncio.run(reclaim.reclaim_once(fake, "s", "g", "new-pod", handle, dlq_stream="s:dlq", **kw))
+
+
+def test_idle_entries_of_dead_consumer_are_handled_by_new_consumer():
+    fake = PelRedis()
+    fake.deliver("1-0", {"text": "a"}, "dead-pod", at=0)
+    fake.deliver("2-0", {"text": "b"}, "live-pod", at=9_500)
+    fake.now = 10_000
+    handled = []
+    report = _run(fake, handled, min_idle_ms=5_000)
+    # only the idle entry moves; the one still being worked on stays with its owner
+    assert handled == [("1-0", {"text": "a"})]
+    assert report == {"claimed": 1, "handled": 1, "dead": 0, "deleted": 0}
+    assert fake.pending["2-0"][0] == "live-pod"
+
+
+def test_entries_over_max_deliveries_go_to_dlq_and_are_acked():
+    fake = PelRedis()
+    fake.deliver("1-0", {"text": "poison"}, "dead-pod", times=3)
+    fake.deliver("2-0", {"text": "ok"}, "dead-pod", times=1)
+    fake.now = 60_000
+    handled = []
+    report = _run(fake, handled, min_idle_ms=1_000, max_deliveries=3)
+    assert [m for m, _ in handled] == ["2-0"]
+    assert report["dead"] == 1
+    stream, dlq = fake.xadds[0]
+    assert stream == "s:dlq"
+    assert dlq["text"] == "poison" and dlq["source_id"] == "1-0" and dlq["deliveries"] == "4"
+    assert dlq["error"] == "max_deliveries"
+    assert fake.pending == {}
+
+
+def test_pass_is_bounded_by_count_and_batches():
+    fake = PelRedis()
+    for n in range(10):
+        fake.deliver(f"{n}-0", {"n": str(n)}, "dead-pod")
+    fake.now = 60_000
+    handled = []
+    report = _run(fake, handled, min_idle_ms=1_000, count=3, max_batches=2)
+    assert report["claimed"] == 6
+    assert [m for m, _ in handled] == [f"{n}-0" for n in range(6)]
+    assert len(fake.pending) == 4
+
+
+def test_delivery_counts_use_one_ranged_xpending(monkeypatch):
+    fake = PelRedis()
+    for n in range(1, 13):
+        fake.deliver(f"{n}-0", {}, "pod-a" if n % 2 else "pod-b", times=n)
+    counts = asyncio.run(reclaim.delivery_counts(fake, "s", "g", ["11-0", "3-0", "4-0", "99-0"], "pod-a"))
+    # 4-0 is pod-b's and 99-0 is not pending: both left out
+    assert counts == {"3-0": 3, "11-0": 11}
+    assert fake.xpending_calls == 1
+
+    # other pending entries between the ids: paged, still in order
+    monkeypatch.setattr(reclaim, "COUNT", 2)
+    counts = asyncio.run(reclaim.delivery_counts(fake, "s", "g", ["1-0", "12-0"]))
+    assert counts == {"1-0": 1, "12-0": 12}
+    assert fake.xpending_calls == 1 + 6
+
+
+class LivePelRedis(PelRedis):
+    """PelRedis on the real clock, plus XCLAIM JUSTID (keeps the delivery count)."""
+
+    @property
+    def now(self):
+        return time.monotonic() * 1000
+
+    @now.setter
+    def now(self, value):
+        pass
+
+    def xclaim(self, stream, group, consumer, min_idle_time, message_ids, justid=False):
+        out = []
+        for i in message_ids:
+            slot = self.pending.get(i)
+            if slot is not None and self.now - slot[1] >= min_idle_time:
+                slot[0], slot[1] = consumer, self.now
+                out.append(i)
+        return out
+
+
+def test_entry_kept_claimed_while_handling_outlasts_min_idle():
+    fake = LivePelRedis()
+    fake.deliver("1-0", {"text": "slow"}, "pod-a", at=fake.now)
+    stolen = []
+
+    async def other_pod(handle_done):
+        while not handle_done.is_set():
+            async def handle(entries):
+                stolen.extend(entries)
+            await reclaim.reclaim_once(fake, "s", "g", "pod-b", handle, dlq_stream="s:dlq", min_idle_ms=100)
+            await asyncio.sleep(0.02)
+
+    async def scenario():
+        done = asyncio.Event()
+        watcher = asyncio.create_task(other_pod(done))
+        # three times the min idle: without the touches pod-b would take it
+        async with reclaim.keep_claimed(fake, "s", "g", "pod-a", "1-0", interval_s=0.03):
+            await asyncio.sleep(0.3)
+        fake.xack("s", "g", "1-0")
+        done.set()
+        await watcher
+
+    asyncio.run(scenario())
+    assert stolen == []
+    assert fake.acks == ["1-0"]
+
+
+def test_without_keep_claimed_a_slow_entry_is_taken_over():
+    fake = LivePelRedis()
+    fake.deliver("1-0", {"text": "slow"}, "pod-a", at=fake.now)
+    time.sleep(0.15)
+    handled = []
+    _run(fake, handled, min_idle_ms=100)
+    assert [m for m, _ in handled] == ["1-0"]
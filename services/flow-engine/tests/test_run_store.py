@@ -0,0 +1,180 @@
+import asyncio
+import importlib.util
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from packages.common import run_store
+
+
+def load_engine_worker():
+    root = Path(__file__).resolve().parents[2].parent
+    module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+    spec = importlib.util.spec_from_file_location("engine_worker_run_store", str(module_path))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)  # type: ignore
+    return mod
+
+
+class KVRedis:
+    """KV/set/ZSET/hash/stream fake without scripting (exercises the stepwise CAS)."""
+
+    def __init__(self):
+        self.kv = {}
+        self.sets = {}
+        self.xadds = []
+
+    def get(self, key):
+        return self.kv.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.kv:
+            return None
+        self.kv[key] = value
+        return True
+
+    def mget(self, keys):
+        return [self.kv.get(k) for k in keys]
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def spop(self, key, count=None):
+        s = self.sets.get(key, set())
+        out = [s.pop() for _ in range(min(count or 1, len(s)))]
+        return out
+
+    def zadd(self, key, mapping):
+        pass
+
+    def hset(self, key, field, value):
+        pass
+
+    def xadd(self, stream, mapping):
+        self.xadds.append((stream, dict(mapping)))
+
+
+@pytest.fixture
+def engine(tmp_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'runs.db').as_posix()}"
+    mod = load_engine_worker()
+    from packages.common.db import engine as db_engine
+    from packages.common.models import Base
+
+    tables = [Base.metadata.tables[t] for t in ("flows", "contacts", "flow_runs")]
+    Base.metadata.create_all(bind=db_engine, tables=tables)
+    return mod
+
+
+def _rows():
+    from packages.common.db import SessionLocal
+    from packages.common.models import FlowRun
+
+    with SessionLocal() as db:
+        return [(r.id, r.contact_key, r.status, r.path, r.step_index, r.version) for r in db.query(FlowRun).order_by(FlowRun.created_at)]
+
+
+def test_one_run_per_contact_updated_in_place_and_flushed(engine, monkeypatch):
+    from packages.common.db import SessionLocal
+    from packages.common.models import Flow
+
+    graph = {
+        "nodes": [{"id": "n1", "type": "intent", "map": {"default": "p"}}],
+        "paths": {"p": [
+            {"type": "action", "action": "send_text", "text": "hola"},
+            {"type": "wait", "seconds": 5},
+            {"type": "action", "action": "send_text", "text": "luego"},
+        ]},
+    }
+    with SessionLocal() as s:
+        s.add(Flow(id="f1", org_id="o1", name="f", version=1, graph=graph, status="active", created_by="t"))
+        s.commit()
+    r = KVRedis()
+    monkeypatch.setattr(engine, "redis", r)
+
+    async def fake_classify(text, memo=None):
+        return "default"
+
+    monkeypatch.setattr(engine, "classify_intent", fake_classify)
+    payload = {"contact": {"phone": "555"}, "text": "hola"}
+    fields = {"payload": json.dumps(payload), "org_id": "o1", "channel_id": "wa_main"}
+
+    async def run():
+        await engine.handle_message("1-0", dict(fields))
+        await engine.flush_runs_once()
+        first = _rows()
+        # the scheduled resume continues the same run
+        await engine.handle_message("2-0", {**fields, "contact_phone": "555", "engine_resume": json.dumps({"path": "p", "index": 2})})
+        await engine.flush_runs_once()
+        second = _rows()
+        # a new conversation after completion starts a new run
+        await engine.handle_message("3-0", dict(fields))
+        await engine.flush_runs_once()
+        return first, second, _rows()
+
+    first, second, third = asyncio.run(run())
+    assert [row[1:] for row in first] == [("555", "waiting", "p", 2, 1)]
+    assert len(second) == 1 and second[0][0] == first[0][0]
+    assert second[0][1:] == ("555", "completed", "p", 3, 2)
+    assert len(third) == 2 and third[0] == second[0]
+    assert third[1][2:] == ("waiting", "p", 2, 3)
+
+
+def test_stale_save_raises_conflict_and_flush_keeps_newest_version():
+    r = KVRedis()
+
+    async def run():
+        run_a = run_store.new_run("o1", "f1", "555")
+        await run_store.save(r, run_a, 0)
+        stale = dict(run_a, status="completed")
+        with pytest.raises(run_store.RunConflict) as exc:
+            await run_store.save(r, stale, 0)
+        assert exc.value.current_version == 1
+        assert json.loads(r.kv[run_store.run_key("o1", "f1", "555")])["status"] == "running"
+        keys, runs = await run_store.drain_dirty(r)
+        return keys, runs
+
+    keys, runs = asyncio.run(run())
+    assert keys == [run_store.run_key("o1", "f1", "555")]
+    assert runs[0]["version"] == 1
+
+
+def test_finished_run_replaced_before_flush_still_reaches_db(engine):
+    from packages.common.db import SessionLocal
+    from packages.common.models import FlowRun
+
+    r = KVRedis()
+
+    async def run():
+        first = run_store.new_run("o-replace", "f1", "555")
+        await run_store.save(r, first, 0)
+        await run_store.save(r, dict(first, status="completed"), 1)
+        # the contact's next message starts a new run before the flusher ran
+        second = run_store.new_run("o-replace", "f1", "555", version=2)
+        await run_store.save(r, second, 2)
+        keys, runs = await run_store.drain_dirty(r)
+        return first["id"], second["id"], keys, runs
+
+    first_id, second_id, keys, runs = asyncio.run(run())
+    assert sorted(keys) == sorted([run_store.run_key("o-replace", "f1", "555"), run_store.run_key("o-replace", "f1", "555") + f":done:{first_id}"])
+    assert run_store.persist_runs(SessionLocal, FlowRun, runs) == (2, [])
+    with SessionLocal() as db:
+        rows = {row.id: row.status for row in db.query(FlowRun).filter(FlowRun.org_id == "o-replace")}
+    assert rows == {first_id: "completed", second_id: "running"}
+
+
+def test_new_active_run_closes_stale_active_row_instead_of_failing_batch(engine):
+    from packages.common.db import SessionLocal
+    from packages.common.models import FlowRun
+
+    stale = dict(run_store.new_run("o-stale", "f1", "555"), version=1)
+    other = dict(run_store.new_run("o-stale", "f1", "777"), version=1)
+    assert run_store.persist_runs(SessionLocal, FlowRun, [stale]) == (1, [])
+    # the stale run's final state was lost; its successor and another contact flush together
+    fresh = dict(run_store.new_run("o-stale", "f1", "555"), version=3)
+    assert run_store.persist_runs(SessionLocal, FlowRun, [fresh, other]) == (2, [])
+    with SessionLocal() as db:
+        rows = {row.id: row.status for row in db.query(FlowRun).filter(FlowRun.org_id == "o-stale")}
+    assert rows == {stale["id"]: "failed", fresh["id"]: "running", other["id"]: "running"}
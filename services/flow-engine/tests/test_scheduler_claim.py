@@ -0,0 +1,212 @@
+import asyncio
+import json
+import importlib.util
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from packages.common import scheduler
+
+root = Path(__file__).resolve().parents[2].parent
+module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+spec = importlib.util.spec_from_file_location("engine_worker_scheduler", str(module_path))
+engine_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_worker)
+
+
+class ZRedis:
+    """ZSET/hash/KV/stream fake without scripting (exercises the stepwise path)."""
+
+    def __init__(self):
+        self.zsets = {}
+        self.hashes = {}
+        self.kv = {}
+        self.xadds = []
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrangebyscore(self, key, lo, hi, start=0, num=None):
+        due = sorted((s, m) for m, s in self.zsets.get(key, {}).items() if s <= float(hi))
+        return [m for _, m in due][start:start + num]
+
+    def zrem(self, key, member):
+        return 1 if self.zsets.get(key, {}).pop(member, None) is not None else 0
+
+    def zremrangebyscore(self, key, lo, hi):
+        z = self.zsets.get(key, {})
+        for m in [m for m, s in z.items() if s <= float(hi)]:
+            z.pop(m)
+
+    def zrange(self, key, a, b, withscores=False):
+        items = sorted(self.zsets.get(key, {}).items(), key=lambda kv: kv[1])
+        items = items[a:] if b == -1 else items[a:b + 1]
+        return items if withscores else [m for m, _ in items]
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(field, None)
+
+    def get(self, key):
+        return self.kv.get(key)
+
+    def set(self, key, value, ex=None):
+        self.kv[key] = value
+
+    def delete(self, key):
+        self.kv.pop(key, None)
+
+    def xadd(self, stream, fields):
+        self.xadds.append((stream, dict(fields)))
+
+
+def _item(phone, token=None):
+    item = {"payload": "{}", "org_id": "o1", "channel_id": "wa_main", "contact_phone": phone, "engine_resume": json.dumps({"path": "p", "index": 1})}
+    if token:
+        item["resume_token"] = token
+    return json.dumps(item)
+
+
+def test_stepwise_claim_checks_tokens_and_reports_next_due():
+    r = ZRedis()
+    now = time.time()
+    r.zadd("z", {_item("1"): now - 1, _item("2", "t-ok"): now - 1, _item("3", "t-stale"): now - 1, _item("4"): now + 30})
+    r.set("fe:wait:o1:wa_main:2", json.dumps({"resume_token": "t-ok"}))
+    r.set("fe:wait:o1:wa_main:3", json.dumps({"resume_token": "t-new"}))
+
+    published, skipped, next_due = asyncio.run(scheduler.claim_due(r, "z", "nf:incoming", "fe:wait", now=now))
+    assert (published, skipped) == (2, 1)
+    assert next_due == now + 30
+    assert sorted(f["contact_phone"] for _, f in r.xadds) == ["1", "2"]
+    assert "fe:wait:o1:wa_main:2" not in r.kv and "fe:wait:o1:wa_main:3" in r.kv
+
+
+def test_claim_runs_one_script_call_when_scripting_is_available():
+    calls = []
+
+    class Script:
+        async def __call__(self, keys=None, args=None):
+            calls.append((keys, args))
+            return [4, 1, "1700000000.25"]
+
+    class ScriptRedis:
+        def register_script(self, source):
+            assert "ZRANGEBYSCORE" in source and "XADD" in source
+            return Script()
+
+    r = ScriptRedis()
+    res = asyncio.run(scheduler.claim_due(r, "z", "nf:incoming", "fe:wait", limit=50, now=1700000000.0))
+    assert res == (4, 1, 1700000000.25)
+    assert calls == [(["z", "nf:incoming"], ["1700000000.0", 50, "fe:wait"])]
+
+
+def test_scheduler_wakes_up_for_a_local_short_delay(monkeypatch):
+    r = ZRedis()
+    monkeypatch.setattr(engine_worker, "redis", r)
+    monkeypatch.setattr(engine_worker, "_SCHED_POLL_MS", 5000)
+
+    async def run():
+        task = asyncio.create_task(engine_worker.scheduler_loop())
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        await engine_worker._schedule_resume({"org_id": "o1"}, {"text": "x"}, "p", 1, 0.2, "123")
+        while not r.xadds and time.monotonic() - started < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(run())
+    assert r.xadds and r.xadds[0][0] == "nf:incoming"
+    # woke up and slept until the due time instead of the 5s poll interval
+    assert 0.15 <= elapsed < 1.5
+
+
+def test_sharded_items_are_compact_and_claimed_per_owned_shard():
+    r = ZRedis()
+    now = time.time()
+
+    async def run():
+        for phone in ("1", "2", "3", "4", "5", "6"):
+            await scheduler.schedule_item(r, "sched", 4, json.loads(_item(phone)), now - 1, f"o1:{phone}")
+        # the same contact always lands on the same shard
+        assert scheduler.shard_for("o1:1", 4) == scheduler.shard_for("o1:1", 4)
+        used = {k for k, z in r.zsets.items() if z}
+        for key in used:
+            # members are short ids, payloads live next door
+            assert all(len(m) <= 20 for m in r.zsets[key])
+            assert set(r.hashes[key + ":items"]) == set(r.zsets[key])
+        first = sorted(int(k.rsplit(":", 1)[1]) for k in used)[0]
+        published, _, _ = await scheduler.claim_due_shards(r, "sched", [first], "nf:incoming", "fe:wait", now=now)
+        assert published == len([p for p in "123456" if scheduler.shard_for(f"o1:{p}", 4) == first])
+        published, _, _ = await scheduler.claim_due_shards(r, "sched", range(4), "nf:incoming", "fe:wait", now=now)
+        assert len(r.xadds) == 6
+        assert not any(r.hashes.values())
+
+    asyncio.run(run())
+
+
+def test_replicas_split_shards_between_live_members():
+    r = ZRedis()
+
+    async def run():
+        now = 1000.0
+        a = await scheduler.owned_shards(r, "m", "engine-a", 8, ttl_s=15, now=now)
+        assert a == list(range(8))
+        b = await scheduler.owned_shards(r, "m", "engine-b", 8, ttl_s=15, now=now)
+        a = await scheduler.owned_shards(r, "m", "engine-a", 8, ttl_s=15, now=now + 1)
+        assert sorted(a + b) == list(range(8)) and not set(a) & set(b)
+        # engine-b stops heartbeating: engine-a takes everything back
+        a = await scheduler.owned_shards(r, "m", "engine-a", 8, ttl_s=15, now=now + 20)
+        assert a == list(range(8))
+
+    asyncio.run(run())
+
+
+_LUA_CHECK = """
+import asyncio, json, fakeredis
+from packages.common import scheduler
+
+async def main():
+    r = fakeredis.FakeAsyncRedis(decode_responses=True)
+    await r.set("w:o1:wa_main:52", json.dumps({"resume_token": "t1"}))
+    items = [
+        {"payload": "a", "org_id": "o1", "contact_phone": "52"},
+        {"payload": "b", "org_id": "o1", "contact_phone": "52", "resume_token": "stale"},
+        {"payload": "c", "org_id": "o1", "contact_phone": "52", "resume_token": "t1", "expire": 1},
+    ]
+    for i, item in enumerate(items):
+        await r.zadd("z", {json.dumps(item): i})
+        await scheduler.schedule_item(r, "p", 4, item, i, str(i))
+    await r.zadd("z", {"not json": 3})
+    await r.set("w:o1:wa_main:52", json.dumps({"resume_token": "t1"}))
+    legacy = await scheduler.claim_due(r, "z", "s1", "w", now=50)
+    await r.set("w:o1:wa_main:52", json.dumps({"resume_token": "t1"}))
+    sharded = await scheduler.claim_due_shards(r, "p", range(4), "s2", "w", now=50)
+    streams = [[e[1] for e in await r.xrange(s)] for s in ("s1", "s2")]
+    print(json.dumps([legacy, sharded, streams]))
+
+asyncio.run(main())
+"""
+
+
+def test_both_claim_scripts_forward_items_the_same_way():
+    # separate process, like the bench test: other tests stub ``redis`` in this one
+    if not (importlib.util.find_spec("fakeredis") and importlib.util.find_spec("lupa")):
+        pytest.skip("fakeredis[lua] not installed")
+    out = subprocess.run([sys.executable, "-c", _LUA_CHECK], cwd=str(root), check=True, capture_output=True, text=True, timeout=60)
+    legacy, sharded, (s1, s2) = json.loads(out.stdout)
+    assert legacy == [1, 3, None]
+    assert sharded == [1, 2, None]
+    assert s1 == s2 == [{"payload": "a", "org_id": "o1", "channel_id": "wa_main", "engine_resume": "", "contact_phone": "52"}]
@@ -0,0 +1,135 @@
+import asyncio
+import contextlib
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+from packages.common import stage_metrics
+
+root = Path(__file__).resolve().parents[2].parent
+module_path = root / "services" / "flow-engine" / "worker" / "engine_worker.py"
+spec = importlib.util.spec_from_file_location("engine_worker_stages", str(module_path))
+engine_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_worker)
+
+
+class FakeHistogram:
+    def __init__(self):
+        self.samples = []
+
+    def labels(self, stage):
+        hist = self
+
+        class _Child:
+            def observe(self, seconds):
+                hist.samples.append((stage, seconds))
+        return _Child()
+
+
+class FakeTracer:
+    """Records (span, parent span) like start_as_current_span would nest them."""
+
+    def __init__(self):
+        self.stack = []
+        self.spans = []
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name):
+        self.spans.append((name, self.stack[-1] if self.stack else None))
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+
+
+def test_stage_timer_observes_failures_and_nests_spans():
+    hist, tracer = FakeHistogram(), FakeTracer()
+    stages = stage_metrics.StageTimer(hist, tracer, span_prefix="engine.")
+    with stages.span("message"):
+        with stages("parse"):
+            pass
+        with pytest.raises(RuntimeError):
+            with stages("nlp"):
+                raise RuntimeError("timeout")
+    assert [s for s, _ in hist.samples] == ["parse", "nlp"]
+    assert tracer.spans == [("engine.message", None), ("engine.parse", "engine.message"), ("engine.nlp", "engine.message")]
+    # disabled: shared null context, nothing recorded
+    off = stage_metrics.StageTimer()
+    assert off("parse") is off("ack") and not off.enabled
+
+
+class LagRedis:
+    def __init__(self, groups, last_generated="0-0", entries=()):
+        self.groups = groups
+        self.last_generated = last_generated
+        self.entries = list(entries)
+        self.ranges = []
+
+    def xinfo_groups(self, stream):
+        return self.groups
+
+    def xinfo_stream(self, stream):
+        return {"last-generated-id": self.last_generated}
+
+    def xrange(self, stream, min="-", max="+", count=None):
+        self.ranges.append(min)
+        after = tuple(int(p) for p in min.lstrip("(").split("-"))
+        rows = [(i, {}) for i in self.entries if tuple(int(p) for p in i.split("-")) > after]
+        return rows[:count]
+
+
+def test_consumer_lag_uses_group_lag_or_counts_after_last_delivered():
+    # Redis 7: XINFO GROUPS reports the lag
+    r7 = LagRedis([{"name": "engine", "pending": 3, "last-delivered-id": "5-0", "lag": 7}])
+    assert asyncio.run(stage_metrics.consumer_lag(r7, "nf:incoming", "engine")) == {"pending": 3, "lag": 7}
+    assert asyncio.run(stage_metrics.consumer_lag(r7, "nf:incoming", "other")) is None
+
+    # older servers: count entries after last-delivered-id
+    r6 = LagRedis([{"name": "engine", "pending": 1, "last-delivered-id": "5-0"}], "9-0", ["4-0", "5-0", "6-0", "9-0"])
+    assert asyncio.run(stage_metrics.consumer_lag(r6, "nf:incoming", "engine")) == {"pending": 1, "lag": 2}
+    assert r6.ranges == ["(5-0"]
+
+    caught_up = LagRedis([{"name": "engine", "pending": 0, "last-delivered-id": "9-0"}], "9-0", ["9-0"])
+    assert asyncio.run(stage_metrics.consumer_lag(caught_up, "nf:incoming", "engine")) == {"pending": 0, "lag": 0}
+    assert caught_up.ranges == []
+
+
+class AckRedis:
+    def __init__(self):
+        self.acks = []
+        self.added = []
+
+    def hget(self, key, field):
+        return None
+
+    def xadd(self, stream, fields):
+        self.added.append((stream, dict(fields)))
+        return "9-0"
+
+    def xack(self, stream, group, *ids):
+        self.acks.append(ids)
+        return len(ids)
+
+
+def test_engine_times_each_stage_under_a_message_span(monkeypatch):
+    hist, tracer = FakeHistogram(), FakeTracer()
+    monkeypatch.setattr(engine_worker, "STAGES", stage_metrics.StageTimer(hist, tracer, span_prefix="engine."))
+    monkeypatch.setattr(engine_worker, "redis", AckRedis())
+    # heuristic intents: no NLP service
+    monkeypatch.setattr(engine_worker, "_NLP_SERVICE_URL", "")
+    monkeypatch.setattr(engine_worker, "_load_active_flow", lambda org_id: None)
+    engine_worker.FLOWS.invalidate()
+
+    payload = {"contact": {"phone": "555"}, "text": "hola"}
+    entries = [("1-0", {"org_id": "o-stages", "payload": json.dumps(payload)})]
+    asyncio.run(engine_worker.process_entries("nf:incoming", entries))
+
+    stages = [s for s, _ in hist.samples]
+    assert stages == ["parse", "wait_check", "flow_load", "nlp", "publish", "ack"]
+    assert all(seconds >= 0 for _, seconds in hist.samples)
+    parents = dict(tracer.spans)
+    assert parents["engine.nlp"] == "engine.message" and parents["engine.ack"] is None
+    assert engine_worker.redis.acks == [("1-0",)]
@@ -0,0 +1,108 @@
+from packages.common import stream_retention as sr
+
+
+class StreamFake:
+    """One stream with a single consumer group, exact trimming."""
+
+    def __init__(self, ids, last_delivered="0-0", pending=()):
+        self.ids = list(ids)
+        self.last_delivered = last_delivered
+        self.pending = list(pending)
+        self.kv = {}
+        self.reads = []
+
+    def xlen(self, stream):
+        return len(self.ids)
+
+    def xrange(self, stream, min="-", max="+", count=None):
+        self.reads.append(count)
+        start = (0, 0) if min == "-" else sr.parse_id(min)
+        return [(i, {}) for i in self.ids if sr.parse_id(i) >= start][:count]
+
+    def xrevrange(self, stream, max="+", min="-", count=None):
+        self.reads.append(count)
+        return [(i, {}) for i in reversed(self.ids)][:count]
+
+    def xinfo_groups(self, stream):
+        return [{"name": "engine", "pending": len(self.pending), "last-delivered-id": self.last_delivered}]
+
+    def xpending(self, stream, group):
+        return {"pending": len(self.pending), "min": min(self.pending, key=sr.parse_id) if self.pending else None}
+
+    def xtrim(self, stream, maxlen=None, approximate=True, minid=None):
+        before = len(self.ids)
+        if minid is not None:
+            self.ids = [i for i in self.ids if sr.parse_id(i) >= sr.parse_id(minid)]
+        if maxlen is not None:
+            self.ids = self.ids[-maxlen:]
+        return before - len(self.ids)
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.kv:
+            return None
+        self.kv[key] = value
+        return True
+
+    def get(self, key):
+        return self.kv.get(key)
+
+    def pexpire(self, key, ttl):
+        return True
+
+
+IDS = [f"{1000 + i}-0" for i in range(100)]
+
+
+def test_trim_never_passes_the_oldest_pending_entry():
+    r = StreamFake(IDS, last_delivered="1029-0", pending=["1020-0", "1025-0"])
+    rep = sr.trim_stream(r, "nf:incoming", {"maxlen": 10})
+    assert rep["trimmed"] == 20
+    assert r.ids[0] == "1020-0"
+
+
+def test_trim_respects_undelivered_entries_then_applies_maxlen():
+    r = StreamFake(IDS, last_delivered="1039-0")
+    sr.trim_stream(r, "nf:incoming", {"maxlen": 10})
+    assert r.ids[0] == "1040-0"  # group has not read past 1039
+
+    r.last_delivered = IDS[-1]
+    sr.trim_stream(r, "nf:incoming", {"maxlen": 10})
+    assert r.ids == IDS[-10:]
+
+
+def test_length_cutoff_reads_single_entries_only():
+    r = StreamFake(IDS, last_delivered=IDS[-1])
+    rep = sr.trim_stream(r, "nf:incoming", {"maxlen": 10})
+    assert rep["trimmed"] == 90 and r.ids == IDS[-10:]
+    assert r.reads and set(r.reads) == {1}
+
+    # ids within one millisecond: interpolated on the sequence
+    same_ms = [f"5000-{n}" for n in range(50)]
+    r = StreamFake(same_ms, last_delivered=same_ms[-1])
+    sr.trim_stream(r, "nf:incoming", {"maxlen": 20})
+    assert r.ids == same_ms[-20:]
+
+
+def test_hard_maxlen_bounds_memory_despite_a_stuck_group():
+    r = StreamFake(IDS, last_delivered="0-0")
+    rep = sr.trim_stream(r, "nf:incoming", {"maxlen": 10, "hard_maxlen": 30})
+    assert rep.get("hard") and len(r.ids) == 30
+
+
+def test_age_policy_keeps_recent_entries():
+    r = StreamFake(IDS, last_delivered=IDS[-1])
+    rep = sr.trim_stream(r, "nf:x", {"max_age_s": 1}, now_ms=1050 + 1000)
+    assert r.ids[0] == "1050-0" and rep["trimmed"] == 50
+
+
+def test_only_the_leader_trims():
+    r = StreamFake(IDS, last_delivered=IDS[-1])
+    assert sr.trim_loop_once(r, "engine-a", 30, {"nf:x": {"maxlen": 10}}) is not None
+    assert sr.trim_loop_once(r, "engine-b", 30, {"nf:x": {"maxlen": 10}}) is None
+    assert sr.trim_loop_once(r, "engine-a", 30, {"nf:x": {"maxlen": 10}}) is not None
+
+
+def test_policy_override_from_env_json():
+    pols = sr.load_policies('{"nf:incoming": {"maxlen": 5}, "nf:inbox": null, "custom": {"max_age_s": 60}}')
+    assert pols["nf:incoming"]["maxlen"] == 5 and pols["nf:incoming"]["hard_maxlen"] == 25
+    assert "nf:inbox" not in pols and pols["custom"] == {"max_age_s": 60}
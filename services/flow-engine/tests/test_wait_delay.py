@@ -19,11 +19,15 @@ def load_engine_worker():
 class FakeRedis:
     def __init__(self):
         self.zadds = []
+        self.hsets = {}
         self.xadds = []
 
     def zadd(self, key, mapping):
         self.zadds.append((key, dict(mapping)))
 
+    def hset(self, key, field, value):
+        self.hsets.setdefault(key, {})[field] = value
+
     def xadd(self, stream, mapping):
         self.xadds.append((stream, dict(mapping)))
 
@@ -80,10 +84,11 @@ def test_wait_schedules_resume(engine):
     # should have scheduled exactly one resume
     assert len(fake.zadds) == 1
     zkey, zmap = fake.zadds[0]
-    assert zkey == os.getenv("FLOW_ENGINE_SCHED_ZSET", "nf:incoming:scheduled")
-    # mapping key is serialized JSON of the item
-    item_raw = next(iter(zmap.keys()))
-    item = json.loads(item_raw)
+    prefix = os.getenv("FLOW_ENGINE_SCHED_ZSET", "nf:incoming:scheduled")
+    assert zkey.startswith(prefix + ":") and zkey[len(prefix) + 1:].isdigit()
+    # ZSET member is a compact id; the JSON item lives in the shard's hash
+    item_id = next(iter(zmap.keys()))
+    item = json.loads(fake.hsets[zkey + ":items"][item_id])
     resume = json.loads(item.get("engine_resume"))
     assert resume["path"] == "p"
     assert resume["index"] == 2
@@ -0,0 +1,161 @@
+import asyncio
+import importlib.util
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from packages.common import scheduler, wait_state
+
+
+class KVRedis:
+    """Strings, hashes, zsets and streams; no pipeline/scripting (one-by-one paths)."""
+
+    def __init__(self):
+        self.kv = {}
+        self.hashes = {}
+        self.zsets = {}
+        self.sets = {}
+        self.xadds = []
+
+    def get(self, key):
+        return self.kv.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.kv:
+            return None
+        self.kv[key] = value
+        return True
+
+    def delete(self, key):
+        self.kv.pop(key, None)
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def hdel(self, key, *fields):
+        h = self.hashes.get(key, {})
+        return sum(1 for f in fields if h.pop(f, None) is not None)
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrangebyscore(self, key, lo, hi, start=0, num=None):
+        due = sorted((s, m) for m, s in self.zsets.get(key, {}).items() if s <= float(hi))
+        return [m for _, m in due][start:start + num]
+
+    def zrem(self, key, member):
+        return 1 if self.zsets.get(key, {}).pop(member, None) is not None else 0
+
+    def zrange(self, key, a, b, withscores=False):
+        items = sorted(self.zsets.get(key, {}).items(), key=lambda kv: kv[1])[a:b + 1]
+        return items if withscores else [m for m, _ in items]
+
+    def xadd(self, stream, fields):
+        self.xadds.append((stream, dict(fields)))
+        return "1-0"
+
+
+def test_compact_record_roundtrip_lookup_and_expiry():
+    r = KVRedis()
+    now = 1_800_000_000
+    rec = wait_state.new_wait("f1", "p", 3, pattern="^s[ií]$", seconds=60, now=now)
+    r.hset("fe:waits:o1", "wa_main:1", wait_state.encode(rec))
+    raw = r.hashes["fe:waits:o1"]["wa_main:1"]
+    assert json.loads(raw)[3] == rec["resume_token"]
+    assert len(raw) < 80
+
+    found = asyncio.run(wait_state.lookup(r, "o1", "wa_main", "1", now=now))
+    assert found == rec
+    assert wait_state.matches(found, "SÍ") and not wait_state.matches(found, "no")
+    # past expires_at the wait is ignored even before the scheduler removes it
+    assert asyncio.run(wait_state.lookup(r, "o1", "wa_main", "1", now=now + 61)) is None
+
+    # waits stored under the old per-contact keys are still found
+    r.set("fe:wait:o1:wa_main:2", json.dumps({"path": "p", "index": 1, "resume_token": "t"}))
+    legacy = asyncio.run(wait_state.lookup(r, "o1", "wa_main", "2", legacy_prefix="fe:wait", now=now))
+    assert legacy["legacy_key"] == "fe:wait:o1:wa_main:2"
+    assert asyncio.run(wait_state.lookup(r, "o1", "wa_main", "2", now=now)) is None
+
+
+def test_scheduler_expires_only_current_waits():
+    r = KVRedis()
+    now = time.time()
+    current = wait_state.new_wait("f1", "p", 1, now=now - 4000)
+    replaced = wait_state.new_wait("f1", "p", 1, now=now - 4000)
+    r.hset("fe:waits:o1", "wa_main:1", wait_state.encode(current))
+    r.hset("fe:waits:o1", "wa_main:2", wait_state.encode(wait_state.new_wait("f1", "p", 5, now=now)))
+
+    async def run():
+        await scheduler.schedule_item(r, "sched", 2, wait_state.expiry_item("o1", "wa_main", "1", current), now - 1, "o1:1")
+        await scheduler.schedule_item(r, "sched", 2, wait_state.expiry_item("o1", "wa_main", "2", replaced), now - 1, "o1:2")
+        return await scheduler.claim_due_shards(r, "sched", range(2), "nf:incoming", "fe:wait", now=now, wait_hash_prefix="fe:waits")
+
+    published, skipped, _ = asyncio.run(run())
+    # expiry items never publish; the newer wait of contact 2 survives its predecessor's expiry
+    assert (published, skipped) == (0, 2)
+    assert r.xadds == []
+    assert set(r.hashes["fe:waits:o1"]) == {"wa_main:2"}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'waits.db').as_posix()}"
+    root = Path(__file__).resolve().parents[2].parent
+    spec = importlib.util.spec_from_file_location("engine_worker_waits", str(root / "services" / "flow-engine" / "worker" / "engine_worker.py"))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)  # type: ignore
+    from packages.common.db import engine as db_engine
+    from packages.common.models import Base
+
+    Base.metadata.create_all(bind=db_engine, tables=[Base.metadata.tables[t] for t in ("flows", "contacts", "flow_runs")])
+    return mod
+
+
+def test_wait_for_reply_stores_compact_wait_and_resumes_on_match(engine, monkeypatch):
+    from packages.common.db import SessionLocal
+    from packages.common.models import Flow
+
+    graph = {
+        "nodes": [{"id": "n1", "type": "intent", "map": {"default": "p"}}],
+        "paths": {"p": [
+            {"type": "action", "action": "send_text", "text": "¿confirmas?"},
+            {"type": "wait_for_reply", "pattern": "^s[ií]$"},
+            {"type": "action", "action": "send_text", "text": "confirmado"},
+        ]},
+    }
+    with SessionLocal() as s:
+        s.add(Flow(id="f-wait", org_id="o-wait", name="f", version=1, graph=graph, status="active", created_by="t"))
+        s.commit()
+
+    async def fake_classify(text, memo=None):
+        return "default"
+
+    r = KVRedis()
+    monkeypatch.setattr(engine, "redis", r)
+    monkeypatch.setattr(engine, "classify_intent", fake_classify)
+
+    def send(text):
+        fields = {"payload": json.dumps({"contact": {"phone": "777"}, "text": text}), "org_id": "o-wait", "channel_id": "wa_main"}
+        before = len(r.xadds)
+        assert asyncio.run(engine.handle_message("1-0", fields))
+        return [f["text"] for s, f in r.xadds[before:] if s == "nf:outbox"]
+
+    assert send("hola") == ["¿confirmas?"]
+    record = wait_state.decode(r.hashes["fe:waits:o-wait"]["wa_main:777"])
+    assert (record["flow_id"], record["path"], record["index"]) == ("f-wait", "p", 2)
+    # no per-key TTL: the scheduler holds the expiry item for this wait
+    items = [json.loads(v) for h in r.hashes.values() for v in h.values() if v.startswith("{")]
+    assert [i["resume_token"] for i in items if i.get("expire")] == [record["resume_token"]]
+
+    assert send("no") == []
+    assert send("si") == ["confirmado"]
+    assert "wa_main:777" not in r.hashes["fe:waits:o-wait"]
@@ -1,10 +1,17 @@
 import os, json, time, asyncio, logging, uuid, re
+from collections import OrderedDict
 import httpx
-from prometheus_client import Counter, start_http_server
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 from pythonjsonlogger import json as jsonlogger
 from redis import Redis
+from packages.common import aredis, effects, flow_cache, flow_interpreter, reclaim, run_store, scheduler, stage_metrics, stream_retention, wait_state
+from packages.common.batching import MicroBatcher
+from packages.common.aredis import maybe_await
+from packages.common.wa_webhook import decode_webhook
 
-redis = Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"), decode_responses=True)
+_REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+# Async pooled client for the event loop; thread-bound helpers (retention) get their own sync client
+redis = aredis.from_url(_REDIS_URL)
 
 handler = logging.StreamHandler()
 formatter = jsonlogger.JsonFormatter('%(asctime)s %(name)s %(levelname)s %(message)s')
@@ -15,18 +22,96 @@ logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
 
 # Metrics (opt-in via env var to avoid duplicate registration in tests)
 _METRICS_ENABLED = os.getenv("FLOW_ENGINE_METRICS", "false").lower() == "true"
+# Per-stage spans (needs opentelemetry-api; exporter configured by the deployment)
+_OTEL_ENABLED = os.getenv("FLOW_ENGINE_OTEL", "false").lower() == "true"
+try:
+    _LAG_INTERVAL_S = float(os.getenv("FLOW_ENGINE_LAG_INTERVAL_S", "15"))
+except Exception:
+    _LAG_INTERVAL_S = 15.0
 CONSUMER_GROUP = os.getenv("FLOW_ENGINE_GROUP", "engine")
 CONSUMER_NAME = os.getenv("FLOW_ENGINE_CONSUMER", None) or os.getenv("HOSTNAME", "engine-1")
 try:
     ENGINE_MAX_RETRIES = int(os.getenv("FLOW_ENGINE_MAX_RETRIES", "2"))
 except Exception:
     ENGINE_MAX_RETRIES = 2
+# Retries: backoff before re-claiming a failed entry doubles per delivery (capped below the reclaim min-idle)
+try:
+    _RETRY_BASE_MS = int(os.getenv("FLOW_ENGINE_RETRY_BASE_MS", "1000"))
+except Exception:
+    _RETRY_BASE_MS = 1000
+try:
+    _RETRY_MAX_MS = int(os.getenv("FLOW_ENGINE_RETRY_MAX_MS", "30000"))
+except Exception:
+    _RETRY_MAX_MS = 30000
+try:
+    _RETRY_POLL_MS = int(os.getenv("FLOW_ENGINE_RETRY_POLL_MS", "500"))
+except Exception:
+    _RETRY_POLL_MS = 500
 try:
     _SCHED_POLL_MS = int(os.getenv("FLOW_ENGINE_SCHED_POLL_MS", "500"))
 except Exception:
     _SCHED_POLL_MS = 500
 _SCHED_ZSET = os.getenv("FLOW_ENGINE_SCHED_ZSET", "nf:incoming:scheduled")
+try:
+    _SCHED_BATCH = max(1, int(os.getenv("FLOW_ENGINE_SCHED_BATCH", "200")))
+except Exception:
+    _SCHED_BATCH = 200
+# Sharded scheduler: items go to <zset>:<n> by contact; replicas split the shards via
+# heartbeats in <zset>:members, or take a fixed list from FLOW_ENGINE_SCHED_OWNED ("0,1,5")
+try:
+    _SCHED_SHARDS = max(1, int(os.getenv("FLOW_ENGINE_SCHED_SHARDS", "16")))
+except Exception:
+    _SCHED_SHARDS = 16
+try:
+    _SCHED_OWNED = [int(x) for x in os.getenv("FLOW_ENGINE_SCHED_OWNED", "").split(",") if x.strip()]
+except Exception:
+    _SCHED_OWNED = []
+try:
+    _SCHED_MEMBER_TTL_S = float(os.getenv("FLOW_ENGINE_SCHED_MEMBER_TTL_S", "15"))
+except Exception:
+    _SCHED_MEMBER_TTL_S = 15.0
+# set by _schedule_resume so a sooner-than-expected item in this process is picked up at once
+_SCHED_WAKE: asyncio.Event | None = None
+# Batched consumption: entries per XREADGROUP, messages handled concurrently, XREADGROUP block
+try:
+    ENGINE_READ_COUNT = max(1, int(os.getenv("FLOW_ENGINE_READ_COUNT", "32")))
+except Exception:
+    ENGINE_READ_COUNT = 32
+try:
+    ENGINE_CONCURRENCY = max(1, int(os.getenv("FLOW_ENGINE_CONCURRENCY", "16")))
+except Exception:
+    ENGINE_CONCURRENCY = 16
+try:
+    ENGINE_BLOCK_MS = int(os.getenv("FLOW_ENGINE_BLOCK_MS", "5000"))
+except Exception:
+    ENGINE_BLOCK_MS = 5000
+# Stream retention: one engine replica (leader lock) trims every stream per policy
+_RETENTION_ENABLED = os.getenv("STREAM_RETENTION_ENABLED", "true").lower() == "true"
+try:
+    _RETENTION_INTERVAL_S = float(os.getenv("STREAM_TRIM_INTERVAL_S", "30"))
+except Exception:
+    _RETENTION_INTERVAL_S = 30.0
+# wait_for_reply state lives in per-org hashes (packages/common/wait_state.py); the old
+# per-contact keys under FLOW_ENGINE_WAIT_PREFIX are still read until they have expired
 _WAIT_PREFIX = os.getenv("FLOW_ENGINE_WAIT_PREFIX", "fe:wait")
+_WAIT_LEGACY = os.getenv("FLOW_ENGINE_WAIT_LEGACY", "true").lower() == "true"
+# Per-message execution budget (packages/common/flow_interpreter.py); a flow out of budget
+# continues in a scheduled resume, at most FLOW_MAX_CONTINUATIONS times in a row
+_FLOW_BUDGET = flow_interpreter.budget()
+try:
+    _FLOW_MAX_CONTINUATIONS = int(os.getenv("FLOW_MAX_CONTINUATIONS", "10"))
+except Exception:
+    _FLOW_MAX_CONTINUATIONS = 10
+# Flow run state: cached in Redis (packages/common/run_store.py), flushed to flow_runs in batches
+_RUN_STORE_ENABLED = os.getenv("FLOW_RUN_STORE_ENABLED", "true").lower() == "true"
+try:
+    _RUN_FLUSH_INTERVAL_MS = int(os.getenv("FLOW_RUN_FLUSH_INTERVAL_MS", "1000"))
+except Exception:
+    _RUN_FLUSH_INTERVAL_MS = 1000
+try:
+    _RUN_FLUSH_BATCH = max(1, int(os.getenv("FLOW_RUN_FLUSH_BATCH", "500")))
+except Exception:
+    _RUN_FLUSH_BATCH = 500
 
 _NLP_SERVICE_URL = os.getenv("NLP_SERVICE_URL", "http://nlp:8000").rstrip("/")
 try:
@@ -35,11 +120,46 @@ except Exception:
     _NLP_TIMEOUT = 1.5
 _INTENT_DEFAULT = os.getenv("NLP_FALLBACK_INTENT", "default")
 _INTENT_WARNED = False
+# Long-lived NLP client (keep-alive pool) and a TTL cache of classifications by normalized text
+try:
+    _NLP_MAX_CONNECTIONS = int(os.getenv("NLP_MAX_CONNECTIONS", "20"))
+except Exception:
+    _NLP_MAX_CONNECTIONS = 20
+try:
+    _INTENT_CACHE_TTL = float(os.getenv("NLP_CACHE_TTL", "300"))
+except Exception:
+    _INTENT_CACHE_TTL = 300.0
+try:
+    _INTENT_CACHE_SIZE = int(os.getenv("NLP_CACHE_SIZE", "2048"))
+except Exception:
+    _INTENT_CACHE_SIZE = 2048
+# Concurrent classifications within the window go to /api/nlp/intents:batch as one request
+_NLP_BATCH_ENABLED = os.getenv("NLP_BATCH_ENABLED", "true").lower() == "true"
+try:
+    _NLP_BATCH_WINDOW_MS = float(os.getenv("NLP_BATCH_WINDOW_MS", "5"))
+except Exception:
+    _NLP_BATCH_WINDOW_MS = 5.0
+try:
+    _NLP_BATCH_MAX = int(os.getenv("NLP_BATCH_MAX", "64"))
+except Exception:
+    _NLP_BATCH_MAX = 64
+# the nlp service's own NLP_MAX_BATCH: larger requests are rejected with 422, so flushes are chunked to it
+try:
+    _NLP_SERVICE_MAX_BATCH = max(1, int(os.getenv("NLP_MAX_BATCH", "256")))
+except Exception:
+    _NLP_SERVICE_MAX_BATCH = 256
+_NLP_BATCH_SUPPORTED = True
+_NLP_CLIENT = None
+_NLP_CLIENT_LOOP = None
+_INTENT_CACHE: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
 
 class _Noop:
     def inc(self, *args, **kwargs):
         return None
 
+    def set(self, *args, **kwargs):
+        return None
+
 if _METRICS_ENABLED:
     ENGINE_PROCESSED = Counter('nexia_engine_incoming_processed_total', 'Incoming messages processed')
     ENGINE_PUBLISHED = Counter('nexia_engine_outbox_published_total', 'Actions published to nf:outbox')
@@ -48,6 +168,12 @@ if _METRICS_ENABLED:
     ENGINE_DLQ = Counter('nexia_engine_dlq_total', 'Engine DLQ messages')
     ENGINE_SCHEDULED = Counter('nexia_engine_scheduled_total', 'Flow events scheduled for later')
     ENGINE_SCHED_PUBLISHED = Counter('nexia_engine_sched_published_total', 'Scheduled events published back to nf:incoming')
+    ENGINE_RUN_CONFLICTS = Counter('nexia_engine_run_conflicts_total', 'Flow run saves retried after a version conflict')
+    ENGINE_RUNS_FLUSHED = Counter('nexia_engine_runs_flushed_total', 'Flow run states written to flow_runs')
+    ENGINE_RECLAIMED = Counter('nexia_engine_reclaimed_total', 'Pending nf:incoming entries reclaimed from idle consumers')
+    ENGINE_STAGE = Histogram('nexia_engine_stage_seconds', 'Time spent per message-handling stage', ['stage'], buckets=stage_metrics.BUCKETS)
+    ENGINE_CONSUMER_LAG = Gauge('nexia_engine_consumer_lag', 'nf:incoming entries not yet delivered to the engine group')
+    ENGINE_CONSUMER_PENDING = Gauge('nexia_engine_consumer_pending', 'nf:incoming entries delivered to the engine group but not acked')
 else:
     ENGINE_PROCESSED = _Noop()
     ENGINE_PUBLISHED = _Noop()
@@ -56,6 +182,17 @@ else:
     ENGINE_DLQ = _Noop()
     ENGINE_SCHEDULED = _Noop()
     ENGINE_SCHED_PUBLISHED = _Noop()
+    ENGINE_RUN_CONFLICTS = _Noop()
+    ENGINE_RUNS_FLUSHED = _Noop()
+    ENGINE_RECLAIMED = _Noop()
+    ENGINE_STAGE = None
+    ENGINE_CONSUMER_LAG = _Noop()
+    ENGINE_CONSUMER_PENDING = _Noop()
+
+# with STAGES("<stage>"): histogram sample and optional span per hot-path stage
+STAGES = stage_metrics.StageTimer(
+    ENGINE_STAGE, stage_metrics.tracer("nexia.flow-engine") if _OTEL_ENABLED else None, span_prefix="engine.",
+)
 
 try:
     from packages.common.db import SessionLocal  # type: ignore
@@ -104,123 +241,233 @@ def _fallback_intent(text: str) -> str:
     return _INTENT_DEFAULT
 
 
-async def classify_intent(text: str) -> str:
+def _nlp_client() -> httpx.AsyncClient:
+    """Shared AsyncClient for the running event loop (connections are reused across messages)."""
+    global _NLP_CLIENT, _NLP_CLIENT_LOOP
+    loop = asyncio.get_running_loop()
+    if _NLP_CLIENT is None or _NLP_CLIENT.is_closed or _NLP_CLIENT_LOOP is not loop:
+        _NLP_CLIENT = httpx.AsyncClient(
+            timeout=_NLP_TIMEOUT,
+            limits=httpx.Limits(max_connections=_NLP_MAX_CONNECTIONS, max_keepalive_connections=_NLP_MAX_CONNECTIONS),
+        )
+        _NLP_CLIENT_LOOP = loop
+    return _NLP_CLIENT
+
+
+async def close_nlp_client() -> None:
+    global _NLP_CLIENT
+    if _NLP_CLIENT is not None:
+        try:
+            await _NLP_CLIENT.aclose()
+        except Exception:
+            pass
+        _NLP_CLIENT = None
+
+
+_WS = re.compile(r"\s+")
+
+
+def _intent_cache_key(text: str) -> str:
+    # "Hola!!", "hola" and " HOLA " classify the same
+    return _WS.sub(" ", text.lower()).strip(" ¿?¡!.,;:")
+
+
+def _intent_cache_get(key: str) -> str | None:
+    item = _INTENT_CACHE.get(key)
+    if item is None:
+        return None
+    if item[0] < time.monotonic():
+        _INTENT_CACHE.pop(key, None)
+        return None
+    _INTENT_CACHE.move_to_end(key)
+    return item[1]
+
+
+def _intent_cache_put(key: str, label: str) -> None:
+    if _INTENT_CACHE_TTL <= 0 or not key:
+        return
+    _INTENT_CACHE[key] = (time.monotonic() + _INTENT_CACHE_TTL, label)
+    _INTENT_CACHE.move_to_end(key)
+    while len(_INTENT_CACHE) > _INTENT_CACHE_SIZE:
+        _INTENT_CACHE.popitem(last=False)
+
+
+async def classify_intent(text: str, memo: dict | None = None) -> str:
+    """Intent label for ``text``; ``memo`` is a per-message dict so one message classifies once."""
     message = (text or "").strip()
     if not message:
         return _INTENT_DEFAULT
-    if not _NLP_SERVICE_URL:
-        return _fallback_intent(message)
+    if memo is not None and message in memo:
+        return memo[message]
+    with STAGES("nlp"):
+        label = await _classify_intent(message)
+    if memo is not None:
+        memo[message] = label
+    return label
 
+
+def _primary_label(data) -> str | None:
+    if not isinstance(data, dict):
+        return None
+    primary = data.get("primary_intent") or (data.get("top_intents") or [{}])[0].get("label")
+    if isinstance(primary, str) and primary:
+        return primary.strip().lower()
+    return None
+
+
+def _nlp_failed(reason: str, status: int | None = None) -> None:
     global _INTENT_WARNED
-    url = f"{_NLP_SERVICE_URL}/api/nlp/intents"
-    payload = {"text": message, "top_k": 1}
+    if _INTENT_WARNED:
+        return
+    if status is not None:
+        logger.warning("nlp service returned %s", status)
+    else:
+        logger.exception(reason)
+    _INTENT_WARNED = True
+
+
+async def _nlp_single(message: str) -> str | None:
     try:
-        async with httpx.AsyncClient(timeout=_NLP_TIMEOUT) as client:
-            resp = await client.post(url, json=payload)
-            if resp.status_code == 200:
-                data = resp.json()
-                primary = data.get("primary_intent") or data.get("top_intents", [{}])[0].get("label")
-                if isinstance(primary, str) and primary:
-                    return primary.strip().lower()
-            else:
-                if not _INTENT_WARNED:
-                    logger.warning("nlp service returned %s", resp.status_code)
-                    _INTENT_WARNED = True
+        resp = await _nlp_client().post(f"{_NLP_SERVICE_URL}/api/nlp/intents", json={"text": message, "top_k": 1})
+        if resp.status_code == 200:
+            return _primary_label(resp.json())
+        _nlp_failed("nlp intent classification failed", resp.status_code)
+    except Exception:
+        _nlp_failed("nlp intent classification failed")
+    return None
+
+
+async def _nlp_batch_request(texts: list[str]) -> dict[str, str | None]:
+    """One ``/intents:batch`` request; ``{}`` when it failed."""
+    global _NLP_BATCH_SUPPORTED
+    try:
+        resp = await _nlp_client().post(f"{_NLP_SERVICE_URL}/api/nlp/intents:batch", json={"texts": texts, "top_k": 1})
+        if resp.status_code == 200:
+            results = resp.json().get("results") or []
+            return {t: _primary_label(r) for t, r in zip(texts, results)}
+        if resp.status_code in (404, 405):
+            # older nlp service without the batch endpoint
+            if _NLP_BATCH_SUPPORTED:
+                logger.warning("nlp batch endpoint unavailable (%s); classifying one by one", resp.status_code)
+            _NLP_BATCH_SUPPORTED = False
+        elif resp.status_code == 422:
+            # the service is up but rejected the request: a config mismatch, not an outage
+            logger.warning(
+                "nlp batch of %d texts rejected (422; NLP_MAX_BATCH=%d here, check the nlp service's): %s",
+                len(texts), _NLP_SERVICE_MAX_BATCH, resp.text[:200],
+            )
+            found = await asyncio.gather(*(_nlp_single(t) for t in texts))
+            return dict(zip(texts, found))
+        else:
+            _nlp_failed("nlp batch classification failed", resp.status_code)
     except Exception:
-        if not _INTENT_WARNED:
-            logger.exception("nlp intent classification failed")
-            _INTENT_WARNED = True
+        _nlp_failed("nlp batch classification failed")
+    return {}
+
+
+async def _nlp_batch(texts: list[str]) -> list[str | None]:
+    """MicroBatcher flush: one HTTP request (and one model pass) per ``NLP_MAX_BATCH`` queued texts."""
+    unique = list(dict.fromkeys(texts))
+    labels: dict[str, str | None] = {}
+    if _NLP_BATCH_SUPPORTED:
+        chunks = [unique[i:i + _NLP_SERVICE_MAX_BATCH] for i in range(0, len(unique), _NLP_SERVICE_MAX_BATCH)]
+        for found in await asyncio.gather(*(_nlp_batch_request(chunk) for chunk in chunks)):
+            labels.update(found)
+    if not _NLP_BATCH_SUPPORTED:
+        found = await asyncio.gather(*(_nlp_single(t) for t in unique))
+        labels = dict(zip(unique, found))
+    return [labels.get(t) for t in texts]
+
+
+INTENT_BATCHER = MicroBatcher(_nlp_batch, window_ms=_NLP_BATCH_WINDOW_MS, max_items=_NLP_BATCH_MAX)
+
+
+async def _classify_intent(message: str) -> str:
+    if not _NLP_SERVICE_URL:
+        return _fallback_intent(message)
+    key = _intent_cache_key(message)
+    cached = _intent_cache_get(key)
+    if cached is not None:
+        return cached
+    if _NLP_BATCH_ENABLED:
+        try:
+            label = (await INTENT_BATCHER.submit([message]))[0]
+        except Exception:
+            _nlp_failed("nlp intent classification failed")
+            label = None
+    else:
+        label = await _nlp_single(message)
+    if label:
+        # only real classifications are cached; fallbacks retry the service next time
+        _intent_cache_put(key, label)
+        return label
     return _fallback_intent(message)
 
+
 async def handle_message(msg_id: str, fields: dict) -> bool:
     payload_raw = fields.get("payload") or fields.get("body") or ""
-    try:
-        payload = json.loads(payload_raw)
-    except Exception:
-        payload = {"text": payload_raw}
-    # try to extract text from common WA structure
-    text = ""
-    # also try to extract contact phone (for replies)
-    contact_phone = None
-    # Common webhook path: entry->[0]->changes->[0]->value->messages->[0]->text->body
-    try:
-        entry = payload.get("entry", [])
-        if entry:
-            changes = entry[0].get("changes", [])
-            if changes:
-                value = changes[0].get("value", {})
-                messages = value.get("messages", [])
-                if messages:
-                    m0 = messages[0]
-                    text = m0.get("text", {}).get("body", "")
-                    # for WhatsApp Cloud incoming, the sender's phone is in `from`
-                    contact_phone = m0.get("from") or contact_phone
-                # also check value.contacts[0].wa_id if present
-                contacts = value.get("contacts", [])
-                if contacts:
-                    contact_phone = contacts[0].get("wa_id") or contact_phone
-    except Exception:
-        pass
-    if not text:
-        # fallback to a top-level text
-        text = payload.get("text") or payload.get("message") or ""
+    with STAGES("parse"):
+        try:
+            payload = json.loads(payload_raw)
+        except Exception:
+            payload = {"text": payload_raw}
+        if not isinstance(payload, dict):
+            payload = {"text": payload_raw}
+        # One stream entry may carry a whole Meta batch (older receivers): handle every message
+        events, _ = decode_webhook(payload)
+    if fields.get("engine_resume") and len(events) > 1:
+        # scheduled resumes belong to a single contact
+        wanted = fields.get("contact_phone")
+        events = [ev for ev in events if ev.get("from") == wanted][:1] or events[:1]
+    if not events:
+        # internal/legacy shape: top-level text and contact.phone
+        events = [{"text": payload.get("text") or payload.get("message") or "", "from": None, "payload": payload}]
+    ok = True
+    for ev in events:
+        ev_fields = dict(fields) if len(events) > 1 else fields
+        if not await _handle_event(ev_fields, ev.get("payload") or payload, ev.get("text") or "", ev.get("from")):
+            ok = False
+    return ok
 
+
+async def _handle_event(fields: dict, payload: dict, text: str, contact_phone: str | None) -> bool:
     # If there's a waiting rule for this contact, check match and optionally resume
     org_id = fields.get("org_id")
     channel_id = fields.get("channel_id") or "wa_main"
     waited = False
+    # the flow path and the fallback reply may both need the intent: classify once
+    intent_memo: dict = {}
+    wait_clear = None
     if org_id and (contact_phone or payload.get("contact", {}).get("phone")):
         target_phone = contact_phone or payload.get("contact", {}).get("phone")
-        wkey = f"{_WAIT_PREFIX}:{org_id}:{channel_id}:{target_phone}"
-        try:
-            raw = redis.get(wkey)
-        except Exception:
-            raw = None
-        if raw:
-            waited = True
+        with STAGES("wait_check"):
             try:
-                cfg = json.loads(raw)
+                cfg = await wait_state.lookup(redis, org_id, channel_id, target_phone, legacy_prefix=_WAIT_PREFIX if _WAIT_LEGACY else None)
             except Exception:
                 cfg = None
-            matched = True
-            patt = None
-            try:
-                patt = cfg.get("pattern") if isinstance(cfg, dict) else None
-            except Exception:
-                patt = None
-            if patt:
-                try:
-                    matched = bool(re.search(str(patt), text or "", re.IGNORECASE))
-                except Exception:
-                    matched = False
-            if matched and isinstance(cfg, dict):
-                # clear wait and resume flow at stored path/index
-                try:
-                    redis.delete(wkey)
-                except Exception:
-                    pass
-                resume = {"path": cfg.get("path"), "index": int(cfg.get("index") or 0)}
-                fields["engine_resume"] = json.dumps(resume)
-            else:
+            matched = bool(cfg) and wait_state.matches(cfg, text)
+        if cfg:
+            waited = True
+            if not matched:
                 # still waiting: suppress default replies
                 return True
+            # clear the wait (in this message's flush) and resume at the stored path/index
+            wait_clear = (org_id, channel_id, target_phone, cfg.get("legacy_key"))
+            resume = {"path": cfg.get("path"), "index": int(cfg.get("index") or 0)}
+            fields["engine_resume"] = json.dumps(resume)
 
-    # Try to run a configured flow; fall back to heuristic reply
+    # Try to run a configured flow; fall back to heuristic reply.
+    # Everything the message produces is buffered and written in one flush at the end.
+    buf = effects.EffectsBuffer()
     published = False
     try:
-        outs = await _run_flow_minimal(text=text, contact_phone=contact_phone, fields=fields, payload=payload)
+        outs = await _run_flow_minimal(text=text, contact_phone=contact_phone, fields=fields, payload=payload, intent_memo=intent_memo, buffer=buf)
         for out in outs:
             # ensure minimal enrichment
             if fields.get("org_id"):
                 out["org_id"] = fields.get("org_id")
-            trace_id = out.get("trace_id") or str(uuid.uuid4())
-            out["trace_id"] = trace_id
-            redis.xadd("nf:outbox", {k: str(v) for k, v in out.items()})
-            try:
-                ENGINE_PUBLISHED.inc()
-            except Exception:
-                pass
-            logger.info("published nf:outbox message", extra={"trace_id": trace_id, "to": out.get("to"), "client_id": out.get("client_id")})
+            out["trace_id"] = out.get("trace_id") or str(uuid.uuid4())
+            buf.add_outbox(out)
             published = True
     except Exception:
         logger.exception("flow execution failed")
@@ -228,9 +475,12 @@ async def handle_message(msg_id: str, fields: dict) -> bool:
             ENGINE_ERRORS.inc()
         except Exception:
             pass
+        # drop half-recorded effects of the failed execution
+        buf = effects.EffectsBuffer()
+        published = False
 
     if not published:
-        intent = await classify_intent(text)
+        intent = await classify_intent(text, intent_memo)
         # simple action: reply with a template based on intent
         if intent == "pricing":
             reply = "Gracias por preguntar sobre precios. Nuestro plan starter cuesta $9/mes."
@@ -243,55 +493,70 @@ async def handle_message(msg_id: str, fields: dict) -> bool:
 
         # publish to outbox (so messaging-gateway will pick it)
         # include org_id/channel_id when provided by upstream (webhook enrichment)
+        channel = fields.get("channel_id") or "wa_main"
+        to_phone = contact_phone or payload.get("contact", {}).get("phone", "unknown")
+        out = {
+            "channel_id": channel,
+            "to": to_phone,
+            "type": "text",
+            "text": reply,
+            "client_id": f"auto_{int(time.time()*1000)}",
+            "orig_text": text,
+            "trace_id": str(uuid.uuid4()),
+        }
+        if fields.get("org_id"):
+            out["org_id"] = fields.get("org_id")
+        buf.add_outbox(out)
+
+    if wait_clear:
+        buf.clear_wait(*wait_clear)
+    try:
+        await _flush_effects(buf)
+    except Exception:
+        logger.exception("engine effects flush failed")
         try:
-            trace_id = str(uuid.uuid4())
-            channel = fields.get("channel_id") or "wa_main"
-            to_phone = contact_phone or payload.get("contact", {}).get("phone", "unknown")
-            out = {
-                "channel_id": channel,
-                "to": to_phone,
-                "type": "text",
-                "text": reply,
-                "client_id": f"auto_{int(time.time()*1000)}",
-                "orig_text": text,
-                "trace_id": trace_id,
-            }
-            if fields.get("org_id"):
-                out["org_id"] = fields.get("org_id")
-            # ensure all values are strings for redis stream
-            redis.xadd("nf:outbox", {k: str(v) for k, v in out.items()})
-            try:
-                ENGINE_PUBLISHED.inc()
-            except Exception:
-                pass
-            # log the published message with trace_id for observability
-            logger.info("published nf:outbox message", extra={"trace_id": trace_id, "to": out.get("to"), "client_id": out.get("client_id")})
+            ENGINE_ERRORS.inc()
         except Exception:
-            logger.exception("engine xadd failed")
-            try:
-                ENGINE_ERRORS.inc()
-            except Exception:
-                pass
-            return False
-        return True
+            pass
+        return False
+    for out in buf.outbox:
+        # log the published message with trace_id for observability
+        logger.info("published nf:outbox message", extra={"trace_id": out.get("trace_id"), "to": out.get("to"), "client_id": out.get("client_id")})
     return True
 
-async def _run_flow_minimal(text: str, contact_phone: str | None, fields: dict, payload: dict) -> list[dict]:
-    """Execute a very small subset of a flow definition if available.
 
-    Strategy:
-    - Look up latest active flow for org_id (if org_id present).
-    - Find first node with type "intent" and a "map" dict.
-    - Map await classify_intent(text) -> path name; default to "default" or first key.
-    - Execute first step of that path if it's an action of type send_*.
-    - Return list of 0..N outbox messages to publish.
-    """
-    org_id = fields.get("org_id")
-    if not org_id or not SessionLocal or not DBFlow:
-        return []
+async def _flush_effects(buf: effects.EffectsBuffer) -> None:
+    """One DB transaction (attributes) and one Redis MULTI/EXEC for a message's effects."""
+    if not len(buf):
+        return
+    if buf.attributes:
+        # off the event loop; a failure fails the message before anything reaches Redis
+        with STAGES("attributes"):
+            await asyncio.to_thread(buf.flush_db, SessionLocal, DBContact)
+    with STAGES("publish"):
+        await buf.flush_redis(redis, _SCHED_ZSET, _SCHED_SHARDS)
+    try:
+        if buf.outbox:
+            ENGINE_PUBLISHED.inc(len(buf.outbox))
+        if buf.schedules:
+            ENGINE_SCHEDULED.inc(len(buf.schedules))
+    except Exception:
+        pass
+    if buf.schedules and _SCHED_WAKE is not None:
+        _SCHED_WAKE.set()
+    if buf.run_conflict and buf.run_retry is not None:
+        # another replica moved the run meanwhile: re-read and re-apply
+        ENGINE_RUN_CONFLICTS.inc()
+        await buf.run_retry()
+
+# Compiled active flow per org; invalidated by the api-gateway's "flow published" signal
+FLOWS = flow_cache.FlowCache()
+
+
+def _load_active_flow(org_id: str):
+    """Latest active flow for the org as ``(flow_id, version, graph)`` (cache miss path)."""
     try:
         with SessionLocal() as db:
-            # Prefer latest active/published flow
             row = (
                 db.query(DBFlow)
                 .filter(getattr(DBFlow, "org_id") == str(org_id))
@@ -299,21 +564,64 @@ async def _run_flow_minimal(text: str, contact_phone: str | None, fields: dict,
                 .order_by(getattr(DBFlow, "version", 0).desc())
                 .first()
             )
+            if row is None:
+                return None
+            return getattr(row, "id", None), getattr(row, "version", None), getattr(row, "graph", None)
     except Exception:
-        row = None
-    if not row:
+        logger.exception("active flow lookup failed")
+        return None
+
+
+async def flow_cache_listener():
+    """Drop cached flows when the api-gateway publishes a flow change."""
+    while True:
+        pubsub = None
+        try:
+            pubsub = redis.pubsub()
+            await maybe_await(pubsub.subscribe(flow_cache.CHANNEL))
+            # anything published while we were not subscribed is lost: start clean
+            FLOWS.invalidate()
+            logger.info("flow cache listening on %s", flow_cache.CHANNEL)
+            while True:
+                msg = await maybe_await(pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0))
+                if msg and msg.get("type") == "message":
+                    FLOWS.handle_message(msg.get("data"))
+                elif msg is None:
+                    await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("flow cache listener error")
+            await asyncio.sleep(1)
+        finally:
+            if pubsub is not None:
+                try:
+                    await maybe_await(pubsub.close())
+                except Exception:
+                    pass
+
+
+async def _run_flow_minimal(text: str, contact_phone: str | None, fields: dict, payload: dict, intent_memo: dict | None = None, buffer: effects.EffectsBuffer | None = None) -> list[dict]:
+    """Run the org's active flow for one inbound message (or scheduled resume).
+
+    Strategy:
+    - Get the compiled active flow for org_id (FLOWS cache; DB only on a miss).
+    - Start on the stored resume position, or the path mapped from the intent.
+    - Execute with ``flow_interpreter.run`` under the per-message budget; record
+      its effects (attributes, webhooks, waits/delays, run state) in ``buffer``.
+    - Return list of 0..N outbox messages to publish.
+
+    Without a ``buffer`` the effects are flushed before returning.
+    """
+    org_id = fields.get("org_id")
+    if not org_id or not SessionLocal or not DBFlow:
         return []
-    graph = getattr(row, "graph", None)
-    if not isinstance(graph, dict):
+    # Compiled active flow from the in-process cache (DB only on a miss, in a worker thread)
+    with STAGES("flow_load"):
+        flow = await FLOWS.aget(org_id, _load_active_flow)
+    if not flow:
         return []
-    mapping = None
-    try:
-        for n in graph.get("nodes", []) or []:
-            if n.get("type") == "intent" and isinstance(n.get("map"), dict):
-                mapping = n.get("map")
-                break
-    except Exception:
-        mapping = None
+    flow_id = flow["flow_id"]
     # Support resume from scheduled step
     resume = None
     try:
@@ -322,189 +630,237 @@ async def _run_flow_minimal(text: str, contact_phone: str | None, fields: dict,
     except Exception:
         resume = None
 
-    intent_label = await classify_intent(text)
-    path_key = None
+    intent_label = await classify_intent(text, intent_memo)
     if resume and resume.get("path"):
         path_key = resume.get("path")
-    elif mapping:
-        path_key = mapping.get(intent_label) or mapping.get("default")
-    # Fallback: try a well-known path
-    if not path_key:
-        path_key = "path_default"
-    steps = None
-    try:
-        steps = (graph.get("paths", {}) or {}).get(path_key)
-    except Exception:
-        steps = None
-    if not isinstance(steps, list) or not steps:
+    else:
+        path_key = flow_interpreter.entry_path(flow, intent_label)
+    if not flow["paths"].get(path_key):
         return []
-    # Execute multiple consecutive steps (MVP: up to 5)
-    channel = fields.get("channel_id") or "wa_main"
-    to_phone = contact_phone or payload.get("contact", {}).get("phone", "unknown")
-    base = {
-        "channel_id": channel,
-        "to": to_phone,
-        "client_id": f"auto_{int(time.time()*1000)}",
-        "orig_text": text,
-    }
-    outputs: list[dict] = []
     start_index = 0
     try:
         if resume and isinstance(resume.get("index"), int):
             start_index = max(0, int(resume["index"]))
     except Exception:
         start_index = 0
-    for idx, step in enumerate(steps[start_index:start_index+5], start=start_index):
-        if not isinstance(step, dict):
-            break
-        stype = step.get("type")
-        if stype == "wait_for_reply":
-            # Store a waiting rule for this contact and schedule an optional timeout resume
-            pattern = step.get("pattern")
-            seconds = 0
-            try:
-                seconds = int(step.get("seconds") or step.get("timeout_seconds") or 0)
-            except Exception:
-                seconds = 0
-            resume_token = str(uuid.uuid4())
-            # Next index to continue when reply arrives
-            next_index = idx + 1
-            # Optionally a timeout path (start at 0)
-            timeout_path = step.get("timeout_path")
-            # Persist wait state with TTL
-            try:
-                wkey = f"{_WAIT_PREFIX}:{org_id}:{channel}:{to_phone}"
-                record = {
-                    "path": path_key,
-                    "index": next_index,
-                    "pattern": pattern,
-                    "resume_token": resume_token,
-                    "org_id": str(org_id or ""),
-                    "channel_id": channel,
+    channel = fields.get("channel_id") or "wa_main"
+    to_phone = contact_phone or payload.get("contact", {}).get("phone", "unknown")
+    attributes: dict = {}
+    if flow_interpreter.reads_attributes(flow):
+        # the interpreter is synchronous: read the contact's attributes off the event loop up front
+        try:
+            attributes = await asyncio.to_thread(_contact_attributes, org_id, to_phone)
+        except Exception:
+            logger.exception("contact attributes lookup failed")
+    with STAGES("execute"):
+        result = flow_interpreter.run(
+            flow, path_key, start_index,
+            intent=intent_label, text=text, contact_key=to_phone, limits=_FLOW_BUDGET,
+            attributes=attributes,
+        )
+    stamp = int(time.time() * 1000)
+    outputs: list[dict] = []
+    for n, msg in enumerate(result["outputs"]):
+        outputs.append({
+            "channel_id": channel,
+            "to": to_phone,
+            # unique per message: the send worker de-duplicates on client_id
+            "client_id": f"auto_{stamp}" if n == 0 else f"auto_{stamp}_{n}",
+            "orig_text": text,
+            **msg,
+        })
+    own_buffer = buffer is None
+    buffer = effects.EffectsBuffer() if own_buffer else buffer
+    _record_effects(buffer, result["effects"], flow_id, org_id, channel, to_phone, text, fields, payload, contact_phone)
+    status = result["status"]
+    if result["stop"].startswith("budget"):
+        # out of budget mid-flow: continue in a fresh message so one contact cannot hog a worker
+        hops = int((resume or {}).get("hops") or 0) + 1
+        if hops <= _FLOW_MAX_CONTINUATIONS:
+            await _schedule_resume(fields=fields, payload=payload, path_key=result["path"], next_index=result["index"], delay_seconds=0, contact_phone=contact_phone, hops=hops, buffer=buffer)
+        else:
+            logger.warning("flow %s stopped after %s continuations (%s)", flow_id, _FLOW_MAX_CONTINUATIONS, result["stop"])
+            status = "failed"
+    run_args = (org_id, flow_id, to_phone, result["path"], result["index"], status, intent_label)
+    with STAGES("persist"):
+        prepared = await _prepare_run(*run_args)
+    if prepared is not None:
+        buffer.save_run(*prepared)
+        buffer.run_retry = lambda: _save_run(*run_args)
+    if own_buffer:
+        await _flush_effects(buffer)
+    return outputs
+
+
+def _contact_attributes(org_id, target) -> dict:
+    if not (SessionLocal and DBContact and org_id and target):
+        return {}
+    with SessionLocal() as db:
+        ct = (
+            db.query(DBContact)
+            .filter(getattr(DBContact, 'org_id') == str(org_id))
+            .filter((getattr(DBContact, 'wa_id') == target) | (getattr(DBContact, 'phone') == target))
+            .first()
+        )
+        return dict(getattr(ct, 'attributes', None) or {}) if ct is not None else {}
+
+
+def _record_effects(buffer: effects.EffectsBuffer, steps_effects: list[dict], flow_id, org_id, channel: str, to_phone: str, text: str, fields: dict, payload: dict, contact_phone: str | None) -> None:
+    """Turn interpreter effects into buffered writes (flushed once per message)."""
+    updates = {e["key"]: e.get("value") for e in steps_effects if e["type"] == "set_attribute"}
+    target = contact_phone or payload.get("contact", {}).get("phone")
+    if updates and org_id and target:
+        buffer.set_attributes(org_id, target, updates)
+    for eff in steps_effects:
+        etype = eff["type"]
+        if etype == "webhook":
+            # flow webhook event for external systems
+            buffer.add_webhook({
+                "org_id": str(org_id or ""),
+                "type": "flow.webhook",
+                "event_id": str(uuid.uuid4()),
+                "ts": str(int(time.time() * 1000)),
+                "body": json.dumps({
+                    "flow_id": flow_id,
+                    "path": eff["path"],
+                    "step_index": eff["index"],
+                    "data": eff.get("data") or {},
+                    "input_text": text,
                     "contact_phone": to_phone,
-                    "timeout_path": timeout_path,
-                }
-                redis.set(wkey, json.dumps(record), ex=max(1, seconds or 3600))
-            except Exception:
-                logger.exception("failed to set wait state")
-            # Schedule a timeout resume when seconds > 0
-            if seconds and seconds > 0:
-                try:
-                    if timeout_path:
-                        await _schedule_resume(fields=fields, payload=payload, path_key=timeout_path, next_index=0, delay_seconds=seconds, contact_phone=contact_phone, resume_token=resume_token)
-                    else:
-                        await _schedule_resume(fields=fields, payload=payload, path_key=path_key, next_index=next_index, delay_seconds=seconds, contact_phone=contact_phone, resume_token=resume_token)
-                except Exception:
-                    logger.exception("schedule timeout for wait_for_reply failed")
-            # Stop processing further steps now
-            break
-        if stype == "set_attribute":
-            # Update contact.attributes[key] = value (best-effort)
-            key = step.get("key")
-            val = step.get("value")
-            if key and SessionLocal and DBContact and org_id and (contact_phone or payload.get("contact", {}).get("phone")):
-                target = contact_phone or payload.get("contact", {}).get("phone")
-                try:
-                    with SessionLocal() as db:
-                        ct = (
-                            db.query(DBContact)
-                            .filter(getattr(DBContact, 'org_id') == str(org_id))
-                            .filter((getattr(DBContact, 'wa_id') == target) | (getattr(DBContact, 'phone') == target))
-                            .first()
-                        )
-                        if ct is not None:
-                            attrs = getattr(ct, 'attributes', None) or {}
-                            attrs[str(key)] = val
-                            ct.attributes = attrs
-                            db.commit()
-                except Exception:
-                    logger.exception("set_attribute failed")
-            # continue to next step
-            continue
-        if stype in ("wait", "delay"):
-            # schedule resume at idx+1
-            seconds = 0
-            try:
-                seconds = int(step.get("seconds") or step.get("sec") or step.get("ms", 0) / 1000)
-            except Exception:
-                seconds = 0
-            await _schedule_resume(fields=fields, payload=payload, path_key=path_key, next_index=idx+1, delay_seconds=max(0, seconds), contact_phone=contact_phone)
-            # stop further processing now
-            break
-        if stype != "action":
-            break
-        act = step.get("action")
-        if act == "send_text":
-            txt = step.get("text") or "Gracias por tu mensaje."
-            outputs.append({**base, "type": "text", "text": txt})
-        elif act == "send_template":
-            name = step.get("template") or "welcome"
-            lang = step.get("language") or {"code": "es"}
-            tpl = {"name": name, "language": lang, "components": step.get("components") or []}
-            outputs.append({**base, "type": "template", "template": json.dumps(tpl)})
-        elif act == "send_media":
-            media = step.get("media") or {"kind": "image", "link": step.get("asset") or "https://example.com/demo.jpg"}
-            outputs.append({**base, "type": "media", "media": json.dumps(media)})
-        elif act == "webhook":
-            # Publish a flow webhook event for external systems (best-effort)
+                    "channel_id": channel,
+                }),
+            })
+        elif etype == "schedule":
+            _queue_resume(buffer, fields, payload, eff["path"], eff["index"], eff["seconds"], contact_phone)
+        elif etype == "wait_for_reply":
+            # Store a waiting rule for this contact; the scheduler handles its timeout or expiry
+            seconds = int(eff.get("seconds") or 0)
+            timeout_path = eff.get("timeout_path")
+            record = wait_state.new_wait(flow_id, eff["path"], eff["index"], eff.get("pattern"), seconds, timeout_path)
+            resume_token = record["resume_token"]
+            buffer.set_wait(org_id, channel, to_phone, record)
+            if seconds > 0:
+                # the timeout finds the wait by the same contact key it was stored under
+                if timeout_path:
+                    _queue_resume(buffer, fields, payload, timeout_path, 0, seconds, contact_phone or to_phone, resume_token=resume_token)
+                else:
+                    _queue_resume(buffer, fields, payload, eff["path"], eff["index"], seconds, contact_phone or to_phone, resume_token=resume_token)
+            else:
+                buffer.schedule(wait_state.expiry_item(org_id, channel, to_phone, record), record["expires_at"], f"{org_id}:{to_phone}")
+
+
+def _next_run_state(current: dict | None, org_id, flow_id, contact_key, path_key, step_index, status, intent_label) -> tuple[dict, int]:
+    expected = int((current or {}).get("version") or 0)
+    run = current if run_store.is_active(current) else run_store.new_run(org_id, flow_id, contact_key, version=expected)
+    ctx = dict(run.get("context") or {})
+    ctx["intent"] = intent_label or _INTENT_DEFAULT
+    ctx["messages"] = int(ctx.get("messages") or 0) + 1
+    run.update(status=status, path=str(path_key), step_index=int(step_index), context=ctx)
+    return run, expected
+
+
+def _run_loader():
+    return run_store.db_loader(SessionLocal, DBFlowRun) if SessionLocal else None
+
+
+async def _prepare_run(org_id, flow_id, contact_key, path_key, step_index, status, intent_label) -> tuple[dict, int] | None:
+    """Next state of the contact's run and the version it was read at (``None``: not tracked)."""
+    if not _RUN_STORE_ENABLED or not DBFlowRun:
+        return None
+    try:
+        current = await run_store.load(redis, org_id, flow_id, contact_key, loader=_run_loader())
+        return _next_run_state(current, org_id, flow_id, contact_key, path_key, step_index, status, intent_label)
+    except Exception:
+        logger.exception("flow_run load failed")
+        return None
+
+
+async def _save_run(org_id, flow_id, contact_key, path_key, step_index, status, intent_label):
+    """Update the contact's active run in place (optimistic, retried on conflicts; best-effort)."""
+    if not _RUN_STORE_ENABLED or not DBFlowRun:
+        return None
+    try:
+        for _ in range(3):
+            current = await run_store.load(redis, org_id, flow_id, contact_key, loader=_run_loader())
+            run, expected = _next_run_state(current, org_id, flow_id, contact_key, path_key, step_index, status, intent_label)
             try:
-                evt = {
-                    "org_id": str(org_id or ""),
-                    "type": "flow.webhook",
-                    "event_id": str(uuid.uuid4()),
-                    "ts": str(int(time.time() * 1000)),
-                    "body": json.dumps({
-                        "flow_id": getattr(row, 'id', None),
-                        "path": path_key,
-                        "step_index": idx,
-                        "data": step.get("data") or step.get("payload") or {},
-                        "input_text": text,
-                        "contact_phone": to_phone,
-                        "channel_id": channel,
-                    }),
-                }
-                redis.xadd("nf:webhooks", evt)
-            except Exception:
-                logger.exception("flow webhook publish failed")
-            # continue chain
-            continue
-        else:
-            # unsupported action -> stop
-            break
-    # Persist a minimal run record (best-effort)
+                return await run_store.save(redis, run, expected)
+            except run_store.RunConflict:
+                ENGINE_RUN_CONFLICTS.inc()
+        logger.warning("flow run for %s/%s kept changing; state not saved", flow_id, contact_key)
+    except Exception:
+        logger.exception("flow_run save failed")
+    return None
+
+
+def _write_runs(runs: list[dict]) -> int:
+    n, rejected = run_store.persist_runs(SessionLocal, DBFlowRun, runs)
+    for run in rejected:
+        # dropped, not re-queued: a row the DB refuses would block every flush behind it
+        logger.error("flow_run %s rejected by the DB; state not persisted", run.get("id"), extra={"flow_id": run.get("flow_id"), "status": run.get("status")})
+    return n
+
+
+async def flush_runs_once() -> int:
+    """Write one batch of dirty run states to flow_runs; keys go back on failure."""
+    keys, runs = await run_store.drain_dirty(redis, _RUN_FLUSH_BATCH)
+    if not runs:
+        return len(keys)
     try:
-        if SessionLocal and DBFlowRun and row is not None:
-            from datetime import datetime
-            run = DBFlowRun(
-                id=str(uuid.uuid4()),
-                org_id=str(org_id),
-                flow_id=getattr(row, 'id', None),
-                status='completed' if outputs else 'running',
-                last_step=str(path_key),
-                context={"intent": intent_label or _INTENT_DEFAULT},
-                created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow(),
-            )
-            with SessionLocal() as db:
-                db.add(run)
-                db.commit()
+        with STAGES("run_flush"):
+            written = await asyncio.to_thread(_write_runs, runs)
     except Exception:
-        logger.exception("flow_run persist failed")
-    return outputs
+        await run_store.mark_dirty(redis, keys)
+        raise
+    ENGINE_RUNS_FLUSHED.inc(written)
+    return len(keys)
+
 
-async def _schedule_resume(fields: dict, payload: dict, path_key: str, next_index: int, delay_seconds: int, contact_phone: str | None, resume_token: str | None = None):
+async def run_flush_loop():
+    logger.info("flow run flush starting (interval=%sms batch=%s)", _RUN_FLUSH_INTERVAL_MS, _RUN_FLUSH_BATCH)
+    while True:
+        try:
+            if await flush_runs_once() >= _RUN_FLUSH_BATCH:
+                # backlog: next batch right away
+                continue
+            await asyncio.sleep(_RUN_FLUSH_INTERVAL_MS / 1000.0)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("flow run flush failed")
+            await asyncio.sleep(1)
+
+def _resume_item(fields: dict, payload: dict, path_key: str, next_index: int, contact_phone: str | None, resume_token: str | None = None, hops: int = 0) -> tuple[dict, str]:
+    item = {
+        "payload": json.dumps(payload),
+        "org_id": fields.get("org_id") or "",
+        "channel_id": fields.get("channel_id") or "wa_main",
+        # stash contact phone to avoid re-parsing webhook payload later
+        "contact_phone": contact_phone or "",
+        "engine_resume": json.dumps({"path": path_key, "index": next_index, **({"hops": hops} if hops else {})}),
+        **({"resume_token": resume_token} if resume_token else {}),
+    }
+    return item, f"{item['org_id']}:{item['contact_phone']}"
+
+
+def _queue_resume(buffer: effects.EffectsBuffer, fields: dict, payload: dict, path_key: str, next_index: int, delay_seconds: int, contact_phone: str | None, resume_token: str | None = None, hops: int = 0) -> None:
+    item, route_key = _resume_item(fields, payload, path_key, next_index, contact_phone, resume_token, hops)
+    buffer.schedule(item, scheduler.due_score(delay_seconds), route_key)
+    logger.info("scheduled resume in %ss for path=%s index=%s", delay_seconds, path_key, next_index)
+
+
+async def _schedule_resume(fields: dict, payload: dict, path_key: str, next_index: int, delay_seconds: int, contact_phone: str | None, resume_token: str | None = None, hops: int = 0, buffer: effects.EffectsBuffer | None = None):
+    if buffer is not None:
+        _queue_resume(buffer, fields, payload, path_key, next_index, delay_seconds, contact_phone, resume_token, hops)
+        return
     try:
-        due_at = int(time.time()) + int(delay_seconds)
-        item = {
-            "payload": json.dumps(payload),
-            "org_id": fields.get("org_id") or "",
-            "channel_id": fields.get("channel_id") or "wa_main",
-            # stash contact phone to avoid re-parsing webhook payload later
-            "contact_phone": contact_phone or "",
-            "engine_resume": json.dumps({"path": path_key, "index": next_index}),
-            **({"resume_token": resume_token} if resume_token else {}),
-        }
-        redis.zadd(_SCHED_ZSET, {json.dumps(item): due_at})
+        item, route_key = _resume_item(fields, payload, path_key, next_index, contact_phone, resume_token, hops)
+        await scheduler.schedule_item(redis, _SCHED_ZSET, _SCHED_SHARDS, item, scheduler.due_score(delay_seconds), route_key)
+        if _SCHED_WAKE is not None:
+            try:
+                _SCHED_WAKE.set()
+            except Exception:
+                pass
         try:
             ENGINE_SCHEDULED.inc()
         except Exception:
@@ -514,167 +870,311 @@ async def _schedule_resume(fields: dict, payload: dict, path_key: str, next_inde
         logger.exception("schedule failed")
 
 async def _ensure_group(stream: str, group: str):
-    try:
-        # MKSTREAM to create if missing
-        await asyncio.to_thread(redis.execute_command, 'XGROUP', 'CREATE', stream, group, '$', 'MKSTREAM')
+    # MKSTREAM to create if missing; an existing group (BUSYGROUP) is fine
+    if await aredis.ensure_group(redis, stream, group):
         logger.info("created consumer group %s on %s", group, stream)
-    except Exception as e:
-        # group exists or race
-        if "BUSYGROUP" in str(e).upper():
-            return
-        # ignore other errors in dev
-        return
 
 
-async def loop():
-    stream = 'nf:incoming'
-    await _ensure_group(stream, CONSUMER_GROUP)
-    logger.info("engine_worker starting (group=%s consumer=%s)", CONSUMER_GROUP, CONSUMER_NAME)
-    while True:
+def _parse_entries(raw) -> list[tuple[str, dict | None]]:
+    # raw format: [[b'stream', [[b'id', [b'k', b'v', ...]], ...]], ...]; fields None = unparseable
+    entries = []
+    for stream_item in raw or []:
+        for msg in stream_item[1]:
+            msg_id = msg[0].decode() if isinstance(msg[0], bytes) else msg[0]
+            entries.append((msg_id, parse_kvs(msg[1])))
+    return entries
+
+
+def _ordering_key(msg_id: str, fields: dict) -> str:
+    """Messages sharing a key are handled in stream order; different keys run concurrently."""
+    phone = fields.get("contact_phone")
+    if not phone:
         try:
-            raw = await asyncio.to_thread(
-                redis.execute_command,
-                'XREADGROUP', 'GROUP', CONSUMER_GROUP, CONSUMER_NAME,
-                'BLOCK', 5000, 'COUNT', 1, 'STREAMS', stream, '>'
-            )
-            if not raw:
-                await asyncio.sleep(0.1)
-                continue
-            # raw format: [[b'stream', [[b'id', [b'k', b'v', ...]], ...]], ...]
-            for stream_item in raw:
-                msgs = stream_item[1]
-                for msg in msgs:
-                    msg_id = msg[0].decode() if isinstance(msg[0], bytes) else msg[0]
-                    kvs = msg[1]
-                    # convert flat list or dict into dict of strings
-                    fields = {}
-                    try:
-                        if isinstance(kvs, dict):
-                            for k, v in kvs.items():
-                                fields[str(k)] = str(v)
-                        else:
-                            for i in range(0, len(kvs), 2):
-                                k = kvs[i].decode() if isinstance(kvs[i], bytes) else kvs[i]
-                                v = kvs[i+1].decode() if isinstance(kvs[i+1], bytes) else kvs[i+1]
-                                fields[k] = v
-                    except Exception:
-                        logger.exception("engine_worker failed parsing XREADGROUP fields")
-                        # ack to avoid poison in dev
-                        try:
-                            redis.xack(stream, CONSUMER_GROUP, msg_id)
-                        except Exception:
-                            pass
-                        continue
-                    ok = await handle_message(msg_id, fields)
-                    try:
-                        ENGINE_PROCESSED.inc()
-                    except Exception:
-                        pass
-                    if ok:
-                        try:
-                            redis.xack(stream, CONSUMER_GROUP, msg_id)
-                        except Exception:
-                            logger.exception("xack failed")
-                    else:
-                        # retry or DLQ
-                        retries = 0
-                        try:
-                            retries = int(fields.get("retries", "0"))
-                        except Exception:
-                            retries = 0
-                        if retries < ENGINE_MAX_RETRIES:
-                            fields["retries"] = str(retries + 1)
-                            try:
-                                redis.xadd(stream, {k: str(v) for k, v in fields.items()})
-                                ENGINE_RETRIED.inc()
-                            except Exception:
-                                logger.exception("requeue failed")
-                            # ack original regardless to avoid poison
-                            try:
-                                redis.xack(stream, CONSUMER_GROUP, msg_id)
-                            except Exception:
-                                pass
-                        else:
-                            # send to DLQ
-                            try:
-                                dlq = {**fields, "error": "max-retries-exceeded"}
-                                redis.xadd('nf:incoming:dlq', {k: str(v) for k, v in dlq.items()})
-                                ENGINE_DLQ.inc()
-                            except Exception:
-                                logger.exception("dlq publish failed")
-                            try:
-                                redis.xack(stream, CONSUMER_GROUP, msg_id)
-                            except Exception:
-                                pass
+            payload = json.loads(fields.get("payload") or fields.get("body") or "")
+            events, _ = decode_webhook(payload) if isinstance(payload, dict) else ([], [])
+            # a legacy multi-contact entry is ordered by its first sender
+            phone = events[0].get("from") if events else (payload.get("contact") or {}).get("phone")
         except Exception:
-            logger.exception("engine error")
+            phone = None
+    if not phone:
+        return f"msg:{msg_id}"
+    return f"{fields.get('org_id') or ''}:{phone}"
+
+
+# Per-contact locks (dropped when no task references them) and XACKs waiting for the next flush
+_KEY_LOCKS: dict[str, list] = {}
+_PENDING_ACKS: list[str] = []
+# Failed entries left pending for retry_loop: msg_id -> (fields, monotonic time of the failure)
+_FAILED: dict[str, tuple[dict, float]] = {}
+
+
+def _retry_backoff_ms(deliveries: int) -> int:
+    """Idle time before the next attempt of an entry delivered ``deliveries`` times."""
+    return int(min(_RETRY_MAX_MS, _RETRY_BASE_MS * (2 ** max(0, int(deliveries) - 1))))
+
+
+async def retry_once(stream: str = 'nf:incoming', sem: asyncio.Semaphore | None = None) -> int:
+    """Re-deliver failed entries whose backoff elapsed (XCLAIM); returns how many were retried.
+
+    A failed entry is not acked: it stays in this consumer's PEL and its
+    XPENDING delivery count is the retry counter (XCLAIM bumps it), so a retry
+    costs no stream write. Past ``ENGINE_MAX_RETRIES`` retries it goes to
+    ``nf:incoming:dlq``; entries no longer pending (acked, trimmed or taken by
+    the reclaim loop) are forgotten.
+    """
+    if not _FAILED:
+        return 0
+    ids = list(_FAILED)
+    counts = await reclaim.delivery_counts(redis, stream, CONSUMER_GROUP, ids, CONSUMER_NAME)
+    now = time.monotonic()
+    due: dict[int, list[str]] = {}
+    for msg_id in ids:
+        deliveries = counts.get(msg_id)
+        if deliveries is None:
+            _FAILED.pop(msg_id, None)
+            continue
+        fields, failed_at = _FAILED[msg_id]
+        if deliveries > ENGINE_MAX_RETRIES:
             try:
-                ENGINE_ERRORS.inc()
+                await reclaim.dead_letter(redis, stream, CONSUMER_GROUP, 'nf:incoming:dlq', msg_id, fields, deliveries, error="max-retries-exceeded")
+                ENGINE_DLQ.inc()
+                _FAILED.pop(msg_id, None)
             except Exception:
-                pass
-            await asyncio.sleep(1)
+                logger.exception("dlq publish failed")
+            continue
+        backoff = _retry_backoff_ms(deliveries)
+        if (now - failed_at) * 1000.0 >= backoff:
+            due.setdefault(backoff, []).append(msg_id)
+    retried = 0
+    for backoff, batch in due.items():
+        # min-idle guard: an entry some other consumer touched meanwhile is left alone
+        claimed = await maybe_await(redis.xclaim(stream, CONSUMER_GROUP, CONSUMER_NAME, backoff, batch))
+        entries = _parse_entries([[stream, claimed or []]])
+        for msg_id, _ in entries:
+            _FAILED.pop(msg_id, None)
+        if entries:
+            ENGINE_RETRIED.inc(len(entries))
+            retried += len(entries)
+            await process_entries(stream, entries, sem)
+    return retried
 
 
-async def scheduler_loop():
-    logger.info("flow scheduler starting (poll=%sms zset=%s)", _SCHED_POLL_MS, _SCHED_ZSET)
+async def retry_loop(sem: asyncio.Semaphore | None = None):
+    stream = 'nf:incoming'
     while True:
         try:
-            now = int(time.time())
-            # fetch small batches of due items
-            items = redis.zrangebyscore(_SCHED_ZSET, '-inf', now, start=0, num=10)
-            if not items:
-                await asyncio.sleep(_SCHED_POLL_MS / 1000.0)
-                continue
-            for raw in items:
-                # attempt to claim by removing; if removed==1 we own it
-                removed = redis.zrem(_SCHED_ZSET, raw)
-                if not removed:
-                    continue
+            await retry_once(stream, sem)
+        except Exception:
+            logger.exception("retry pass failed")
+        await asyncio.sleep(_RETRY_POLL_MS / 1000.0)
+
+
+async def _run_entry(stream: str, msg_id: str, fields: dict | None, sem: asyncio.Semaphore) -> None:
+    if fields is None:
+        # ack to avoid poison in dev
+        _PENDING_ACKS.append(msg_id)
+        return
+    key = _ordering_key(msg_id, fields)
+    slot = _KEY_LOCKS.setdefault(key, [asyncio.Lock(), 0])
+    slot[1] += 1
+    try:
+        # lock before the semaphore: waiters for one contact queue in stream order without holding a slot
+        async with slot[0]:
+            async with sem:
                 try:
-                    obj = json.loads(raw)
+                    # parent span of this message's stage spans
+                    with STAGES.span("message"):
+                        ok = await handle_message(msg_id, fields)
                 except Exception:
-                    obj = None
-                if not isinstance(obj, dict):
+                    logger.exception("handle_message failed")
+                    ENGINE_ERRORS.inc()
+                    ok = False
+                ENGINE_PROCESSED.inc()
+                if ok:
+                    _PENDING_ACKS.append(msg_id)
+                else:
+                    # left pending; retry_loop re-delivers it after a backoff
+                    _FAILED[msg_id] = (fields, time.monotonic())
+    finally:
+        slot[1] -= 1
+        if slot[1] <= 0:
+            _KEY_LOCKS.pop(key, None)
+
+
+async def _flush_acks(stream: str, chunk: int = 500) -> int:
+    """XACK everything handled since the last flush (one command per ``chunk`` ids)."""
+    if not _PENDING_ACKS:
+        return 0
+    ids = list(_PENDING_ACKS)
+    del _PENDING_ACKS[:]
+    with STAGES("ack"):
+        for i in range(0, len(ids), chunk):
+            try:
+                await maybe_await(redis.xack(stream, CONSUMER_GROUP, *ids[i:i + chunk]))
+            except Exception:
+                # left pending: picked up again by reclaim_loop once idle
+                logger.exception("xack failed")
+    return len(ids)
+
+
+async def process_entries(stream: str, entries: list[tuple[str, dict | None]], sem: asyncio.Semaphore | None = None) -> int:
+    """Handle one batch concurrently (per-contact ordering) and flush its acks.
+
+    The worker's loops pass one shared ``sem`` so retries and reclaimed
+    entries count against the same ``ENGINE_CONCURRENCY``; without it the
+    batch gets its own.
+    """
+    sem = sem or asyncio.Semaphore(ENGINE_CONCURRENCY)
+    await asyncio.gather(*(_run_entry(stream, msg_id, fields, sem) for msg_id, fields in entries))
+    return await _flush_acks(stream)
+
+
+async def loop(sem: asyncio.Semaphore | None = None):
+    stream = 'nf:incoming'
+    await _ensure_group(stream, CONSUMER_GROUP)
+    logger.info(
+        "engine_worker starting (group=%s consumer=%s count=%s concurrency=%s)",
+        CONSUMER_GROUP, CONSUMER_NAME, ENGINE_READ_COUNT, ENGINE_CONCURRENCY,
+    )
+    sem = sem or asyncio.Semaphore(ENGINE_CONCURRENCY)
+    max_inflight = max(ENGINE_READ_COUNT, ENGINE_CONCURRENCY * 2)
+    inflight: set[asyncio.Task] = set()
+    try:
+        while True:
+            try:
+                await _flush_acks(stream)
+                inflight = {t for t in inflight if not t.done()}
+                room = max_inflight - len(inflight)
+                if room <= 0:
+                    await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                # keep reading while work is in flight, but come back quickly to flush acks
+                block = ENGINE_BLOCK_MS if not inflight else min(ENGINE_BLOCK_MS, 50)
+                # includes the BLOCK time: high values with idle workers just mean no traffic
+                with STAGES("xreadgroup"):
+                    raw = await aredis.read_group(redis, CONSUMER_GROUP, CONSUMER_NAME, stream, count=min(ENGINE_READ_COUNT, room), block_ms=block)
+                entries = _parse_entries(raw)
+                if not entries:
+                    if not inflight:
+                        await asyncio.sleep(0.1)
                     continue
-                # Skip if waiting state cleared or token mismatch (reply already arrived)
+                for msg_id, fields in entries:
+                    inflight.add(asyncio.create_task(_run_entry(stream, msg_id, fields, sem)))
+            except Exception:
+                logger.exception("engine error")
                 try:
-                    if obj.get("resume_token"):
-                        wkey = f"{_WAIT_PREFIX}:{obj.get('org_id') or ''}:{obj.get('channel_id') or 'wa_main'}:{obj.get('contact_phone') or ''}"
-                        raw_state = redis.get(wkey)
-                        if not raw_state:
-                            # already handled or expired
-                            continue
-                        st = json.loads(raw_state)
-                        if st.get("resume_token") != obj.get("resume_token"):
-                            continue
-                        # clear state on timeout resume
-                        try:
-                            redis.delete(wkey)
-                        except Exception:
-                            pass
+                    ENGINE_ERRORS.inc()
                 except Exception:
-                    logger.exception("wait state check failed")
-                mapping = {
-                    "payload": obj.get("payload") or "",
-                    "org_id": obj.get("org_id") or "",
-                    "channel_id": obj.get("channel_id") or "wa_main",
-                    "engine_resume": obj.get("engine_resume") or "",
-                }
-                # also pass through contact_phone for faster resolution
-                if obj.get("contact_phone"):
-                    mapping["contact_phone"] = obj.get("contact_phone")
+                    pass
+                await asyncio.sleep(1)
+    finally:
+        if inflight:
+            await asyncio.gather(*inflight, return_exceptions=True)
+        await _flush_acks(stream)
+
+
+async def reclaim_loop(sem: asyncio.Semaphore | None = None):
+    """Take over ``nf:incoming`` entries left pending by dead consumers (``packages.common.reclaim``)."""
+    stream = 'nf:incoming'
+    await _ensure_group(stream, CONSUMER_GROUP)
+
+    async def _handle(entries):
+        await process_entries(stream, entries, sem)
+
+    def _count(report):
+        if report["claimed"]:
+            ENGINE_RECLAIMED.inc(report["claimed"])
+        if report["dead"]:
+            ENGINE_DLQ.inc(report["dead"])
+
+    await reclaim.reclaim_loop(redis, stream, CONSUMER_GROUP, CONSUMER_NAME, _handle, dlq_stream='nf:incoming:dlq', on_report=_count)
+
+
+async def lag_loop():
+    """Consumer-lag gauges for the engine group (the same group-wide value on every replica)."""
+    stream = 'nf:incoming'
+    while True:
+        try:
+            lag = await stage_metrics.consumer_lag(redis, stream, CONSUMER_GROUP)
+            if lag is not None:
+                ENGINE_CONSUMER_LAG.set(lag["lag"])
+                ENGINE_CONSUMER_PENDING.set(lag["pending"])
+        except Exception:
+            logger.exception("consumer lag check failed")
+        await asyncio.sleep(_LAG_INTERVAL_S)
+
+
+async def _sched_owned_shards() -> list[int]:
+    if _SCHED_OWNED:
+        return [s for s in _SCHED_OWNED if 0 <= s < _SCHED_SHARDS]
+    return await scheduler.owned_shards(redis, f"{_SCHED_ZSET}:members", CONSUMER_NAME, _SCHED_SHARDS, ttl_s=_SCHED_MEMBER_TTL_S)
+
+
+async def scheduler_loop():
+    global _SCHED_WAKE
+    logger.info(
+        "flow scheduler starting (max_poll=%sms batch=%s zset=%s shards=%s)",
+        _SCHED_POLL_MS, _SCHED_BATCH, _SCHED_ZSET, _SCHED_SHARDS,
+    )
+    _SCHED_WAKE = asyncio.Event()
+    owned: list[int] = []
+    refresh_at = 0.0
+    while True:
+        try:
+            if time.monotonic() >= refresh_at:
+                refresh_at = time.monotonic() + max(1.0, _SCHED_MEMBER_TTL_S / 3)
+                new_owned = await _sched_owned_shards()
+                if new_owned != owned:
+                    logger.info("scheduler shards owned: %s", new_owned)
+                owned = new_owned
+                if 0 in owned:
+                    # drain items scheduled in the pre-sharding single ZSET (JSON members)
+                    legacy, _, _ = await scheduler.claim_due(redis, _SCHED_ZSET, 'nf:incoming', _WAIT_PREFIX, limit=_SCHED_BATCH, wait_hash_prefix=wait_state.PREFIX)
+                    if legacy:
+                        ENGINE_SCHED_PUBLISHED.inc(legacy)
+            # one atomic server-side call over the owned shards: pop due items,
+            # check wait tokens, XADD to nf:incoming
+            published, skipped, next_due = await scheduler.claim_due_shards(
+                redis, _SCHED_ZSET, owned, 'nf:incoming', _WAIT_PREFIX, limit=_SCHED_BATCH, wait_hash_prefix=wait_state.PREFIX,
+            )
+            if published:
                 try:
-                    redis.xadd('nf:incoming', mapping)
-                    try:
-                        ENGINE_SCHED_PUBLISHED.inc()
-                    except Exception:
-                        pass
+                    ENGINE_SCHED_PUBLISHED.inc(published)
                 except Exception:
-                    logger.exception("scheduler publish failed")
+                    pass
+            if published + skipped >= _SCHED_BATCH:
+                # backlog: claim the next batch right away
+                continue
+            # sleep until the next due item, but never longer than the poll interval
+            # (shard ownership may change and other replicas schedule too)
+            delay = _SCHED_POLL_MS / 1000.0
+            if next_due is not None:
+                delay = min(delay, max(0.0, next_due - time.time()))
+            _SCHED_WAKE.clear()
+            try:
+                await asyncio.wait_for(_SCHED_WAKE.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
         except Exception:
             logger.exception("scheduler loop error")
             await asyncio.sleep(1)
 
+
+async def retention_loop():
+    policies = stream_retention.load_policies()
+    sync_redis = Redis.from_url(_REDIS_URL, decode_responses=True)
+    logger.info("stream retention starting (interval=%ss streams=%s)", _RETENTION_INTERVAL_S, len(policies))
+    while True:
+        try:
+            report = await asyncio.to_thread(stream_retention.trim_loop_once, sync_redis, CONSUMER_NAME, _RETENTION_INTERVAL_S, policies)
+            trimmed = [r for r in report or [] if r.get("trimmed")]
+            if trimmed:
+                logger.info("streams trimmed", extra={"retention": trimmed})
+        except Exception:
+            logger.exception("retention loop error")
+        await asyncio.sleep(_RETENTION_INTERVAL_S)
+
+
 if __name__ == "__main__":
     # Start metrics HTTP server if a port is provided
     try:
@@ -684,5 +1184,24 @@ if __name__ == "__main__":
     except Exception:
         pass
     async def _main():
-        await asyncio.gather(loop(), scheduler_loop())
+        # one concurrency budget for fresh, retried and reclaimed entries
+        sem = asyncio.Semaphore(ENGINE_CONCURRENCY)
+        tasks = [loop(sem), retry_loop(sem), reclaim_loop(sem), scheduler_loop(), flow_cache_listener()]
+        if _RETENTION_ENABLED:
+            tasks.append(retention_loop())
+        if _METRICS_ENABLED:
+            tasks.append(lag_loop())
+        if _RUN_STORE_ENABLED and DBFlowRun:
+            tasks.append(run_flush_loop())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # queued intent lookups still need the NLP client
+            await INTENT_BATCHER.close()
+            await close_nlp_client()
+            if _RUN_STORE_ENABLED and DBFlowRun:
+                try:
+                    await flush_runs_once()
+                except Exception:
+                    logger.exception("final flow run flush failed")
     asyncio.run(_main())
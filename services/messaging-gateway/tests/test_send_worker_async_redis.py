@@ -0,0 +1,66 @@
+import asyncio
+import importlib.util
+from pathlib import Path
+
+root = Path(__file__).resolve().parents[3]
+module_path = root / "services" / "messaging-gateway" / "worker" / "send_worker.py"
+spec = importlib.util.spec_from_file_location("send_worker_async_redis", str(module_path))
+send_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(send_worker)
+
+
+class AsyncRedis:
+    def __init__(self):
+        self.xadd_calls = []
+        self.incr_calls = []
+        self.acks = []
+
+    async def xadd(self, stream, mapping):
+        self.xadd_calls.append((stream, dict(mapping)))
+        return "1-0"
+
+    async def incr(self, key):
+        self.incr_calls.append(key)
+        return 1
+
+    async def mget(self, keys):
+        return [None for _ in keys]
+
+    async def xack(self, stream, group, *ids):
+        self.acks.extend(ids)
+        return len(ids)
+
+
+def test_process_message_awaits_async_client():
+    fake = AsyncRedis()
+    send_worker.redis = fake
+    send_worker.FAKE = True
+    fields = {"to": "9876", "text": "hola", "client_id": "cid1", "org_id": "o1", "channel_id": "wa_main"}
+    asyncio.run(send_worker.process_message("1-0", fields))
+    assert [s for s, _ in fake.xadd_calls] == ["nf:sent"]
+    assert fake.xadd_calls[0][1]["client_id"] == "cid1"
+    assert fake.incr_calls == ["mgw:metrics:processed_total"]
+
+
+def test_reclaimed_entries_are_sent_and_acked():
+    from packages.common import reclaim
+
+    class PendingRedis(AsyncRedis):
+        async def xautoclaim(self, stream, group, consumer, min_idle_time, start_id="0-0", count=100):
+            return ["0-0", [("5-0", {"to": "9876", "text": "hola", "client_id": "cid5"})], []]
+
+        async def xpending_range(self, stream, group, min, max, count, consumername=None, idle=None):
+            return [{"message_id": min, "consumer": "sender-2", "time_since_delivered": 0, "times_delivered": 2}]
+
+    fake = PendingRedis()
+    send_worker.redis = fake
+    send_worker.FAKE = True
+
+    async def handle(entries):
+        for msg_id, fields in entries:
+            await send_worker.handle_entry("nf:outbox", msg_id, fields)
+
+    report = asyncio.run(reclaim.reclaim_once(fake, "nf:outbox", "sender", "sender-1", handle, dlq_stream="nf:outbox:dlq", min_idle_ms=0))
+    assert report["handled"] == 1
+    assert fake.acks == ["5-0"]
+    assert [s for s, _ in fake.xadd_calls] == ["nf:sent"]
@@ -1,12 +1,14 @@
 import os, asyncio, time, logging, uuid, json
+from datetime import datetime
 
 import httpx
 from pythonjsonlogger import json as jsonlogger
-from redis import Redis
+from packages.common import aredis, conversation_cache, reclaim
+from packages.common.aredis import maybe_await
 from packages.common.db import SessionLocal
-from packages.common.models import Message as DBMessage, Conversation as DBConversation, Contact as DBContact, Channel as DBChannel
+from packages.common.models import Message as DBMessage, Conversation as DBConversation, Contact as DBContact, Channel as DBChannel, MessageProviderId as DBProviderId
 
-redis = Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"), decode_responses=True)
+redis = aredis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
 FAKE = os.getenv("WHATSAPP_FAKE_MODE", "true").lower() == "true"
 TOKEN = os.getenv("WHATSAPP_TOKEN", "")
 PHONE_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID", "")
@@ -99,15 +101,15 @@ async def process_message(msg_id: str, fields: dict):
                 wa_msg_id = resp.json().get("messages", [{}])[0].get("id")
                 # increment WhatsApp call counter
                 try:
-                    redis.incr("mgw:metrics:wa_calls_total")
+                    await maybe_await(redis.incr("mgw:metrics:wa_calls_total"))
                 except Exception:
                     pass
                 break
             except Exception:
                 logger.exception("whatsapp send attempt %s failed", attempt + 1)
                 try:
-                    redis.incr("mgw:metrics:errors_total")
-                    redis.incr("mgw:metrics:retries_total")
+                    await maybe_await(redis.incr("mgw:metrics:errors_total"))
+                    await maybe_await(redis.incr("mgw:metrics:retries_total"))
                 except Exception:
                     pass
                 if attempt < 2:
@@ -117,8 +119,8 @@ async def process_message(msg_id: str, fields: dict):
             try:
                 dlq_payload = {k: str(v) for k, v in fields.items()}
                 dlq_payload['error'] = 'send_failed'
-                redis.xadd('nf:outbox:dlq', dlq_payload)
-                redis.incr("mgw:metrics:dlq_total")
+                await maybe_await(redis.xadd('nf:outbox:dlq', dlq_payload))
+                await maybe_await(redis.incr("mgw:metrics:dlq_total"))
             except Exception:
                 logger.exception("failed to write to nf:outbox:dlq")
         result = {"fake": False, "to": to, "text": text, "client_id": client_id, "ts": time.time()}
@@ -134,11 +136,11 @@ async def process_message(msg_id: str, fields: dict):
             result['channel_id'] = fields.get('channel_id')
     try:
         # ensure all values are strings for redis stream
-        redis.xadd("nf:sent", {k: str(v) for k, v in result.items()})
+        await maybe_await(redis.xadd("nf:sent", {k: str(v) for k, v in result.items()}))
     except Exception:
         logger.exception("send_worker xadd error")
         try:
-            redis.incr("mgw:metrics:errors_total")
+            await maybe_await(redis.incr("mgw:metrics:errors_total"))
         except Exception:
             pass
     # log with trace_id when available for correlation
@@ -147,17 +149,27 @@ async def process_message(msg_id: str, fields: dict):
     else:
         logger.info("processed %s %s", msg_id, result)
     try:
-        redis.incr("mgw:metrics:processed_total")
+        await maybe_await(redis.incr("mgw:metrics:processed_total"))
     except Exception:
         pass
 
     # Best-effort persistence of outbound message when conversation context is available
+    cache_key = (str(fields.get('org_id') or ''), str(fields.get('channel_id') or ''), fields.get('to'))
+    cached = None
+    to_cache = None
+    if not fields.get('conversation_id') and all(cache_key):
+        # Shared resolution cache first (same entries the webhook receiver fills for inbound)
+        cached = (await conversation_cache.get_many_async(redis, [cache_key])).get(cache_key)
     try:
         with SessionLocal() as db:
             conv_id = fields.get('conversation_id')
             conv = None
             if conv_id:
                 conv = db.get(DBConversation, conv_id)
+            if not conv and cached:
+                conv = db.get(DBConversation, cached[1])
+                if conv is not None and getattr(conv, 'state', 'open') != 'open':
+                    conv = None
             # Attempt to resolve conversation if missing and org/channel/to present
             if not conv and fields.get('org_id') and fields.get('channel_id') and fields.get('to'):
                 # find contact by wa_id/phone within org
@@ -176,6 +188,8 @@ async def process_message(msg_id: str, fields: dict):
                         .filter(DBConversation.state == 'open')
                         .first()
                     )
+                    if conv:
+                        to_cache = (ct.id, conv.id)
             if conv:
                 # de-duplicate on client_id when available: if API already persisted an outgoing message
                 # for this conversation with the same client_id, update metadata instead of inserting another row.
@@ -201,6 +215,7 @@ async def process_message(msg_id: str, fields: dict):
                         db.commit()
                     except Exception:
                         db.rollback()
+                    _record_provider_id(db, result.get('wa_msg_id'), existing.id, conv)
                 else:
                     # persist new message row
                     db_msg = DBMessage(
@@ -216,17 +231,42 @@ async def process_message(msg_id: str, fields: dict):
                     )
                     db.add(db_msg)
                     db.commit()
+                    _record_provider_id(db, result.get('wa_msg_id'), db_msg.id, conv)
     except Exception:
         logger.exception("persist outbound failed")
+    if to_cache:
+        await conversation_cache.put_many_async(redis, {cache_key: to_cache})
 
-async def _ensure_group(stream: str, group: str):
+
+def _record_provider_id(db, wa_msg_id, message_id, conv):
+    """Index wa_msg_id -> message so status receipts resolve with one PK lookup (best-effort)."""
+    if not wa_msg_id or not DBProviderId:
+        return
     try:
-        await asyncio.to_thread(redis.execute_command, 'XGROUP', 'CREATE', stream, group, '$', 'MKSTREAM')
+        db.merge(DBProviderId(
+            wa_msg_id=str(wa_msg_id),
+            message_id=message_id,
+            conversation_id=getattr(conv, 'id', None),
+            org_id=str(conv.org_id) if getattr(conv, 'org_id', None) else None,
+            created_at=datetime.utcnow(),
+        ))
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("record provider id failed")
+
+async def _ensure_group(stream: str, group: str):
+    if await aredis.ensure_group(redis, stream, group):
         logger.info("created consumer group %s on %s", group, stream)
-    except Exception as e:
-        if "BUSYGROUP" in str(e).upper():
-            return
-        return
+
+
+async def handle_entry(stream: str, msg_id: str, fields: dict | None):
+    if fields is not None:
+        await process_message(msg_id, fields)
+    try:
+        await maybe_await(redis.xack(stream, CONSUMER_GROUP, msg_id))
+    except Exception:
+        logger.exception("xack failed")
 
 
 async def loop():
@@ -235,11 +275,7 @@ async def loop():
     logger.info("send_worker starting (FAKE=%s, group=%s consumer=%s)", FAKE, CONSUMER_GROUP, CONSUMER_NAME)
     while True:
         try:
-            raw = await asyncio.to_thread(
-                redis.execute_command,
-                'XREADGROUP', 'GROUP', CONSUMER_GROUP, CONSUMER_NAME,
-                'BLOCK', 5000, 'COUNT', 1, 'STREAMS', stream, '>'
-            )
+            raw = await aredis.read_group(redis, CONSUMER_GROUP, CONSUMER_NAME, stream, count=1, block_ms=5000)
             if not raw:
                 await asyncio.sleep(0.1)
                 continue
@@ -257,14 +293,27 @@ async def loop():
                             k = kvs[i].decode() if isinstance(kvs[i], bytes) else kvs[i]
                             v = kvs[i+1].decode() if isinstance(kvs[i+1], bytes) else kvs[i+1]
                             fields[k] = v
-                    await process_message(msg_id, fields)
-                    try:
-                        redis.xack(stream, CONSUMER_GROUP, msg_id)
-                    except Exception:
-                        logger.exception("xack failed")
+                    await handle_entry(stream, msg_id, fields)
         except Exception:
             logger.exception("send_worker loop error")
             await asyncio.sleep(1)
 
+
+async def reclaim_loop():
+    """Take over entries left pending by dead consumers (``packages.common.reclaim``)."""
+    stream = 'nf:outbox'
+    await _ensure_group(stream, CONSUMER_GROUP)
+
+    async def _handle(entries):
+        for msg_id, fields in entries:
+            await handle_entry(stream, msg_id, fields)
+
+    await reclaim.reclaim_loop(redis, stream, CONSUMER_GROUP, CONSUMER_NAME, _handle, dlq_stream='nf:outbox:dlq')
+
+
+async def _main():
+    await asyncio.gather(loop(), reclaim_loop())
+
+
 if __name__ == "__main__":
-    asyncio.run(loop())
+    asyncio.run(_main())
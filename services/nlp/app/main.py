@@ -6,13 +6,11 @@ from typing import List, Optional
 
 from fastapi import FastAPI
 from pydantic import BaseModel, Field
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.naive_bayes import ComplementNB
-from sklearn.pipeline import make_pipeline
 
 MODEL_VERSION = "0.1.0"
 _MIN_SCORE = float(os.getenv("NLP_MIN_SCORE", "0.32"))
 _DEFAULT_LABEL = os.getenv("NLP_DEFAULT_LABEL", "default")
+_MAX_BATCH = int(os.getenv("NLP_MAX_BATCH", "256"))
 
 _INTENT_SAMPLES = [
     ("hola", "greeting"),
@@ -89,6 +87,11 @@ def _augment_samples() -> List[tuple[str, str]]:
 
 @lru_cache(maxsize=1)
 def _load_pipeline():
+    # imported here so the request handling can be exercised without scikit-learn
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.naive_bayes import ComplementNB
+    from sklearn.pipeline import make_pipeline
+
     samples = _augment_samples()
     texts = [t for t, _ in samples]
     labels = [l for _, l in samples]
@@ -122,6 +125,22 @@ class IntentResponse(BaseModel):
     model_version: str = MODEL_VERSION
 
 
+class BatchIntentRequest(BaseModel):
+    texts: List[str] = Field(..., max_length=_MAX_BATCH, description="Mensajes a clasificar (una sola pasada del modelo)")
+    candidates: Optional[List[str]] = Field(
+        default=None, description="Opcional: restringir a intentos permitidos"
+    )
+    top_k: int = Field(3, ge=1, le=10)
+    org_id: Optional[str] = Field(
+        default=None, description="Reservado: permite modelos por organización"
+    )
+
+
+class BatchIntentResponse(BaseModel):
+    results: List[IntentResponse]
+    model_version: str = MODEL_VERSION
+
+
 EMAIL_RE = re.compile(r"[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}", re.IGNORECASE)
 PHONE_RE = re.compile(r"(?:\+\d{1,3}[\s-]?)?(?:\d{2,4}[\s-]?){2,4}\d{2,4}")
 NAME_PATTERNS = [
@@ -155,26 +174,13 @@ def _choose_default(label: Optional[str], score: float) -> str:
     return label
 
 
-@app.post("/api/nlp/intents", response_model=IntentResponse)
-def classify_intent(payload: IntentRequest):
-    text = (payload.text or "").strip()
-    if not text:
-        return IntentResponse(
-            top_intents=[IntentScore(label=_DEFAULT_LABEL, score=1.0)],
-            primary_intent=_DEFAULT_LABEL,
-        )
-
-    pipeline = _load_pipeline()
-    raw_scores = pipeline.predict_proba([text.lower()])[0]
-    classes = list(pipeline.classes_)
-    scored = list(zip(classes, raw_scores))
-
-    if payload.candidates:
-        allowed = {_normalize_label(c) for c in payload.candidates}
+def _rank(scored: list, candidates: Optional[List[str]], top_k: int) -> IntentResponse:
+    if candidates:
+        allowed = {_normalize_label(c) for c in candidates}
         scored = [item for item in scored if _normalize_label(item[0]) in allowed]
 
     scored.sort(key=lambda item: item[1], reverse=True)
-    top_items = scored[: payload.top_k] if scored else [( _DEFAULT_LABEL, 1.0 )]
+    top_items = scored[: top_k] if scored else [( _DEFAULT_LABEL, 1.0 )]
 
     top_intents = [
         IntentScore(label=_normalize_label(label), score=float(score))
@@ -193,6 +199,34 @@ def classify_intent(payload: IntentRequest):
     )
 
 
+def _classify_many(texts: List[str], candidates: Optional[List[str]], top_k: int) -> List[IntentResponse]:
+    """Score every non-empty text with a single ``predict_proba`` call on the whole matrix."""
+    cleaned = [(t or "").strip() for t in texts]
+    todo = [i for i, t in enumerate(cleaned) if t]
+    results: List[Optional[IntentResponse]] = [None] * len(cleaned)
+    if todo:
+        pipeline = _load_pipeline()
+        classes = list(pipeline.classes_)
+        matrix = pipeline.predict_proba([cleaned[i].lower() for i in todo])
+        for i, row in zip(todo, matrix):
+            results[i] = _rank(list(zip(classes, row)), candidates, top_k)
+    empty = IntentResponse(
+        top_intents=[IntentScore(label=_DEFAULT_LABEL, score=1.0)],
+        primary_intent=_DEFAULT_LABEL,
+    )
+    return [r if r is not None else empty for r in results]
+
+
+@app.post("/api/nlp/intents", response_model=IntentResponse)
+def classify_intent(payload: IntentRequest):
+    return _classify_many([payload.text], payload.candidates, payload.top_k)[0]
+
+
+@app.post("/api/nlp/intents:batch", response_model=BatchIntentResponse)
+def classify_intents_batch(payload: BatchIntentRequest):
+    return BatchIntentResponse(results=_classify_many(payload.texts, payload.candidates, payload.top_k))
+
+
 @app.post("/api/nlp/extract", response_model=ExtractResponse)
 def extract_entities(payload: ExtractRequest):
     text = payload.text or ""
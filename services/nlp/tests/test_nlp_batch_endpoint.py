@@ -0,0 +1,85 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+class StubPipeline:
+    """Stands in for the sklearn pipeline: scores by keyword and records every call."""
+
+    classes_ = ["greeting", "pricing", "support"]
+
+    def __init__(self):
+        self.calls = []
+
+    def predict_proba(self, texts):
+        self.calls.append(list(texts))
+        rows = []
+        for text in texts:
+            if "hola" in text:
+                rows.append([0.9, 0.05, 0.05])
+            elif "cuesta" in text:
+                rows.append([0.05, 0.9, 0.05])
+            else:
+                rows.append([0.05, 0.05, 0.9])
+        return rows
+
+
+@pytest.fixture
+def main(monkeypatch):
+    # small limit: the request model reads NLP_MAX_BATCH at import
+    monkeypatch.setenv("NLP_MAX_BATCH", "4")
+    path = Path(__file__).resolve().parents[1] / "app" / "main.py"
+    spec = importlib.util.spec_from_file_location("nlp_main_batch", str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def client(main):
+    return TestClient(main.app)
+
+
+def test_classify_many_scores_the_batch_in_one_model_pass(main, monkeypatch):
+    stub = StubPipeline()
+    monkeypatch.setattr(main, "_load_pipeline", lambda: stub)
+    results = main._classify_many(["Hola", "  ", "cuánto cuesta", "mi pedido no llegó"], None, 1)
+    assert stub.calls == [["hola", "cuánto cuesta", "mi pedido no llegó"]]
+    assert [r.primary_intent for r in results] == ["greeting", "default", "pricing", "support"]
+    # candidates restrict the ranking per text, like the single endpoint
+    restricted = main._classify_many(["hola"], ["pricing", "support"], 2)[0]
+    assert [s.label for s in restricted.top_intents][-2:] == ["pricing", "support"]
+    assert restricted.primary_intent == "default"
+
+
+def test_batch_endpoint_matches_single_requests_with_stub_model(main, client, monkeypatch):
+    monkeypatch.setattr(main, "_load_pipeline", lambda: StubPipeline())
+    texts = ["hola", "cuánto cuesta", "", "necesito soporte"]
+    resp = client.post("/api/nlp/intents:batch", json={"texts": texts, "top_k": 1})
+    assert resp.status_code == 200
+    batch = [r["primary_intent"] for r in resp.json()["results"]]
+    singles = [client.post("/api/nlp/intents", json={"text": t, "top_k": 1}).json()["primary_intent"] for t in texts]
+    assert batch == singles == ["greeting", "pricing", "default", "support"]
+
+
+def test_batch_matches_single_requests_in_order(client):
+    pytest.importorskip("sklearn")
+    texts = ["hola", "cuánto cuesta", "", "necesito soporte"]
+    resp = client.post("/api/nlp/intents:batch", json={"texts": texts, "top_k": 1})
+    assert resp.status_code == 200
+    batch = [r["primary_intent"] for r in resp.json()["results"]]
+    singles = [client.post("/api/nlp/intents", json={"text": t, "top_k": 1}).json()["primary_intent"] for t in texts]
+    assert batch == singles
+    assert batch[2] == "default"
+
+
+def test_oversized_batch_is_rejected_with_422(main, client, monkeypatch):
+    stub = StubPipeline()
+    monkeypatch.setattr(main, "_load_pipeline", lambda: stub)
+    resp = client.post("/api/nlp/intents:batch", json={"texts": ["hola"] * 5, "top_k": 1})
+    assert resp.status_code == 422
+    assert resp.json()["detail"][0]["loc"][-1] == "texts"
+    assert stub.calls == []
+    assert client.post("/api/nlp/intents:batch", json={"texts": ["hola"] * 4, "top_k": 1}).status_code == 200
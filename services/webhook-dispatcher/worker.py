@@ -1,12 +1,13 @@
 import os, json, asyncio, time, hmac, hashlib, logging
 import httpx
-from redis import Redis
+from packages.common import aredis, reclaim
+from packages.common.aredis import maybe_await
 try:
     from pythonjsonlogger import jsonlogger
 except ImportError:
     jsonlogger = None
 
-redis = Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"), decode_responses=True)
+redis = aredis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
 
 CONSUMER_GROUP = os.getenv("WH_GROUP", "wh_dispatcher")
 CONSUMER_NAME = os.getenv("WH_CONSUMER", None) or os.getenv("HOSTNAME", "wh-1")
@@ -46,7 +47,7 @@ async def process_event(fields: dict):
         body = {"raw": body_raw}
     # Load endpoints for org
     try:
-        eps = redis.hgetall(_endpoints_key(org_id)) or {}
+        eps = await maybe_await(redis.hgetall(_endpoints_key(org_id))) or {}
     except Exception:
         eps = {}
     if not eps:
@@ -71,13 +72,13 @@ async def process_event(fields: dict):
             try:
                 await _deliver(url, payload, secret)
                 try:
-                    redis.xadd("wh:delivered", {
+                    await maybe_await(redis.xadd("wh:delivered", {
                         "org_id": org_id,
                         "wid": wid,
                         "type": evt_type,
                         "url": url,
                         "ts": str(int(time.time()*1000)),
-                    })
+                    }))
                 except Exception:
                     pass
                 break
@@ -87,19 +88,25 @@ async def process_event(fields: dict):
                     await asyncio.sleep(2 ** attempt)
                 else:
                     try:
-                        redis.xadd("nf:webhooks:dlq", {"org_id": org_id, "wid": wid, "type": evt_type, "body": json.dumps(body)})
+                        await maybe_await(redis.xadd("nf:webhooks:dlq", {"org_id": org_id, "wid": wid, "type": evt_type, "body": json.dumps(body)}))
                     except Exception:
                         pass
 
 
 async def _ensure_group(stream: str, group: str):
-    try:
-        await asyncio.to_thread(redis.execute_command, 'XGROUP', 'CREATE', stream, group, '$', 'MKSTREAM')
+    if await aredis.ensure_group(redis, stream, group):
         logger.info("created consumer group %s on %s", group, stream)
-    except Exception as e:
-        if "BUSYGROUP" in str(e).upper():
-            return
-        return
+
+
+async def handle_entry(stream: str, msg_id: str, fields: dict | None):
+    if fields is not None:
+        # retries and fan-out can outlast STREAM_RECLAIM_MIN_IDLE_MS: stay the owner meanwhile
+        async with reclaim.keep_claimed(redis, stream, CONSUMER_GROUP, CONSUMER_NAME, msg_id):
+            await process_event(fields)
+    try:
+        await maybe_await(redis.xack(stream, CONSUMER_GROUP, msg_id))
+    except Exception:
+        logger.exception("xack failed")
 
 
 async def loop():
@@ -108,11 +115,7 @@ async def loop():
     logger.info("webhook dispatcher starting (group=%s consumer=%s)", CONSUMER_GROUP, CONSUMER_NAME)
     while True:
         try:
-            raw = await asyncio.to_thread(
-                redis.execute_command,
-                'XREADGROUP', 'GROUP', CONSUMER_GROUP, CONSUMER_NAME,
-                'BLOCK', 5000, 'COUNT', 1, 'STREAMS', stream, '>'
-            )
+            raw = await aredis.read_group(redis, CONSUMER_GROUP, CONSUMER_NAME, stream, count=1, block_ms=5000)
             if not raw:
                 await asyncio.sleep(0.1)
                 continue
@@ -130,15 +133,27 @@ async def loop():
                             k = kvs[i].decode() if isinstance(kvs[i], bytes) else kvs[i]
                             v = kvs[i+1].decode() if isinstance(kvs[i+1], bytes) else kvs[i+1]
                             fields[k] = v
-                    await process_event(fields)
-                    try:
-                        redis.xack(stream, CONSUMER_GROUP, msg_id)
-                    except Exception:
-                        logger.exception("xack failed")
+                    await handle_entry(stream, msg_id, fields)
         except Exception:
             logger.exception("dispatcher loop error")
             await asyncio.sleep(1)
 
 
+async def reclaim_loop():
+    """Take over entries left pending by dead consumers (``packages.common.reclaim``)."""
+    stream = 'nf:webhooks'
+    await _ensure_group(stream, CONSUMER_GROUP)
+
+    async def _handle(entries):
+        for msg_id, fields in entries:
+            await handle_entry(stream, msg_id, fields)
+
+    await reclaim.reclaim_loop(redis, stream, CONSUMER_GROUP, CONSUMER_NAME, _handle, dlq_stream='nf:webhooks:dlq')
+
+
+async def _main():
+    await asyncio.gather(loop(), reclaim_loop())
+
+
 if __name__ == "__main__":
-    asyncio.run(loop())
+    asyncio.run(_main())
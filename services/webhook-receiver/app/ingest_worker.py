@@ -0,0 +1,15 @@
+import asyncio
+import logging
+
+from app.main import INGEST_CONSUMER, INGEST_WORKERS, ingest_loop
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main():
+	# Each consumer reads its own batches from the raw stream's consumer group
+	await asyncio.gather(*(ingest_loop(f"{INGEST_CONSUMER}-{i}") for i in range(INGEST_WORKERS)))
+
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -1,26 +1,88 @@
+import asyncio
 import os
 import hmac
 import hashlib
 import json
 import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
 from json import JSONDecodeError
 from fastapi import FastAPI, HTTPException, Request
 from redis import Redis
-from sqlalchemy import text
+from sqlalchemy import bindparam, case, insert, update
 from packages.common.db import SessionLocal
-from packages.common.models import Contact as _Contact, Conversation as _Conversation, Message as _Message
+from packages.common import conversation_cache
+from packages.common.batching import MicroBatcher
+from packages.common.channel_index import ChannelIndex
+from packages.common.payload_capture import PayloadCapture
+from packages.common.upserts import upsert_contact, upsert_open_conversation
+from packages.common.streams import xadd_many
+from packages.common.wa_webhook import MEDIA_TYPES, decode_webhook, iter_changes
+from packages.common.models import Contact as _Contact, Conversation as _Conversation, Message as _Message, MessageProviderId as _MessageProviderId
 from prometheus_client import CollectorRegistry, Counter, generate_latest, CONTENT_TYPE_LATEST
 
-app = FastAPI(title="NexIA Webhook Receiver")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+	yield
+	# don't drop statuses still waiting for their batch window on shutdown
+	await STATUSES.close()
+
+
+app = FastAPI(title="NexIA Webhook Receiver", lifespan=lifespan)
 redis = Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"), decode_responses=True)
 VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "change-me")
 APP_SECRET = os.getenv("WHATSAPP_APP_SECRET", "dev_secret").encode()
 logger = logging.getLogger(__name__)
 
+# phone_number_id/display number -> (org_id, channel_id), LRU + Redis hash
+CHANNELS = ChannelIndex()
+
+# Fast-ack mode: verify signature, XADD the raw body and return; ingest workers do the rest
+FAST_ACK = os.getenv("WEBHOOK_FAST_ACK", "false").lower() == "true"
+RAW_STREAM = os.getenv("WEBHOOK_RAW_STREAM", "nf:webhooks:raw")
+INGEST_GROUP = os.getenv("WEBHOOK_INGEST_GROUP", "ingest")
+INGEST_CONSUMER = os.getenv("WEBHOOK_INGEST_CONSUMER", None) or os.getenv("HOSTNAME", "ingest-1")
+try:
+	INGEST_WORKERS = max(1, int(os.getenv("WEBHOOK_INGEST_WORKERS", "1")))
+except Exception:
+	INGEST_WORKERS = 1
+try:
+	INGEST_BATCH = max(1, int(os.getenv("WEBHOOK_INGEST_BATCH", "64")))
+except Exception:
+	INGEST_BATCH = 64
+try:
+	INGEST_BLOCK_MS = int(os.getenv("WEBHOOK_INGEST_BLOCK_MS", "1000"))
+except Exception:
+	INGEST_BLOCK_MS = 1000
+try:
+	INGEST_MAX_RETRIES = int(os.getenv("WEBHOOK_INGEST_MAX_RETRIES", "3"))
+except Exception:
+	INGEST_MAX_RETRIES = 3
+# Receipt coalescing (inline mode): buffer statuses from concurrent requests for a few ms
+try:
+	STATUS_WINDOW_MS = float(os.getenv("WEBHOOK_STATUS_WINDOW_MS", "5"))
+except Exception:
+	STATUS_WINDOW_MS = 5.0
+try:
+	STATUS_MAX_BATCH = int(os.getenv("WEBHOOK_STATUS_MAX_BATCH", "500"))
+except Exception:
+	STATUS_MAX_BATCH = 500
+
+# Receipts only move forward; "failed" is terminal
+STATUS_RANK = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+# Sampled raw-payload capture (WEBHOOK_CAPTURE_*) instead of logging every body
+CAPTURE = PayloadCapture.from_env("WEBHOOK", "nf:webhooks:samples", logger=logger)
+INSPECT_TOKEN = os.getenv("WEBHOOK_CAPTURE_INSPECT_TOKEN", "")
+
 # Allow tests to override these with sqlite-friendly models
 Contact = _Contact
 Conversation = _Conversation
 Message = _Message
+MessageProviderId = _MessageProviderId
 
 # Prometheus metrics
 PROM_REGISTRY = CollectorRegistry()
@@ -29,6 +91,10 @@ METRIC_INVALID_SIG = Counter('nexia_webhook_invalid_signature_total', 'Invalid s
 METRIC_INVALID_JSON = Counter('nexia_webhook_invalid_json_total', 'Invalid JSON payloads', registry=PROM_REGISTRY)
 METRIC_RECEIVED = Counter('nexia_webhook_received_total', 'Valid webhook payloads received', registry=PROM_REGISTRY)
 METRIC_REDIS_FAIL = Counter('nexia_webhook_redis_fail_total', 'Redis publish failures', registry=PROM_REGISTRY)
+METRIC_QUEUED = Counter('nexia_webhook_queued_total', 'Raw payloads queued in fast-ack mode', registry=PROM_REGISTRY)
+METRIC_INGESTED = Counter('nexia_webhook_ingested_total', 'Raw payloads processed by ingest workers', registry=PROM_REGISTRY)
+METRIC_STATUS_FLUSH = Counter('nexia_webhook_status_flush_total', 'Coalesced status batches applied', registry=PROM_REGISTRY)
+METRIC_INGEST_FAIL = Counter('nexia_webhook_ingest_fail_total', 'Ingest batches that failed and were left pending', registry=PROM_REGISTRY)
 
 
 @app.get("/api/webhooks/whatsapp")
@@ -59,7 +125,23 @@ async def receive(req: Request):
 		raise HTTPException(403, "Invalid signature")
 
 	raw_text = body.decode(errors="replace")
-	logger.info("raw webhook body: %s", raw_text)
+	CAPTURE.maybe_capture(redis, body)
+
+	if FAST_ACK:
+		# p99 bounded by one XADD; enrichment/persistence happen in the ingest workers
+		try:
+			redis.xadd(RAW_STREAM, {"body": raw_text, "received_at": str(int(time.time() * 1000))})
+			try:
+				METRIC_QUEUED.inc()
+			except Exception:
+				pass
+			return {"ok": True, "queued": True}
+		except Exception:
+			try:
+				METRIC_REDIS_FAIL.inc()
+			except Exception:
+				pass
+			logger.exception("redis unavailable when queuing raw payload; processing inline")
 
 	# Try parse JSON, but tolerate malformed payloads to avoid webhook retries
 	try:
@@ -70,6 +152,7 @@ async def receive(req: Request):
 		except Exception:
 			pass
 		logger.error("Invalid JSON webhook body (signature OK). Storing raw payload for inspection.")
+		CAPTURE.maybe_capture(redis, body, reason="invalid-json", force=True)
 		try:
 			# store raw payload so it can be inspected manually
 			redis.xadd("nf:incoming", {"source": "wa", "payload": raw_text})
@@ -82,207 +165,542 @@ async def receive(req: Request):
 			return {"ok": True, "warning": "redis-unavailable-invalid-json"}
 		return {"ok": True, "warning": "invalid-json"}
 
-	# Try enrich with org_id/channel_id via phone_number_id mapping
-	org_id = None
-	channel_id = None
+	# Count received valid payload
 	try:
-		pnid = None
-		display = None
+		METRIC_RECEIVED.inc()
+	except Exception:
+		pass
+
+	statuses: list[dict] = []
+	out = _ingest([payload], statuses_sink=statuses)
+	if statuses:
 		try:
-			entry = payload.get("entry", [])
-			if entry:
-				changes = entry[0].get("changes", [])
-				if changes:
-					value = changes[0].get("value", {})
-					meta = value.get("metadata", {})
-					pnid = meta.get("phone_number_id")
-					display = meta.get("display_phone_number")
+			await STATUSES.submit(statuses)
+		except Exception:
+			logger.exception("status update failed")
+	try:
+		xadd_many(redis, out)
+	except Exception:
+		try:
+			METRIC_REDIS_FAIL.inc()
 		except Exception:
 			pass
-		if pnid or display:
-			with SessionLocal() as db:
-				rows = db.execute(text("SELECT id, org_id, credentials, phone_number FROM channels"))
-				for r in rows:
-					row = dict(r._mapping)
-					creds = row.get("credentials") if isinstance(row.get("credentials"), dict) else None
-					if pnid and creds and creds.get("phone_number_id") == pnid:
-						channel_id = row.get("id")
-						org_id = row.get("org_id")
-						break
-					if display and row.get("phone_number") == display:
-						channel_id = row.get("id")
-						org_id = row.get("org_id")
-						break
+		logger.exception("redis unavailable when enqueuing parsed payload")
+		return {"ok": True, "warning": "redis-unavailable"}
+	_confirm_published(out)
+
+	return {"ok": True}
+
+
+def _ingest(payloads: list, strict: bool = False, statuses_sink: list | None = None) -> list[tuple[str, dict]]:
+	"""Enrich and persist parsed payloads; returns the stream entries to publish.
+
+	One payload -> N inbound message events + N status events (every
+	entry/change/item). With ``strict`` persistence errors propagate so the
+	ingest worker can leave the batch pending and retry it. When
+	``statuses_sink`` is given, routed statuses are appended to it instead of
+	being applied here (the inline path hands them to the coalescer).
+	"""
+	messages: list[dict] = []
+	statuses: list[dict] = []
+	passthrough: list = []
+	for payload in payloads:
+		m, st = decode_webhook(payload)
+		messages.extend(m)
+		statuses.extend(st)
+		if not m and not st:
+			passthrough.append(payload)
+	_resolve_routes(messages + statuses)
+
+	out: list[tuple[str, dict]] = []
+	if statuses_sink is not None:
+		statuses_sink.extend(statuses)
+		statuses = []
+	try:
+		out.extend(_apply_statuses(statuses))
 	except Exception:
-		logger.exception("channel lookup failed")
+		if strict:
+			raise
+		logger.exception("status update failed")
+	try:
+		out.extend(_persist_inbound(messages))
+	except Exception:
+		if strict:
+			raise
+		logger.exception("inbound persistence failed")
 
-	# Count received valid payload
+	# Fan-out: inbox (SSE) and incoming flow, one single-message envelope per event
+	for ev in messages:
+		if ev.get("duplicate"):
+			continue
+		fields = {"source": "wa", "payload": json.dumps(ev["payload"])}
+		if ev.get("org_id"):
+			fields["org_id"] = str(ev["org_id"])
+		if ev.get("channel_id"):
+			fields["channel_id"] = str(ev["channel_id"])
+		out.append(("nf:inbox", fields))
+		out.append(("nf:incoming", fields))
+	for payload in passthrough:
+		# Other change types (templates, account updates...): forward untouched
+		fields = {"source": "wa", "payload": json.dumps(payload)}
+		for _, _, value in iter_changes(payload):
+			meta = value.get("metadata") or {}
+			ev = {"phone_number_id": meta.get("phone_number_id"), "display_phone_number": meta.get("display_phone_number")}
+			_resolve_routes([ev])
+			if ev.get("org_id"):
+				fields["org_id"] = str(ev["org_id"])
+				fields["channel_id"] = str(ev["channel_id"])
+			break
+		out.append(("nf:inbox", fields))
+		out.append(("nf:incoming", fields))
+	return out
+
+
+def process_raw_batch(items: list[tuple[str, dict]], strict: bool = True) -> None:
+	"""Ingest a batch of ``nf:webhooks:raw`` entries and publish the results in one pipeline."""
+	payloads: list = []
+	out: list[tuple[str, dict]] = []
+	for _, fields in items:
+		raw_text = fields.get("body") or ""
+		try:
+			payloads.append(json.loads(raw_text))
+		except JSONDecodeError:
+			try:
+				METRIC_INVALID_JSON.inc()
+			except Exception:
+				pass
+			# same as the inline path: keep the raw payload for inspection
+			CAPTURE.maybe_capture(redis, raw_text.encode(), reason="invalid-json", force=True)
+			out.append(("nf:incoming", {"source": "wa", "payload": raw_text}))
+	if payloads:
+		try:
+			METRIC_RECEIVED.inc(len(payloads))
+		except Exception:
+			pass
+	out = _ingest(payloads, strict=strict) + out
+	xadd_many(redis, out)
+	_confirm_published(out)
 	try:
-		METRIC_RECEIVED.inc()
+		METRIC_INGESTED.inc(len(items))
 	except Exception:
 		pass
 
-	# Handle WhatsApp delivery/read statuses for outbound messages (best-effort)
-	statuses = []
+
+def _ensure_ingest_group() -> None:
+	try:
+		# "0": bodies queued before the first worker started are not skipped
+		redis.xgroup_create(RAW_STREAM, INGEST_GROUP, id="0", mkstream=True)
+	except Exception as e:
+		if "BUSYGROUP" not in str(e).upper():
+			raise
+
+
+def ingest_once(consumer: str, backlog: bool = False, failures: int = 0) -> tuple[int, bool]:
+	"""Read and process one batch; returns ``(entries, ok)``.
+
+	``backlog`` re-reads this consumer's own pending entries (after a restart or
+	a failed batch) instead of new ones. Entries are acked only after their
+	fan-out is published; after ``INGEST_MAX_RETRIES`` failed attempts the batch
+	is processed best-effort (like the inline path) so a poison payload cannot
+	block the stream.
+	"""
+	resp = redis.xreadgroup(INGEST_GROUP, consumer, {RAW_STREAM: "0" if backlog else ">"}, count=INGEST_BATCH, block=None if backlog else INGEST_BLOCK_MS)
+	items: list[tuple[str, dict]] = []
+	for _, entries in resp or []:
+		for msg_id, fields in entries:
+			if fields is not None:
+				items.append((msg_id, fields))
+	if not items:
+		return 0, True
 	try:
-		entry = payload.get("entry", [])
-		if entry:
-			changes = entry[0].get("changes", [])
-			if changes:
-				value = changes[0].get("value", {})
-				statuses = value.get("statuses", []) or []
+		process_raw_batch(items, strict=failures < INGEST_MAX_RETRIES)
 	except Exception:
-		statuses = []
-	if statuses:
-		from packages.common.db import SessionLocal as _SL
-		for st in statuses:
-			wa_id = (st or {}).get("id")
-			new_status = (st or {}).get("status")
-			if not wa_id or not new_status:
+		try:
+			METRIC_INGEST_FAIL.inc()
+		except Exception:
+			pass
+		logger.exception("ingest batch failed (%d entries); left pending", len(items))
+		return len(items), False
+	redis.xack(RAW_STREAM, INGEST_GROUP, *[msg_id for msg_id, _ in items])
+	return len(items), True
+
+
+async def ingest_loop(consumer: str | None = None) -> None:
+	consumer = consumer or INGEST_CONSUMER
+	await asyncio.to_thread(_ensure_ingest_group)
+	logger.info("webhook ingest starting (stream=%s group=%s consumer=%s)", RAW_STREAM, INGEST_GROUP, consumer)
+	backlog = True
+	failures = 0
+	while True:
+		try:
+			n, ok = await asyncio.to_thread(ingest_once, consumer, backlog, failures)
+			if not ok:
+				failures += 1
+				backlog = True
+				await asyncio.sleep(min(5.0, 0.5 * failures))
 				continue
-			with _SL() as db:
-				row = None
+			failures = 0
+			if backlog and n == 0:
+				backlog = False
+		except Exception:
+			logger.exception("ingest loop error")
+			await asyncio.sleep(1)
+
+
+def _resolve_routes(events: list[dict]) -> None:
+	"""Set ``org_id``/``channel_id`` on each event; one index lookup per distinct change metadata."""
+	seen: dict[tuple, tuple | None] = {}
+	for ev in events:
+		key = (ev.get("phone_number_id"), ev.get("display_phone_number"))
+		if key not in seen:
+			route = None
+			if key[0] or key[1]:
 				try:
-					row = db.query(Message).filter(Message.meta["wa_msg_id"].astext == str(wa_id)).first()  # type: ignore
+					route = CHANNELS.resolve(redis, pnid=key[0], display=key[1])
 				except Exception:
-					row = None
-				if row is None:
-					try:
-						candidates = db.query(Message).order_by(Message.id.desc()).limit(200).all()
-						for r in candidates:
-							m = getattr(r, "meta", None) or {}
-							if isinstance(m, dict) and str(m.get("wa_msg_id")) == str(wa_id):
-								row = r
-								break
-					except Exception:
-						pass
-				if row is not None:
-					try:
-						if getattr(row, "status", None) != new_status:
-							row.status = new_status
-							try:
-								meta = getattr(row, "meta", None) or {}
-								if isinstance(meta, dict):
-									meta["last_status"] = new_status
-									row.meta = meta
-							except Exception:
-								pass
-								db.commit()
-							except Exception:
-								pass
-							payload_ev = {
-							"conversation_id": getattr(row, "conversation_id", None),
-							"message_id": getattr(row, "id", None),
-							"wa_msg_id": wa_id,
-							"status": new_status,
-							"channel_id": str(channel_id) if channel_id else None,
-						}
-						org_for_evt = str(org_id) if org_id else None
-						if not org_for_evt:
-							try:
-								conv = db.get(Conversation, getattr(row, "conversation_id", None))
-								if conv and getattr(conv, "org_id", None):
-									org_for_evt = str(conv.org_id)
-							except Exception:
-								pass
-						if org_for_evt:
-							try:
-								redis.xadd("nf:webhooks", {
-									"org_id": org_for_evt,
-									"type": "message.status",
-									"body": json.dumps(payload_ev),
-									"event_id": __import__('uuid').uuid4().hex,
-									"ts": str(int(__import__('time').time()*1000)),
-								})
-							except Exception:
-								pass
-
-	# Fan-out: inbox (SSE) and incoming flow with enrichment when available
-	out_common = {"source": "wa", "payload": json.dumps(payload)}
-	if org_id:
-		out_common["org_id"] = str(org_id)
-	if channel_id:
-		out_common["channel_id"] = str(channel_id)
-
-	# Persist inbound message (best-effort) when org/channel available
+					logger.exception("channel lookup failed")
+			seen[key] = route
+		org_id, channel_id = seen[key] or (None, None)
+		ev["org_id"] = org_id
+		ev["channel_id"] = channel_id
+
+
+def _webhook_event(org_id: str, event_type: str, body: dict) -> tuple[str, dict]:
+	return ("nf:webhooks", {
+		"org_id": str(org_id),
+		"type": event_type,
+		"body": json.dumps(body),
+		"event_id": uuid.uuid4().hex,
+		"ts": str(int(time.time() * 1000)),
+	})
+
+
+def _provider_lookup(db, wa_ids: list[str]) -> dict[str, dict] | None:
+	"""``wa_msg_id -> {message_id, conversation_id, org_id}`` with one indexed lookup.
+
+	Returns ``None`` when the ``message_provider_ids`` table is unavailable
+	(not migrated yet) so callers can fall back.
+	"""
+	if not wa_ids:
+		return {}
 	try:
-		if org_id and channel_id and Contact and Conversation and Message:
-			# extract sender and text
-			wa_from = None
-			text_body = None
+		rows = db.query(MessageProviderId).filter(MessageProviderId.wa_msg_id.in_(wa_ids)).all()
+	except Exception:
+		db.rollback()
+		return None
+	return {
+		r.wa_msg_id: {
+			"message_id": r.message_id,
+			"conversation_id": r.conversation_id,
+			"org_id": r.org_id,
+			"published_at": r.published_at,
+			"status_published": r.status_published,
+		}
+		for r in rows
+	}
+
+
+def _confirm_published(out: list[tuple[str, dict]]) -> None:
+	"""Record that the events in ``out`` reached Redis (best-effort).
+
+	Rows are stored before their events are published. A wamid whose
+	``published_at`` / ``status_published`` was never set is re-emitted when the
+	batch is retried or Meta redelivers it, instead of being dropped as a
+	duplicate.
+	"""
+	received: set[str] = set()
+	statuses: dict[str, str] = {}
+	for stream, fields in out:
+		if stream != "nf:webhooks" or fields.get("type") not in ("message.received", "message.status"):
+			continue
+		try:
+			body = json.loads(fields.get("body") or "{}")
+		except Exception:
+			continue
+		if fields["type"] == "message.received" and body.get("message_id"):
+			received.add(str(body["message_id"]))
+		elif fields["type"] == "message.status" and body.get("wa_msg_id"):
+			statuses[str(body["wa_msg_id"])] = str(body.get("status"))
+	if not (received or statuses) or not MessageProviderId:
+		return
+	tbl = MessageProviderId.__table__
+	try:
+		with SessionLocal() as db:
+			if received:
+				db.execute(
+					update(tbl)
+					.where(tbl.c.message_id.in_(list(received)))
+					.where(tbl.c.published_at.is_(None))
+					.values(published_at=datetime.utcnow())
+				)
+			if statuses:
+				db.execute(
+					update(tbl).where(tbl.c.wa_msg_id == bindparam("_wa")).values(status_published=bindparam("_status")),
+					[{"_wa": wa, "_status": st} for wa, st in statuses.items()],
+				)
+			db.commit()
+	except Exception:
+		# unconfirmed events are published again on a retry/redelivery (at-least-once)
+		logger.exception("publish confirmation failed")
+
+
+def _meta_lookup(db, wa_ids: list[str]) -> dict[str, dict]:
+	"""Fallback for trees without the side table: one JSON-path query on ``messages.meta``."""
+	try:
+		wa_col = Message.meta["wa_msg_id"].as_string()
+		rows = db.query(Message.id, Message.conversation_id, wa_col).filter(wa_col.in_(wa_ids)).all()
+	except Exception:
+		db.rollback()
+		logger.exception("wa_msg_id meta lookup failed")
+		return {}
+	return {str(wa): {"message_id": mid, "conversation_id": cid, "org_id": None} for mid, cid, wa in rows}
+
+
+def _status_rank(status) -> int:
+	if status is None:
+		return -1
+	return STATUS_RANK.get(str(status), 0)
+
+
+def _apply_statuses(statuses: list[dict]) -> list[tuple[str, dict]]:
+	"""Apply delivery/read receipts to outbound messages; returns ``message.status`` events.
+
+	Receipts for the same message collapse to the highest status
+	(sent < delivered < read, failed terminal) and never downgrade what is
+	stored. One lookup resolves every ``wa_msg_id`` and one executemany
+	UPDATE applies the batch; the WHERE clause re-checks the rank so a
+	concurrent writer cannot be overwritten with an older status.
+	"""
+	events: list[tuple[str, dict]] = []
+	if not statuses:
+		return events
+	wa_ids = list(dict.fromkeys(st["wa_msg_id"] for st in statuses))
+	with SessionLocal() as db:
+		found = _provider_lookup(db, wa_ids)
+		if found is None:
+			found = _meta_lookup(db, wa_ids)
+		if not found:
+			return events
+
+		# collapse: highest-ranked receipt per message (later wins on ties)
+		best: dict[str, dict] = {}
+		for st in statuses:
+			info = found.get(st["wa_msg_id"])
+			if info is None:
+				continue
+			prev = best.get(info["message_id"])
+			if prev is None or _status_rank(st["status"]) >= _status_rank(prev["status"]):
+				best[info["message_id"]] = {**st, "info": info}
+		if not best:
+			return events
+
+		current = {
+			mid: (status, meta)
+			for mid, status, meta in db.query(Message.id, Message.status, Message.meta).filter(Message.id.in_(list(best))).all()
+		}
+		updates: list[dict] = []
+		replays: list[str] = []
+		for mid, st in best.items():
+			if mid not in current:
+				continue
+			status, meta = current[mid]
+			if _status_rank(st["status"]) <= _status_rank(status):
+				if st["status"] == status and "status_published" in st["info"] and st["info"]["status_published"] != status:
+					# applied by an earlier attempt whose event never reached Redis: emit it again
+					replays.append(mid)
+				continue
+			meta = dict(meta or {})
+			meta["last_status"] = st["status"]
+			updates.append({"_id": mid, "_status": st["status"], "_meta": meta, "_rank": _status_rank(st["status"])})
+		if not updates and not replays:
+			return events
+
+		tbl = Message.__table__
+		rank_expr = case(
+			(tbl.c.status.is_(None), -1),
+			*[(tbl.c.status == name, rank) for name, rank in STATUS_RANK.items()],
+			else_=0,
+		)
+		stmt = (
+			update(tbl)
+			.where(tbl.c.id == bindparam("_id"))
+			.where(rank_expr < bindparam("_rank"))
+			.values(status=bindparam("_status"), meta=bindparam("_meta", type_=tbl.c.meta.type))
+		)
+		if updates:
+			db.execute(stmt, updates)
+			db.commit()
+
+		# org for events: routed channel first, then the side table, then the conversation
+		applied = [best[u["_id"]] for u in updates] + [best[mid] for mid in replays]
+		conv_orgs: dict[str, str] = {}
+		missing_convs = {
+			st["info"]["conversation_id"] for st in applied
+			if not st.get("org_id") and not st["info"].get("org_id") and st["info"].get("conversation_id")
+		}
+		if missing_convs:
 			try:
-				entry = payload.get("entry", [])
-				if entry:
-					changes = entry[0].get("changes", [])
-					if changes:
-						value = changes[0].get("value", {})
-						msgs = value.get("messages", [])
-						if msgs:
-							m0 = msgs[0]
-							wa_from = m0.get("from")
-							text_body = (m0.get("text", {}) or {}).get("body")
+				for cid, org in db.query(Conversation.id, Conversation.org_id).filter(Conversation.id.in_(missing_convs)).all():
+					if org:
+						conv_orgs[cid] = str(org)
 			except Exception:
-				pass
-			if wa_from or text_body:
-				with SessionLocal() as db:
-					# find or create contact
-					ct = (
-						db.query(Contact)
-						.filter(Contact.org_id == str(org_id))
-						.filter((Contact.wa_id == wa_from) | (Contact.phone == wa_from))
-						.first()
-					)
-					if not ct:
-						import uuid
-						ct = Contact(id=str(uuid.uuid4()), org_id=str(org_id), wa_id=wa_from, phone=wa_from, name=None, attributes={})
-						db.add(ct)
-						db.commit()
-					# find open conversation for this contact/channel
-					conv = (
-						db.query(Conversation)
-						.filter(Conversation.org_id == str(org_id))
-						.filter(Conversation.contact_id == ct.id)
-						.filter(Conversation.channel_id == str(channel_id))
-						.filter(Conversation.state == 'open')
-						.first()
-					)
-					if not conv:
-						import uuid
-						conv = Conversation(id=str(uuid.uuid4()), org_id=str(org_id), contact_id=ct.id, channel_id=str(channel_id), state='open', assignee=None)
-						db.add(conv)
-						db.commit()
-		# persist inbound message
-					import uuid
-					msg = Message(id=str(uuid.uuid4()), conversation_id=conv.id, direction='in', type='text', content={"text": text_body} if text_body else None, template_id=None, status=None, meta=None, client_id=None)
-					db.add(msg)
-					db.commit()
-					# Publish outgoing webhook event for inbound message (best-effort)
-					try:
-						payload = {
-							"conversation_id": conv.id,
-							"message_id": msg.id,
-							"type": msg.type,
-							"direction": msg.direction,
-							"content": msg.content,
-							"channel_id": conv.channel_id,
-						}
-						redis.xadd("nf:webhooks", {"org_id": str(org_id), "type": "message.received", "body": json.dumps(payload), "event_id": str(uuid.uuid4()), "ts": str(int(__import__('time').time()*1000))})
-					except Exception:
-						pass
-	except Exception:
-		logger.exception("inbound persistence failed")
+				db.rollback()
+		for st in applied:
+			info = st["info"]
+			org_for_evt = st.get("org_id") or info.get("org_id") or conv_orgs.get(info.get("conversation_id"))
+			if org_for_evt:
+				events.append(_webhook_event(org_for_evt, "message.status", {
+					"conversation_id": info.get("conversation_id"),
+					"message_id": info["message_id"],
+					"wa_msg_id": st["wa_msg_id"],
+					"status": st["status"],
+					"channel_id": str(st["channel_id"]) if st.get("channel_id") else None,
+				}))
+	return events
+
+
+async def _flush_statuses(batch: list[dict]) -> None:
+	"""Coalescer flush: one bulk UPDATE, then all ``message.status`` events in one pipeline."""
+	events = await asyncio.to_thread(_apply_statuses, batch)
 	try:
-		redis.xadd("nf:inbox", out_common)
-		redis.xadd("nf:incoming", out_common)
+		METRIC_STATUS_FLUSH.inc()
 	except Exception:
+		pass
+	if events:
 		try:
-			METRIC_REDIS_FAIL.inc()
+			await asyncio.to_thread(xadd_many, redis, events)
 		except Exception:
-			pass
-		logger.exception("redis unavailable when enqueuing parsed payload")
-		return {"ok": True, "warning": "redis-unavailable"}
+			try:
+				METRIC_REDIS_FAIL.inc()
+			except Exception:
+				pass
+			logger.exception("redis unavailable when publishing status events")
+			return
+		await asyncio.to_thread(_confirm_published, events)
 
-	return {"ok": True}
+
+STATUSES = MicroBatcher(_flush_statuses, window_ms=STATUS_WINDOW_MS, max_items=STATUS_MAX_BATCH)
+
+
+def _open_conversation_id(db, org_id: str, channel_id: str, wa_from: str | None) -> tuple[str, str]:
+	"""Find or create the contact and its open conversation on this channel (no commit).
+
+	One ``INSERT ... ON CONFLICT ... RETURNING`` per entity, so concurrent
+	receivers/ingest workers converge on the same rows. Returns
+	``(contact_id, conversation_id)``.
+	"""
+	contact_id = upsert_contact(db, Contact, org_id, wa_from)
+	return contact_id, upsert_open_conversation(db, Conversation, org_id, contact_id, channel_id)
+
+
+def _message_type(ev: dict) -> str:
+	mtype = ev.get("type") or "text"
+	return "media" if mtype in MEDIA_TYPES else mtype
+
+
+def _received_event(org_id: str, channel_id: str, conversation_id, message_id, mtype: str, content) -> tuple[str, dict]:
+	return _webhook_event(org_id, "message.received", {
+		"conversation_id": conversation_id,
+		"message_id": message_id,
+		"type": mtype,
+		"direction": "in",
+		"content": content,
+		"channel_id": channel_id,
+	})
+
+
+def _persist_inbound(messages: list[dict]) -> list[tuple[str, dict]]:
+	"""Persist routed inbound messages with one multi-row INSERT; returns ``message.received`` events.
+
+	A known wamid is a duplicate only once its publish was confirmed
+	(``published_at``). A row stored by an attempt whose publish failed is not
+	inserted again, but its events and fan-out are emitted again.
+	"""
+	routed = [ev for ev in messages if ev.get("org_id") and ev.get("channel_id") and (ev.get("from") or ev.get("text"))]
+	if not routed or not (Contact and Conversation and Message):
+		return []
+	rows: list[dict] = []
+	provider_rows: list[dict] = []
+	events: list[tuple[str, dict]] = []
+	with SessionLocal() as db:
+		# Meta redelivers on timeouts (and ingest retries a failed batch): skip known wa_msg_ids
+		known = _provider_lookup(db, [str(ev["wa_msg_id"]) for ev in routed if ev.get("wa_msg_id")])
+		# steady state: every sender resolves from the cache (one MGET), no contact/conversation queries
+		convs: dict[tuple, tuple[str, str]] = conversation_cache.get_many(
+			redis, [(str(ev["org_id"]), str(ev["channel_id"]), ev.get("from")) for ev in routed]
+		)
+		cached = set(convs)
+		seen: set[str] = set()
+		for ev in routed:
+			key = (str(ev["org_id"]), str(ev["channel_id"]), ev.get("from"))
+			if known is not None and ev.get("wa_msg_id"):
+				wa = str(ev["wa_msg_id"])
+				info = known.get(wa)
+				if wa in seen or (info is not None and info.get("published_at") is not None):
+					ev["duplicate"] = True
+					continue
+				seen.add(wa)
+				if info is not None:
+					# persisted, never published: re-emit from the stored row
+					events.append(_received_event(
+						str(info.get("org_id") or key[0]), key[1], info.get("conversation_id"), info.get("message_id"),
+						_message_type(ev), {"text": ev["text"]} if ev.get("text") else None,
+					))
+					continue
+			if key not in convs:
+				convs[key] = _open_conversation_id(db, *key)
+			row = {
+				"id": str(uuid.uuid4()),
+				"conversation_id": convs[key][1],
+				"direction": "in",
+				"type": _message_type(ev),
+				"content": {"text": ev["text"]} if ev.get("text") else None,
+				"template_id": None,
+				"status": None,
+				"meta": {"wa_msg_id": ev["wa_msg_id"]} if ev.get("wa_msg_id") else None,
+				"client_id": None,
+			}
+			rows.append(row)
+			if known is not None and ev.get("wa_msg_id"):
+				provider_rows.append({
+					"wa_msg_id": str(ev["wa_msg_id"]),
+					"message_id": row["id"],
+					"conversation_id": row["conversation_id"],
+					"org_id": key[0],
+					"created_at": datetime.utcnow(),
+				})
+			events.append(_received_event(key[0], key[1], row["conversation_id"], row["id"], row["type"], row["content"]))
+		if not rows:
+			db.rollback()
+			return events
+		try:
+			db.execute(insert(Message), rows)
+			if provider_rows:
+				db.execute(insert(MessageProviderId), provider_rows)
+			db.commit()
+		except Exception:
+			# a cached conversation may have been deleted meanwhile: resolve from the DB next time
+			for key in cached:
+				try:
+					conversation_cache.invalidate_conversation(redis, convs[key][1])
+				except Exception:
+					pass
+			raise
+	conversation_cache.put_many(redis, {k: v for k, v in convs.items() if k not in cached})
+	return events
+
+
+@app.get("/internal/webhooks/samples")
+async def payload_samples(req: Request, count: int = 20):
+	# disabled unless an inspection token is configured; never exposed to Meta's callers
+	token = req.headers.get("X-Internal-Token", "")
+	if not INSPECT_TOKEN or not hmac.compare_digest(token, INSPECT_TOKEN):
+		raise HTTPException(404, "Not Found")
+	try:
+		return {"stream": CAPTURE.stream, "samples": CAPTURE.recent(redis, min(max(1, count), 200))}
+	except Exception:
+		logger.exception("reading payload samples failed")
+		raise HTTPException(503, "samples unavailable")
 
 
 @app.get("/metrics")
@@ -0,0 +1,302 @@
+"""Micro-benchmark for the webhook receiver hot path (``POST /api/webhooks/whatsapp``).
+
+Replays synthetic WhatsApp Cloud payloads against the real FastAPI app with
+SQLite and an in-process Redis stand-in, and prints one JSON document with
+requests/s, p50/p95/p99 latency and DB/Redis round trips per request for
+each scenario. Compare the JSON between commits to spot regressions.
+
+Usage (from repo root):
+  python services/webhook-receiver/bench/bench_receive.py
+  python services/webhook-receiver/bench/bench_receive.py -n 2000 --scenario batch50 --out before.json
+  python services/webhook-receiver/bench/bench_receive.py --redis-url redis://localhost:6379/15
+
+Redis backend: ``--redis-url`` (real server, the DB is flushed), else
+``fakeredis`` when installed, else a small built-in in-memory stand-in.
+"""
+import argparse
+import hashlib
+import hmac
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SERVICE_ROOT = Path(__file__).resolve().parents[1]
+REPO_ROOT = SERVICE_ROOT.parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+APP_SECRET = "bench_secret"
+PNID = "bench-pnid"
+SCENARIOS = ("single", "batch50", "status_only", "malformed")
+
+
+class _MemoryPipeline:
+    def __init__(self, r):
+        self.r = r
+        self.ops = []
+
+    def __getattr__(self, name):
+        def _op(*args, **kwargs):
+            self.ops.append((name, args, kwargs))
+            return self
+        return _op
+
+    def execute(self):
+        ops, self.ops = self.ops, []
+        return [getattr(self.r, name)(*args, **kwargs) for name, args, kwargs in ops]
+
+
+class MemoryRedis:
+    """Just enough of redis-py for the receiver: streams, hashes, pipelines."""
+
+    def __init__(self):
+        self.streams = {}
+        self.hashes = {}
+        self.seq = 0
+
+    def pipeline(self, transaction=True):
+        return _MemoryPipeline(self)
+
+    def xadd(self, stream, fields, **kwargs):
+        self.seq += 1
+        msg_id = f"{self.seq}-0"
+        self.streams.setdefault(stream, []).append((msg_id, dict(fields)))
+        return msg_id
+
+    def delete(self, *keys):
+        for k in keys:
+            self.hashes.pop(k, None)
+            self.streams.pop(k, None)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        h = self.hashes.setdefault(key, {})
+        if mapping:
+            h.update(mapping)
+        if field is not None:
+            h[field] = value
+
+    def hsetnx(self, key, field, value):
+        self.hashes.setdefault(key, {}).setdefault(field, value)
+
+    def hdel(self, key, *fields):
+        for f in fields:
+            self.hashes.get(key, {}).pop(f, None)
+
+    def hmget(self, key, fields):
+        h = self.hashes.get(key, {})
+        return [h.get(f) for f in fields]
+
+
+class CountingRedis:
+    """Proxy that counts network round trips (a pipeline execute counts once)."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = 0
+
+    def pipeline(self, *args, **kwargs):
+        parent = self
+        pipe = self.inner.pipeline(*args, **kwargs)
+
+        class _Pipe:
+            def __getattr__(self, name):
+                attr = getattr(pipe, name)
+                if name != "execute":
+                    return attr
+
+                def _execute(*a, **k):
+                    parent.calls += 1
+                    return attr(*a, **k)
+                return _execute
+
+        return _Pipe()
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if not callable(attr):
+            return attr
+
+        def _call(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return _call
+
+
+def _make_redis(url: str | None):
+    if url:
+        from redis import Redis
+        r = Redis.from_url(url, decode_responses=True)
+        r.flushdb()
+        return r, "redis"
+    try:
+        import fakeredis
+        return fakeredis.FakeRedis(decode_responses=True), "fakeredis"
+    except ImportError:
+        return MemoryRedis(), "memory"
+
+
+def _sign(body: bytes) -> str:
+    return "sha256=" + hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+def _message(i: int, j: int = 0) -> dict:
+    return {
+        "from": f"52155{(i * 50 + j) % 5000:05d}",
+        "id": f"wamid.bench.{i}.{j}",
+        "timestamp": str(int(time.time())),
+        "type": "text",
+        "text": {"body": f"hola {i}-{j}"},
+    }
+
+
+def _envelope(value: dict) -> dict:
+    value = {"messaging_product": "whatsapp", "metadata": {"phone_number_id": PNID, "display_phone_number": "+15550000"}, **value}
+    return {"object": "whatsapp_business_account", "entry": [{"id": "waba-bench", "changes": [{"field": "messages", "value": value}]}]}
+
+
+def build_body(scenario: str, i: int) -> bytes:
+    if scenario == "single":
+        return json.dumps(_envelope({"messages": [_message(i)]})).encode()
+    if scenario == "batch50":
+        return json.dumps(_envelope({"messages": [_message(i, j) for j in range(50)]})).encode()
+    if scenario == "status_only":
+        statuses = [{"id": f"wamid.out.{i}.{k}", "status": s, "recipient_id": "5215500000"} for k, s in enumerate(("sent", "delivered", "read"))]
+        return json.dumps(_envelope({"statuses": statuses})).encode()
+    if scenario == "malformed":
+        return b'{"entry": [{"changes": [' + str(i).encode()
+    raise ValueError(scenario)
+
+
+def _load_app(db_path: Path, fast_ack: bool):
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path.as_posix()}"
+    os.environ["WHATSAPP_APP_SECRET"] = APP_SECRET
+    os.environ["WEBHOOK_FAST_ACK"] = "true" if fast_ack else "false"
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+    spec = importlib.util.spec_from_file_location("webhook_bench_main", SERVICE_ROOT / "app" / "main.py")
+    main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(main)
+    return main, common_db
+
+
+def _seed(common_db, total_requests: int) -> None:
+    from packages.common.models import Base, Channel, Conversation, Message, MessageProviderId
+    tables = ("channels", "contacts", "conversations", "messages", "message_provider_ids")
+    Base.metadata.create_all(bind=common_db.engine, tables=[Base.metadata.tables[t] for t in tables])
+    with common_db.SessionLocal() as s:
+        s.add(Channel(id="ch-bench", org_id="org-bench", type="whatsapp", mode="cloud", status="active",
+                      credentials={"phone_number_id": PNID}, phone_number="+15550000"))
+        s.add(Conversation(id="cv-bench", org_id="org-bench", contact_id=None, channel_id="ch-bench", state="open"))
+        for i in range(total_requests):
+            for k in range(3):
+                mid = f"out-{i}-{k}"
+                s.add(Message(id=mid, conversation_id="cv-bench", direction="out", type="text", meta={"wa_msg_id": f"wamid.out.{i}.{k}"}))
+                s.add(MessageProviderId(wa_msg_id=f"wamid.out.{i}.{k}", message_id=mid, conversation_id="cv-bench", org_id="org-bench"))
+        s.commit()
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def run_scenario(client, counters, scenario: str, n: int, warmup: int, offset: int) -> dict:
+    for i in range(warmup):
+        body = build_body(scenario, offset + i)
+        client.post("/api/webhooks/whatsapp", content=body, headers={"X-Hub-Signature-256": _sign(body)})
+    bodies = [build_body(scenario, offset + warmup + i) for i in range(n)]
+    counters["db"] = 0
+    counters["redis"].calls = 0
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for body in bodies:
+        t0 = time.perf_counter()
+        r = client.post("/api/webhooks/whatsapp", content=body, headers={"X-Hub-Signature-256": _sign(body)})
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+        if r.status_code != 200:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": n,
+        "errors": errors,
+        "payload_bytes": len(bodies[0]) if bodies else 0,
+        "rps": round(n / elapsed, 1) if elapsed > 0 else None,
+        "p50_ms": round(statistics.median(latencies), 3) if latencies else 0.0,
+        "p95_ms": round(_percentile(latencies, 95), 3),
+        "p99_ms": round(_percentile(latencies, 99), 3),
+        "max_ms": round(max(latencies), 3) if latencies else 0.0,
+        "db_roundtrips_per_request": round(counters["db"] / n, 2) if n else 0.0,
+        "redis_roundtrips_per_request": round(counters["redis"].calls / n, 2) if n else 0.0,
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main(argv=None) -> dict:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-n", "--requests", type=int, default=300, help="measured requests per scenario")
+    ap.add_argument("--warmup", type=int, default=20)
+    ap.add_argument("--scenario", choices=(*SCENARIOS, "all"), default="all")
+    ap.add_argument("--redis-url", default=None, help="use a real Redis instead of fakeredis/in-memory")
+    ap.add_argument("--fast-ack", action="store_true", help="benchmark with WEBHOOK_FAST_ACK=true")
+    ap.add_argument("--out", default=None, help="also write the JSON report to this file")
+    args = ap.parse_args(argv)
+
+    import logging
+    logging.disable(logging.CRITICAL)
+    from fastapi.testclient import TestClient
+    from sqlalchemy import event
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    with tempfile.TemporaryDirectory() as tmp:
+        main_mod, common_db = _load_app(Path(tmp) / "bench.db", args.fast_ack)
+        per_scenario = args.requests + args.warmup
+        _seed(common_db, per_scenario * len(SCENARIOS))
+
+        counters = {"db": 0}
+        event.listen(common_db.get_engine(), "before_cursor_execute", lambda *a, **k: counters.__setitem__("db", counters["db"] + 1))
+        backend, backend_name = _make_redis(args.redis_url)
+        counters["redis"] = CountingRedis(backend)
+        main_mod.redis = counters["redis"]
+
+        report = {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "redis_backend": backend_name,
+            "database": "sqlite",
+            "fast_ack": args.fast_ack,
+            "scenarios": {},
+        }
+        with TestClient(main_mod.app) as client:
+            for idx, name in enumerate(scenarios):
+                offset = SCENARIOS.index(name) * per_scenario if args.scenario == "all" else idx
+                report["scenarios"][name] = run_scenario(client, counters, name, args.requests, args.warmup, offset)
+        common_db.get_engine().dispose()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+import importlib.util
+from pathlib import Path
+
+
+def test_bench_harness_reports_every_scenario(tmp_path):
+    path = Path(__file__).resolve().parents[1] / "bench" / "bench_receive.py"
+    spec = importlib.util.spec_from_file_location("webhook_bench", path)
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+
+    out = tmp_path / "bench.json"
+    report = bench.main(["-n", "3", "--warmup", "1", "--out", str(out)])
+    assert set(report["scenarios"]) == set(bench.SCENARIOS)
+    for name, res in report["scenarios"].items():
+        assert res["errors"] == 0, name
+        assert res["p99_ms"] >= res["p50_ms"] > 0
+    assert report["scenarios"]["malformed"]["db_roundtrips_per_request"] == 0
+    assert out.exists()
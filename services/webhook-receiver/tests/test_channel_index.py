@@ -0,0 +1,171 @@
+import importlib
+import json
+import os
+
+import pytest
+from sqlalchemy import Column, String, event
+from sqlalchemy.dialects.sqlite import JSON
+from sqlalchemy.orm import declarative_base
+
+
+DBBase = declarative_base()
+
+
+class ChannelModel(DBBase):
+    __tablename__ = "channels"
+    id = Column(String, primary_key=True)
+    org_id = Column(String)
+    credentials = Column(JSON)
+    phone_number = Column(String)
+
+
+class FakePipeline:
+    def __init__(self, r):
+        self.r = r
+        self.ops = []
+
+    def __getattr__(self, name):
+        def _op(*args, **kwargs):
+            self.ops.append((name, args, kwargs))
+            return self
+        return _op
+
+    def execute(self):
+        out = [getattr(self.r, name)(*args, **kwargs) for name, args, kwargs in self.ops]
+        self.ops = []
+        return out
+
+
+class FakeHashRedis:
+    def __init__(self):
+        self.hashes = {}
+        self.kv = {}
+        self.hmget_calls = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        h = self.hashes.setdefault(key, {})
+        if mapping:
+            h.update(mapping)
+        if field is not None:
+            h[field] = value
+
+    def hsetnx(self, key, field, value):
+        self.hashes.setdefault(key, {}).setdefault(field, value)
+
+    def hdel(self, key, *fields):
+        for f in fields:
+            self.hashes.get(key, {}).pop(f, None)
+
+    def get(self, key):
+        return self.kv.get(key)
+
+    def incr(self, key):
+        self.kv[key] = str(int(self.kv.get(key) or 0) + 1)
+        return int(self.kv[key])
+
+    def hmget(self, key, fields):
+        self.hmget_calls += 1
+        h = self.hashes.get(key, {})
+        return [h.get(f) for f in fields]
+
+
+@pytest.fixture
+def db(tmp_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'test.db').as_posix()}"
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+    from packages.common.db import engine, SessionLocal
+    DBBase.metadata.create_all(bind=engine)
+    s = SessionLocal()
+    try:
+        s.add(ChannelModel(id="ch1", org_id="o1", credentials={"phone_number_id": "pnid-1"}, phone_number="+111"))
+        s.add(ChannelModel(id="ch2", org_id="o2", credentials={"phone_number_id": "pnid-2"}, phone_number="+222"))
+        s.commit()
+    finally:
+        s.close()
+    queries = []
+    event.listen(common_db.get_engine(), "before_cursor_execute", lambda *a, **k: queries.append(a[2]))
+    yield queries
+
+
+def test_resolve_builds_index_once_then_serves_from_cache(db):
+    from packages.common.channel_index import ChannelIndex, READY_FIELD
+
+    r = FakeHashRedis()
+    idx = ChannelIndex(key="test:channels")
+    assert idx.resolve(r, pnid="pnid-2") == ("o2", "ch2")
+    assert len(db) == 1  # single rebuild query
+    assert READY_FIELD in r.hashes["test:channels"]
+    assert json.loads(r.hashes["test:channels"]["pnid:pnid-1"]) == {"org_id": "o1", "channel_id": "ch1"}
+
+    # Another process (cold LRU) resolves with one HMGET and no DB access
+    other = ChannelIndex(key="test:channels")
+    assert other.resolve(r, display="+111") == ("o1", "ch1")
+    assert other.resolve(r, pnid="unknown") is None
+    assert len(db) == 1
+
+    # Warm LRU: no Redis round trip either
+    calls = r.hmget_calls
+    assert other.resolve(r, display="+111") == ("o1", "ch1")
+    assert r.hmget_calls == calls
+
+
+def test_index_and_unindex_channel(db):
+    from packages.common.channel_index import ChannelIndex, index_channel, unindex_channel, route_fields, READY_FIELD
+
+    r = FakeHashRedis()
+    ChannelIndex(key="test:channels").rebuild(r)
+    ch = {"id": "ch3", "org_id": "o3", "credentials": {"phone_number_id": "pnid-3"}, "phone_number": "+333"}
+    index_channel(r, ch, key="test:channels")
+    assert ChannelIndex(key="test:channels").resolve(r, pnid="pnid-3") == ("o3", "ch3")
+
+    moved = {**ch, "credentials": {"phone_number_id": "pnid-4"}}
+    index_channel(r, moved, previous=route_fields(ch), key="test:channels")
+    assert "pnid:pnid-3" not in r.hashes["test:channels"]
+    assert ChannelIndex(key="test:channels").resolve(r, pnid="pnid-4") == ("o3", "ch3")
+
+    unindex_channel(r, moved, key="test:channels")
+    assert "pnid:pnid-4" not in r.hashes["test:channels"]
+    assert READY_FIELD not in r.hashes["test:channels"]
+
+
+def test_channel_indexed_during_rebuild_is_not_wiped(db, monkeypatch):
+    from packages.common import channel_index
+    from packages.common.db import SessionLocal
+
+    r = FakeHashRedis()
+    real_load = channel_index.load_routes
+    reads = []
+
+    def load_then_create():
+        routes = real_load()
+        reads.append(len(routes))
+        if len(reads) == 1:
+            # the api-gateway creates a channel after the snapshot was read, before it is installed
+            s = SessionLocal()
+            try:
+                s.add(ChannelModel(id="ch3", org_id="o3", credentials={"phone_number_id": "pnid-3"}, phone_number="+333"))
+                s.commit()
+            finally:
+                s.close()
+            channel_index.index_channel(r, {"id": "ch3", "org_id": "o3", "credentials": {"phone_number_id": "pnid-3"}, "phone_number": "+333"}, key="test:channels")
+        return routes
+
+    monkeypatch.setattr(channel_index, "load_routes", load_then_create)
+    channel_index.ChannelIndex(key="test:channels").rebuild(r)
+    # the stale snapshot was discarded and the DB read again
+    assert reads == [4, 6]
+    assert channel_index.READY_FIELD in r.hashes["test:channels"]
+    assert channel_index.ChannelIndex(key="test:channels").resolve(r, pnid="pnid-3") == ("o3", "ch3")
+
+    # a generation that keeps moving: the hash is never marked ready
+    r2 = FakeHashRedis()
+    monkeypatch.setattr(channel_index, "load_routes", lambda: (r2.incr(channel_index.generation_key("test:channels")), real_load())[1])
+    channel_index.ChannelIndex(key="test:channels").rebuild(r2, attempts=2)
+    assert channel_index.READY_FIELD not in r2.hashes.get("test:channels", {})
@@ -0,0 +1,169 @@
+import hmac
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+
+
+class KVRedis:
+    def __init__(self):
+        self.kv = {}
+        self.sets = {}
+        self.calls = []
+
+    def pipeline(self, transaction=True):
+        parent = self
+
+        class _Pipe:
+            def __init__(self):
+                self.ops = []
+
+            def __getattr__(self, name):
+                def _op(*args, **kwargs):
+                    self.ops.append((name, args, kwargs))
+                    return self
+                return _op
+
+            def execute(self):
+                return [getattr(parent, n)(*a, **k) for n, a, k in self.ops]
+
+        return _Pipe()
+
+    def xadd(self, stream, mapping):
+        self.calls.append((stream, dict(mapping)))
+
+    def mget(self, keys):
+        return [self.kv.get(k) for k in keys]
+
+    def set(self, key, value, ex=None):
+        self.kv[key] = value
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def expire(self, key, ttl):
+        return True
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+    def delete(self, *keys):
+        for k in keys:
+            self.kv.pop(k, None)
+            self.sets.pop(k, None)
+
+
+def sign(secret: str, body: bytes) -> str:
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def env(tmp_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'test.db').as_posix()}"
+    os.environ["WHATSAPP_APP_SECRET"] = "dev_secret"
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+
+    service_root = Path(__file__).resolve().parents[1]
+    spec = importlib.util.spec_from_file_location("webhook_main_conv_cache", service_root / "app" / "main.py")
+    main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(main)
+
+    from packages.common.db import engine, SessionLocal
+    from packages.common.models import Base, Channel
+    tables = ("channels", "contacts", "conversations", "messages", "message_provider_ids")
+    Base.metadata.create_all(bind=engine, tables=[Base.metadata.tables[t] for t in tables])
+    s = SessionLocal()
+    try:
+        s.add(Channel(id="ch1", org_id="o1", credentials={"phone_number_id": "pnid-1"}, phone_number="+111"))
+        s.commit()
+    finally:
+        s.close()
+
+    queries = []
+    event.listen(common_db.get_engine(), "before_cursor_execute", lambda *a, **k: queries.append(a[2]))
+    r = KVRedis()
+    main.redis = r
+    with TestClient(main.app) as c:
+        yield main, c, r, queries
+
+
+def _post(c, wa_id):
+    payload = {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "pnid-1"}, "messages": [{"from": "5211", "id": wa_id, "text": {"body": "hola"}}]}}]}]}
+    body = json.dumps(payload).encode()
+    return c.post("/api/webhooks/whatsapp", content=body, headers={"X-Hub-Signature-256": sign("dev_secret", body)})
+
+
+def _touches_resolution(q):
+    q = q.upper()
+    return "FROM CONTACTS" in q or "FROM CONVERSATIONS" in q or "INTO CONTACTS" in q or "INTO CONVERSATIONS" in q
+
+
+def test_second_message_skips_contact_and_conversation_queries(env):
+    main, c, r, queries = env
+    assert _post(c, "wamid.1").status_code == 200
+    assert any(_touches_resolution(q) for q in queries)
+
+    del queries[:]
+    assert _post(c, "wamid.2").status_code == 200
+    assert not any(_touches_resolution(q) for q in queries)
+    assert len([q for q in queries if q.lstrip().upper().startswith("INSERT INTO MESSAGES")]) == 1
+
+    from packages.common.db import SessionLocal
+    s = SessionLocal()
+    try:
+        assert s.execute(text("SELECT COUNT(DISTINCT conversation_id) FROM messages")).scalar() == 1
+        conv_id = s.execute(text("SELECT id FROM conversations")).scalar()
+    finally:
+        s.close()
+
+    # closing the conversation invalidates the route; the next message opens a new one
+    from packages.common import conversation_cache
+    s = SessionLocal()
+    try:
+        s.execute(text("UPDATE conversations SET state='closed'"))
+        s.commit()
+    finally:
+        s.close()
+    conversation_cache.invalidate_conversation(r, conv_id)
+    assert not [k for k in r.kv if k.startswith(f"{conversation_cache.PREFIX}:k:")]
+    assert conversation_cache.tombstone_key(conv_id) in r.kv
+    del queries[:]
+    assert _post(c, "wamid.3").status_code == 200
+    assert any(_touches_resolution(q) for q in queries)
+    s = SessionLocal()
+    try:
+        assert s.execute(text("SELECT COUNT(*) FROM conversations WHERE state='open'")).scalar() == 1
+    finally:
+        s.close()
+
+
+def test_conversation_closed_during_resolution_is_not_cached_again(env):
+    main, c, r, queries = env
+    from packages.common import conversation_cache
+
+    real_open = main._open_conversation_id
+
+    def open_then_close(db, *key):
+        # the api-gateway closes the conversation (and invalidates it) between the DB lookup and the cache fill
+        resolved = real_open(db, *key)
+        conversation_cache.invalidate_conversation(r, resolved[1])
+        return resolved
+
+    main._open_conversation_id = open_then_close
+    try:
+        assert _post(c, "wamid.race").status_code == 200
+    finally:
+        main._open_conversation_id = real_open
+    assert not [k for k in r.kv if k.startswith(f"{conversation_cache.PREFIX}:k:")]
+
+    # the next message resolves from the DB again
+    del queries[:]
+    assert _post(c, "wamid.after").status_code == 200
+    assert any(_touches_resolution(q) for q in queries)
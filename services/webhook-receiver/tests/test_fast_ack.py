@@ -0,0 +1,199 @@
+import hmac
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+
+class StreamRedis:
+    """Minimal consumer-group stream store (single group)."""
+
+    def __init__(self):
+        self.streams = {}
+        self.delivered = {}
+        self.pending = {}
+        self.published = []
+        self.fail_publish = 0
+
+    def xadd(self, stream, mapping):
+        entries = self.streams.setdefault(stream, [])
+        msg_id = f"{len(entries) + 1}-0"
+        entries.append((msg_id, dict(mapping)))
+        return msg_id
+
+    def pipeline(self, transaction=True):
+        parent = self
+
+        class _Pipe:
+            def __init__(self):
+                self.ops = []
+
+            def xadd(self, stream, mapping):
+                self.ops.append((stream, dict(mapping)))
+
+            def execute(self):
+                if parent.fail_publish:
+                    parent.fail_publish -= 1
+                    raise RuntimeError("redis down")
+                for stream, mapping in self.ops:
+                    parent.published.append((stream, mapping))
+                    parent.xadd(stream, mapping)
+                return []
+
+        return _Pipe()
+
+    def xgroup_create(self, stream, group, id="$", mkstream=False):
+        self.streams.setdefault(stream, [])
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        out = []
+        for stream, start in streams.items():
+            entries = self.streams.get(stream, [])
+            pending = self.pending.setdefault((stream, consumer), [])
+            if start == ">":
+                pos = self.delivered.get(stream, 0)
+                batch = entries[pos:pos + (count or len(entries))]
+                self.delivered[stream] = pos + len(batch)
+                pending.extend(mid for mid, _ in batch)
+            else:
+                batch = [(mid, f) for mid, f in entries if mid in pending][: count or None]
+            if batch:
+                out.append((stream, batch))
+        return out
+
+    def xack(self, stream, group, *ids):
+        for key, pending in self.pending.items():
+            if key[0] == stream:
+                pending[:] = [mid for mid in pending if mid not in ids]
+        return len(ids)
+
+
+def sign(secret: str, body: bytes) -> str:
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def env(tmp_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'test.db').as_posix()}"
+    os.environ["WHATSAPP_APP_SECRET"] = "dev_secret"
+    os.environ["WEBHOOK_FAST_ACK"] = "true"
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+
+    service_root = Path(__file__).resolve().parents[1]
+    spec = importlib.util.spec_from_file_location("webhook_main_fast_ack", service_root / "app" / "main.py")
+    main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(main)
+    os.environ.pop("WEBHOOK_FAST_ACK", None)
+
+    from packages.common.db import engine, SessionLocal
+    from packages.common.models import Base, Channel
+    from packages.common.models import Conversation, Message, MessageProviderId
+    tables = ("channels", "contacts", "conversations", "messages", "message_provider_ids")
+    Base.metadata.create_all(bind=engine, tables=[Base.metadata.tables[t] for t in tables])
+    s = SessionLocal()
+    try:
+        s.add(Channel(id="ch1", org_id="o1", credentials={"phone_number_id": "pnid-1"}, phone_number="+111"))
+        # an outbound message awaiting receipts
+        s.add(Conversation(id="cv-out", org_id="o1", contact_id=None, channel_id="ch1", state="open"))
+        s.add(Message(id="m-out", conversation_id="cv-out", direction="out", type="text", meta={"wa_msg_id": "wamid.out"}))
+        s.add(MessageProviderId(wa_msg_id="wamid.out", message_id="m-out", conversation_id="cv-out", org_id="o1"))
+        s.commit()
+    finally:
+        s.close()
+
+    r = StreamRedis()
+    main.redis = r
+    with TestClient(main.app) as c:
+        yield main, c, r
+
+
+def _post(c, payload):
+    body = json.dumps(payload).encode()
+    return c.post("/api/webhooks/whatsapp", content=body, headers={"X-Hub-Signature-256": sign("dev_secret", body)})
+
+
+def _msg_payload(wa_id):
+    return {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "pnid-1"}, "messages": [{"from": "5211", "id": wa_id, "text": {"body": "hola"}}]}}]}]}
+
+
+def _count_messages():
+    from packages.common.db import SessionLocal
+    s = SessionLocal()
+    try:
+        return s.execute(text("SELECT COUNT(*) FROM messages WHERE direction='in'")).scalar()
+    finally:
+        s.close()
+
+
+def test_fast_ack_only_queues_raw_body(env):
+    main, c, r = env
+    r1 = _post(c, _msg_payload("wamid.1"))
+    r2 = _post(c, _msg_payload("wamid.2"))
+    assert r1.status_code == 200 and r1.json().get("queued") is True
+    assert len(r.streams[main.RAW_STREAM]) == 2
+    assert r.published == []
+    assert _count_messages() == 0
+
+    main._ensure_ingest_group()
+    n, ok = main.ingest_once("c-0")
+    assert (n, ok) == (2, True)
+    assert _count_messages() == 2
+    assert len([s for s, _ in r.published if s == "nf:incoming"]) == 2
+    assert r.pending[(main.RAW_STREAM, "c-0")] == []
+
+
+def test_failed_batch_stays_pending_and_is_retried(env):
+    main, c, r = env
+    _post(c, _msg_payload("wamid.1"))
+    _post(c, {"not": "a whatsapp payload"})
+    main._ensure_ingest_group()
+
+    r.fail_publish = 1
+    n, ok = main.ingest_once("c-0")
+    assert (n, ok) == (2, False)
+    assert len(r.pending[(main.RAW_STREAM, "c-0")]) == 2
+
+    # backlog re-read picks up the same entries
+    n, ok = main.ingest_once("c-0", backlog=True, failures=1)
+    assert (n, ok) == (2, True)
+    assert r.pending[(main.RAW_STREAM, "c-0")] == []
+    assert len([s for s, _ in r.published if s == "nf:incoming"]) == 2
+
+
+def _webhook_events(r, event_type):
+    return [json.loads(m["body"]) for s, m in r.published if s == "nf:webhooks" and m.get("type") == event_type]
+
+
+def test_publish_failure_after_commit_is_republished_on_retry(env):
+    main, c, r = env
+    _post(c, _msg_payload("wamid.1"))
+    status = {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "pnid-1"}, "statuses": [{"id": "wamid.out", "status": "read"}]}}]}]}
+    _post(c, status)
+    main._ensure_ingest_group()
+
+    # rows and the receipt are committed, then the publish fails
+    r.fail_publish = 1
+    assert main.ingest_once("c-0") == (2, False)
+    assert _count_messages() == 1 and r.published == []
+
+    # the retry re-emits what was stored but never published instead of dropping it as a duplicate
+    assert main.ingest_once("c-0", backlog=True, failures=1) == (2, True)
+    assert _count_messages() == 1
+    assert len([s for s, _ in r.published if s == "nf:incoming"]) == 1
+    received = _webhook_events(r, "message.received")
+    assert len(received) == 1 and received[0]["message_id"]
+    assert [(e["message_id"], e["status"]) for e in _webhook_events(r, "message.status")] == [("m-out", "read")]
+
+    # once confirmed, a Meta redelivery is a real duplicate
+    r.published.clear()
+    _post(c, _msg_payload("wamid.1"))
+    _post(c, status)
+    assert main.ingest_once("c-0") == (2, True)
+    assert r.published == []
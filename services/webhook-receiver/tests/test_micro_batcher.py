@@ -0,0 +1,64 @@
+import asyncio
+
+from packages.common.batching import MicroBatcher
+
+
+def test_concurrent_submits_share_one_flush():
+    flushes = []
+
+    async def flush(items):
+        flushes.append(list(items))
+        return [i * 10 for i in items]
+
+    async def run():
+        b = MicroBatcher(flush, window_ms=5, max_items=100)
+        return await asyncio.gather(b.submit([1, 2]), b.submit([3]), b.submit([4, 5]))
+
+    results = asyncio.run(run())
+    assert flushes == [[1, 2, 3, 4, 5]]
+    assert results == [[10, 20], [30], [40, 50]]
+
+
+def test_max_items_flushes_early_and_errors_reach_every_caller():
+    calls = []
+
+    async def flush(items):
+        calls.append(len(items))
+        raise RuntimeError("db down")
+
+    async def run():
+        b = MicroBatcher(flush, window_ms=10_000, max_items=3)
+        return await asyncio.gather(b.submit([1, 2]), b.submit([3]), return_exceptions=True)
+
+    results = asyncio.run(asyncio.wait_for(run(), timeout=2))
+    assert calls == [3]
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_close_flushes_queued_items_and_waits_for_in_flight_flushes():
+    flushed = []
+    release = None
+
+    async def flush(items):
+        await release.wait()
+        flushed.append(list(items))
+        return items
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        b = MicroBatcher(flush, window_ms=10_000, max_items=2)
+        first = asyncio.ensure_future(b.submit([1, 2]))  # full batch: flush task starts
+        queued = asyncio.ensure_future(b.submit([3]))  # still waiting for the window
+        await asyncio.sleep(0)
+        assert len(b._tasks) == 1
+        closing = asyncio.ensure_future(b.close())
+        await asyncio.sleep(0)
+        assert not closing.done()
+        release.set()
+        await closing
+        assert not b._tasks
+        return await first, await queued
+
+    assert asyncio.run(asyncio.wait_for(run(), timeout=2)) == ([1, 2], [3])
+    assert sorted(flushed) == [[1, 2], [3]]
@@ -0,0 +1,83 @@
+import hmac
+import hashlib
+import importlib
+import importlib.util
+import json
+import logging
+import os
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+class SampleRedis:
+    def __init__(self):
+        self.calls = []
+
+    def xadd(self, stream, mapping, **kwargs):
+        self.calls.append((stream, dict(mapping), kwargs))
+        return f"{len(self.calls)}-0"
+
+    def xrevrange(self, stream, max="+", min="-", count=None):
+        rows = [(f"{i + 1}-0", m) for i, (s, m, _) in enumerate(self.calls) if s == stream]
+        return list(reversed(rows))[:count]
+
+
+def sign(secret: str, body: bytes) -> str:
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def _load(tmp_path, **env):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'test.db').as_posix()}"
+    os.environ["WHATSAPP_APP_SECRET"] = "dev_secret"
+    os.environ.update(env)
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+    service_root = Path(__file__).resolve().parents[1]
+    spec = importlib.util.spec_from_file_location("webhook_main_capture", service_root / "app" / "main.py")
+    main = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(main)
+    finally:
+        for k in env:
+            os.environ.pop(k, None)
+    main.redis = SampleRedis()
+    return main
+
+
+def _post(c, payload):
+    body = json.dumps(payload).encode()
+    return c.post("/api/webhooks/whatsapp", content=body, headers={"X-Hub-Signature-256": sign("dev_secret", body)})
+
+
+def test_bodies_are_not_logged_by_default(tmp_path, caplog):
+    main = _load(tmp_path)
+    with caplog.at_level(logging.DEBUG), TestClient(main.app) as c:
+        assert _post(c, {"entry": [{"changes": [{"value": {"messages": [{"from": "5215512345678", "text": {"body": "secreto"}}]}}]}]}).status_code == 200
+    assert "secreto" not in caplog.text
+    assert not [s for s, _, _ in main.redis.calls if s == "nf:webhooks:samples"]
+
+
+def test_sampled_capture_is_truncated_redacted_and_capped(tmp_path):
+    main = _load(
+        tmp_path,
+        WEBHOOK_CAPTURE_RATE="1",
+        WEBHOOK_CAPTURE_REDIS="true",
+        WEBHOOK_CAPTURE_MAX_BYTES="120",
+        WEBHOOK_CAPTURE_MAXLEN="50",
+        WEBHOOK_CAPTURE_INSPECT_TOKEN="t0k",
+    )
+    with TestClient(main.app) as c:
+        assert _post(c, {"entry": [{"changes": [{"value": {"messages": [{"from": "5215512345678", "text": {"body": "x" * 200}}]}}]}]}).status_code == 200
+        samples = [(m, kw) for s, m, kw in main.redis.calls if s == "nf:webhooks:samples"]
+        assert len(samples) == 1
+        sample, kwargs = samples[0]
+        assert kwargs == {"maxlen": 50, "approximate": True}
+        assert sample["truncated"] == "1" and len(sample["body"]) <= 120
+        assert "5215512345678" not in sample["body"] and "*********5678" in sample["body"]
+
+        assert c.get("/internal/webhooks/samples").status_code == 404
+        r = c.get("/internal/webhooks/samples", headers={"X-Internal-Token": "t0k"})
+        assert r.status_code == 200
+        assert r.json()["samples"][0]["sha256"] == sample["sha256"]
@@ -6,7 +6,7 @@ from pathlib import Path
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import Column, String
+from sqlalchemy import Column, String, text
 from sqlalchemy.dialects.sqlite import JSON
 from sqlalchemy.orm import declarative_base
 
@@ -129,18 +129,18 @@ def test_persists_inbound_contact_conv_msg(client):
     s = SessionLocal()
     try:
         # count rows
-        contact = s.execute("SELECT id, org_id, wa_id, phone FROM contacts").fetchone()
+        contact = s.execute(text("SELECT id, org_id, wa_id, phone FROM contacts")).fetchone()
         assert contact is not None
         assert contact._mapping["org_id"] == "o1"
         assert contact._mapping["wa_id"] == "521777888999"
 
-        conv = s.execute("SELECT id, org_id, contact_id, channel_id, state FROM conversations").fetchone()
+        conv = s.execute(text("SELECT id, org_id, contact_id, channel_id, state FROM conversations")).fetchone()
         assert conv is not None
         assert conv._mapping["org_id"] == "o1"
         assert conv._mapping["channel_id"] == "ch1"
         assert conv._mapping["state"] == "open"
 
-        msg = s.execute("SELECT id, conversation_id, direction, type, content FROM messages").fetchone()
+        msg = s.execute(text("SELECT id, conversation_id, direction, type, content FROM messages")).fetchone()
         assert msg is not None
         assert msg._mapping["direction"] == "in"
         assert msg._mapping["type"] == "text"
@@ -0,0 +1,129 @@
+import hmac
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+
+
+class DummyRedis:
+    def __init__(self):
+        self.calls = []
+
+    def xadd(self, stream, mapping):
+        self.calls.append((stream, dict(mapping)))
+
+
+def sign(secret: str, body: bytes) -> str:
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def env(tmp_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'test.db').as_posix()}"
+    os.environ["WHATSAPP_APP_SECRET"] = "dev_secret"
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+
+    service_root = Path(__file__).resolve().parents[1]
+    spec = importlib.util.spec_from_file_location("webhook_main_provider_ids", service_root / "app" / "main.py")
+    main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(main)
+
+    from packages.common.db import engine, SessionLocal
+    from packages.common.models import Base, Channel, Conversation, Message, MessageProviderId
+    tables = ("channels", "contacts", "conversations", "messages", "message_provider_ids")
+    Base.metadata.create_all(bind=engine, tables=[Base.metadata.tables[t] for t in tables])
+    s = SessionLocal()
+    try:
+        s.add(Channel(id="ch1", org_id="o1", credentials={"phone_number_id": "pnid-1"}, phone_number="+111"))
+        s.add(Conversation(id="cv1", org_id="o1", contact_id=None, channel_id="ch1", state="open"))
+        for i in (1, 2):
+            s.add(Message(id=f"m{i}", conversation_id="cv1", direction="out", type="text", meta={"wa_msg_id": f"wamid.{i}"}))
+            s.add(MessageProviderId(wa_msg_id=f"wamid.{i}", message_id=f"m{i}", conversation_id="cv1", org_id="o1"))
+        s.commit()
+    finally:
+        s.close()
+
+    queries = []
+    event.listen(common_db.get_engine(), "before_cursor_execute", lambda *a, **k: queries.append(a[2]))
+    dummy = DummyRedis()
+    main.redis = dummy
+    with TestClient(main.app) as c:
+        yield c, dummy, queries
+
+
+def _post(c, payload):
+    body = json.dumps(payload).encode()
+    return c.post("/api/webhooks/whatsapp", content=body, headers={"X-Hub-Signature-256": sign("dev_secret", body)})
+
+
+def test_status_batch_uses_side_table_and_single_update(env):
+    c, dummy, queries = env
+    statuses = [
+        {"id": "wamid.1", "status": "delivered"},
+        {"id": "wamid.2", "status": "read"},
+        {"id": "wamid.unknown", "status": "read"},
+    ]
+    assert _post(c, {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "pnid-1"}, "statuses": statuses}}]}]}).status_code == 200
+
+    from packages.common.db import SessionLocal
+    s = SessionLocal()
+    try:
+        rows = dict(s.execute(text("SELECT id, status FROM messages ORDER BY id")).fetchall())
+    finally:
+        s.close()
+    assert rows == {"m1": "delivered", "m2": "read"}
+
+    updates = [q for q in queries if q.lstrip().upper().startswith("UPDATE MESSAGES")]
+    assert len(updates) == 1  # executemany, one statement
+    assert not any("LIMIT" in q.upper() and "FROM MESSAGES" in q.upper() for q in queries)
+    evs = [json.loads(m["body"]) for s_, m in dummy.calls if m.get("type") == "message.status"]
+    assert sorted(e["message_id"] for e in evs) == ["m1", "m2"]
+
+
+def test_redelivered_inbound_message_is_persisted_once(env):
+    c, dummy, _ = env
+    payload = {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "pnid-1"}, "messages": [{"from": "5211", "id": "wamid.in", "text": {"body": "hola"}}]}}]}]}
+    assert _post(c, payload).status_code == 200
+    assert _post(c, payload).status_code == 200
+
+    from packages.common.db import SessionLocal
+    s = SessionLocal()
+    try:
+        assert s.execute(text("SELECT COUNT(*) FROM messages WHERE direction='in'")).scalar() == 1
+        assert s.execute(text("SELECT message_id FROM message_provider_ids WHERE wa_msg_id='wamid.in'")).scalar()
+    finally:
+        s.close()
+    # the duplicate is not fanned out to flows again
+    assert len([1 for stream, _ in dummy.calls if stream == "nf:incoming"]) == 1
+
+
+def test_receipts_collapse_to_highest_status_and_never_downgrade(env):
+    c, dummy, queries = env
+    statuses = [
+        {"id": "wamid.1", "status": "sent"},
+        {"id": "wamid.1", "status": "read"},
+        {"id": "wamid.1", "status": "delivered"},
+    ]
+    assert _post(c, {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "pnid-1"}, "statuses": statuses}}]}]}).status_code == 200
+    evs = [json.loads(m["body"]) for _, m in dummy.calls if m.get("type") == "message.status"]
+    assert [(e["message_id"], e["status"]) for e in evs] == [("m1", "read")]
+
+    # a late "delivered" receipt does not move m1 back
+    del queries[:]
+    dummy.calls.clear()
+    assert _post(c, {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "pnid-1"}, "statuses": [{"id": "wamid.1", "status": "delivered"}]}}]}]}).status_code == 200
+    from packages.common.db import SessionLocal
+    s = SessionLocal()
+    try:
+        assert s.execute(text("SELECT status FROM messages WHERE id='m1'")).scalar() == "read"
+    finally:
+        s.close()
+    assert not [q for q in queries if q.lstrip().upper().startswith("UPDATE MESSAGES")]
+    assert not [m for _, m in dummy.calls if m.get("type") == "message.status"]
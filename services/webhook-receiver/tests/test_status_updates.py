@@ -7,7 +7,7 @@ from pathlib import Path
 import json
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import Column, String
+from sqlalchemy import Column, String, text
 from sqlalchemy.dialects.sqlite import JSON
 from sqlalchemy.orm import declarative_base
 
@@ -77,7 +77,7 @@ def client(tmp_path):
     s = SessionLocal()
     try:
         s.execute(
-            "INSERT INTO channels(id, org_id, credentials, phone_number) VALUES (:id,:org,:cred,:ph)",
+            text("INSERT INTO channels(id, org_id, credentials, phone_number) VALUES (:id,:org,:cred,:ph)"),
             {
                 "id": "ch1",
                 "org": "o1",
@@ -86,8 +86,10 @@ def client(tmp_path):
             },
         )
         s.execute(
-            "INSERT INTO messages(id, conversation_id, direction, type, content, template_id, status, meta, client_id)"
-            " VALUES (:id,:conv,:dir,:typ,:content,:tpl,:status,:meta,:client)",
+            text(
+                "INSERT INTO messages(id, conversation_id, direction, type, content, template_id, status, meta, client_id)"
+                " VALUES (:id,:conv,:dir,:typ,:content,:tpl,:status,:meta,:client)"
+            ),
             {
                 "id": "m1",
                 "conv": "conv1",
@@ -142,7 +144,7 @@ def test_updates_status_and_emits_webhook(client):
 
     s = SessionLocal()
     try:
-        row = s.execute("SELECT status FROM messages WHERE id='m1'").fetchone()
+        row = s.execute(text("SELECT status FROM messages WHERE id='m1'")).fetchone()
         assert row is not None
         assert row._mapping["status"] == "delivered"
     finally:
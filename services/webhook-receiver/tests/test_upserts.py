@@ -0,0 +1,113 @@
+import importlib
+import os
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+
+@pytest.fixture
+def db(tmp_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'test.db').as_posix()}"
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+    from packages.common.models import Base
+    Base.metadata.create_all(bind=common_db.engine, tables=[Base.metadata.tables[t] for t in ("contacts", "conversations")])
+    yield common_db.SessionLocal
+
+
+def test_upserts_converge_on_one_contact_and_one_open_conversation(db):
+    from packages.common.models import Contact, Conversation
+    from packages.common.upserts import upsert_contact, upsert_open_conversation
+
+    ids = []
+    for _ in range(2):
+        # separate sessions, like two receiver replicas
+        s = db()
+        try:
+            ct = upsert_contact(s, Contact, "o1", "5211")
+            ids.append((ct, upsert_open_conversation(s, Conversation, "o1", ct, "ch1")))
+            s.commit()
+        finally:
+            s.close()
+    assert ids[0] == ids[1]
+
+    s = db()
+    try:
+        assert s.execute(text("SELECT COUNT(*) FROM contacts")).scalar() == 1
+        # a closed conversation frees the slot for a new open one
+        s.execute(text("UPDATE conversations SET state='closed'"))
+        s.commit()
+        new_conv = upsert_open_conversation(s, Conversation, "o1", ids[0][0], "ch1")
+        s.commit()
+        assert new_conv != ids[0][1]
+        assert s.execute(text("SELECT COUNT(*) FROM conversations WHERE state='open'")).scalar() == 1
+    finally:
+        s.close()
+
+
+def test_unique_indexes_reject_duplicates(db):
+    from packages.common.models import Contact, Conversation
+
+    s = db()
+    try:
+        s.add(Contact(id="a", org_id="o1", wa_id="5211"))
+        s.add(Contact(id="b", org_id="o1", wa_id="5211"))
+        with pytest.raises(IntegrityError):
+            s.commit()
+        s.rollback()
+        s.add(Conversation(id="c1", org_id="o1", contact_id="a", channel_id="ch1", state="open"))
+        s.add(Conversation(id="c2", org_id="o1", contact_id="a", channel_id="ch1", state="open"))
+        with pytest.raises(IntegrityError):
+            s.commit()
+    finally:
+        s.close()
+
+
+def test_phone_only_contact_is_reused_and_gets_its_wa_id(db):
+    from packages.common.models import Contact
+    from packages.common.upserts import upsert_contact
+
+    s = db()
+    try:
+        # created through the contacts API: phone, no wa_id
+        s.add(Contact(id="api-1", org_id="o1", wa_id=None, phone="5211", name="Ana", attributes={}))
+        s.commit()
+        assert upsert_contact(s, Contact, "o1", "5211") == "api-1"
+        s.commit()
+        assert upsert_contact(s, Contact, "o1", "5211") == "api-1"
+        s.commit()
+        rows = s.execute(text("SELECT id, wa_id, name FROM contacts")).fetchall()
+        assert [tuple(r) for r in rows] == [("api-1", "5211", "Ana")]
+    finally:
+        s.close()
+
+
+def test_known_sender_resolves_with_one_statement(db):
+    from sqlalchemy import event
+
+    from packages.common.models import Contact
+    from packages.common.upserts import upsert_contact
+
+    s = db()
+    try:
+        s.add(Contact(id="api-1", org_id="o1", wa_id=None, phone="5299", name="Ana", attributes={}))
+        s.commit()
+        first = upsert_contact(s, Contact, "o1", "5211")
+        s.commit()
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(s.get_bind(), "before_cursor_execute", record)
+        try:
+            assert upsert_contact(s, Contact, "o1", "5211") == first
+        finally:
+            event.remove(s.get_bind(), "before_cursor_execute", record)
+        assert len(statements) == 1 and statements[0].lstrip().upper().startswith("INSERT")
+        s.commit()
+        # a sender without a phone-only match keeps the freshly inserted row
+        assert s.execute(text("SELECT COUNT(*) FROM contacts")).scalar() == 2
+    finally:
+        s.close()
@@ -0,0 +1,121 @@
+import hmac
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+
+class PipelineRedis:
+    def __init__(self):
+        self.calls = []
+        self.executes = 0
+
+    def pipeline(self, transaction=True):
+        parent = self
+
+        class _Pipe:
+            def __init__(self):
+                self.ops = []
+
+            def xadd(self, stream, mapping):
+                self.ops.append((stream, dict(mapping)))
+                return self
+
+            def execute(self):
+                parent.executes += 1
+                parent.calls.extend(self.ops)
+                return [None] * len(self.ops)
+
+        return _Pipe()
+
+    def xadd(self, stream, mapping):
+        self.calls.append((stream, dict(mapping)))
+
+
+def sign(secret: str, body: bytes) -> str:
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def client(tmp_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{(tmp_path / 'test.db').as_posix()}"
+    os.environ["WHATSAPP_APP_SECRET"] = "dev_secret"
+    import packages.common.db as common_db
+    importlib.reload(common_db)
+
+    service_root = Path(__file__).resolve().parents[1]
+    spec = importlib.util.spec_from_file_location("webhook_main", service_root / "app" / "main.py")
+    main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(main)
+
+    from packages.common.db import engine, SessionLocal
+    from packages.common.models import Base, Channel
+    Base.metadata.create_all(bind=engine, tables=[Base.metadata.tables[t] for t in ("channels", "contacts", "conversations", "messages")])
+    s = SessionLocal()
+    try:
+        s.add(Channel(id="ch1", org_id="o1", credentials={"phone_number_id": "pnid-1"}, phone_number="+111"))
+        s.add(Channel(id="ch2", org_id="o2", credentials={"phone_number_id": "pnid-2"}, phone_number="+222"))
+        s.commit()
+    finally:
+        s.close()
+
+    dummy = PipelineRedis()
+    main.redis = dummy
+    with TestClient(main.app) as c:
+        yield c, dummy
+
+
+def _change(pnid, messages):
+    return {"field": "messages", "value": {"metadata": {"phone_number_id": pnid}, "messages": messages}}
+
+
+def test_batch_payload_fans_out_every_message(client):
+    c, dummy = client
+    payload = {
+        "entry": [
+            {"id": "e1", "changes": [_change("pnid-1", [
+                {"from": "5211", "id": "wamid.a", "text": {"body": "hola"}},
+                {"from": "5211", "id": "wamid.b", "text": {"body": "precio"}},
+            ])]},
+            {"id": "e2", "changes": [_change("pnid-2", [
+                {"from": "5299", "id": "wamid.c", "text": {"body": "ayuda"}},
+            ])]},
+        ]
+    }
+    body = json.dumps(payload).encode()
+    r = c.post("/api/webhooks/whatsapp", content=body, headers={"X-Hub-Signature-256": sign("dev_secret", body)})
+    assert r.status_code == 200
+
+    # single pipelined round trip for everything published
+    assert dummy.executes == 1
+    incoming = [m for s, m in dummy.calls if s == "nf:incoming"]
+    assert len(incoming) == 3
+    assert [m["org_id"] for m in incoming] == ["o1", "o1", "o2"]
+    bodies = [json.loads(m["payload"])["entry"][0]["changes"][0]["value"]["messages"] for m in incoming]
+    assert [b[0]["id"] for b in bodies] == ["wamid.a", "wamid.b", "wamid.c"]
+    assert all(len(b) == 1 for b in bodies)
+    assert len([m for s, m in dummy.calls if s == "nf:webhooks" and m["type"] == "message.received"]) == 3
+
+    from packages.common.db import SessionLocal
+    s = SessionLocal()
+    try:
+        assert s.execute(text("SELECT COUNT(*) FROM messages")).scalar() == 3
+        assert s.execute(text("SELECT COUNT(*) FROM contacts")).scalar() == 2
+        assert s.execute(text("SELECT COUNT(*) FROM conversations")).scalar() == 2
+    finally:
+        s.close()
+
+
+def test_status_only_payload_is_not_routed_to_engine(client):
+    c, dummy = client
+    payload = {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "pnid-1"}, "statuses": [{"id": "wamid.x", "status": "read"}]}}]}]}
+    body = json.dumps(payload).encode()
+    r = c.post("/api/webhooks/whatsapp", content=body, headers={"X-Hub-Signature-256": sign("dev_secret", body)})
+    assert r.status_code == 200
+    assert not [s for s, _ in dummy.calls if s in ("nf:incoming", "nf:inbox")]